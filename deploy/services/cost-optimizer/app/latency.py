@@ -0,0 +1,343 @@
+"""Background latency probing of the upstream LLM providers.
+
+One long-lived pooled ``httpx.AsyncClient`` (HTTP/2 when ``h2`` is installed, keep-alive
+otherwise) probes every provider concurrently on an interval. Each provider keeps an EWMA and a
+window of recent samples for percentiles, so ``/providers/latency`` and its ``/details`` answer
+from memory instead of waiting on the slowest provider. With shared state, one replica at a
+time holds the probe lease and publishes its snapshot; the others serve that snapshot instead
+of probing too.
+"""
+
+import asyncio
+import importlib.util
+import math
+import time
+from collections import deque
+from typing import Deque, Dict, Iterable, Optional
+
+import httpx
+
+PROVIDER_URLS: Dict[str, str] = {
+    "openrouter": "https://openrouter.ai/api/v1/models",
+    "openai": "https://api.openai.com/v1/models",
+    "anthropic": "https://api.anthropic.com/v1/models",
+    "gemini": "https://generativelanguage.googleapis.com/v1beta/models",
+    "huggingface": "https://huggingface.co/api/models",
+}
+
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+
+def _percentile(ordered: list, q: float) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    rank = max(1, math.ceil(q / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+class LatencyStats:
+    """EWMA and recent-sample window for one provider. Failures are counted, not averaged in."""
+
+    def __init__(self, alpha: float = 0.2, window: int = 256) -> None:
+        self.alpha = alpha
+        self.ewma_ms: Optional[float] = None
+        self.samples: Deque[float] = deque(maxlen=window)
+        self.probes = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.last_ms: Optional[float] = None
+        self.last_status: Optional[int] = None
+        self.last_error: Optional[str] = None
+        self.last_probe_at: Optional[float] = None
+
+    def observe(self, latency_ms: float, status: int) -> None:
+        self.probes += 1
+        self.consecutive_failures = 0
+        self.last_ms = latency_ms
+        self.last_status = status
+        self.last_error = None
+        self.last_probe_at = time.time()
+        self.samples.append(latency_ms)
+        if self.ewma_ms is None:
+            self.ewma_ms = latency_ms
+        else:
+            self.ewma_ms += self.alpha * (latency_ms - self.ewma_ms)
+
+    def fail(self, error: str) -> None:
+        self.probes += 1
+        self.failures += 1
+        self.consecutive_failures += 1
+        self.last_error = error
+        self.last_probe_at = time.time()
+
+    @property
+    def healthy(self) -> bool:
+        return self.ewma_ms is not None and self.consecutive_failures == 0
+
+    def snapshot(self) -> Dict[str, Optional[float]]:
+        ordered = sorted(self.samples)
+        percentiles = {
+            f"p{q}_ms": round(_percentile(ordered, q), 2) if ordered else None for q in (50, 90, 95, 99)
+        }
+        return {
+            "ewma_ms": round(self.ewma_ms, 2) if self.ewma_ms is not None else None,
+            **percentiles,
+            "last_ms": round(self.last_ms, 2) if self.last_ms is not None else None,
+            "samples": len(ordered),
+            "probes": self.probes,
+            "failures": self.failures,
+            "healthy": self.healthy,
+            "last_status": self.last_status,
+            "last_error": self.last_error,
+            "last_probe_at": self.last_probe_at,
+        }
+
+
+class LatencyProber:
+    """Probes all providers concurrently every ``interval`` seconds on one pooled client."""
+
+    def __init__(
+        self,
+        urls: Dict[str, str],
+        interval: float = 30.0,
+        timeout: float = 5.0,
+        alpha: float = 0.2,
+        window: int = 256,
+        state=None,
+    ) -> None:
+        self.urls = dict(urls)
+        self.state = state
+        self.interval = interval
+        self.timeout = timeout
+        self.stats: Dict[str, LatencyStats] = {name: LatencyStats(alpha, window) for name in self.urls}
+        self.rounds = 0
+        self._client: Optional[httpx.AsyncClient] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def _make_client(self) -> httpx.AsyncClient:
+        # Idle connections must outlive the probe interval, or every round pays a fresh TLS handshake
+        limits = httpx.Limits(
+            max_connections=2 * len(self.urls) or 1,
+            max_keepalive_connections=len(self.urls) or 1,
+            keepalive_expiry=self.interval + self.timeout,
+        )
+        return httpx.AsyncClient(
+            http2=HTTP2_AVAILABLE, timeout=self.timeout, limits=limits, follow_redirects=True
+        )
+
+    async def start(self) -> None:
+        if self._task is not None:
+            return
+        self._client = self._make_client()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def _run(self) -> None:
+        while True:
+            started = time.perf_counter()
+            # The prober renews its lease every round; another replica takes over once it has
+            # missed one and a half rounds
+            if self.state is None or await self.state.acquire("probe-leader", self.interval * 1.5):
+                await self.probe_all()
+                if self.state is not None:
+                    await self.state.set("probes", {"rounds": self.rounds, "providers": self.snapshot()},
+                                         ttl=3 * self.interval)
+            await asyncio.sleep(max(0.0, self.interval - (time.perf_counter() - started)))
+
+    async def probe_all(self) -> None:
+        """One round: every provider at once, so a slow one costs at most ``timeout``."""
+        if self._client is None:
+            self._client = self._make_client()
+        await asyncio.gather(*(self._probe(name, url) for name, url in self.urls.items()))
+        self.rounds += 1
+
+    async def _probe(self, name: str, url: str) -> None:
+        started = time.perf_counter()
+        try:
+            response = await self._client.get(url)
+        except httpx.HTTPError as exc:
+            self.stats[name].fail(f"{type(exc).__name__}: {exc}" if str(exc) else type(exc).__name__)
+            return
+        # Any HTTP answer (401 without credentials included) measures the round trip
+        self.stats[name].observe((time.perf_counter() - started) * 1000, response.status_code)
+
+    def snapshot(self, names: Optional[Iterable[str]] = None) -> Dict[str, Dict[str, Optional[float]]]:
+        return select({name: stats.snapshot() for name, stats in self.stats.items()}, names)
+
+    async def shared_snapshot(self, names: Optional[Iterable[str]] = None):
+        """(rounds, per-provider snapshot) published by the probing replica, else this replica's own."""
+        shared = await self.state.get("probes") if self.state is not None else None
+        if shared is None:
+            return self.rounds, self.snapshot(names)
+        return shared["rounds"], select(shared["providers"], names)
+
+
+def select(snapshot: Dict[str, Dict], names: Optional[Iterable[str]] = None) -> Dict[str, Dict]:
+    wanted = set(snapshot) if names is None else {n.strip().lower() for n in names}
+    return {name: stats for name, stats in snapshot.items() if name in wanted}
+
+
+# Pytest tests
+class _StubProviders:
+    """Local HTTP server standing in for the provider APIs (/fast answers 401, /slow sleeps)."""
+
+    def __init__(self, slow_seconds: float = 0.3) -> None:
+        import threading
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        self.connections = 0
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                stub.connections += 1
+                super().setup()
+
+            def do_GET(self):  # noqa: N802 - http.server naming
+                if self.path == "/slow":
+                    time.sleep(slow_seconds)
+                body = b'{"data": []}'
+                self.send_response(401 if self.path == "/fast" else 200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.base = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    @staticmethod
+    def refused_url() -> str:
+        """A local port nothing listens on."""
+        import socket
+
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+        return f"http://127.0.0.1:{port}/"
+
+    def close(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def test_stats_ewma_and_percentiles():
+    stats = LatencyStats(alpha=0.5, window=4)
+    for value in (100, 200, 300, 400, 500):
+        stats.observe(value, 200)
+    snap = stats.snapshot()
+    assert snap["ewma_ms"] == 406.25
+    assert snap["samples"] == 4 and snap["p50_ms"] == 300 and snap["p99_ms"] == 500
+    stats.fail("ConnectTimeout")
+    assert stats.snapshot()["healthy"] is False and stats.failures == 1
+
+
+def test_prober_probes_concurrently_and_keeps_state():
+    stub = _StubProviders(slow_seconds=0.3)
+    urls = {"fast": f"{stub.base}/fast", "slow": f"{stub.base}/slow", "broken": stub.refused_url()}
+
+    async def scenario():
+        prober = LatencyProber(urls, interval=60, timeout=2)
+        try:
+            started = time.perf_counter()
+            await prober.probe_all()
+            await prober.probe_all()
+            elapsed = time.perf_counter() - started
+        finally:
+            await prober.stop()
+        return prober, elapsed
+
+    try:
+        prober, elapsed = asyncio.run(scenario())
+    finally:
+        stub.close()
+    # Two rounds of concurrent probes take about two slow responses, and reuse pooled connections
+    assert elapsed < 0.3 * 2 + 0.25
+    assert stub.connections == 2
+    snap = prober.snapshot()
+    assert snap["fast"]["samples"] == 2 and snap["fast"]["last_status"] == 401 and snap["fast"]["healthy"]
+    assert snap["slow"]["p50_ms"] >= 300 > snap["fast"]["p50_ms"]
+    assert snap["broken"]["failures"] == 2 and snap["broken"]["ewma_ms"] is None
+    assert snap["broken"]["last_error"].startswith("ConnectError")
+    assert set(prober.snapshot(["FAST", "slow "])) == {"fast", "slow"}
+
+
+def test_latency_endpoint_answers_from_background_state():
+    from app import main
+
+    stub = _StubProviders(slow_seconds=1.0)
+    urls = {"fast": f"{stub.base}/fast", "slow": f"{stub.base}/slow"}
+
+    async def scenario():
+        prober = LatencyProber(urls, interval=0.05, timeout=3)
+        original, main.prober = main.prober, prober
+        await prober.start()
+        try:
+            while prober.stats["fast"].probes == 0:
+                await asyncio.sleep(0.01)
+            transport = httpx.ASGITransport(app=main.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://optimizer") as client:
+                started = time.perf_counter()
+                response = await client.get("/providers/latency/details", params={"providers": "fast,slow"})
+                elapsed = time.perf_counter() - started
+                flat = await client.get("/providers/latency", params={"providers": "fast,slow"})
+        finally:
+            await prober.stop()
+            main.prober = original
+        return response, elapsed, flat
+
+    try:
+        response, elapsed, flat = asyncio.run(scenario())
+    finally:
+        stub.close()
+    body = response.json()
+    # The slow provider is still mid-probe; the endpoint does not wait for it
+    assert response.status_code == 200 and elapsed < 0.5
+    assert body["providers"]["fast"]["samples"] >= 1 and body["providers"]["slow"]["samples"] == 0
+    assert body["interval_seconds"] == 0.05
+    # The original flat {provider: ms} contract is unchanged
+    assert flat.json()["fast"] > 0 and flat.json()["slow"] is None
+
+
+def test_one_replica_probes_and_the_others_serve_its_snapshot():
+    from app.state import _replicas
+
+    stub = _StubProviders()
+    urls = {"fast": f"{stub.base}/fast"}
+
+    async def scenario():
+        _, states = await _replicas(3, cache_ttl=0.001)
+        probers = [LatencyProber(urls, interval=0.05, timeout=2, state=state) for state in states]
+        for prober in probers:
+            await prober.start()
+        await asyncio.sleep(0.3)
+        for prober in probers:
+            await prober.stop()
+        views = [await prober.shared_snapshot(["fast"]) for prober in probers]
+        for state in states:
+            await state.stop()
+        return probers, views
+
+    try:
+        probers, views = asyncio.run(scenario())
+    finally:
+        stub.close()
+    assert sorted(prober.rounds > 0 for prober in probers) == [False, False, True]
+    leader = next(prober for prober in probers if prober.rounds)
+    assert all(view == (leader.rounds, leader.snapshot(["fast"])) for view in views)
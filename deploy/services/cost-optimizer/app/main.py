@@ -1,12 +1,24 @@
+import asyncio
+import hashlib
+import logging
 import os
 import statistics
-from typing import Dict, List, Optional
+from contextlib import asynccontextmanager
+from typing import Any, Dict, List, Optional, Union
 
-import httpx
+import numpy as np
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import JSONResponse
 from pydantic import BaseModel, Field
 
-app = FastAPI(title="AI-SWARM Cost Optimizer", version="1.0.0")
+from .latency import HTTP2_AVAILABLE, PROVIDER_URLS, LatencyProber
+from .planner import InfeasiblePlan, SplitPlanner, describe
+from .ranking import ProviderTable, best_choice
+from .state import SharedState
+from .telemetry import TelemetryStore
+from .vault import SecretCache
+
+logger = logging.getLogger(__name__)
 
 
 class ProviderMetrics(BaseModel):
@@ -16,18 +28,72 @@ class ProviderMetrics(BaseModel):
     reliability_percent: Optional[float] = Field(default=None, ge=0, le=100)
 
 
+class RankingWeights(BaseModel):
+    """Weights of the min-max normalized objectives; unset ranks on cost with latency as tie-break."""
+
+    cost: float = Field(default=1.0, ge=0)
+    latency: float = Field(default=0.0, ge=0)
+    reliability: float = Field(default=0.0, ge=0)
+
+
 class OptimizationRequest(BaseModel):
     workload_tokens: int = Field(..., gt=0)
     providers: List[ProviderMetrics]
     max_latency_ms: Optional[float] = Field(default=None, gt=0)
     min_reliability_percent: Optional[float] = Field(default=None, ge=0, le=100)
+    weights: Optional[RankingWeights] = None
 
 
 class OptimizationResponse(BaseModel):
     best_provider: str
     estimated_cost: float
     rationale: str
-    ranked_providers: List[Dict[str, float]]
+    ranked_providers: List[Dict[str, Union[str, float]]]
+    pareto_front: List[str] = Field(default_factory=list)
+
+
+class BatchWorkload(BaseModel):
+    workload_tokens: int = Field(..., gt=0)
+    max_latency_ms: Optional[float] = Field(default=None, gt=0)
+    min_reliability_percent: Optional[float] = Field(default=None, ge=0, le=100)
+
+
+class BatchOptimizationRequest(BaseModel):
+    providers: List[ProviderMetrics]
+    workloads: List[BatchWorkload]
+    weights: Optional[RankingWeights] = None
+    include_ranking: bool = Field(default=True, description="Return each workload's full ranked list")
+
+
+class RequestOutcome(BaseModel):
+    provider: str
+    latency_ms: float = Field(..., ge=0)
+    tokens: int = Field(default=0, ge=0)
+    success: bool = True
+
+
+class TelemetryBatch(BaseModel):
+    outcomes: List[RequestOutcome]
+
+
+class ProviderCapacity(ProviderMetrics):
+    tokens_per_minute: float = Field(..., gt=0, description="Rate limit in tokens per minute")
+    max_tokens: Optional[int] = Field(default=None, ge=0, description="Remaining quota, e.g. of a daily cap")
+
+
+class PlanRequest(BaseModel):
+    workload_tokens: int = Field(..., gt=0)
+    providers: List[ProviderCapacity]
+    deadline_seconds: Optional[float] = Field(default=None, gt=0)
+    budget: Optional[float] = Field(default=None, gt=0, description="Maximum total cost in dollars")
+
+
+class PlanResponse(BaseModel):
+    objective: str
+    total_cost: float
+    completion_seconds: float
+    allocations: List[Dict[str, Union[str, float]]]
+    rationale: str
 
 
 class ConfigStatus(BaseModel):
@@ -38,37 +104,163 @@ class ConfigStatus(BaseModel):
     huggingface_configured: bool
 
 
-API_KEYS = {
-    "OPENROUTER_API_KEY": os.getenv("OPENROUTER_API_KEY"),
-    "GEMINI_API_KEY": os.getenv("GEMINI_API_KEY"),
-    "OPENAI_API_KEY": os.getenv("OPENAI_API_KEY"),
-    "ANTHROPIC_API_KEY": os.getenv("ANTHROPIC_API_KEY"),
-    "HUGGINGFACE_TOKEN": os.getenv("HUGGINGFACE_TOKEN") or os.getenv("HF_TOKEN"),
+# Provider key -> field of the Vault secret that scripts/key_rotation.py maintains
+API_KEY_FIELDS = {
+    "OPENROUTER_API_KEY": "openrouter",
+    "GEMINI_API_KEY": "gemini_primary",
+    "OPENAI_API_KEY": "openai",
+    "ANTHROPIC_API_KEY": "anthropic",
+    "HUGGINGFACE_TOKEN": "huggingface",
 }
 
+# Keys are read from Vault in the background and hot-swapped; the environment is the fallback
+secrets = SecretCache(
+    os.getenv("VAULT_ADDR"),
+    os.getenv("OPTIMIZER_VAULT_PATH", "secret/api-keys"),
+    token=os.getenv("VAULT_TOKEN"),
+    role_id=os.getenv("VAULT_ROLE_ID"),
+    secret_id=os.getenv("VAULT_SECRET_ID"),
+    refresh_interval=float(os.getenv("OPTIMIZER_VAULT_REFRESH_SECONDS", "60")),
+    fallback={
+        field: os.getenv(env) or (os.getenv("HF_TOKEN") if env == "HUGGINGFACE_TOKEN" else None)
+        for env, field in API_KEY_FIELDS.items()
+    },
+)
+
+
+def api_keys() -> Dict[str, Optional[str]]:
+    return {env: secrets.get(field) for env, field in API_KEY_FIELDS.items()}
+
+
 REDIS_URL = os.getenv("REDIS_URL")
+STATE_CACHE_TTL = float(os.getenv("OPTIMIZER_STATE_CACHE_TTL", "2"))
+DECISION_TTL = float(os.getenv("OPTIMIZER_DECISION_TTL", "5"))
 HTTP_TIMEOUT = float(os.getenv("OPTIMIZER_HTTP_TIMEOUT", "5"))
+PROBE_INTERVAL = float(os.getenv("OPTIMIZER_PROBE_INTERVAL", "30"))
+PROBE_EWMA_ALPHA = float(os.getenv("OPTIMIZER_PROBE_EWMA_ALPHA", "0.2"))
+PROBE_WINDOW = int(os.getenv("OPTIMIZER_PROBE_WINDOW", "256"))
+
+TELEMETRY_WINDOW_SECONDS = float(os.getenv("OPTIMIZER_TELEMETRY_WINDOW_SECONDS", "30"))
+TELEMETRY_SLOTS = int(os.getenv("OPTIMIZER_TELEMETRY_SLOTS", "10"))
+TELEMETRY_MIN_SAMPLES = int(os.getenv("OPTIMIZER_TELEMETRY_MIN_SAMPLES", "20"))
+TELEMETRY_LATENCY_QUANTILE = float(os.getenv("OPTIMIZER_TELEMETRY_LATENCY_QUANTILE", "0.95"))
+TELEMETRY_MAX_PROVIDERS = int(os.getenv("OPTIMIZER_TELEMETRY_MAX_PROVIDERS", "256"))
+TELEMETRY_SYNC_SECONDS = float(os.getenv("OPTIMIZER_TELEMETRY_SYNC_SECONDS", "2"))
+
+state = SharedState(REDIS_URL, cache_ttl=STATE_CACHE_TTL)
+prober = LatencyProber(PROVIDER_URLS, PROBE_INTERVAL, HTTP_TIMEOUT, PROBE_EWMA_ALPHA, PROBE_WINDOW, state=state)
+telemetry = TelemetryStore(
+    TELEMETRY_WINDOW_SECONDS, TELEMETRY_SLOTS, TELEMETRY_MIN_SAMPLES, TELEMETRY_LATENCY_QUANTILE, TELEMETRY_MAX_PROVIDERS
+)
+
+
+async def sync_telemetry() -> None:
+    while True:
+        try:
+            await telemetry.sync(state)
+        except Exception as exc:  # a bad entry from another replica must not stop the loop
+            logger.warning("Telemetry sync failed: %s", exc)
+        await asyncio.sleep(TELEMETRY_SYNC_SECONDS)
+
+
+@asynccontextmanager
+async def lifespan(_: FastAPI):
+    await state.start()
+    await secrets.start()
+    await prober.start()
+    # A lone replica has nobody to exchange telemetry with
+    sync = asyncio.create_task(sync_telemetry()) if state.backend == "redis" else None
+    try:
+        yield
+    finally:
+        if sync is not None:
+            sync.cancel()
+        await prober.stop()
+        await secrets.stop()
+        await state.stop()
+
+
+app = FastAPI(title="AI-SWARM Cost Optimizer", version="1.0.0", lifespan=lifespan)
 
 
 @app.get("/health")
-async def health_check() -> Dict[str, bool]:
-    configured = {key: value is not None and value != "" for key, value in API_KEYS.items()}
+async def health_check() -> Dict[str, Any]:
+    configured = {key: value is not None and value != "" for key, value in api_keys().items()}
     return {
         "status": "ok",
         "providers_configured": configured,
         "redis_enabled": bool(REDIS_URL),
+        "shared_state": state.summary(),
+        "secrets": secrets.summary(),
     }
 
 
 @app.get("/config", response_model=ConfigStatus)
 async def config_status() -> ConfigStatus:
+    keys = api_keys()
     return ConfigStatus(
-        openrouter_configured=bool(API_KEYS["OPENROUTER_API_KEY"]),
-        gemini_configured=bool(API_KEYS["GEMINI_API_KEY"]),
-        openai_configured=bool(API_KEYS["OPENAI_API_KEY"]),
-        anthropic_configured=bool(API_KEYS["ANTHROPIC_API_KEY"]),
-        huggingface_configured=bool(API_KEYS["HUGGINGFACE_TOKEN"]),
+        openrouter_configured=bool(keys["OPENROUTER_API_KEY"]),
+        gemini_configured=bool(keys["GEMINI_API_KEY"]),
+        openai_configured=bool(keys["OPENAI_API_KEY"]),
+        anthropic_configured=bool(keys["ANTHROPIC_API_KEY"]),
+        huggingface_configured=bool(keys["HUGGINGFACE_TOKEN"]),
+    )
+
+
+NO_FEASIBLE_PROVIDER = "No providers meet the supplied constraints"
+
+
+def _decisions(
+    providers: List[ProviderMetrics],
+    workloads: List[Any],
+    weights: Optional[RankingWeights],
+    include_ranking: bool = True,
+) -> List[Optional[Dict[str, Any]]]:
+    """
+    Decide every workload against one provider table; None where no provider qualifies. Latency and
+    reliability the caller left out come from live telemetry when there is enough of it.
+    """
+    providers = telemetry.fill(providers)
+    table = ProviderTable.from_metrics(providers)
+    feasible = table.feasible(
+        [w.max_latency_ms for w in workloads], [w.min_reliability_percent for w in workloads]
     )
+    order = table.order(weights.model_dump() if weights else None)
+    best, any_feasible = best_choice(feasible, order)
+    front = table.pareto(feasible)
+    tokens = np.array([w.workload_tokens for w in workloads], dtype=np.float64)
+    costs = (tokens / 1000) * table.cost[best]
+
+    summaries = [
+        {"provider": p.provider, "cost_per_1k_tokens": p.cost_per_1k_tokens, "latency_ms": p.latency_ms or 0}
+        for p in providers
+    ]
+    ranked_rows = feasible[:, order]
+    results: List[Optional[Dict[str, Any]]] = []
+    for row in range(len(workloads)):
+        if not any_feasible[row]:
+            results.append(None)
+            continue
+        choice = providers[best[row]]
+        estimated_cost = round(float(costs[row]), 4)
+        rationale_parts = [
+            f"Selected provider '{choice.provider}' with ${choice.cost_per_1k_tokens}/1K tokens",
+            f"Estimated workload cost: ${estimated_cost}",
+        ]
+        if choice.latency_ms:
+            rationale_parts.append(f"Latency: {choice.latency_ms}ms")
+        if choice.reliability_percent:
+            rationale_parts.append(f"Reliability: {choice.reliability_percent}%")
+        result = {
+            "best_provider": choice.provider,
+            "estimated_cost": estimated_cost,
+            "rationale": " | ".join(rationale_parts),
+            "pareto_front": [providers[i].provider for i in np.flatnonzero(front[row])],
+        }
+        if include_ranking:
+            result["ranked_providers"] = [summaries[i] for i in order[ranked_rows[row]]]
+        results.append(result)
+    return results
 
 
 @app.post("/optimize", response_model=OptimizationResponse)
@@ -76,86 +268,132 @@ async def optimize_workload(payload: OptimizationRequest) -> OptimizationRespons
     if not payload.providers:
         raise HTTPException(status_code=400, detail="At least one provider must be supplied")
 
-    # Apply filters based on latency and reliability constraints
-    filtered_providers: List[ProviderMetrics] = []
-    for option in payload.providers:
-        if payload.max_latency_ms and option.latency_ms and option.latency_ms > payload.max_latency_ms:
-            continue
-        if (
-            payload.min_reliability_percent
-            and option.reliability_percent
-            and option.reliability_percent < payload.min_reliability_percent
-        ):
-            continue
-        filtered_providers.append(option)
+    # Identical requests hitting any replica within DECISION_TTL reuse the first decision
+    key = "decision:" + hashlib.sha256(payload.model_dump_json().encode()).hexdigest()
+    result = await state.get(key) if DECISION_TTL > 0 else None
+    if result is None:
+        result = _decisions(payload.providers, [payload], payload.weights)[0]
+        if result is not None and DECISION_TTL > 0:
+            await state.set(key, result, ttl=DECISION_TTL)
+    if result is None:
+        raise HTTPException(status_code=422, detail=NO_FEASIBLE_PROVIDER)
+    return OptimizationResponse(**result)
+
+
+@app.post("/optimize/batch")
+async def optimize_batch(payload: BatchOptimizationRequest) -> JSONResponse:
+    """
+    Decide many workloads against one provider table in a single call. Each result matches what
+    /optimize returns for that workload; workloads no provider qualifies for get an error entry.
+    """
+    if not payload.providers:
+        raise HTTPException(status_code=400, detail="At least one provider must be supplied")
 
-    if not filtered_providers:
-        raise HTTPException(status_code=422, detail="No providers meet the supplied constraints")
+    results = _decisions(payload.providers, payload.workloads, payload.weights, payload.include_ranking)
+    # Built directly as JSON: re-validating 100k results through a response model costs more than deciding them
+    return JSONResponse({
+        "results": [
+            result if result is not None else {"error": NO_FEASIBLE_PROVIDER, "status_code": 422}
+            for result in results
+        ],
+        "feasible": sum(result is not None for result in results),
+    })
+
+
+@app.post("/optimize/plan", response_model=PlanResponse)
+async def plan_workload(payload: PlanRequest) -> PlanResponse:
+    """
+    Split one workload across providers within their rate limits: the cheapest split that meets the
+    deadline, or the fastest split within the budget (at any price when neither is given).
+    """
+    if not payload.providers:
+        raise HTTPException(status_code=400, detail="At least one provider must be supplied")
 
-    ranked = sorted(filtered_providers, key=lambda opt: (opt.cost_per_1k_tokens, opt.latency_ms or 0))
-    best = ranked[0]
-    estimated_cost = round((payload.workload_tokens / 1000) * best.cost_per_1k_tokens, 4)
+    providers = telemetry.fill(payload.providers)
+    planner = SplitPlanner(
+        [p.cost_per_1k_tokens for p in providers],
+        [p.tokens_per_minute for p in providers],
+        [p.latency_ms for p in providers],
+        [p.max_tokens for p in providers],
+    )
+    try:
+        plan = planner.plan(payload.workload_tokens, payload.deadline_seconds, payload.budget)
+    except InfeasiblePlan as exc:
+        raise HTTPException(status_code=422, detail=str(exc))
 
+    allocations = describe(plan, [p.provider for p in providers])
+    objective = "cost" if payload.deadline_seconds is not None else "time"
     rationale_parts = [
-        f"Selected provider '{best.provider}' with ${best.cost_per_1k_tokens}/1K tokens",
-        f"Estimated workload cost: ${estimated_cost}",
+        f"Split {payload.workload_tokens} tokens across {len(allocations)} provider(s)",
+        f"Estimated cost: ${round(plan.total_cost, 4)}",
+        f"Completion: {plan.completion_seconds:.2f}s",
     ]
-    if best.latency_ms:
-        rationale_parts.append(f"Latency: {best.latency_ms}ms")
-    if best.reliability_percent:
-        rationale_parts.append(f"Reliability: {best.reliability_percent}%")
-
-    ranked_summary = [
-        {
-            "provider": option.provider,
-            "cost_per_1k_tokens": option.cost_per_1k_tokens,
-            "latency_ms": option.latency_ms or 0,
-        }
-        for option in ranked
-    ]
-
-    return OptimizationResponse(
-        best_provider=best.provider,
-        estimated_cost=estimated_cost,
+    if payload.deadline_seconds is not None:
+        rationale_parts.append(f"Deadline: {payload.deadline_seconds:g}s")
+    if payload.budget is not None:
+        rationale_parts.append(f"Budget: ${payload.budget:g}")
+    return PlanResponse(
+        objective=objective,
+        total_cost=round(plan.total_cost, 4),
+        completion_seconds=round(plan.completion_seconds, 3),
+        allocations=allocations,
         rationale=" | ".join(rationale_parts),
-        ranked_providers=ranked_summary,
     )
 
 
-@app.get("/providers/latency")
-async def provider_latency_sample(providers: Optional[str] = None) -> Dict[str, float]:
-    """Run simple latency probes against configured providers when health endpoints exist."""
-
-    provider_urls = {
-        "openrouter": "https://openrouter.ai/api/v1/models",
-        "openai": "https://api.openai.com/v1/models",
-        "anthropic": "https://api.anthropic.com/v1/models",
-        "gemini": "https://generativelanguage.googleapis.com/v1beta/models",
-        "huggingface": "https://huggingface.co/api/models",
+@app.post("/telemetry")
+async def ingest_telemetry(payload: TelemetryBatch) -> Dict[str, int]:
+    """Record observed request outcomes; they feed the live metrics /optimize falls back on."""
+    accepted = sum(
+        telemetry.record(o.provider, o.latency_ms, o.tokens, o.success) for o in payload.outcomes
+    )
+    return {"accepted": accepted, "dropped": len(payload.outcomes) - accepted}
+
+
+@app.get("/telemetry")
+async def telemetry_summary() -> Dict[str, Any]:
+    return {
+        "window_seconds": telemetry.window_seconds,
+        "min_samples": telemetry.min_samples,
+        "latency_quantile": telemetry.latency_quantile,
+        "providers": telemetry.snapshot(),
     }
 
-    if providers:
-        requested = {name.strip().lower() for name in providers.split(",")}
-        provider_urls = {name: url for name, url in provider_urls.items() if name in requested}
 
-    latencies: Dict[str, float] = {}
-    async with httpx.AsyncClient(timeout=HTTP_TIMEOUT) as client:
-        for name, url in provider_urls.items():
-            try:
-                response = await client.get(url)
-                latencies[name] = response.elapsed.total_seconds() * 1000
-            except httpx.HTTPError:
-                latencies[name] = float("inf")
-    return latencies
+@app.get("/providers/latency")
+async def provider_latency_sample(providers: Optional[str] = None) -> Dict[str, Optional[float]]:
+    """
+    ``{provider: ms}`` from the background probes: the smoothed (EWMA) latency, or null while a
+    provider fails or has not been probed yet. Never probes inline; details are under /details.
+    """
+
+    names = providers.split(",") if providers else None
+    _, snapshot = await prober.shared_snapshot(names)
+    return {name: stats["ewma_ms"] if stats["healthy"] else None for name, stats in snapshot.items()}
+
+
+@app.get("/providers/latency/details")
+async def provider_latency_details(providers: Optional[str] = None) -> Dict[str, Any]:
+    """Latest background probe results (EWMA and percentiles) per provider; never probes inline."""
+
+    names = providers.split(",") if providers else None
+    rounds, snapshot = await prober.shared_snapshot(names)
+    return {
+        "interval_seconds": prober.interval,
+        "rounds": rounds,
+        "http2": HTTP2_AVAILABLE,
+        "providers": snapshot,
+    }
 
 
 @app.get("/providers/summary")
 async def provider_summary() -> Dict[str, Optional[float]]:
-    configured_counts = [1 if key else 0 for key in API_KEYS.values()]
+    keys = api_keys()
+    configured_counts = [1 if key else 0 for key in keys.values()]
     total_configured = sum(configured_counts)
     avg_configured = statistics.mean(configured_counts) if configured_counts else 0
     return {
-        "total_providers": len(API_KEYS),
+        "total_providers": len(keys),
         "configured": total_configured,
         "configuration_score": avg_configured,
     }
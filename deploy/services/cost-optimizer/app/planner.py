@@ -0,0 +1,257 @@
+"""Splitting one large workload across rate-limited providers.
+
+Provider i starts answering after its latency L_i and then serves at most R_i tokens per second
+(its tokens-per-minute limit / 60), up to an optional remaining quota. Given a finishing time T its
+capacity is min(quota_i, R_i * max(0, T - L_i)), and the cheapest way to place W tokens within T
+fills providers cheapest first up to that capacity. That greedy fill is optimal because cost is
+linear in tokens, so:
+
+* under a deadline, the plan is the greedy fill at the deadline;
+* under a budget, the plan is the greedy fill at the earliest T whose fill costs no more than the
+  budget. Fill cost only falls as T grows, so T is found by evaluating a grid of candidate times
+  as one [times, providers] array per pass and narrowing around the first one that works.
+
+Capacities are rounded down to whole tokens, so allocations are integers that meet the deadline
+and budget exactly.
+
+Fifty providers plan in under a millisecond; a deadline plan is a single array pass.
+"""
+
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+_GRID = 64
+_PASSES = 6  # the bracket shrinks by _GRID each pass: 64**6 ~ 7e10
+
+
+class InfeasiblePlan(ValueError):
+    """No allocation meets the deadline / budget; the message says what the providers can do."""
+
+
+class SplitPlan:
+    def __init__(self, tokens: np.ndarray, costs: np.ndarray, finish_seconds: np.ndarray) -> None:
+        self.tokens = tokens
+        self.costs = costs
+        self.finish_seconds = finish_seconds
+
+    @property
+    def total_cost(self) -> float:
+        return float(self.costs.sum())
+
+    @property
+    def completion_seconds(self) -> float:
+        used = self.tokens > 0
+        return float(self.finish_seconds[used].max()) if used.any() else 0.0
+
+
+class SplitPlanner:
+    """Costs per 1K tokens, tokens-per-minute limits, latencies (ms) and optional quotas of one provider list."""
+
+    def __init__(
+        self,
+        costs: Sequence[float],
+        tokens_per_minute: Sequence[float],
+        latencies_ms: Sequence[Optional[float]],
+        quotas: Optional[Sequence[Optional[float]]] = None,
+    ) -> None:
+        self.cost = np.asarray(costs, dtype=np.float64) / 1000
+        self.rate = np.asarray(tokens_per_minute, dtype=np.float64) / 60
+        self.start = np.array([0.0 if v is None else v / 1000 for v in latencies_ms], dtype=np.float64)
+        quotas = quotas if quotas is not None else [None] * len(self.cost)
+        self.quota = np.array([np.inf if q is None else q for q in quotas], dtype=np.float64)
+        # Cheapest first, then the quicker starter, then input order
+        self.order = np.lexsort((np.arange(len(self.cost)), self.start, self.cost))
+
+    def _fill(self, workload: float, times: np.ndarray) -> np.ndarray:
+        """[times, providers] cheapest-first allocation of `workload` tokens finishing by each time."""
+        cost_order = self.order
+        capacity = np.floor(np.minimum(
+            self.quota[cost_order], self.rate[cost_order] * np.maximum(0.0, times[:, None] - self.start[cost_order])
+        ) + 1e-9)
+        # Exclusive prefix sum; subtracting from an inclusive one would give inf - inf for unlimited quotas
+        before = np.zeros_like(capacity)
+        np.cumsum(capacity[:, :-1], axis=1, out=before[:, 1:])
+        filled = np.clip(workload - before, 0.0, capacity)
+        tokens = np.empty_like(filled)
+        tokens[:, cost_order] = filled
+        return tokens
+
+    def _plan(self, tokens: np.ndarray) -> SplitPlan:
+        finish = np.where(tokens > 0, self.start + tokens / self.rate, 0.0)
+        return SplitPlan(tokens.astype(np.int64), tokens * self.cost, finish)
+
+    def fastest_seconds(self, workload: int) -> float:
+        """Earliest completion with an unlimited budget; inf when the quotas cannot hold the workload."""
+        try:
+            return self.within_budget(workload, np.inf).completion_seconds
+        except InfeasiblePlan:
+            return np.inf
+
+    def within_deadline(self, workload: int, deadline_seconds: float) -> SplitPlan:
+        """Cheapest allocation finishing within the deadline."""
+        allocation = self._fill(workload, np.array([deadline_seconds]))[0]
+        if allocation.sum() < workload:
+            fastest = self.fastest_seconds(workload)
+            raise InfeasiblePlan(
+                f"Providers cannot finish {workload} tokens within {deadline_seconds:g}s; "
+                + (f"the earliest possible completion is {fastest:.2f}s" if np.isfinite(fastest)
+                   else "their quotas hold fewer tokens than the workload")
+            )
+        return self._plan(allocation)
+
+    def within_budget(self, workload: int, budget: float) -> SplitPlan:
+        """Fastest allocation costing at most the budget (inf: fastest at any price, cheapest among those)."""
+        unlimited = self._fill(workload, np.array([np.inf]))[0]
+        if unlimited.sum() < workload:
+            raise InfeasiblePlan(f"Provider quotas hold fewer than the {workload} tokens requested")
+        cheapest = float(unlimited @ self.cost)
+        if cheapest > budget * (1 + 1e-12):
+            raise InfeasiblePlan(f"The cheapest allocation costs ${cheapest:.4f}, over the ${budget:g} budget")
+
+        # The cheapest allocation finishes by `high`; nothing at all is served before `low`
+        used = unlimited > 0
+        high = float((self.start + unlimited / self.rate)[used].max())
+        low = float(self.start.min())
+        for _ in range(_PASSES):
+            times = np.linspace(low, high, _GRID + 1)[1:]
+            fills = self._fill(workload, times)
+            ok = (fills.sum(axis=1) >= workload) & (fills @ self.cost <= budget * (1 + 1e-12))
+            first = int(np.argmax(ok)) if ok.any() else _GRID - 1
+            low, high = (times[first - 1] if first else low), times[first]
+        return self._plan(self._fill(workload, np.array([high]))[0])
+
+    def plan(self, workload: int, deadline_seconds: Optional[float] = None,
+             budget: Optional[float] = None) -> SplitPlan:
+        """Cheapest plan under a deadline (checked against the budget if both are given), else fastest under the budget."""
+        if deadline_seconds is None:
+            return self.within_budget(workload, np.inf if budget is None else budget)
+        plan = self.within_deadline(workload, deadline_seconds)
+        if budget is not None and plan.total_cost > budget * (1 + 1e-12):
+            raise InfeasiblePlan(
+                f"The cheapest allocation finishing within {deadline_seconds:g}s costs ${plan.total_cost:.4f}, "
+                f"over the ${budget:g} budget"
+            )
+        return plan
+
+
+def describe(plan: SplitPlan, names: List[str]) -> List[Dict[str, object]]:
+    """Per-provider allocations, largest share first, leaving out providers that get nothing."""
+    rows = [
+        {
+            "provider": names[i],
+            "tokens": int(plan.tokens[i]),
+            "share": round(float(plan.tokens[i] / plan.tokens.sum()), 4),
+            "cost": round(float(plan.costs[i]), 4),
+            "finish_seconds": round(float(plan.finish_seconds[i]), 3),
+        }
+        for i in np.flatnonzero(plan.tokens)
+    ]
+    return sorted(rows, key=lambda row: -row["tokens"])
+
+
+# Pytest tests
+def _random_planner(rng, size):
+    return SplitPlanner(
+        rng.uniform(0.1, 3.0, size),
+        rng.choice([10_000, 40_000, 90_000, 400_000], size),
+        [None if rng.random() < 0.1 else float(v) for v in rng.uniform(50, 3000, size)],
+        [None if rng.random() < 0.7 else float(v) for v in rng.integers(1_000, 200_000, size)],
+    )
+
+
+def test_deadline_and_budget_plans_on_a_small_case():
+    # cheap but slow, mid, fast but expensive (per 1K tokens; tokens per minute; ms)
+    planner = SplitPlanner([0.5, 1.0, 4.0], [60_000, 120_000, 600_000], [1000, 500, 200])
+    # A day: everything goes to the cheapest provider
+    relaxed = planner.plan(100_000, deadline_seconds=86_400)
+    assert relaxed.tokens.tolist() == [100_000, 0, 0] and relaxed.total_cost == 50.0
+    # 30 s: the cheap one serves 29 s * 1000 tok/s, the mid one 29.5 s * 2000, the rest spills over
+    tight = planner.plan(100_000, deadline_seconds=30)
+    assert tight.tokens.tolist() == [29_000, 59_000, 12_000] and tight.completion_seconds <= 30
+    # An unlimited budget finishes as early as possible, every provider ending together
+    fastest = planner.plan(100_000)
+    used = fastest.finish_seconds[fastest.tokens > 0]
+    assert abs(fastest.completion_seconds - (100_000 + 1000 + 1000 + 2000) / 13_000) < 1e-3
+    assert used.max() - used.min() < 0.01
+    # Below the deadline plan's $121.5 the cost falls 9.5 $/s: $100 buys completion at 32.26 s
+    budgeted = planner.plan(100_000, budget=100.0)
+    assert abs(budgeted.completion_seconds - 306.5 / 9.5) < 0.01 and 99.9 < budgeted.total_cost <= 100.0
+    for call, message in ((lambda: planner.plan(100_000, deadline_seconds=0.1), "earliest possible"),
+                          (lambda: planner.plan(100_000, budget=1.0), "cheapest allocation costs"),
+                          (lambda: planner.plan(100_000, deadline_seconds=30, budget=60), "over the $60")):
+        try:
+            call()
+        except InfeasiblePlan as exc:
+            assert message in str(exc)
+        else:
+            raise AssertionError(message)
+
+
+def test_plans_are_optimal_against_perturbations_and_fast():
+    import time
+
+    rng = np.random.default_rng(0)
+    for _ in range(30):
+        planner = _random_planner(rng, 40)
+        workload = int(rng.integers(10_000, 2_000_000))
+        fastest = planner.fastest_seconds(workload)
+        if not np.isfinite(fastest):
+            continue
+        deadline = fastest * rng.uniform(1.0, 3.0)
+        plan = planner.plan(workload, deadline_seconds=deadline)
+        assert plan.tokens.sum() == workload and plan.completion_seconds <= deadline
+        # Moving a token from a used provider to one with room left never makes the plan cheaper
+        capacity = np.floor(np.minimum(planner.quota, planner.rate * np.maximum(0, deadline - planner.start)) + 1e-9)
+        room = plan.tokens < capacity
+        if room.any():
+            assert planner.cost[plan.tokens > 0].max() <= planner.cost[room].min()
+        # Under a budget no earlier time can be afforded
+        budget = plan.total_cost * rng.uniform(1.0, 1.5)
+        quick = planner.plan(workload, budget=budget)
+        assert quick.total_cost <= budget and quick.completion_seconds <= plan.completion_seconds + 1e-6
+        earlier = planner._fill(workload, np.array([quick.completion_seconds * (1 - 1e-4)]))[0]
+        assert earlier.sum() < workload or earlier @ planner.cost > budget
+
+    planners = [_random_planner(rng, 48) for _ in range(20)]
+    started = time.perf_counter()
+    for planner in planners:
+        planner.plan(1_000_000, budget=1e9)
+    assert (time.perf_counter() - started) / len(planners) < 0.005
+
+
+def test_plan_endpoint():
+    import asyncio
+
+    import httpx
+
+    from app import main
+
+    request = {
+        "workload_tokens": 100_000,
+        "deadline_seconds": 30,
+        "providers": [
+            {"provider": "cheap", "cost_per_1k_tokens": 0.5, "latency_ms": 1000, "tokens_per_minute": 60_000},
+            {"provider": "mid", "cost_per_1k_tokens": 1.0, "latency_ms": 500, "tokens_per_minute": 120_000},
+            {"provider": "fast", "cost_per_1k_tokens": 4.0, "latency_ms": 200, "tokens_per_minute": 600_000},
+            {"provider": "capped", "cost_per_1k_tokens": 0.1, "latency_ms": 100, "tokens_per_minute": 600_000,
+             "max_tokens": 5_000},
+        ],
+    }
+
+    async def scenario():
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://optimizer") as client:
+            planned = await client.post("/optimize/plan", json=request)
+            impossible = await client.post("/optimize/plan", json=dict(request, deadline_seconds=1))
+        return planned, impossible
+
+    planned, impossible = asyncio.run(scenario())
+    body = planned.json()
+    assert planned.status_code == 200 and body["objective"] == "cost"
+    assert {row["provider"]: row["tokens"] for row in body["allocations"]} == {
+        "mid": 59_000, "cheap": 29_000, "fast": 7_000, "capped": 5_000,
+    }
+    assert body["completion_seconds"] <= 30 and body["total_cost"] == round(
+        sum(row["cost"] for row in body["allocations"]), 4)
+    assert impossible.status_code == 422 and "earliest possible completion" in impossible.json()["detail"]
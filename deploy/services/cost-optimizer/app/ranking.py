@@ -0,0 +1,295 @@
+"""Vectorized provider filtering, scoring and Pareto ranking for the cost optimizer.
+
+The provider table becomes arrays once; each workload's constraints become one row of a
+boolean feasibility matrix, so thousands of decisions cost a handful of array operations
+instead of a Python loop each. Provider order never depends on the workload (a workload's
+token count scales every provider's cost alike), so it is computed once per table.
+
+Micro-benchmark: python -m app.ranking --bench
+"""
+
+import sys
+import time
+from typing import Dict, Iterable, Optional, Sequence
+
+import numpy as np
+
+
+def _column(values: Iterable[Optional[float]]) -> np.ndarray:
+    return np.array([np.nan if v is None else v for v in values], dtype=np.float64)
+
+
+def _normalized(values: np.ndarray) -> np.ndarray:
+    span = values.max() - values.min() if values.size else 0.0
+    return (values - values.min()) / span if span > 0 else np.zeros_like(values)
+
+
+class ProviderTable:
+    """Cost, latency and reliability columns of one provider list (NaN where not reported)."""
+
+    def __init__(
+        self,
+        costs: Sequence[float],
+        latencies: Sequence[Optional[float]],
+        reliabilities: Sequence[Optional[float]],
+    ) -> None:
+        self.cost = np.asarray(costs, dtype=np.float64)
+        self.latency = _column(latencies)
+        self.reliability = _column(reliabilities)
+        self._dominates: Optional[np.ndarray] = None
+
+    @classmethod
+    def from_metrics(cls, providers) -> "ProviderTable":
+        return cls(
+            [p.cost_per_1k_tokens for p in providers],
+            [p.latency_ms for p in providers],
+            [p.reliability_percent for p in providers],
+        )
+
+    def __len__(self) -> int:
+        return self.cost.size
+
+    def _imputed(self):
+        """Latency and reliability with unreported values set to the worst reported one."""
+        latency, reliability = self.latency.copy(), self.reliability.copy()
+        if np.isnan(latency).all():
+            latency[:] = 0.0
+        else:
+            latency[np.isnan(latency)] = np.nanmax(latency)
+        if np.isnan(reliability).all():
+            reliability[:] = 0.0
+        else:
+            reliability[np.isnan(reliability)] = np.nanmin(reliability)
+        return latency, reliability
+
+    def feasible(self, max_latency_ms: Sequence[Optional[float]],
+                 min_reliability_percent: Sequence[Optional[float]]) -> np.ndarray:
+        """
+        [workloads, providers] mask of providers meeting each workload's limits. Same rules as the
+        single-call path: a limit that is unset (or 0) filters nothing, and a provider that does
+        not report a metric (or reports 0) is never filtered on it.
+        """
+        max_latency = _column(max_latency_ms)
+        min_reliability = _column(min_reliability_percent)
+        max_latency[max_latency == 0] = np.nan
+        min_reliability[min_reliability == 0] = np.nan
+        reliability = np.where(self.reliability == 0, np.nan, self.reliability)
+        # Comparisons with NaN are False, which is exactly "not filtered"
+        too_slow = self.latency[None, :] > max_latency[:, None]
+        unreliable = reliability[None, :] < min_reliability[:, None]
+        return ~(too_slow | unreliable)
+
+    def order(self, weights: Optional[Dict[str, float]] = None) -> np.ndarray:
+        """
+        Provider indices best first. Without weights: cheapest first, then lower latency (unreported
+        counts as 0), then input order. With weights: the lowest weighted sum of min-max normalized
+        cost, latency and unreliability first, with the unweighted order breaking ties.
+        """
+        index = np.arange(len(self))
+        keys = [index, np.nan_to_num(self.latency, nan=0.0), self.cost]
+        if weights:
+            latency, reliability = self._imputed()
+            score = (
+                weights.get("cost", 0.0) * _normalized(self.cost)
+                + weights.get("latency", 0.0) * _normalized(latency)
+                + weights.get("reliability", 0.0) * _normalized(-reliability)
+            )
+            keys.append(score)
+        return np.lexsort(keys)
+
+    @property
+    def dominates(self) -> np.ndarray:
+        """[i, j] is True when provider i is at least as good as j on every objective and better on one."""
+        if self._dominates is None:
+            latency, reliability = self._imputed()
+            objectives = np.stack([self.cost, latency, -reliability], axis=1)
+            no_worse = (objectives[:, None, :] <= objectives[None, :, :]).all(axis=-1)
+            better = (objectives[:, None, :] < objectives[None, :, :]).any(axis=-1)
+            self._dominates = no_worse & better
+        return self._dominates
+
+    def pareto(self, feasible: np.ndarray) -> np.ndarray:
+        """[workloads, providers] mask of each workload's Pareto front among its feasible providers."""
+        dominated = (feasible.astype(np.uint16) @ self.dominates.astype(np.uint16)) > 0
+        return feasible & ~dominated
+
+
+def best_choice(feasible: np.ndarray, order: np.ndarray):
+    """(best provider index, any feasible) per workload: the first feasible provider in `order`."""
+    ranked = feasible[:, order]
+    return order[np.argmax(ranked, axis=1)], ranked.any(axis=1)
+
+
+# Pytest tests
+def _reference(providers, max_latency, min_reliability):
+    """optimize_workload's original per-request loop."""
+    kept = []
+    for i, (cost, latency, reliability) in enumerate(providers):
+        if max_latency and latency and latency > max_latency:
+            continue
+        if min_reliability and reliability and reliability < min_reliability:
+            continue
+        kept.append((i, cost, latency))
+    return [i for i, _, _ in sorted(kept, key=lambda k: (k[1], k[2] or 0))]
+
+
+def _random_table(rng, size):
+    providers = []
+    for _ in range(size):
+        providers.append((
+            float(rng.choice([0.5, 1.0, 1.5, 2.0])),
+            None if rng.random() < 0.2 else float(rng.choice([100, 250, 400, 900])),
+            None if rng.random() < 0.2 else float(rng.choice([0, 90, 95, 99.9])),
+        ))
+    return providers
+
+
+def test_feasibility_and_order_match_reference_loop():
+    rng = np.random.default_rng(0)
+    for _ in range(20):
+        providers = _random_table(rng, 8)
+        table = ProviderTable(*zip(*providers))
+        limits = [(rng.choice([None, 0, 200, 500]), rng.choice([None, 0, 92, 99])) for _ in range(50)]
+        feasible = table.feasible([m for m, _ in limits], [r for _, r in limits])
+        order = table.order()
+        best, any_feasible = best_choice(feasible, order)
+        for row, (max_latency, min_reliability) in enumerate(limits):
+            expected = _reference(providers, max_latency, min_reliability)
+            assert [i for i in order if feasible[row, i]] == expected
+            assert any_feasible[row] == bool(expected)
+            if expected:
+                assert best[row] == expected[0]
+
+
+def test_weighted_order_and_pareto_front():
+    # cost, latency, reliability
+    table = ProviderTable([1.0, 2.0, 1.0, 3.0], [500, 100, 600, 100], [99, 99, 90, 95])
+    assert table.order().tolist() == [0, 2, 1, 3]
+    assert table.order({"latency": 1.0}).tolist() == [1, 3, 0, 2]
+    assert table.order({"cost": 1.0, "reliability": 1.0}).tolist() == [0, 1, 2, 3]
+    everything = np.ones((1, 4), dtype=bool)
+    # 2 is beaten by 0 everywhere; 3 by 1 (same latency, cheaper, more reliable)
+    assert table.pareto(everything).tolist() == [[True, True, False, False]]
+    without_0_1 = np.array([[False, False, True, True]])
+    assert table.pareto(without_0_1).tolist() == [[False, False, True, True]]
+
+
+def test_batch_endpoint_matches_single_calls():
+    import asyncio
+
+    import httpx
+
+    from app import main
+
+    rng = np.random.default_rng(1)
+    providers = [
+        {"provider": f"p{i}", "cost_per_1k_tokens": cost, "latency_ms": latency, "reliability_percent": reliability}
+        for i, (cost, latency, reliability) in enumerate(_random_table(rng, 6))
+    ]
+    workloads = [
+        {"workload_tokens": int(rng.integers(1, 50_000)), "max_latency_ms": rng.choice([None, 120.0, 450.0]),
+         "min_reliability_percent": rng.choice([None, 95.0, 99.5])}
+        for _ in range(40)
+    ]
+
+    async def scenario():
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://optimizer") as client:
+            for weights in (None, {"cost": 0.5, "latency": 1.0, "reliability": 2.0}):
+                batch = await client.post("/optimize/batch", json={
+                    "providers": providers, "workloads": workloads, "weights": weights,
+                })
+                assert batch.status_code == 200
+                for workload, result in zip(workloads, batch.json()["results"]):
+                    single = await client.post("/optimize", json=dict(workload, providers=providers, weights=weights))
+                    if single.status_code == 422:
+                        assert result == {"error": main.NO_FEASIBLE_PROVIDER, "status_code": 422}
+                    else:
+                        assert single.status_code == 200 and single.json() == result
+                        assert result["best_provider"] in result["pareto_front"] or weights is None
+
+    asyncio.run(scenario())
+
+
+def test_reported_zero_reliability_is_not_filtered():
+    import asyncio
+
+    import httpx
+
+    from app import main
+
+    providers = [
+        {"provider": "cheap", "cost_per_1k_tokens": 0.5, "latency_ms": 200, "reliability_percent": 0},
+        {"provider": "solid", "cost_per_1k_tokens": 1.0, "latency_ms": 200, "reliability_percent": 99.9},
+    ]
+    workload = {"workload_tokens": 1000, "min_reliability_percent": 99.0}
+
+    async def scenario():
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://optimizer") as client:
+            single = await client.post("/optimize", json=dict(workload, providers=providers))
+            batch = await client.post("/optimize/batch", json={"providers": providers, "workloads": [workload]})
+        return single, batch
+
+    single, batch = asyncio.run(scenario())
+    # 0% has always read as "not reported", like a missing value
+    assert single.status_code == 200 and single.json()["best_provider"] == "cheap"
+    assert batch.json()["results"][0] == single.json()
+
+
+def _benchmark():
+    """Per-decision cost of the array path, the old Python loop, and the HTTP endpoints (in-process)."""
+    import asyncio
+
+    import httpx
+
+    from app import main
+
+    rng = np.random.default_rng(0)
+    providers = _random_table(rng, 12)
+    provider_json = [
+        {"provider": f"p{i}", "cost_per_1k_tokens": c, "latency_ms": lat, "reliability_percent": rel}
+        for i, (c, lat, rel) in enumerate(providers)
+    ]
+
+    async def endpoint_costs(workloads):
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://optimizer", timeout=None) as client:
+            start = time.perf_counter()
+            response = await client.post("/optimize/batch", json={
+                "providers": provider_json, "workloads": workloads, "include_ranking": False,
+            })
+            response.raise_for_status()
+            batch = (time.perf_counter() - start) * 1e6 / len(workloads)
+            sample = workloads[:500]
+            start = time.perf_counter()
+            for workload in sample:
+                await client.post("/optimize", json=dict(workload, providers=provider_json))
+            single = (time.perf_counter() - start) * 1e6 / len(sample)
+        return batch, single
+
+    print(f"{'workloads':>10} {'arrays':>10} {'py loop':>10} {'/optimize/batch':>16} {'/optimize each':>15}   (us/decision)")
+    for count in (1_000, 100_000):
+        limits = [(rng.choice([None, 200.0, 500.0]), rng.choice([None, 92.0, 99.0])) for _ in range(count)]
+        start = time.perf_counter()
+        table = ProviderTable(*zip(*providers))
+        feasible = table.feasible([m for m, _ in limits], [r for _, r in limits])
+        best_choice(feasible, table.order({"cost": 1.0, "latency": 0.5}))
+        table.pareto(feasible)
+        arrays = (time.perf_counter() - start) * 1e6 / count
+        start = time.perf_counter()
+        for max_latency, min_reliability in limits:
+            _reference(providers, max_latency, min_reliability)
+        loop = (time.perf_counter() - start) * 1e6 / count
+        workloads = [
+            {"workload_tokens": 2000, "max_latency_ms": m, "min_reliability_percent": r} for m, r in limits
+        ]
+        batch, single = asyncio.run(endpoint_costs(workloads))
+        print(f"{count:>10} {arrays:>10.2f} {loop:>10.2f} {batch:>16.2f} {single:>15.2f}")
+
+
+if __name__ == "__main__":
+    if "--bench" in sys.argv:
+        _benchmark()
+    else:
+        print(__doc__)
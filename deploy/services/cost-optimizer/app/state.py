@@ -0,0 +1,391 @@
+"""Shared state for cost-optimizer replicas.
+
+Values live in Redis behind one pooled ``redis.asyncio`` client per process, so replicas behind
+HAProxy share probe results, provider telemetry and recent decisions. Reads go through a small
+in-process LRU cache with a TTL (at most ``max_cached`` keys; expired keys are swept on write).
+Every write publishes its key on a pub/sub channel and the other replicas drop their cached
+copy when the message arrives, so the TTL only bounds staleness when a message is lost. Without
+REDIS_URL the same API keeps everything in process. Redis errors are logged and treated as
+misses; they never fail a request.
+"""
+
+import asyncio
+import json
+import logging
+import math
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+_MISS = object()
+
+
+class SharedState:
+    def __init__(
+        self,
+        url: Optional[str] = None,
+        client=None,
+        namespace: str = "cost-optimizer:",
+        cache_ttl: float = 2.0,
+        max_connections: int = 20,
+        max_cached: int = 4096,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.instance_id = uuid.uuid4().hex[:12]
+        self.namespace = namespace
+        self.channel = namespace + "invalidate"
+        self.cache_ttl = cache_ttl
+        self.clock = clock
+        self._redis = client
+        if self._redis is None and url:
+            import redis.asyncio as aioredis
+
+            self._redis = aioredis.Redis.from_url(
+                url, max_connections=max_connections, decode_responses=True, socket_timeout=0.5
+            )
+        self.max_cached = max_cached
+        self._cache: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        self._next_sweep = 0.0
+        self._listener: Optional[asyncio.Task] = None
+        self.stats = {"hits": 0, "misses": 0, "invalidations": 0, "errors": 0}
+
+    @property
+    def backend(self) -> str:
+        return "redis" if self._redis is not None else "memory"
+
+    async def start(self) -> None:
+        if self._redis is not None and self._listener is None:
+            self._listener = asyncio.create_task(self._listen())
+
+    async def stop(self) -> None:
+        if self._listener is not None:
+            self._listener.cancel()
+            try:
+                await self._listener
+            except asyncio.CancelledError:
+                pass
+            self._listener = None
+        if self._redis is not None:
+            await self._redis.aclose()
+
+    # Local cache: the read-through copy with Redis, the store itself without it
+    def _cached(self, key: str) -> Any:
+        entry = self._cache.get(key)
+        if entry is None:
+            return _MISS
+        expires_at, value = entry
+        if expires_at <= self.clock():
+            del self._cache[key]
+            return _MISS
+        self._cache.move_to_end(key)
+        return value
+
+    def _remember(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        if self._redis is not None:
+            ttl = self.cache_ttl if ttl is None else min(ttl, self.cache_ttl)
+        now = self.clock()
+        self._cache[key] = (now + ttl if ttl else math.inf, value)
+        self._cache.move_to_end(key)
+        if now >= self._next_sweep:
+            # Keys written once and never read again (decision:<hash>) would otherwise stay until evicted
+            for stale in [k for k, (expires_at, _) in self._cache.items() if expires_at <= now]:
+                del self._cache[stale]
+            self._next_sweep = now + 1.0
+        while len(self._cache) > self.max_cached:
+            self._cache.popitem(last=False)
+
+    def _failed(self, operation: str, key: str, error: Exception) -> None:
+        self.stats["errors"] += 1
+        logger.warning("Redis %s %s failed: %s", operation, key, error)
+
+    async def _publish(self, key: str) -> None:
+        message = json.dumps({"key": key, "origin": self.instance_id})
+        await self._redis.publish(self.channel, message)
+
+    async def get(self, key: str) -> Any:
+        """JSON value stored under ``key``, or None."""
+        value = self._cached(key)
+        if value is not _MISS:
+            self.stats["hits"] += 1
+            return value
+        self.stats["misses"] += 1
+        if self._redis is None:
+            return None
+        try:
+            raw = await self._redis.get(self.namespace + key)
+        except Exception as exc:
+            self._failed("GET", key, exc)
+            return None
+        if raw is None:
+            return None  # misses are not cached: the next read asks Redis again
+        value = json.loads(raw)
+        self._remember(key, value)
+        return value
+
+    async def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        self._remember(key, value, ttl)
+        if self._redis is None:
+            return
+        try:
+            await self._redis.set(self.namespace + key, json.dumps(value), px=int(ttl * 1000) if ttl else None)
+            await self._publish(key)
+        except Exception as exc:
+            self._failed("SET", key, exc)
+
+    async def hgetall(self, key: str) -> Dict[str, Any]:
+        """All fields of the hash ``key`` as decoded JSON values."""
+        value = self._cached(key)
+        if value is not _MISS:
+            self.stats["hits"] += 1
+            return dict(value)
+        self.stats["misses"] += 1
+        if self._redis is None:
+            return {}
+        try:
+            raw = await self._redis.hgetall(self.namespace + key)
+        except Exception as exc:
+            self._failed("HGETALL", key, exc)
+            return {}
+        value = {name: json.loads(item) for name, item in raw.items()}
+        if value:
+            self._remember(key, value)
+        return dict(value)
+
+    async def hset(self, key: str, field: str, value: Any, ttl: Optional[float] = None) -> None:
+        """Set one field; ``ttl`` applies to the whole hash and is refreshed by every write."""
+        if self._redis is None:
+            current = self._cached(key)
+            fields = dict(current) if current is not _MISS else {}
+            fields[field] = value
+            self._remember(key, fields, ttl)
+            return
+        self._cache.pop(key, None)
+        try:
+            async with self._redis.pipeline(transaction=False) as pipe:
+                pipe.hset(self.namespace + key, field, json.dumps(value))
+                if ttl:
+                    pipe.pexpire(self.namespace + key, int(ttl * 1000))
+                await pipe.execute()
+            await self._publish(key)
+        except Exception as exc:
+            self._failed("HSET", key, exc)
+
+    async def acquire(self, key: str, ttl: float) -> bool:
+        """
+        Take or renew a lease for ``ttl`` seconds; True for exactly one replica while it keeps renewing.
+        Without Redis this process is the only replica. If Redis is unreachable every replica acts on its own.
+        """
+        if self._redis is None:
+            return True
+        name = self.namespace + key
+        try:
+            if await self._redis.set(name, self.instance_id, nx=True, px=int(ttl * 1000)):
+                return True
+            if await self._redis.get(name) != self.instance_id:
+                return False
+            await self._redis.pexpire(name, int(ttl * 1000))
+            return True
+        except Exception as exc:
+            self._failed("SET NX", key, exc)
+            return True
+
+    async def _listen(self) -> None:
+        while True:
+            try:
+                pubsub = self._redis.pubsub()
+                await pubsub.subscribe(self.channel)
+                async for message in pubsub.listen():
+                    if message.get("type") != "message":
+                        continue
+                    data = json.loads(message["data"])
+                    if data.get("origin") != self.instance_id and self._cache.pop(data.get("key"), None):
+                        self.stats["invalidations"] += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                # Invalidations may have been missed while disconnected
+                self._cache.clear()
+                self._failed("SUBSCRIBE", self.channel, exc)
+                await asyncio.sleep(1.0)
+
+    def summary(self) -> Dict[str, Any]:
+        return {"backend": self.backend, "instance": self.instance_id, "cached_keys": len(self._cache), **self.stats}
+
+
+# Pytest tests
+class _FakeRedis:
+    """Asyncio stand-in for the redis commands used above, shared by several SharedState replicas."""
+
+    def __init__(self) -> None:
+        self.data: Dict[str, Any] = {}
+        self.expires: Dict[str, float] = {}
+        self.subscribers = []
+        self.commands = 0
+
+    def _live(self, key):
+        if key in self.expires and self.expires[key] <= time.monotonic():
+            self.data.pop(key, None)
+            self.expires.pop(key, None)
+        return self.data.get(key)
+
+    async def get(self, key):
+        self.commands += 1
+        return self._live(key)
+
+    async def set(self, key, value, px=None, nx=False):
+        self.commands += 1
+        if nx and self._live(key) is not None:
+            return None
+        self.data[key] = value
+        if px:
+            self.expires[key] = time.monotonic() + px / 1000
+        return True
+
+    async def pexpire(self, key, ms):
+        self.commands += 1
+        self.expires[key] = time.monotonic() + ms / 1000
+
+    async def hgetall(self, key):
+        self.commands += 1
+        return dict(self._live(key) or {})
+
+    def pipeline(self, transaction=False):
+        fake = self
+
+        class Pipeline:
+            def __init__(self):
+                self.ops = []
+
+            async def __aenter__(self):
+                return self
+
+            async def __aexit__(self, *exc):
+                return False
+
+            def hset(self, key, field, value):
+                self.ops.append(lambda: fake.data.setdefault(key, {}).__setitem__(field, value))
+
+            def pexpire(self, key, ms):
+                self.ops.append(lambda: fake.expires.__setitem__(key, time.monotonic() + ms / 1000))
+
+            async def execute(self):
+                fake.commands += 1
+                return [op() for op in self.ops]
+
+        return Pipeline()
+
+    async def publish(self, channel, message):
+        self.commands += 1
+        for queue in self.subscribers:
+            queue.put_nowait({"type": "message", "channel": channel, "data": message})
+
+    def pubsub(self):
+        fake = self
+
+        class PubSub:
+            async def subscribe(self, channel):
+                self.queue = asyncio.Queue()
+                fake.subscribers.append(self.queue)
+
+            async def listen(self):
+                while True:
+                    yield await self.queue.get()
+
+        return PubSub()
+
+    async def aclose(self):
+        pass
+
+
+async def _replicas(count, **kwargs):
+    fake = _FakeRedis()
+    states = [SharedState(client=fake, **kwargs) for _ in range(count)]
+    for state in states:
+        await state.start()
+    await asyncio.sleep(0)
+    return fake, states
+
+
+def test_read_through_cache_and_pubsub_invalidation():
+    async def scenario():
+        fake, (a, b) = await _replicas(2, cache_ttl=60)
+        await a.set("probes", {"openai": 120})
+        assert await b.get("probes") == {"openai": 120}
+        commands = fake.commands
+        assert await b.get("probes") == {"openai": 120} and fake.commands == commands  # served locally
+        await a.set("probes", {"openai": 90})
+        await asyncio.sleep(0.01)  # let b's listener handle the invalidation
+        assert await b.get("probes") == {"openai": 90} and b.stats["invalidations"] == 1
+        await a.hset("telemetry", "replica-a", {"n": 1}, ttl=30)
+        await b.hset("telemetry", "replica-b", {"n": 2}, ttl=30)
+        await asyncio.sleep(0.01)
+        assert await a.hgetall("telemetry") == {"replica-a": {"n": 1}, "replica-b": {"n": 2}}
+        assert [await s.acquire("probe-leader", 5) for s in (a, b, a)] == [True, False, True]
+        for state in (a, b):
+            await state.stop()
+
+    asyncio.run(scenario())
+
+
+def test_memory_backend_and_redis_errors_degrade_to_misses():
+    class Broken(_FakeRedis):
+        async def get(self, key):
+            raise ConnectionError("redis down")
+
+    async def scenario():
+        local = SharedState()
+        await local.set("decision:x", {"best": "a"}, ttl=30)
+        await local.hset("telemetry", "me", {"n": 1})
+        assert await local.get("decision:x") == {"best": "a"} and await local.acquire("lease", 1)
+        assert await local.hgetall("telemetry") == {"me": {"n": 1}} and local.backend == "memory"
+        broken = SharedState(client=Broken())
+        assert await broken.get("anything") is None and broken.stats["errors"] == 1
+
+    asyncio.run(scenario())
+
+
+def test_local_cache_is_bounded_and_swept():
+    async def scenario():
+        now = [0.0]
+        fake, (state,) = await _replicas(1, cache_ttl=60, max_cached=100)
+        state.clock = lambda: now[0]
+        for i in range(20_000):
+            await state.set(f"decision:{i}", {"best": "a"}, ttl=30)
+        assert len(state._cache) == 100 and await state.get("decision:19999") == {"best": "a"}
+        assert "decision:0" not in state._cache  # least recently used went first
+        now[0] = 31.0
+        await state.set("probes", {"openai": 1})
+        assert list(state._cache) == ["probes"]  # expired entries are swept on write
+        assert await state.get("missing") is None and "missing" not in state._cache
+        await state.stop()
+
+    asyncio.run(scenario())
+
+
+def test_against_real_redis_when_available():
+    import os
+
+    import pytest
+
+    url = os.getenv("REDIS_TEST_URL")
+    if not url:
+        pytest.skip("set REDIS_TEST_URL to run against a real Redis")
+
+    async def scenario():
+        namespace = f"cost-optimizer-test:{uuid.uuid4().hex[:8]}:"
+        a, b = SharedState(url, namespace=namespace), SharedState(url, namespace=namespace)
+        for state in (a, b):
+            await state.start()
+        await asyncio.sleep(0.1)
+        await a.set("k", {"v": 1}, ttl=5)
+        assert await b.get("k") == {"v": 1}
+        await a.set("k", {"v": 2}, ttl=5)
+        await asyncio.sleep(0.2)
+        assert await b.get("k") == {"v": 2}
+        for state in (a, b):
+            await state.stop()
+
+    asyncio.run(scenario())
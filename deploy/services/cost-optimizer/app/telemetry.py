@@ -0,0 +1,332 @@
+"""Live provider metrics from observed request outcomes.
+
+Callers report each request's provider, latency, tokens and success. Every provider keeps a
+sliding window split into time slots. Each slot holds an HDR-style log-bucketed latency
+histogram (fixed relative error, fixed size) plus success/failure/token counters, so memory is
+bounded whatever the traffic and old samples age out slot by slot. ``/optimize`` uses the
+window's latency quantile and success rate for any provider the caller sent without them.
+With shared state, replicas exchange their window counts every few seconds; log-bucketed
+histograms add exactly, so every replica sees quantiles over the traffic of all of them.
+"""
+
+import math
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+
+class LatencyScale:
+    """Log-spaced latency buckets: any value in range is reported within ``precision`` of itself."""
+
+    def __init__(self, lowest_ms: float = 0.1, highest_ms: float = 600_000.0, precision: float = 0.02) -> None:
+        self.lowest_ms = lowest_ms
+        self.log_growth = math.log1p(precision)
+        self.buckets = int(math.ceil(math.log(highest_ms / lowest_ms) / self.log_growth)) + 1
+
+    def index(self, latency_ms: float) -> int:
+        if latency_ms <= self.lowest_ms:
+            return 0
+        return min(int(math.log(latency_ms / self.lowest_ms) / self.log_growth), self.buckets - 1)
+
+    def value(self, index: int) -> float:
+        """Geometric midpoint of a bucket."""
+        return self.lowest_ms * math.exp((index + 0.5) * self.log_growth)
+
+
+class ProviderWindow:
+    """Ring of ``slots`` time slots covering the last ``window_seconds`` for one provider."""
+
+    def __init__(self, scale: LatencyScale, window_seconds: float, slots: int) -> None:
+        self.scale = scale
+        self.slot_seconds = window_seconds / slots
+        self.latency = np.zeros((slots, scale.buckets), dtype=np.uint32)
+        self.successes = np.zeros(slots, dtype=np.int64)
+        self.failures = np.zeros(slots, dtype=np.int64)
+        self.tokens = np.zeros(slots, dtype=np.int64)
+        # Absolute slot number held at each ring position; -1 means never used
+        self.slot_ids = np.full(slots, -1, dtype=np.int64)
+
+    def _position(self, now: float) -> int:
+        slot_id = int(now // self.slot_seconds)
+        position = slot_id % len(self.slot_ids)
+        if self.slot_ids[position] != slot_id:
+            self.latency[position] = 0
+            self.successes[position] = self.failures[position] = self.tokens[position] = 0
+            self.slot_ids[position] = slot_id
+        return position
+
+    def record(self, now: float, latency_ms: float, tokens: int, success: bool) -> None:
+        position = self._position(now)
+        self.tokens[position] += tokens
+        if success:
+            self.successes[position] += 1
+            self.latency[position, self.scale.index(latency_ms)] += 1
+        else:
+            self.failures[position] += 1
+
+    def _live(self, now: float) -> np.ndarray:
+        current = int(now // self.slot_seconds)
+        return self.slot_ids > current - len(self.slot_ids)
+
+    def counts(self, now: float) -> "WindowCounts":
+        live = self._live(now)
+        return WindowCounts(
+            self.latency[live].sum(axis=0, dtype=np.int64),
+            int(self.successes[live].sum()),
+            int(self.failures[live].sum()),
+            int(self.tokens[live].sum()),
+        )
+
+
+class WindowCounts:
+    """Totals of one window: what replicas exchange and what quantiles are read from."""
+
+    def __init__(self, latency: np.ndarray, successes: int, failures: int, tokens: int) -> None:
+        self.latency = latency
+        self.successes = successes
+        self.failures = failures
+        self.tokens = tokens
+
+    def to_json(self) -> Dict[str, Any]:
+        nonzero = np.flatnonzero(self.latency)
+        return {
+            "latency": [[int(i), int(self.latency[i])] for i in nonzero],
+            "successes": self.successes,
+            "failures": self.failures,
+            "tokens": self.tokens,
+        }
+
+    def add_json(self, data: Dict[str, Any]) -> None:
+        for index, count in data["latency"]:
+            self.latency[index] += count
+        self.successes += data["successes"]
+        self.failures += data["failures"]
+        self.tokens += data["tokens"]
+
+    def summary(self, scale: LatencyScale, seconds: float, quantiles: Tuple[float, ...]) -> Dict[str, Optional[float]]:
+        successes, failures = self.successes, self.failures
+        total = successes + failures
+        cdf = np.cumsum(self.latency)
+        summary: Dict[str, Optional[float]] = {
+            "requests": total,
+            "errors": failures,
+            "error_rate": round(failures / total, 4) if total else None,
+            "reliability_percent": round(100.0 * successes / total, 2) if total else None,
+            "tokens_per_second": round(self.tokens / seconds, 2),
+        }
+        for q in quantiles:
+            key = f"p{q * 100:g}_ms"
+            if not successes:
+                summary[key] = None
+                continue
+            # Nearest rank: the first bucket whose cumulative count reaches ceil(q * n)
+            index = int(np.searchsorted(cdf, max(1, math.ceil(q * successes))))
+            summary[key] = round(scale.value(index), 2)
+        return summary
+
+
+class TelemetryStore:
+    """Per-provider windows, capped at ``max_providers`` so arbitrary provider names cannot grow memory."""
+
+    QUANTILES = (0.5, 0.9, 0.95, 0.99)
+
+    def __init__(
+        self,
+        window_seconds: float = 30.0,
+        slots: int = 10,
+        min_samples: int = 20,
+        latency_quantile: float = 0.95,
+        max_providers: int = 256,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.scale = LatencyScale()
+        self.window_seconds = window_seconds
+        self.slots = slots
+        self.min_samples = min_samples
+        self.latency_quantile = latency_quantile
+        self.max_providers = max_providers
+        self.clock = clock
+        self.windows: Dict[str, ProviderWindow] = {}
+        # Other replicas' latest window counts: {replica: {provider: WindowCounts JSON}}
+        self.remote: Dict[str, Dict[str, Dict[str, Any]]] = {}
+
+    @staticmethod
+    def _key(provider: str) -> str:
+        return provider.strip().lower()
+
+    def record(self, provider: str, latency_ms: float, tokens: int = 0, success: bool = True) -> bool:
+        """Add one outcome; False when it was dropped because the provider cap is reached."""
+        key = self._key(provider)
+        window = self.windows.get(key)
+        if window is None:
+            if len(self.windows) >= self.max_providers:
+                return False
+            window = self.windows[key] = ProviderWindow(self.scale, self.window_seconds, self.slots)
+        window.record(self.clock(), latency_ms, tokens, success)
+        return True
+
+    def summary(self, provider: str) -> Optional[Dict[str, Optional[float]]]:
+        key = self._key(provider)
+        window = self.windows.get(key)
+        remote = [counts[key] for counts in self.remote.values() if key in counts]
+        if window is None and not remote:
+            return None
+        if window is not None:
+            counts = window.counts(self.clock())
+        else:
+            counts = WindowCounts(np.zeros(self.scale.buckets, dtype=np.int64), 0, 0, 0)
+        for data in remote:
+            counts.add_json(data)
+        quantiles = tuple(sorted(set(self.QUANTILES) | {self.latency_quantile}))
+        return counts.summary(self.scale, self.window_seconds, quantiles)
+
+    def snapshot(self) -> Dict[str, Dict[str, Optional[float]]]:
+        providers = set(self.windows).union(*(counts.keys() for counts in self.remote.values()))
+        return {provider: self.summary(provider) for provider in sorted(providers)}
+
+    def export(self) -> Dict[str, Dict[str, Any]]:
+        """This replica's live window counts per provider, for the other replicas."""
+        now = self.clock()
+        return {provider: window.counts(now).to_json() for provider, window in self.windows.items()}
+
+    async def sync(self, state) -> None:
+        """Publish this replica's counts to the shared state and take in every other replica's."""
+        await state.hset("telemetry", state.instance_id, {"at": time.time(), "providers": self.export()},
+                         ttl=self.window_seconds)
+        now = time.time()
+        self.remote = {
+            replica: entry["providers"]
+            for replica, entry in (await state.hgetall("telemetry")).items()
+            if replica != state.instance_id and now - entry["at"] <= self.window_seconds
+        }
+
+    def estimates(self, provider: str) -> Tuple[Optional[float], Optional[float]]:
+        """(latency_ms, reliability_percent) from the live window, None while it has too few samples."""
+        summary = self.summary(provider)
+        if summary is None or summary["requests"] < self.min_samples:
+            return None, None
+        return summary[f"p{self.latency_quantile * 100:g}_ms"], summary["reliability_percent"]
+
+    def fill(self, providers: List) -> List:
+        """Copies of the ProviderMetrics with missing latency / reliability taken from live data."""
+        filled = []
+        for option in providers:
+            if option.latency_ms is None or option.reliability_percent is None:
+                latency, reliability = self.estimates(option.provider)
+                update = {}
+                if option.latency_ms is None and latency is not None:
+                    update["latency_ms"] = latency
+                if option.reliability_percent is None and reliability is not None:
+                    update["reliability_percent"] = reliability
+                if update:
+                    option = option.model_copy(update=update)
+            filled.append(option)
+        return filled
+
+
+# Pytest tests
+class _Clock:
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_quantiles_within_precision_and_bounded_memory():
+    store = TelemetryStore(clock=_Clock())
+    rng = np.random.default_rng(0)
+    samples = rng.lognormal(mean=5.5, sigma=0.6, size=20_000)
+    for value in samples:
+        store.record("OpenAI ", float(value), tokens=10)
+    summary = store.summary("openai")
+    for q in (0.5, 0.9, 0.99):
+        exact = np.quantile(samples, q, method="inverted_cdf")
+        assert abs(summary[f"p{q * 100:g}_ms"] - exact) / exact < 0.02
+    window = store.windows["openai"]
+    assert window.latency.nbytes < 64 * 1024 and summary["requests"] == 20_000
+
+
+def test_window_slides_and_error_rate_reacts():
+    clock = _Clock()
+    store = TelemetryStore(window_seconds=30, slots=10, min_samples=5, clock=clock)
+    for _ in range(100):
+        store.record("gemini", 100.0)
+        clock.now += 0.1
+    assert store.estimates("gemini")[1] == 100.0
+    # The provider starts failing: within a few seconds reliability drops sharply
+    for _ in range(30):
+        store.record("gemini", 5000.0, success=False)
+        clock.now += 0.1
+    latency, reliability = store.estimates("gemini")
+    assert reliability < 80 and 95 < latency < 105
+    # Thirty seconds later the healthy samples have aged out completely
+    clock.now += 30
+    store.record("gemini", 5000.0, success=False)
+    assert store.summary("gemini")["requests"] == 1 and store.summary("gemini")["reliability_percent"] == 0.0
+
+
+def test_provider_cap_and_optimize_uses_live_metrics():
+    import asyncio
+
+    import httpx
+
+    from app import main
+
+    store = TelemetryStore(min_samples=10, max_providers=2, clock=_Clock())
+    assert store.record("a", 1.0) and store.record("b", 1.0) and not store.record("c", 1.0)
+
+    async def scenario():
+        original, main.telemetry = main.telemetry, TelemetryStore(min_samples=10)
+        transport = httpx.ASGITransport(app=main.app)
+        try:
+            async with httpx.AsyncClient(transport=transport, base_url="http://optimizer") as client:
+                outcomes = [{"provider": "cheap", "latency_ms": 900.0, "tokens": 50, "success": i % 2 == 0}
+                            for i in range(40)]
+                outcomes += [{"provider": "fast", "latency_ms": 80.0, "tokens": 50} for _ in range(40)]
+                ingest = await client.post("/telemetry", json={"outcomes": outcomes})
+                assert ingest.json() == {"accepted": 80, "dropped": 0}
+                request = {
+                    "workload_tokens": 1000, "min_reliability_percent": 90,
+                    "providers": [{"provider": "cheap", "cost_per_1k_tokens": 0.1},
+                                  {"provider": "fast", "cost_per_1k_tokens": 0.5},
+                                  {"provider": "unknown", "cost_per_1k_tokens": 0.9}],
+                }
+                decision = (await client.post("/optimize", json=request)).json()
+                snapshot = (await client.get("/telemetry")).json()
+        finally:
+            main.telemetry = original
+        return decision, snapshot
+
+    decision, snapshot = asyncio.run(scenario())
+    # "cheap" fails half its requests, so the live reliability filters it out
+    assert decision["best_provider"] == "fast"
+    assert [p["provider"] for p in decision["ranked_providers"]] == ["fast", "unknown"]
+    assert decision["ranked_providers"][0]["latency_ms"] == snapshot["providers"]["fast"]["p95_ms"]
+    assert snapshot["providers"]["cheap"]["error_rate"] == 0.5
+
+
+def test_replicas_share_windows_through_state():
+    import asyncio
+
+    from app.state import _replicas
+
+    async def scenario():
+        _, states = await _replicas(2, cache_ttl=0.001)
+        stores = [TelemetryStore(min_samples=10, clock=_Clock()) for _ in states]
+        for i in range(30):
+            stores[i % 2].record("openai", 100.0 + i, tokens=10, success=i != 7)
+        for store, state in zip(stores, states):
+            await store.sync(state)
+        await stores[0].sync(states[0])  # picks up the second replica's counts
+        for state in states:
+            await state.stop()
+        return stores
+
+    stores = asyncio.run(scenario())
+    merged = stores[0].summary("openai")
+    assert merged["requests"] == 30 and merged["errors"] == 1
+    assert stores[1].summary("openai") == merged
+    # Each replica exports only its own traffic, so counts are never added twice
+    assert stores[0].export()["openai"]["successes"] + stores[1].export()["openai"]["successes"] == 29
@@ -0,0 +1,368 @@
+"""In-process cache of a Vault KV v2 secret for the swarm's services.
+
+Services read keys from memory with ``SecretCache.get``. They never call Vault per request. A
+background task re-reads the secret and swaps in the new values when its version changes, so a
+rotation reaches a running service without a restart. The refresh period follows the shortest
+lease involved: the configured interval, the secret's own lease when Vault reports one, and the
+auth token's TTL. A token in its last refresh interval is renewed, and an AppRole login is
+redone if renewal is refused or the token was revoked. When Vault is unreachable the last good
+values keep being served; without VAULT_ADDR the cache only serves its environment fallbacks.
+The module depends on httpx alone, so other services can copy it as-is.
+"""
+
+import asyncio
+import logging
+import time
+from typing import Any, Callable, Dict, List, Mapping, Optional
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+
+class VaultError(RuntimeError):
+    pass
+
+
+class SecretCache:
+    def __init__(
+        self,
+        addr: Optional[str],
+        path: str,
+        mount: str = "secret",
+        token: Optional[str] = None,
+        role_id: Optional[str] = None,
+        secret_id: Optional[str] = None,
+        refresh_interval: float = 60.0,
+        retry_interval: float = 5.0,
+        fallback: Optional[Mapping[str, Optional[str]]] = None,
+        timeout: float = 5.0,
+        transport: Optional[httpx.AsyncBaseTransport] = None,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.addr = addr
+        self.path = path
+        self.mount = mount
+        self.role_id = role_id
+        self.secret_id = secret_id
+        self.refresh_interval = refresh_interval
+        self.retry_interval = retry_interval
+        self.clock = clock
+        self.version: Optional[int] = None
+        self.refreshed_at: Optional[float] = None
+        self.stats = {"reads": 0, "changes": 0, "errors": 0, "logins": 0, "renewals": 0}
+        self._fallback = {k: v for k, v in (fallback or {}).items() if v}
+        self._values: Dict[str, str] = dict(self._fallback)
+        self._token = token
+        self._token_expires: Optional[float] = None  # None: the token does not expire
+        self._token_renewable = False
+        self._lease: Optional[float] = None
+        self._listeners: List[Callable[[Dict[str, str]], Any]] = []
+        self._task: Optional[asyncio.Task] = None
+        self._client = (
+            httpx.AsyncClient(base_url=addr, timeout=timeout, transport=transport) if addr else None
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return self._client is not None
+
+    def get(self, key: str, default: Optional[str] = None) -> Optional[str]:
+        return self._values.get(key, default)
+
+    def values(self) -> Dict[str, str]:
+        return dict(self._values)
+
+    def subscribe(self, listener: Callable[[Dict[str, str]], Any]) -> None:
+        """Call ``listener(values)`` after every change, e.g. to rebuild a provider client."""
+        self._listeners.append(listener)
+
+    async def start(self) -> None:
+        if not self.enabled:
+            return
+        try:
+            await self.refresh()
+        except (VaultError, httpx.HTTPError) as exc:
+            self.stats["errors"] += 1
+            logger.warning("Initial Vault read of %s failed, serving fallbacks: %s", self.path, exc)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._client is not None:
+            await self._client.aclose()
+
+    def next_refresh(self) -> float:
+        """Seconds until the next read: the interval, cut short by a secret lease or the token's TTL."""
+        delay = self.refresh_interval
+        if self._lease:
+            delay = min(delay, self._lease * 2 / 3)
+        if self._token_expires is not None:
+            delay = min(delay, max(0.0, (self._token_expires - self.clock()) * 2 / 3))
+        return delay
+
+    async def _run(self) -> None:
+        while True:
+            delay = self.next_refresh() if self.refreshed_at is not None else self.retry_interval
+            await asyncio.sleep(delay)
+            try:
+                await self.refresh()
+            except (VaultError, httpx.HTTPError) as exc:
+                self.stats["errors"] += 1
+                logger.warning("Vault refresh of %s failed, keeping version %s: %s", self.path, self.version, exc)
+                await asyncio.sleep(self.retry_interval)
+
+    async def _request(self, method: str, url: str, **kwargs) -> httpx.Response:
+        headers = {"X-Vault-Token": self._token} if self._token else {}
+        return await self._client.request(method, url, headers=headers, **kwargs)
+
+    async def _login(self) -> None:
+        if not (self.role_id and self.secret_id):
+            raise VaultError("Vault token rejected and no AppRole credentials to log in again")
+        response = await self._client.post(
+            "/v1/auth/approle/login", json={"role_id": self.role_id, "secret_id": self.secret_id}
+        )
+        if response.status_code != 200:
+            raise VaultError(f"AppRole login failed: HTTP {response.status_code}")
+        self._set_token(response.json()["auth"])
+        self.stats["logins"] += 1
+
+    def _set_token(self, auth: Dict[str, Any]) -> None:
+        self._token = auth.get("client_token", self._token)
+        ttl = auth.get("lease_duration") or 0
+        self._token_expires = self.clock() + ttl if ttl else None
+        self._token_renewable = bool(auth.get("renewable"))
+
+    async def _ensure_token(self) -> None:
+        if self._token is None:
+            return await self._login()
+        if self._token_expires is None or self._token_expires - self.clock() > self.refresh_interval:
+            return
+        # Inside the last refresh interval of the token's life: renew it, or log in again
+        if self._token_renewable:
+            response = await self._request("POST", "/v1/auth/token/renew-self", json={})
+            if response.status_code == 200:
+                self._set_token(response.json()["auth"])
+                self.stats["renewals"] += 1
+                return
+        await self._login()
+
+    async def refresh(self) -> bool:
+        """Read the secret now; True when a new version was swapped in."""
+        await self._ensure_token()
+        url = f"/v1/{self.mount}/data/{self.path}"
+        response = await self._request("GET", url)
+        if response.status_code == 403 and self.role_id:
+            await self._login()
+            response = await self._request("GET", url)
+        self.stats["reads"] += 1
+        if response.status_code == 404:
+            raise VaultError(f"No secret at {self.mount}/{self.path}")
+        if response.status_code != 200:
+            raise VaultError(f"Reading {self.mount}/{self.path}: HTTP {response.status_code}")
+        body = response.json()
+        self._lease = body.get("lease_duration") or None
+        self.refreshed_at = self.clock()
+        secret = body["data"]
+        version = secret["metadata"]["version"]
+        if version == self.version:
+            return False
+        # One dict swap: readers see the old or the new key set, never a mix
+        self._values = {**self._fallback, **{k: str(v) for k, v in secret["data"].items() if v}}
+        self.version = version
+        self.stats["changes"] += 1
+        logger.info("Loaded version %s of %s/%s", version, self.mount, self.path)
+        for listener in self._listeners:
+            try:
+                listener(self.values())
+            except Exception as exc:  # one bad listener must not stop the swap for the others
+                logger.warning("Secret listener failed: %s", exc)
+        return True
+
+    def summary(self) -> Dict[str, Any]:
+        """Health view: where the keys come from and how fresh they are, never the values."""
+        age = None if self.refreshed_at is None else round(self.clock() - self.refreshed_at, 1)
+        return {"source": "vault" if self.enabled else "env", "version": self.version, "age_seconds": age, **self.stats}
+
+
+# Pytest tests
+class _LocalVault:
+    """Stand-in for Vault's KV v2, token and AppRole endpoints, with check-and-set and token TTLs."""
+
+    def __init__(self, token_ttl: float = 0.0, clock: Callable[[], float] = time.monotonic) -> None:
+        from fastapi import FastAPI, Request
+        from fastapi.responses import JSONResponse
+
+        self.clock = clock
+        self.token_ttl = token_ttl
+        self.secrets: Dict[str, List[Dict[str, str]]] = {}
+        self.tokens: Dict[str, Optional[float]] = {"root": None}
+        self.roles = {"cost-optimizer": "s3cret"}
+        self.requests: List[str] = []
+        self.down = False
+        self.app = app = FastAPI()
+
+        def denied():
+            return JSONResponse({"errors": ["permission denied"]}, status_code=403)
+
+        def authorized(request: Request) -> bool:
+            token = request.headers.get("x-vault-token")
+            if token not in self.tokens:
+                return False
+            expires = self.tokens[token]
+            return expires is None or expires > self.clock()
+
+        def issue() -> Dict[str, Any]:
+            token = f"t{len(self.tokens)}"
+            self.tokens[token] = self.clock() + token_ttl if token_ttl else None
+            return {"auth": {"client_token": token, "lease_duration": token_ttl, "renewable": True}}
+
+        @app.middleware("http")
+        async def record(request: Request, call_next):
+            self.requests.append(f"{request.method} {request.url.path}")
+            if self.down:
+                return JSONResponse({"errors": ["sealed"]}, status_code=503)
+            return await call_next(request)
+
+        @app.post("/v1/auth/approle/login")
+        async def login(request: Request):
+            body = await request.json()
+            if self.roles.get(body.get("role_id")) != body.get("secret_id"):
+                return JSONResponse({"errors": ["invalid role or secret ID"]}, status_code=400)
+            return issue()
+
+        @app.post("/v1/auth/token/renew-self")
+        async def renew(request: Request):
+            if not authorized(request):
+                return denied()
+            token = request.headers["x-vault-token"]
+            self.tokens[token] = self.clock() + token_ttl if token_ttl else None
+            return {"auth": {"client_token": token, "lease_duration": token_ttl, "renewable": True}}
+
+        @app.get("/v1/{mount}/data/{path:path}")
+        async def read(mount: str, path: str, request: Request):
+            if not authorized(request):
+                return denied()
+            versions = self.secrets.get(f"{mount}/{path}")
+            if not versions:
+                return JSONResponse({"errors": []}, status_code=404)
+            return {"lease_duration": 0, "data": {"data": versions[-1], "metadata": {"version": len(versions)}}}
+
+        @app.post("/v1/{mount}/data/{path:path}")
+        async def write(mount: str, path: str, request: Request):
+            if not authorized(request):
+                return denied()
+            body = await request.json()
+            versions = self.secrets.setdefault(f"{mount}/{path}", [])
+            cas = body.get("options", {}).get("cas")
+            if cas is not None and cas != len(versions):
+                return JSONResponse(
+                    {"errors": ["check-and-set parameter did not match the current version"]}, status_code=400
+                )
+            versions.append(body["data"])
+            return {"data": {"version": len(versions)}}
+
+    def put(self, path: str, data: Dict[str, str], mount: str = "secret") -> None:
+        self.secrets.setdefault(f"{mount}/{path}", []).append(data)
+
+    def transport(self) -> httpx.ASGITransport:
+        return httpx.ASGITransport(app=self.app)
+
+
+def test_keys_hot_swap_without_per_request_reads():
+    vault = _LocalVault()
+    vault.put("secret/api-keys", {"openrouter": "sk-or-1", "gemini_primary": "AIza-1"})
+    cache = SecretCache(
+        "http://vault", "secret/api-keys", token="root", refresh_interval=0.05,
+        fallback={"openrouter": "sk-env", "openai": "sk-openai-env"}, transport=vault.transport(),
+    )
+    seen = []
+    cache.subscribe(lambda values: seen.append(values["openrouter"]))
+
+    async def scenario():
+        await cache.start()
+        first = [cache.get("openrouter") for _ in range(1000)]
+        vault.put("secret/api-keys", {"openrouter": "sk-or-2", "gemini_primary": "AIza-1"})
+        deadline = time.monotonic() + 2
+        while cache.get("openrouter") != "sk-or-2" and time.monotonic() < deadline:
+            await asyncio.sleep(0.01)
+        await cache.stop()
+        return first
+
+    first = asyncio.run(scenario())
+    assert set(first) == {"sk-or-1"} and cache.get("openrouter") == "sk-or-2"
+    # Vault values win over the environment; keys only in the environment stay available
+    assert cache.get("openai") == "sk-openai-env" and cache.version == 2 and seen == ["sk-or-1", "sk-or-2"]
+    # A thousand lookups cost no Vault calls: only the background refreshes read
+    reads = [r for r in vault.requests if r.startswith("GET")]
+    assert len(reads) == cache.stats["reads"] < 100
+    assert "sk-or" not in str(cache.summary())
+
+
+def test_token_lease_renewal_relogin_and_outages():
+    now = [0.0]
+    vault = _LocalVault(token_ttl=30.0, clock=lambda: now[0])
+    vault.put("secret/api-keys", {"openrouter": "sk-or-1"})
+    cache = SecretCache(
+        "http://vault", "secret/api-keys", role_id="cost-optimizer", secret_id="s3cret",
+        refresh_interval=60.0, transport=vault.transport(), clock=lambda: now[0],
+    )
+
+    async def scenario():
+        assert await cache.refresh() is True and cache.stats["logins"] == 1
+        # Refresh before the token's 30s lease runs out rather than after the 60s interval
+        assert cache.next_refresh() == 20.0
+        now[0] = 25.0
+        assert await cache.refresh() is False and cache.stats["renewals"] == 1
+        # Token revoked behind our back: log in again and carry on
+        vault.tokens.clear()
+        vault.put("secret/api-keys", {"openrouter": "sk-or-2"})
+        assert await cache.refresh() is True and cache.stats["logins"] == 2
+        vault.down = True
+        try:
+            await cache.refresh()
+        except VaultError:
+            pass
+        await cache.stop()
+
+    asyncio.run(scenario())
+    # The outage keeps the last good keys
+    assert cache.get("openrouter") == "sk-or-2" and cache.version == 2
+
+
+def test_without_vault_serves_environment():
+    cache = SecretCache(None, "secret/api-keys", fallback={"openrouter": "sk-env", "gemini_primary": ""})
+    asyncio.run(cache.start())
+    assert cache.values() == {"openrouter": "sk-env"} and cache.summary()["source"] == "env"
+
+
+def test_config_endpoint_sees_rotated_keys_without_restart():
+    from app import main
+
+    vault = _LocalVault()
+    vault.put("secret/api-keys", {"openrouter": "sk-or-1"})
+
+    async def scenario():
+        original = main.secrets
+        main.secrets = SecretCache("http://vault", "secret/api-keys", token="root", transport=vault.transport())
+        transport = httpx.ASGITransport(app=main.app)
+        try:
+            await main.secrets.refresh()
+            async with httpx.AsyncClient(transport=transport, base_url="http://optimizer") as client:
+                before = (await client.get("/config")).json()
+                vault.put("secret/api-keys", {"openrouter": "sk-or-2", "anthropic": "sk-ant-1"})
+                await main.secrets.refresh()
+                after = (await client.get("/config")).json()
+                health = (await client.get("/health")).json()
+        finally:
+            await main.secrets.stop()
+            main.secrets = original
+        return before, after, health
+
+    before, after, health = asyncio.run(scenario())
+    assert before["openrouter_configured"] and not before["anthropic_configured"]
+    assert after["anthropic_configured"] and health["secrets"]["version"] == 2
+    assert main.api_keys()["OPENROUTER_API_KEY"] != "sk-or-2"  # the module-level cache is untouched
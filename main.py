@@ -5,13 +5,22 @@ Main orchestration and deployment module with auto-scaling for vLLM.
 For single power user on private Tailscale network - simple, efficient scaling.
 """
 
+import argparse
 import asyncio
 import logging
-import subprocess
-import paramiko
+import os
+import time
 from pathlib import Path
-from typing import Dict, List, Optional
-import pytest
+from typing import TYPE_CHECKING, Dict, List, Optional
+
+from swarm_autoscale import HysteresisPolicy, ScalingPolicy, Signals
+from swarm_deploy import DeployGraph, DeployStep
+from swarm_fingerprint import AppliedState, Fingerprinter, changes
+from swarm_ssh import SSHPool
+from swarm_telemetry import TelemetryCollector
+
+if TYPE_CHECKING:  # httpx is only imported once the router is built
+    from swarm_router import SwarmRouter
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -19,7 +28,7 @@ logger = logging.getLogger(__name__)
 class AISwarmOrchestrator:
     """Main orchestrator for 3-node AI swarm deployment with auto-scaling."""
 
-    def __init__(self, ssh_key_path: Optional[str] = None):
+    def __init__(self, ssh_key_path: Optional[str] = None, state_path: Optional[str] = None):
         self.nodes = {
             'oracle': {
                 'ip_tailscale': '100.96.197.84',
@@ -45,99 +54,263 @@ class AISwarmOrchestrator:
         self.scale_threshold = 0.8  # 80% GPU util to scale up
         self.min_batch = 8
         self.max_batch = 32
+        self.scale_interval = 60  # seconds between scaling decisions
+        # Every batch change recreates vLLM: act on sustained, smoothed pressure and cap restarts
+        self.scaling_policy: ScalingPolicy = HysteresisPolicy(
+            up_util=self.scale_threshold, down_util=0.3, latency_slo_ms=30000,
+            min_batch=self.min_batch, max_batch=self.max_batch)
+        self.deploy_parallelism = 4
+        self.last_deploy_report = None
+        # Fingerprints of what each node last had applied, for incremental deploys
+        self.fingerprinter = Fingerprinter(Path(__file__).resolve().parent)
+        self.applied = AppliedState(Path(
+            state_path or os.getenv('SWARM_STATE_FILE', '~/.ai-swarm/applied.json')).expanduser())
+        # One persistent session per node, driven off the event loop
+        self.ssh = SSHPool(
+            {name: {'host': node['ip_tailscale'], 'username': node['username']} for name, node in self.nodes.items()},
+            key_path=self.ssh_key_path,
+        )
+        # Streaming GPU/vLLM telemetry on the GPU nodes (node -> vLLM port)
+        self.telemetry = TelemetryCollector(self.ssh, {'starlord': 8000, 'thanos': 8002})
+        self.util_window = 60  # seconds of telemetry the auto-scaler averages over
+        self.router: Optional['SwarmRouter'] = None
 
-    async def ssh_command(self, node: str, command: str) -> str:
-        """Execute SSH command on node."""
-        client = paramiko.SSHClient()
-        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        try:
-            client.connect(
-                self.nodes[node]['ip_tailscale'],
-                username=self.nodes[node]['username'],
-                key_filename=self.ssh_key_path,
-                timeout=10
-            )
-            stdin, stdout, stderr = client.exec_command(command)
-            result = stdout.read().decode().strip()
-            error = stderr.read().decode().strip()
-            if error:
-                logger.warning(f"SSH error on {node}: {error}")
-            return result
-        except Exception as e:
-            logger.error(f"SSH failed on {node}: {e}")
+    def _ssh_output(self, node: str, result) -> str:
+        if result.error:
+            logger.error(f"SSH failed on {node}: {result.error}")
             return ""
-        finally:
-            client.close()
+        if result.stderr.strip():
+            logger.warning(f"SSH error on {node}: {result.stderr.strip()}")
+        return result.stdout.strip()
+
+    async def ssh_command(self, node: str, command: str) -> str:
+        """Execute SSH command on node; stdout, or "" if the node could not be reached."""
+        return self._ssh_output(node, await self.ssh.run(node, command))
+
+    async def ssh_all(self, command: str) -> Dict[str, str]:
+        """Execute SSH command on every node concurrently."""
+        results = await self.ssh.run_all(command)
+        return {node: self._ssh_output(node, result) for node, result in results.items()}
+
+    async def close(self):
+        await self.telemetry.stop()
+        await self.ssh.close()
 
     async def validate_infrastructure(self) -> bool:
         """Validate all nodes are accessible and ready."""
         logger.info("Validating infrastructure...")
-        for node in self.nodes:
-            result = await self.ssh_command(node, "docker --version && nvidia-smi || echo 'No GPU'")
+        results = await self.ssh_all("docker --version && nvidia-smi || echo 'No GPU'")
+        valid = True
+        for node, result in results.items():
             if "docker" not in result:
                 logger.error(f"Node {node} validation failed")
-                return False
-            logger.info(f"Node {node} validated")
-        return True
+                valid = False
+            else:
+                logger.info(f"Node {node} validated")
+        return valid
+
+    def node_env(self, node: str) -> Dict[str, str]:
+        """Variables the orchestrator itself sets on a node's compose commands."""
+        return {'VLLM_MAX_NUM_SEQS': str(self.vllm_batch_size)} if node == 'starlord' else {}
+
+    def deployment_graph(self) -> DeployGraph:
+        """Per-node compose steps; dependencies follow depends_on and the cross-node URLs in the compose files."""
+        oracle, starlord, thanos = ("deploy/01-oracle-ARM.yml", "deploy/02-starlord-OPTIMIZED.yml",
+                                    "deploy/03-thanos-SECURED.yml")
+
+        def compose(name, node, compose_file, services, depends_on=()):
+            return DeployStep.compose(name, node, compose_file, services, depends_on, env=self.node_env(node))
 
-    async def deploy_services(self) -> bool:
-        """Deploy services to appropriate nodes."""
+        return DeployGraph([
+            compose('oracle-data', 'oracle', oracle, ['postgres', 'redis', 'consul', 'vault']),
+            compose('oracle-gateway', 'oracle', oracle, ['litellm', 'haproxy'], ['oracle-data']),
+            compose('oracle-apps', 'oracle', oracle, ['open-webui', 'pipelines'], ['oracle-gateway']),
+            compose('oracle-monitoring', 'oracle', oracle,
+                    ['prometheus', 'alertmanager', 'grafana', 'elasticsearch', 'logstash', 'kibana', 'cpu-inference']),
+            compose('starlord-storage', 'starlord', starlord, ['qdrant', 'qdrant-optimizer']),
+            compose('starlord-inference', 'starlord', starlord, ['vllm', 'model-manager', 'gpu-monitor', 'node-exporter']),
+            # Both keep state in Oracle's Redis and register with its Consul
+            compose('starlord-routing', 'starlord', starlord, ['cost-optimizer', 'request-router'],
+                    ['oracle-data', 'starlord-inference']),
+            compose('thanos-inference', 'thanos', thanos, ['vllm-backup', 'node-exporter', 'thermal-monitor']),
+            compose('thanos-apps', 'thanos', thanos, ['sillytavern', 'sillytavern-extras', 'gpt-researcher'],
+                    ['oracle-gateway']),
+            compose('thanos-rag', 'thanos', thanos, ['document-processor', 'rag-pipeline'],
+                    ['oracle-data', 'starlord-storage']),
+        ])
+
+    def _is_local(self, node: str) -> bool:
+        return node == 'starlord' and self.nodes['starlord']['ip_local'] == '192.168.68.130'  # Assume local
+
+    async def _run_step(self, step: DeployStep):
+        if step.compose_file and not step.services:
+            return True, "unchanged"
+        if self._is_local(step.node):
+            proc = await asyncio.create_subprocess_shell(
+                step.command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT)
+            output, _ = await proc.communicate()
+            return proc.returncode == 0, output.decode(errors="replace")
+        result = await self.ssh.run(step.node, step.remote_command, timeout=step.timeout)
+        if result.stderr.strip():
+            logger.warning(f"SSH error on {step.node}: {result.stderr.strip()}")
+        return result.ok, result.stdout if result.error is None else result.error
+
+    def _plan(self, graph: DeployGraph, force: bool = False, steps: Optional[List[str]] = None):
+        """{step: {service: (reasons, fingerprint)}} for the services each step has to (re)deploy."""
+        plan = {}
+        for name in graph.order:
+            step = graph.steps[name]
+            if steps is not None and name not in steps:
+                continue
+            plan[name] = {}
+            for service in step.services:
+                # Only what this step injects; the node's own .env and our shell are not fingerprinted
+                current = self.fingerprinter.service(step.compose_file, service, step.env)
+                reasons = changes(self.applied.get(step.node, step.compose_file, service), current)
+                if reasons or force:
+                    plan[name][service] = (reasons or ['forced'], current)
+        return plan
+
+    def plan_deploy(self, force: bool = False, steps: Optional[List[str]] = None) -> Dict[str, Dict[str, List[str]]]:
+        """Dry run: the services each step would (re)deploy and why; unchanged services are left out."""
+        plan = self._plan(self.deployment_graph(), force, steps)
+        return {name: {service: reasons for service, (reasons, _) in services.items()}
+                for name, services in plan.items()}
+
+    async def deploy_services(self, dry_run: bool = False, force: bool = False,
+                              steps: Optional[List[str]] = None) -> bool:
+        """
+        Deploy services to appropriate nodes, independent steps in parallel. Only services whose
+        compose definition, mounted config or env changed since they were last applied are sent;
+        `force` sends every service, `steps` limits the deploy to those graph steps.
+        """
         logger.info("Deploying services...")
-        # Deploy Oracle
-        await self.ssh_command('oracle', "cd /opt/ai-swarm && docker-compose -f deploy/01-oracle-ARM.yml up -d")
-        # Deploy Starlord (local)
-        if self.nodes['starlord']['ip_local'] == '192.168.68.130':  # Assume local
-            subprocess.run(["docker-compose", "-f", "deploy/02-starlord-OPTIMIZED.yml", "up", "-d"], check=True)
-        else:
-            await self.ssh_command('starlord', "cd /opt/ai-swarm && docker-compose -f deploy/02-starlord-OPTIMIZED.yml up -d")
-        # Deploy Thanos
-        await self.ssh_command('thanos', "cd /opt/ai-swarm && docker-compose -f deploy/03-thanos-SECURED.yml up -d")
+        graph = self.deployment_graph()
+        plan = self._plan(graph, force, steps)
+        if dry_run:
+            for name, services in plan.items():
+                for service, (reasons, _) in services.items():
+                    logger.info(f"[dry-run] {name}: {service} ({', '.join(reasons)})")
+            logger.info(f"[dry-run] {sum(map(len, plan.values()))} service(s) would be deployed")
+            return True
+        selected = []
+        for name, services in plan.items():
+            step = graph.steps[name]
+            # Compose cannot see a mounted config file change, so those containers are recreated
+            recreate = [svc for svc, (reasons, _) in services.items() if any(r.startswith('file:') for r in reasons)]
+            selected.append(DeployStep.compose(
+                name, step.node, step.compose_file, list(services), [d for d in step.depends_on if d in plan],
+                step.timeout, step.env, recreate))
+        report = await DeployGraph(selected).run(self._run_step, parallelism=self.deploy_parallelism)
+        self.last_deploy_report = report
+        for name, result in report.results.items():
+            if result.status == 'ok':
+                for service, (_, fingerprint) in plan[name].items():
+                    self.applied.record(result.step.node, result.step.compose_file, service, fingerprint)
+        self.applied.save()
+        logger.info("Deploy report:\n" + report.summary())
+        if not report.ok:
+            logger.error("Service deployment incomplete")
+            return False
         logger.info("Services deployed")
         return True
 
-    async def deploy(self):
+    async def deploy(self, force: bool = False):
         """Full deployment."""
         if not await self.validate_infrastructure():
             raise ValueError("Infrastructure validation failed")
-        if not await self.deploy_services():
+        if not await self.deploy_services(force=force):
             raise ValueError("Service deployment failed")
         logger.info("Deployment complete")
-        # Start auto-scaling
+        # Start telemetry and auto-scaling
+        self.telemetry.start()
         asyncio.create_task(self.auto_scale_vllm())
 
-    async def get_gpu_util(self) -> float:
-        """Get GPU utilization on Starlord."""
+    async def get_gpu_util(self) -> Optional[float]:
+        """Mean GPU utilization on Starlord over the telemetry window; None when it cannot be read."""
+        stats = self.telemetry.store.aggregate('starlord', 'utilization', self.util_window)
+        if stats is not None:
+            return stats.mean / 100.0
+        # No streamed samples yet: fall back to a one-shot query
         result = await self.ssh_command('starlord', "nvidia-smi --query-gpu=utilization.gpu --format=csv,noheader,nounits")
         try:
-            util = float(result.strip().strip('%')) / 100.0
-            return util
-        except:
-            return 0.0
+            values = [float(v.strip().strip('%')) for v in result.splitlines()]
+        except ValueError:
+            logger.warning(f"Unparseable GPU utilization from starlord: {result!r}")
+            return None
+        return sum(values) / len(values) / 100.0 if values else None
 
     async def adjust_vllm_batch(self, new_batch: int):
-        """Adjust vLLM batch size by restarting with new env."""
+        """Adjust vLLM batch size; vLLM is recreated only when the value actually changes."""
         if new_batch < self.min_batch or new_batch > self.max_batch:
             logger.warning(f"Batch size {new_batch} out of range [{self.min_batch}, {self.max_batch}]")
             return
-        self.vllm_batch_size = new_batch
-        # Restart vLLM with new batch
-        env_update = f"docker-compose -f deploy/02-starlord-OPTIMIZED.yml restart vllm"  # Simple restart; in prod, update env
-        await self.ssh_command('starlord', env_update)
+        if new_batch == self.vllm_batch_size:
+            return
+        previous, self.vllm_batch_size = self.vllm_batch_size, new_batch
+        # The batch size reaches vLLM as VLLM_MAX_NUM_SEQS, so the incremental deploy recreates vLLM alone
+        if not await self.deploy_services(steps=['starlord-inference']):
+            self.vllm_batch_size = previous
+            logger.error(f"vLLM batch size change to {new_batch} failed")
+            return
+        if self.router is not None:
+            self.router.backends['starlord-vllm'].capacity = new_batch
         logger.info(f"vLLM batch size adjusted to {new_batch}")
 
+    async def scaling_signals(self) -> Signals:
+        """Starlord's load over the telemetry window, as the scaling policy sees it."""
+        store = self.telemetry.store
+        queue = store.aggregate('starlord', 'queue_depth', self.util_window)
+        latency = store.aggregate('starlord', 'latency_p95_ms', self.util_window)
+        return Signals(await self.get_gpu_util(), queue.mean if queue else None, latency.max if latency else None)
+
+    async def scale_once(self) -> int:
+        """One scaling decision; returns the batch size in effect afterwards."""
+        signals = await self.scaling_signals()
+        new_batch = self.scaling_policy.decide(signals, self.vllm_batch_size, time.monotonic())
+        logger.info(f"Scaling signals {signals}: batch {self.vllm_batch_size} -> {new_batch}")
+        if new_batch != self.vllm_batch_size:
+            await self.adjust_vllm_batch(new_batch)
+        return self.vllm_batch_size
+
+    def build_router(self, spill_queue_depth: float = 4.0) -> 'SwarmRouter':
+        """Request router over the inference backends, spilling from the GPUs to Oracle's CPU server."""
+        from swarm_router import Backend, SwarmRouter
+
+        starlord, thanos, oracle = (self.nodes[n]['ip_tailscale'] for n in ('starlord', 'thanos', 'oracle'))
+        backends = [
+            Backend('starlord-vllm', f"http://{starlord}:8000", node='starlord', capacity=self.vllm_batch_size),
+            Backend('thanos-vllm', f"http://{thanos}:8002", node='thanos', capacity=8, latency_ms=1500.0),
+            Backend('oracle-cpu', f"http://{oracle}:8001", kind='cpu', node='oracle', capacity=4, latency_ms=5000.0),
+        ]
+
+        def queue_depth(backend: 'Backend') -> Optional[float]:
+            # vLLM's own waiting count also covers traffic that does not pass through the router
+            stats = self.telemetry.store.aggregate(backend.node, 'queue_depth', 15)
+            return stats.last if stats else None
+
+        self.router = SwarmRouter(backends, spill_queue_depth=spill_queue_depth, queue_depth=queue_depth)
+        return self.router
+
+    async def serve_router(self, port: int):
+        """Run the request router with live telemetry until interrupted."""
+        import uvicorn
+
+        from swarm_router import create_app
+
+        self.telemetry.start()
+        server = uvicorn.Server(uvicorn.Config(create_app(self.build_router()), host='0.0.0.0', port=port))
+        try:
+            await server.serve()
+        finally:
+            await self.close()
+
     async def auto_scale_vllm(self):
-        """Simple auto-scaling loop for vLLM batch size."""
-        logger.info("Starting vLLM auto-scaling monitor...")
+        """Auto-scaling loop for vLLM batch size."""
+        logger.info(f"Starting vLLM auto-scaling monitor ({self.scaling_policy.name} policy)...")
         while True:
-            util = await self.get_gpu_util()
-            logger.info(f"GPU util: {util:.2f}")
-            if util > self.scale_threshold:
-                new_batch = min(self.vllm_batch_size + 4, self.max_batch)
-                await self.adjust_vllm_batch(new_batch)
-            elif util < 0.3:
-                new_batch = max(self.vllm_batch_size - 4, self.min_batch)
-                await self.adjust_vllm_batch(new_batch)
-            await asyncio.sleep(60)  # Poll every minute
+            await self.scale_once()
+            await asyncio.sleep(self.scale_interval)
 
 # Pytest tests
 def test_orchestrator_init():
@@ -152,6 +325,125 @@ def test_gpu_util_mock():
     # Test would require patching, but basic check
     assert orch.scale_threshold == 0.8
 
+def test_ssh_command_through_pool(tmp_path):
+    from swarm_ssh import _LocalSSHServer
+    server = _LocalSSHServer(tmp_path)
+    orch = AISwarmOrchestrator(ssh_key_path=server.key_path)
+    orch.ssh = SSHPool({'starlord': server.node(), 'thanos': {**server.node(), 'port': 1}},
+                       key_path=server.key_path, connect_timeout=2)
+
+    async def scenario():
+        try:
+            return await orch.ssh_command('starlord', "echo 85"), await orch.ssh_command('thanos', "echo 85")
+        finally:
+            await orch.close()
+
+    try:
+        assert asyncio.run(scenario()) == ("85", "")
+    finally:
+        server.close()
+
+def test_gpu_util_from_telemetry_window():
+    orch = AISwarmOrchestrator()
+    for util in (70, 90):
+        orch.telemetry.store.record('starlord', 'utilization', util, device='0')
+    assert abs(asyncio.run(orch.get_gpu_util()) - 0.8) < 1e-9
+
+    orch = AISwarmOrchestrator()
+
+    async def garbled(node, command):
+        return "NVIDIA-SMI has failed"
+    orch.ssh_command = garbled
+    # A failed read is "unknown", not 0% utilization that would shrink the batch
+    assert asyncio.run(orch.get_gpu_util()) is None
+
+def test_scaling_uses_policy_and_telemetry(tmp_path):
+    orch = AISwarmOrchestrator(state_path=str(tmp_path / 'applied.json'))
+    orch.nodes['starlord']['ip_local'] = 'remote'
+    commands = []
+    orch.ssh = _fake_pool(commands)
+    for _ in range(5):
+        orch.telemetry.store.record('starlord', 'utilization', 97, device='0')
+        orch.telemetry.store.record('starlord', 'queue_depth', 9)
+
+    async def scenario():
+        return [await orch.scale_once() for _ in range(4)]
+
+    # Sustained pressure scales up once; the cooldown then holds the batch despite the same signals
+    assert asyncio.run(scenario()) == [16, 16, 20, 20]
+    assert len(commands) == 1 and 'VLLM_MAX_NUM_SEQS=20' in commands[0][1]
+
+def test_router_follows_batch_size_and_telemetry(tmp_path):
+    orch = AISwarmOrchestrator(state_path=str(tmp_path / 'applied.json'))
+    orch.nodes['starlord']['ip_local'] = 'remote'
+    orch.ssh = _fake_pool([])
+    router = orch.build_router(spill_queue_depth=4)
+    for backend in router.backends.values():
+        backend.models = {'llama'}
+    assert router.choose('llama').name == 'starlord-vllm'
+    # vLLM reports a deep queue: spill to the CPU server
+    orch.telemetry.store.record('starlord', 'queue_depth', 12)
+    orch.telemetry.store.record('thanos', 'queue_depth', 9)
+    assert router.choose('llama').name == 'oracle-cpu'
+    asyncio.run(orch.adjust_vllm_batch(24))
+    assert router.backends['starlord-vllm'].capacity == 24
+
+def _fake_pool(commands, failing=()):
+    from swarm_ssh import SSHResult
+
+    class FakePool:
+        async def run(self, node, command, timeout=None):
+            commands.append((node, command))
+            await asyncio.sleep(0.01)
+            return SSHResult(node, exit_status=1 if any(f in command for f in failing) else 0)
+
+    return FakePool()
+
+def test_deploy_services_runs_graph(tmp_path):
+    orch = AISwarmOrchestrator(state_path=str(tmp_path / 'applied.json'))
+    orch.nodes['starlord']['ip_local'] = 'remote'
+    commands = []
+    orch.ssh = _fake_pool(commands, failing=['qdrant'])
+    assert asyncio.run(orch.deploy_services()) is False
+    status = {name: r.status for name, r in orch.last_deploy_report.results.items()}
+    assert status['starlord-storage'] == 'failed' and status['thanos-rag'] == 'skipped'
+    assert status['thanos-apps'] == 'ok' and status['oracle-apps'] == 'ok'
+    started = [c for _, c in commands]
+    assert started.index(next(c for c in started if 'litellm' in c)) > \
+        started.index(next(c for c in started if 'postgres' in c))
+    assert all(c.startswith("cd /opt/ai-swarm && ") and "docker-compose -f deploy/" in c for c in started)
+
+def test_incremental_deploy_and_batch_changes(tmp_path):
+    orch = AISwarmOrchestrator(state_path=str(tmp_path / 'applied.json'))
+    orch.nodes['starlord']['ip_local'] = 'remote'
+    commands = []
+    orch.ssh = _fake_pool(commands)
+    assert asyncio.run(orch.deploy_services())
+    assert len(commands) == len(orch.deployment_graph().steps)
+    # Nothing changed: no command reaches any node, even for a freshly started orchestrator
+    commands.clear()
+    again = AISwarmOrchestrator(state_path=str(tmp_path / 'applied.json'))
+    again.nodes['starlord']['ip_local'] = 'remote'
+    again.ssh = _fake_pool(commands)
+    assert again.plan_deploy() == {name: {} for name in again.deployment_graph().order}
+    assert asyncio.run(again.deploy_services()) and commands == []
+    # A batch change recreates vLLM alone; asking for the same batch again sends nothing
+    asyncio.run(again.adjust_vllm_batch(20))
+    asyncio.run(again.adjust_vllm_batch(20))
+    assert commands == [('starlord', "cd /opt/ai-swarm && VLLM_MAX_NUM_SEQS=20 docker-compose "
+                                     "-f deploy/02-starlord-OPTIMIZED.yml up -d --no-deps vllm")]
+    assert again.plan_deploy(force=True)['oracle-data']['redis'] == ['forced']
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Deploy the AI swarm")
+    parser.add_argument("--dry-run", action="store_true", help="show what would be redeployed and why, then exit")
+    parser.add_argument("--force", action="store_true", help="send every service, changed or not")
+    parser.add_argument("--router", type=int, metavar="PORT", help="run the inference request router on PORT")
+    args = parser.parse_args()
     orchestrator = AISwarmOrchestrator()
-    asyncio.run(orchestrator.deploy())
\ No newline at end of file
+    if args.router:
+        asyncio.run(orchestrator.serve_router(args.router))
+    elif args.dry_run:
+        asyncio.run(orchestrator.deploy_services(dry_run=True, force=args.force))
+    else:
+        asyncio.run(orchestrator.deploy(force=args.force))
\ No newline at end of file
@@ -0,0 +1,354 @@
+#!/usr/bin/env python3
+"""
+ASGI serving mode for the ONNX CPU inference server - same endpoints as the Flask app, on uvicorn.
+Requires: pip install fastapi uvicorn (plus the cpu_inference_server requirements)
+Run: python cpu_inference_asgi.py  (or: uvicorn cpu_inference_asgi:app --port 8000, one worker per node;
+PREFORK_WORKERS=N runs N processes sharing the weights instead)
+
+Decoding already runs on each model's scheduler thread; request handlers only tokenize and load models,
+which goes through a bounded executor sized to the cores. Waiting for tokens never holds a thread:
+scheduler events are bridged into the event loop, so idle streaming connections cost a coroutine each.
+Admission control rejects early instead of letting latency grow:
+  429 when the model's scheduler queue is ASGI_MAX_QUEUE_DEPTH deep (client should back off)
+  503 when ASGI_MAX_IN_FLIGHT requests are open, or a request waited ASGI_QUEUE_TIMEOUT_MS for a batch slot
+"""
+
+import asyncio
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from starlette.background import BackgroundTask
+
+import cpu_inference_metrics as metrics
+import cpu_inference_server as server
+from cpu_inference_registry import ModelCapacityError
+from cpu_inference_server import ApiError, ChatChunks
+
+EXECUTOR_THREADS = int(os.getenv("ASGI_EXECUTOR_THREADS", str(os.cpu_count() or 1)))
+MAX_IN_FLIGHT = int(os.getenv("ASGI_MAX_IN_FLIGHT", "1024"))
+MAX_QUEUE_DEPTH = int(os.getenv("ASGI_MAX_QUEUE_DEPTH", str(4 * server.BATCH_MAX_SIZE)))
+QUEUE_TIMEOUT_MS = float(os.getenv("ASGI_QUEUE_TIMEOUT_MS", "10000"))
+
+executor = ThreadPoolExecutor(max_workers=EXECUTOR_THREADS, thread_name_prefix="inference")
+rejections = {"queue_full": 0, "in_flight": 0, "queue_timeout": 0}
+
+_in_flight = 0
+_in_flight_lock = threading.Lock()
+
+
+@asynccontextmanager
+async def lifespan(app):
+    # Serve /health (status "loading") while the preloaded models load
+    asyncio.get_running_loop().run_in_executor(executor, server.load_model)
+    yield
+
+
+app = FastAPI(title="ONNX CPU Inference Server", docs_url=None, redoc_url=None, lifespan=lifespan)
+
+
+async def run_blocking(fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(executor, fn, *args)
+
+
+def reject(status, reason, message):
+    rejections[reason] += 1
+    return ApiError(status, message)
+
+
+def error_response(e):
+    headers = {"Retry-After": "1"} if e.status in (429, 503) else None
+    return JSONResponse({"error": str(e)}, e.status, headers=headers)
+
+
+class Lease:
+    """
+    One admitted request: its in-flight slot, the pinned model and the scheduler handle.
+    `close()` is idempotent and safe to call from both the stream and its background task.
+    """
+
+    def __init__(self):
+        global _in_flight
+        with _in_flight_lock:
+            if _in_flight >= MAX_IN_FLIGHT:
+                raise reject(503, "in_flight", f"Server busy: {_in_flight} requests in flight")
+            _in_flight += 1
+        self.model = None
+        self.handle = None
+        self._changed = None
+        self._listener = None
+        self._closed = False
+
+    async def start(self, req, stream=False):
+        """Pin the model (cold-loading it if needed), tokenize, queue, and wait for a batch slot."""
+        self.model = await run_blocking(server.registry.checkout, req.model_id)
+        scheduler = self.model.scheduler
+        if scheduler.queue_depth >= MAX_QUEUE_DEPTH:
+            raise reject(429, "queue_full", f"{req.model_id} queue is full ({scheduler.queue_depth} waiting)")
+        seq = await run_blocking(server.prepare_sequence, self.model, req.messages, req.max_tokens,
+                                 req.sampling, req.stop)
+
+        loop = asyncio.get_running_loop()
+        self._changed = asyncio.Event()
+        self.handle = scheduler.submit(seq, stream=stream)
+        self._listener = lambda: loop.call_soon_threadsafe(self._changed.set)
+        self.handle.add_listener(self._listener)
+
+        deadline = self.handle.submitted_at + QUEUE_TIMEOUT_MS / 1000
+        while self.handle.admitted_at is None and not self.handle.done:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                raise reject(503, "queue_timeout", f"No batch slot for {req.model_id} within {QUEUE_TIMEOUT_MS:.0f}ms")
+            await self.changed(remaining)
+
+    async def changed(self, timeout=None):
+        """Wait until the scheduler reports progress on this request (or the timeout passes)."""
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            return
+        self._changed.clear()
+
+    async def result(self):
+        while not self.handle.done:
+            await self.changed()
+        return self.handle.wait()
+
+    async def deltas(self):
+        """Yield coalesced text deltas without blocking the event loop."""
+        while True:
+            parts = []
+            while True:
+                try:
+                    parts.append(self.handle.deltas.get_nowait())
+                except queue.Empty:
+                    break
+            done = None in parts
+            text = "".join(p for p in parts[:parts.index(None)] if p) if done else "".join(parts)
+            if text:
+                yield text
+            if done:
+                return
+            await self.changed()
+
+    def close(self):
+        global _in_flight
+        if self._closed:
+            return
+        self._closed = True
+        if self.handle is not None:
+            self.handle.remove_listener(self._listener)
+            if not self.handle.done:
+                # Client went away or the request was rejected while queued: free the batch slot
+                self.handle.cancel()
+        if self.model is not None:
+            server.registry.release(self.model)
+        with _in_flight_lock:
+            _in_flight -= 1
+
+
+async def cached_generate(req):
+    """Async twin of cpu_inference_server.cached_generate_response."""
+    key = server.response_cache_key(req)
+    if key is not None:
+        cached = await run_blocking(server.cached_result, key)
+        if cached is not None:
+            return cached, "hit"
+
+    lease = Lease()
+    try:
+        await lease.start(req)
+        result = server.finish_result(await lease.result())
+    finally:
+        lease.close()
+    if key is None:
+        return result, None
+    await run_blocking(server.store_result, key, result)
+    return result, "miss"
+
+
+async def stream_chat(req):
+    lease = Lease()
+    try:
+        await lease.start(req, stream=True)
+    except BaseException:
+        lease.close()
+        raise
+    chunks = ChatChunks(lease.model.id)
+
+    async def events():
+        with metrics.track_request("chat_stream"):
+            try:
+                yield chunks.role()
+                async for text in lease.deltas():
+                    event = chunks.content(text)
+                    if event:
+                        yield event
+                for event in chunks.finish(await lease.result(), req.include_usage):
+                    yield event
+            except Exception as e:
+                yield chunks.error(e)
+            finally:
+                lease.close()
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers=ChatChunks.HEADERS,
+                             background=BackgroundTask(lease.close))
+
+
+async def completion_endpoint(request, chat):
+    try:
+        req = server.parse_request(await request.json(), chat=chat)
+        if req.stream:
+            return await stream_chat(req)
+        with metrics.track_request("chat" if chat else "completions"):
+            result, cache_status = await cached_generate(req)
+        body = server.chat_completion_body(req, result) if chat else server.completion_body(req, result)
+        return JSONResponse(body, headers={"x-cache": cache_status} if cache_status else None)
+
+    except ApiError as e:
+        return error_response(e)
+    except ModelCapacityError as e:
+        return error_response(ApiError(503, str(e)))
+    except Exception as e:
+        print(f"❌ {'Chat completion' if chat else 'Completion'} error: {e}")
+        return JSONResponse({"error": str(e)}, 500)
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    """OpenAI-compatible chat completions endpoint"""
+    return await completion_endpoint(request, chat=True)
+
+
+@app.post("/v1/completions")
+async def completions(request: Request):
+    """OpenAI-compatible completions endpoint"""
+    return await completion_endpoint(request, chat=False)
+
+
+@app.get("/health")
+async def health_check():
+    body = server.health_body()
+    body["admission"] = {
+        "in_flight": _in_flight,
+        "max_in_flight": MAX_IN_FLIGHT,
+        "max_queue_depth": MAX_QUEUE_DEPTH,
+        "queue_timeout_ms": QUEUE_TIMEOUT_MS,
+        "executor_threads": EXECUTOR_THREADS,
+        "rejections": dict(rejections),
+    }
+    return body
+
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    body, content_type = metrics.exposition()
+    return Response(body, headers={"Content-Type": content_type})
+
+
+@app.get("/v1/models")
+async def list_models():
+    return server.models_body()
+
+
+@app.get("/")
+async def root():
+    return server.root_body()
+
+
+def main():
+    import uvicorn
+    print(f"🌐 Starting ASGI server on port {server.PORT} ({EXECUTOR_THREADS} executor threads, "
+          f"max {MAX_IN_FLIGHT} in flight, queue limit {MAX_QUEUE_DEPTH}, queue timeout {QUEUE_TIMEOUT_MS:.0f}ms)")
+    if server.PREFORK_WORKERS > 1:
+        # Forked after the master shares the weights, instead of uvicorn workers that each load their own
+        from cpu_inference_prefork import listen, serve
+        server.share_preloaded_models(server.PREFORK_WORKERS)
+        config = dict(host="0.0.0.0", port=server.PORT, timeout_keep_alive=30)
+        serve(listen("0.0.0.0", server.PORT), server.PREFORK_WORKERS,
+              lambda sock, index: uvicorn.Server(uvicorn.Config(app, **config)).run(sockets=[sock]))
+    else:
+        # One process: uvicorn workers would each hold their own copy of the models
+        uvicorn.run(app, host="0.0.0.0", port=server.PORT, workers=1, timeout_keep_alive=30)
+
+
+# Pytest tests
+def _asgi_call(scenario):
+    import httpx
+
+    async def run():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://asgi", timeout=30) as client:
+            return await scenario(client)
+
+    return asyncio.run(run())
+
+
+def test_asgi_endpoints_match_flask_app():
+    import json
+    server._use_stub_model()
+    payload = {"messages": [{"role": "user", "content": "hi"}], "max_tokens": 8, "temperature": 0}
+    expected = server.app.test_client().post("/v1/chat/completions", json=payload).get_json()
+
+    async def scenario(client):
+        chat = (await client.post("/v1/chat/completions", json=payload)).json()
+        stream = await client.post("/v1/chat/completions", json=dict(
+            payload, stream=True, stream_options={"include_usage": True}))
+        completion = await client.post("/v1/completions", json={"prompt": "hi", "max_tokens": 3})
+        missing = await client.post("/v1/completions", json={"prompt": "hi", "model": "nope"})
+        health = (await client.get("/health")).json()
+        return chat, stream, completion, missing, health
+
+    chat, stream, completion, missing, health = _asgi_call(scenario)
+    assert chat["choices"] == expected["choices"] and chat["usage"]["completion_tokens"] == 8
+    events = [line[len("data: "):] for line in stream.text.split("\n\n") if line]
+    assert stream.headers["content-type"].startswith("text/event-stream") and events[-1] == "[DONE]"
+    chunks = [json.loads(e) for e in events[:-1]]
+    content = "".join(c["choices"][0]["delta"].get("content", "") for c in chunks if c["choices"])
+    assert content == expected["choices"][0]["message"]["content"]
+    assert chunks[-1]["usage"]["completion_tokens"] == 8
+    assert completion.status_code == 200 and missing.status_code == 404
+    assert health["status"] == "healthy" and health["admission"]["in_flight"] == 0
+
+
+def test_overload_is_rejected_fast():
+    global MAX_QUEUE_DEPTH, QUEUE_TIMEOUT_MS
+    from cpu_inference_registry import LoadedModel
+    from cpu_inference_stub import StubSession, StubTokenizer
+    server._use_stub_model()
+    spec = server.registry.specs[server.registry.default_id]
+    # One batch slot, 20ms per forward pass: the first request holds the slot for ~0.4s
+    model = server.registry.install(LoadedModel(spec, StubSession(step_ms=20), StubTokenizer(), max_batch_size=1))
+    limits = MAX_QUEUE_DEPTH, QUEUE_TIMEOUT_MS
+    MAX_QUEUE_DEPTH, QUEUE_TIMEOUT_MS = 1, 100
+    payload = {"prompt": "hi", "max_tokens": 20, "temperature": 0}
+
+    async def scenario(client):
+        running = asyncio.create_task(client.post("/v1/completions", json=payload))
+        while model.scheduler.active_count == 0:
+            await asyncio.sleep(0.005)
+        queued = asyncio.create_task(client.post("/v1/completions", json=payload))
+        while model.scheduler.queue_depth == 0:
+            await asyncio.sleep(0.005)
+        start = time.perf_counter()
+        full = await client.post("/v1/completions", json=payload)
+        full_ms = (time.perf_counter() - start) * 1000
+        return await running, await queued, full, full_ms
+
+    try:
+        running, queued, full, full_ms = _asgi_call(scenario)
+    finally:
+        MAX_QUEUE_DEPTH, QUEUE_TIMEOUT_MS = limits
+    assert running.status_code == 200
+    assert queued.status_code == 503 and queued.headers["retry-after"] == "1"
+    assert full.status_code == 429 and full_ms < 100
+    assert _in_flight == 0 and model.in_use == 0
+
+
+if __name__ == "__main__":
+    main()
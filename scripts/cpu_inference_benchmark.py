@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+"""
+Load-generation benchmark for the CPU inference server's OpenAI-compatible endpoints.
+Replays a synthetic workload (prompt length distribution x concurrency levels x streaming modes)
+against /v1/chat/completions and /v1/completions and prints one JSON report, so runs can be diffed.
+
+Targets:
+  --url http://host:8001            an already running server
+  --stub                            in-process server on the deterministic stub session (no model)
+  --model-dir DIR --tokenizer NAME  in-process server on a local ONNX export
+In-process servers run the Flask app by default, or the ASGI app on uvicorn with --server asgi.
+
+Examples:
+  python cpu_inference_benchmark.py --stub --concurrency 1,4,8 --requests 64 --stream both
+  python cpu_inference_benchmark.py --url http://localhost:8001 --prompt-words lognormal:4:0.8 -o run.json
+
+Prompt lengths are drawn in words (roughly one token each for the short words used here).
+"""
+
+import argparse
+import http.client
+import json
+import logging
+import math
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+from urllib.parse import urlparse
+
+WORDS = ("the node model cache token batch query answer swarm oracle latency vector prompt stream "
+         "server local quick small test value input output router metric graph").split()
+
+
+def percentiles(values: List[float]) -> Optional[Dict[str, float]]:
+    """p50/p95/p99/mean with linear interpolation; None when there are no samples."""
+    if not values:
+        return None
+    ordered = sorted(values)
+
+    def pick(q):
+        pos = (len(ordered) - 1) * q
+        lo, hi = math.floor(pos), math.ceil(pos)
+        return ordered[lo] + (ordered[hi] - ordered[lo]) * (pos - lo)
+
+    return {
+        "p50": round(pick(0.50), 2),
+        "p95": round(pick(0.95), 2),
+        "p99": round(pick(0.99), 2),
+        "mean": round(sum(ordered) / len(ordered), 2),
+    }
+
+
+def prompt_lengths(spec: str, count: int, rng: random.Random) -> List[int]:
+    """`fixed:N`, `uniform:LO:HI` or `lognormal:MU:SIGMA` (in words, at least 1)."""
+    kind, *args = spec.split(":")
+    if kind == "fixed":
+        return [int(args[0])] * count
+    if kind == "uniform":
+        return [rng.randint(int(args[0]), int(args[1])) for _ in range(count)]
+    if kind == "lognormal":
+        return [max(1, int(rng.lognormvariate(float(args[0]), float(args[1])))) for _ in range(count)]
+    raise ValueError(f"Unknown prompt length distribution: {spec}")
+
+
+def make_prompt(words: int, rng: random.Random) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(words))
+
+
+class Client:
+    """Minimal stdlib HTTP client; one keep-alive connection per worker thread."""
+
+    def __init__(self, base_url: str, timeout: float):
+        parsed = urlparse(base_url)
+        self.host, self.port = parsed.hostname, parsed.port or 80
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _conn(self) -> http.client.HTTPConnection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        return conn
+
+    def post(self, path: str, body: dict, stream: bool) -> dict:
+        """Send one request and return its timing sample."""
+        conn = self._conn()
+        start = time.perf_counter()
+        try:
+            conn.request("POST", path, json.dumps(body), {"Content-Type": "application/json"})
+            resp = conn.getresponse()
+            if resp.status != 200:
+                resp.read()
+                return {"ok": False, "status": resp.status, "latency_ms": (time.perf_counter() - start) * 1000}
+            if not stream:
+                data = json.loads(resp.read())
+                return {
+                    "ok": True,
+                    "latency_ms": (time.perf_counter() - start) * 1000,
+                    "completion_tokens": data.get("usage", {}).get("completion_tokens", 0),
+                }
+            return self._read_stream(resp, start)
+        except (OSError, http.client.HTTPException) as e:
+            conn.close()
+            self._local.conn = None
+            return {"ok": False, "error": str(e), "latency_ms": (time.perf_counter() - start) * 1000}
+
+    @staticmethod
+    def _read_stream(resp, start: float) -> dict:
+        ttft, last, gaps, tokens = None, None, [], 0
+        for raw in resp:
+            line = raw.decode().strip()
+            if not line.startswith("data: "):
+                continue
+            payload = line[len("data: "):]
+            if payload == "[DONE]":
+                break
+            event = json.loads(payload)
+            if event.get("usage"):
+                tokens = event["usage"].get("completion_tokens", tokens)
+            choices = event.get("choices") or [{}]
+            if choices[0].get("delta", {}).get("content"):
+                now = time.perf_counter()
+                if ttft is None:
+                    ttft = (now - start) * 1000
+                else:
+                    gaps.append((now - last) * 1000)
+                last = now
+        return {
+            "ok": True,
+            "latency_ms": (time.perf_counter() - start) * 1000,
+            "ttft_ms": ttft,
+            "itl_ms": gaps,
+            "completion_tokens": tokens,
+        }
+
+
+def build_request(endpoint: str, prompt: str, max_tokens: int, stream: bool) -> tuple:
+    body = {"max_tokens": max_tokens, "temperature": 0.7}
+    if endpoint == "chat":
+        body["messages"] = [{"role": "user", "content": prompt}]
+        if stream:
+            body.update(stream=True, stream_options={"include_usage": True})
+        return "/v1/chat/completions", body
+    body["prompt"] = prompt
+    return "/v1/completions", body
+
+
+def run_scenario(client: Client, endpoint: str, stream: bool, concurrency: int, prompts: List[str],
+                 max_tokens: int) -> dict:
+    """Fire every prompt through `concurrency` workers and aggregate the samples."""
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        samples = list(pool.map(
+            lambda p: client.post(*build_request(endpoint, p, max_tokens, stream), stream=stream), prompts
+        ))
+    duration = time.perf_counter() - start
+
+    ok = [s for s in samples if s["ok"]]
+    tokens = sum(s.get("completion_tokens", 0) for s in ok)
+    return {
+        "endpoint": endpoint,
+        "stream": stream,
+        "concurrency": concurrency,
+        "requests": len(samples),
+        "errors": len(samples) - len(ok),
+        "duration_s": round(duration, 3),
+        "throughput_rps": round(len(ok) / duration, 3) if duration else 0.0,
+        "tokens_per_sec": round(tokens / duration, 2) if duration else 0.0,
+        "completion_tokens": tokens,
+        "latency_ms": percentiles([s["latency_ms"] for s in ok]),
+        "ttft_ms": percentiles([s["ttft_ms"] for s in ok if s.get("ttft_ms") is not None]),
+        "itl_ms": percentiles([gap for s in ok for gap in s.get("itl_ms", [])]),
+    }
+
+
+def start_local_server(args) -> str:
+    """Run cpu_inference_server in-process on a free port and return its base URL."""
+    if args.model_dir:
+        os.environ["ONNX_MODEL_PATH"] = args.model_dir
+        os.environ["MODEL_NAME"] = args.tokenizer or args.model_dir
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import cpu_inference_server as server
+    from werkzeug.serving import make_server
+
+    if args.model_dir:
+        if not server.load_model():
+            raise SystemExit("Failed to load model")
+    else:
+        from cpu_inference_stub import StubSession, StubTokenizer
+        server.install_model(StubSession(step_ms=args.stub_step_ms, token_ms=args.stub_token_ms), StubTokenizer())
+        server.model_ready = True
+
+    if args.server == "asgi":
+        return start_asgi_server()
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    httpd = make_server("127.0.0.1", 0, server.app, threaded=True)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{httpd.server_port}"
+
+
+def start_asgi_server() -> str:
+    import socket
+    import uvicorn
+    import cpu_inference_asgi
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    # Lifespan off: the model is already installed, the app must not start its own preload
+    config = uvicorn.Config(cpu_inference_asgi.app, log_level="warning", lifespan="off")
+    threading.Thread(target=uvicorn.Server(config).run, kwargs={"sockets": [sock]}, daemon=True).start()
+    base_url = f"http://127.0.0.1:{sock.getsockname()[1]}"
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", sock.getsockname()[1], timeout=1)
+            conn.request("GET", "/health")
+            if conn.getresponse().status == 200:
+                return base_url
+        except OSError:
+            time.sleep(0.05)
+    raise SystemExit("ASGI server did not start")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--url", help="Base URL of a running server")
+    target.add_argument("--stub", action="store_true", help="Benchmark an in-process server on the stub session")
+    target.add_argument("--model-dir", help="Benchmark an in-process server on a local ONNX export")
+    parser.add_argument("--tokenizer", help="Tokenizer name or path for --model-dir")
+    parser.add_argument("--server", choices=["flask", "asgi"], default="flask", help="In-process serving mode")
+    parser.add_argument("--endpoint", choices=["chat", "completions", "both"], default="chat")
+    parser.add_argument("--stream", choices=["true", "false", "both"], default="both",
+                        help="Streaming applies to the chat endpoint only")
+    parser.add_argument("--concurrency", default="1,4", help="Comma-separated concurrency levels")
+    parser.add_argument("--requests", type=int, default=32, help="Requests per scenario")
+    parser.add_argument("--prompt-words", default="uniform:8:64", help="fixed:N | uniform:LO:HI | lognormal:MU:SIGMA")
+    parser.add_argument("--max-tokens", type=int, default=32)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--stub-step-ms", type=float, default=5.0, help="Stub cost per forward pass")
+    parser.add_argument("--stub-token-ms", type=float, default=0.2, help="Stub cost per input token")
+    parser.add_argument("-o", "--output", help="Write the JSON report here instead of stdout")
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> dict:
+    args = parse_args(argv)
+    base_url = args.url or start_local_server(args)
+    client = Client(base_url, args.timeout)
+    rng = random.Random(args.seed)
+    prompts = [make_prompt(n, rng) for n in prompt_lengths(args.prompt_words, args.requests, rng)]
+
+    endpoints = ["chat", "completions"] if args.endpoint == "both" else [args.endpoint]
+    modes = {"true": [True], "false": [False], "both": [False, True]}[args.stream]
+    runs = []
+    for endpoint in endpoints:
+        for stream in (modes if endpoint == "chat" else [False]):
+            for concurrency in (int(c) for c in args.concurrency.split(",")):
+                runs.append(run_scenario(client, endpoint, stream, concurrency, prompts, args.max_tokens))
+                print(f"✅ {endpoint} stream={stream} concurrency={concurrency}: "
+                      f"{runs[-1]['tokens_per_sec']} tok/s", file=sys.stderr)
+
+    report = {
+        "target": "stub" if args.stub else (args.model_dir or args.url),
+        "server": None if args.url else args.server,
+        "workload": {
+            "requests": args.requests,
+            "prompt_words": args.prompt_words,
+            "max_tokens": args.max_tokens,
+            "seed": args.seed,
+        },
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "runs": runs,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    return report
+
+
+# Pytest tests
+def test_percentiles_interpolate():
+    assert percentiles([]) is None
+    stats = percentiles([float(v) for v in range(1, 101)])
+    assert stats["p50"] == 50.5 and stats["p99"] == 99.01 and stats["mean"] == 50.5
+
+
+def test_stub_benchmark_reports_every_scenario(tmp_path):
+    out = tmp_path / "report.json"
+    main(["--stub", "--endpoint", "both", "--concurrency", "1,3", "--requests", "6", "--max-tokens", "4",
+          "--stub-step-ms", "0", "--stub-token-ms", "0", "-o", str(out)])
+    report = json.loads(out.read_text())
+    scenarios = [(r["endpoint"], r["stream"], r["concurrency"]) for r in report["runs"]]
+    assert scenarios == [("chat", False, 1), ("chat", False, 3), ("chat", True, 1), ("chat", True, 3),
+                         ("completions", False, 1), ("completions", False, 3)]
+    for run in report["runs"]:
+        assert run["errors"] == 0 and run["completion_tokens"] > 0 and run["latency_ms"]["p50"] > 0
+    assert all(r["ttft_ms"] for r in report["runs"] if r["stream"])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+"""
+Caches for the ONNX CPU inference server.
+PrefixCache keeps KV tensors of finished sequences in a token-id trie so a follow-up request that
+resends the same system prompt / conversation history only prefills its new suffix.
+ResponseCache returns stored completions for repeated deterministic requests without touching the
+tokenizer or the session, in process or shared through Redis.
+"""
+
+import hashlib
+import itertools
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+
+class _TrieNode:
+    __slots__ = ("children", "entries")
+
+    def __init__(self):
+        self.children: Dict[int, "_TrieNode"] = {}
+        # Ids of cached entries whose token path runs through this node
+        self.entries = set()
+
+
+class PrefixCache:
+    """
+    Longest-prefix KV cache keyed on token ids, LRU-evicted under a byte budget.
+    Any entry passing through the deepest matched trie node covers the matched prefix, so a stored
+    conversation also serves shorter shared prefixes (e.g. just the system prompt) by slicing its KV.
+    Not thread-safe: only the scheduler thread touches it.
+    """
+
+    def __init__(self, max_bytes: int, min_prefix_tokens: int = 8):
+        self.max_bytes = max_bytes
+        self.min_prefix_tokens = min_prefix_tokens
+        self._root = _TrieNode()
+        self._entries: "OrderedDict[int, Tuple[Tuple[int, ...], List[np.ndarray], int]]" = OrderedDict()
+        self._ids = itertools.count()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.hit_tokens = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "entries": len(self._entries),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "reused_tokens": self.hit_tokens,
+            "evictions": self.evictions,
+        }
+
+    def lookup(self, token_ids: List[int]) -> Tuple[int, Optional[List[np.ndarray]]]:
+        """
+        Return (matched length, KV tensors covering it) for the longest cached prefix of token_ids.
+        At least one token is always left unmatched so the caller gets logits for the last position.
+        """
+        if not self.enabled:
+            return 0, None
+        node, depth = self._root, 0
+        for token in token_ids[:-1]:
+            child = node.children.get(token)
+            if child is None:
+                break
+            node, depth = child, depth + 1
+        if depth < self.min_prefix_tokens:
+            self.misses += 1
+            return 0, None
+
+        # Ids grow monotonically, so the largest is the newest entry covering this prefix
+        entry_id = max(node.entries)
+        self._entries.move_to_end(entry_id)
+        _, past, _ = self._entries[entry_id]
+        self.hits += 1
+        self.hit_tokens += depth
+        return depth, [np.ascontiguousarray(p[:, :, :depth]) for p in past]
+
+    def insert(self, token_ids: List[int], past: List[np.ndarray]) -> None:
+        """Store KV tensors for token_ids (past holds exactly len(token_ids) positions)."""
+        if not self.enabled or len(token_ids) < self.min_prefix_tokens:
+            return
+        nbytes = sum(p.nbytes for p in past)
+        if nbytes > self.max_bytes:
+            return
+
+        node, path = self._root, []
+        for token in token_ids:
+            node = node.children.get(token)
+            if node is None:
+                break
+            path.append(node)
+        else:
+            if node.entries:
+                # An existing entry already covers this whole sequence
+                for entry_id in node.entries:
+                    self._entries.move_to_end(entry_id)
+                return
+
+        # Entries that end on this path are superseded by the longer sequence
+        superseded = {
+            entry_id for n in path for entry_id in n.entries
+            if len(self._entries[entry_id][0]) <= len(token_ids)
+            and self._entries[entry_id][0] == tuple(token_ids[:len(self._entries[entry_id][0])])
+        }
+        for entry_id in superseded:
+            self._remove(entry_id)
+
+        entry_id = next(self._ids)
+        key = tuple(token_ids)
+        self._entries[entry_id] = (key, past, nbytes)
+        self.bytes += nbytes
+        node = self._root
+        for token in key:
+            node = node.children.setdefault(token, _TrieNode())
+            node.entries.add(entry_id)
+
+        while self.bytes > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def clear(self) -> None:
+        """Drop all entries and counters, e.g. when the model is reloaded."""
+        self._root = _TrieNode()
+        self._entries.clear()
+        self.bytes = 0
+        self.hits = self.misses = self.hit_tokens = self.evictions = 0
+
+    def _remove(self, entry_id: int) -> None:
+        key, _, nbytes = self._entries.pop(entry_id)
+        self.bytes -= nbytes
+        node = self._root
+        for token in key:
+            child = node.children[token]
+            child.entries.discard(entry_id)
+            if not child.entries:
+                del node.children[token]
+                break
+            node = child
+
+
+class ResponseCache:
+    """
+    Exact-match completion cache with TTL. In-process it is an LRU bounded to max_entries; with a
+    Redis URL entries are shared between replicas and bounded by TTL and Redis' own maxmemory policy.
+    Redis errors are logged and treated as misses so the cache can never fail a request.
+    """
+
+    def __init__(self, ttl_seconds: float = 300, max_entries: int = 1024, redis_url: Optional[str] = None,
+                 redis_client=None, namespace: str = "cpu-inference:response:", clock=time.monotonic):
+        self.ttl = ttl_seconds
+        self.max_entries = max_entries
+        self.namespace = namespace
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+        self._redis = redis_client
+        if self._redis is None and redis_url:
+            import redis
+            self._redis = redis.Redis.from_url(redis_url, socket_timeout=0.5)
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def backend(self) -> str:
+        return "redis" if self._redis is not None else "memory"
+
+    @staticmethod
+    def make_key(**request: Any) -> str:
+        """Stable digest of the normalized request (prompt text plus sampling parameters)."""
+        blob = json.dumps(request, sort_keys=True, separators=(",", ":"), default=str)
+        return hashlib.sha256(blob.encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        value = self._redis_get(key) if self._redis is not None else self._memory_get(key)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, key: str, value: Dict[str, Any]) -> None:
+        if self._redis is not None:
+            try:
+                self._redis.setex(self.namespace + key, max(1, int(self.ttl)), json.dumps(value))
+            except Exception as e:
+                print(f"⚠️  Response cache write failed: {e}")
+            return
+        with self._lock:
+            self._entries[key] = (self._clock() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "backend": self.backend,
+            "entries": len(self._entries) if self._redis is None else None,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+    def _memory_get(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at <= self._clock():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def _redis_get(self, key: str) -> Optional[Dict[str, Any]]:
+        try:
+            raw = self._redis.get(self.namespace + key)
+        except Exception as e:
+            print(f"⚠️  Response cache read failed: {e}")
+            return None
+        return json.loads(raw) if raw else None
+
+
+# Pytest tests
+def _fake_past(token_ids, layers=2):
+    kv = np.zeros((1, 1, len(token_ids), 2), dtype=np.float32)
+    kv[0, 0, :, 0] = token_ids
+    return [kv.copy() for _ in range(layers)]
+
+
+def test_prefix_lookup_slices_longest_match():
+    cache = PrefixCache(max_bytes=1 << 20, min_prefix_tokens=2)
+    history = [5, 6, 7, 8, 9]
+    cache.insert(history, _fake_past(history))
+    depth, past = cache.lookup([5, 6, 7, 1, 2])
+    assert depth == 3 and past[0][0, 0, :, 0].tolist() == [5, 6, 7]
+    # Full match still leaves the last token to prefill
+    depth, _ = cache.lookup(history)
+    assert depth == 4
+    assert cache.lookup([1, 2, 3]) == (0, None)
+    assert (cache.hits, cache.misses) == (2, 1)
+
+
+def test_lru_eviction_under_byte_budget():
+    entry_bytes = sum(p.nbytes for p in _fake_past(range(10)))
+    cache = PrefixCache(max_bytes=2 * entry_bytes, min_prefix_tokens=2)
+    for start in (100, 200, 300):
+        cache.insert(list(range(start, start + 10)), _fake_past(range(start, start + 10)))
+    assert cache.bytes <= cache.max_bytes and cache.evictions == 1
+    assert cache.lookup(list(range(100, 110)))[0] == 0
+    assert cache.lookup(list(range(300, 311)))[0] == 10
+
+    # A longer turn of the same conversation replaces the shorter entry
+    cache.insert(list(range(300, 315)), _fake_past(range(300, 315)))
+    assert cache.stats()["entries"] == 1
+    assert cache.lookup(list(range(300, 320)))[0] == 15
+
+
+def test_response_cache_ttl_and_lru():
+    now = [0.0]
+    cache = ResponseCache(ttl_seconds=10, max_entries=2, clock=lambda: now[0])
+    keys = [ResponseCache.make_key(prompt=p, temperature=0) for p in ("a", "b", "c")]
+    assert keys[0] == ResponseCache.make_key(temperature=0, prompt="a")
+    cache.set(keys[0], {"text": "A"})
+    cache.set(keys[1], {"text": "B"})
+    assert cache.get(keys[0]) == {"text": "A"}
+    cache.set(keys[2], {"text": "C"})  # evicts the least recently used entry, B
+    assert cache.get(keys[1]) is None
+    now[0] = 11
+    assert cache.get(keys[0]) is None and cache.stats()["entries"] == 1
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+def test_response_cache_redis_backend():
+    class FakeRedis:
+        def __init__(self):
+            self.data, self.ttls = {}, {}
+
+        def get(self, key):
+            return self.data.get(key)
+
+        def setex(self, key, ttl, value):
+            self.data[key], self.ttls[key] = value.encode(), ttl
+
+    fake = FakeRedis()
+    cache = ResponseCache(ttl_seconds=60, redis_client=fake)
+    cache.set("k", {"text": "shared"})
+    assert fake.ttls == {"cpu-inference:response:k": 60}
+    assert ResponseCache(redis_client=fake).get("k") == {"text": "shared"}
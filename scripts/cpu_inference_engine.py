@@ -0,0 +1,337 @@
+#!/usr/bin/env python3
+"""
+Generation engine for the ONNX CPU inference server.
+Incremental autoregressive decoding: the prompt is prefilled once, then every decode step feeds only
+the newest token plus the returned `present.*` tensors back in as `past_key_values.*`, so a step costs
+O(1) new tokens instead of re-running the whole prefix.
+Works with optimum exports made with `--task text-generation-with-past` (plain or merged decoder);
+models exported without past inputs fall back to full recompute per step.
+"""
+
+import json
+import os
+import re
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from cpu_inference_sampling import SamplingParams, sample_sequences
+
+_ORT_FLOAT_TYPES = {
+    "tensor(float)": np.float32,
+    "tensor(float16)": np.float16,
+    "tensor(double)": np.float64,
+}
+
+
+def _layer_key(name: str):
+    """Sort `past_key_values.10.key` after `past_key_values.9.value`."""
+    match = re.search(r"\.(\d+)\.(key|value)$", name)
+    return (int(match.group(1)), match.group(2)) if match else (0, name)
+
+
+def load_model_config(model_path: str) -> Dict:
+    """Read the config.json optimum writes next to model.onnx (empty dict if absent)."""
+    config_path = os.path.join(model_path, "config.json")
+    if not os.path.exists(config_path):
+        return {}
+    with open(config_path) as f:
+        return json.load(f)
+
+
+class DecoderIO:
+    """Maps an ONNX decoder session's signature to feeds and outputs for cached decoding."""
+
+    def __init__(self, session, config: Optional[Dict] = None):
+        config = config or {}
+        self.session = session
+        inputs = {i.name: i for i in session.get_inputs()}
+        self.input_names = set(inputs)
+        self.output_names = [o.name for o in session.get_outputs()]
+        self.past_names = sorted((n for n in inputs if n.startswith("past_key_values.")), key=_layer_key)
+        self.present_names = [n.replace("past_key_values.", "present.", 1) for n in self.past_names]
+        missing = [n for n in self.present_names if n not in self.output_names]
+        if missing:
+            raise ValueError(f"ONNX model has past inputs but no matching outputs: {missing[:2]}")
+        self.has_past = bool(self.past_names)
+
+        self.num_heads = None
+        self.head_dim = None
+        self.past_dtype = np.float32
+        if self.has_past:
+            first = inputs[self.past_names[0]]
+            self.past_dtype = _ORT_FLOAT_TYPES.get(first.type, np.float32)
+            heads, head_dim = first.shape[1], first.shape[3]
+            hidden = config.get("n_embd") or config.get("hidden_size")
+            if not isinstance(heads, int):
+                heads = config.get("num_key_value_heads") or config.get("n_head") or config.get("num_attention_heads")
+            if not isinstance(head_dim, int):
+                head_dim = config.get("head_dim") or (
+                    hidden // (config.get("n_head") or config.get("num_attention_heads")) if hidden else None
+                )
+            if not heads or not head_dim:
+                raise ValueError("Cannot infer KV cache shape; export config.json alongside model.onnx")
+            self.num_heads, self.head_dim = int(heads), int(head_dim)
+
+    def empty_past(self, batch: int = 1) -> List[np.ndarray]:
+        shape = (batch, self.num_heads, 0, self.head_dim)
+        return [np.zeros(shape, dtype=self.past_dtype) for _ in self.past_names]
+
+    def run(self, input_ids: np.ndarray, attention_mask: np.ndarray, position_ids: np.ndarray,
+            past: Optional[List[np.ndarray]]):
+        """One forward pass. Returns (logits [batch, new, vocab], present tensors or None)."""
+        feeds = {"input_ids": input_ids.astype(np.int64)}
+        if "attention_mask" in self.input_names:
+            feeds["attention_mask"] = attention_mask.astype(np.int64)
+        if "position_ids" in self.input_names:
+            feeds["position_ids"] = position_ids.astype(np.int64)
+        if self.has_past:
+            if past is None:
+                past = self.empty_past(input_ids.shape[0])
+            feeds.update(zip(self.past_names, past))
+            if "use_cache_branch" in self.input_names:
+                feeds["use_cache_branch"] = np.array([past[0].shape[2] > 0])
+        outputs = dict(zip(self.output_names, self.session.run(self.output_names, feeds)))
+        presents = [outputs[n] for n in self.present_names] if self.has_past else None
+        return outputs["logits"], presents
+
+
+@dataclass
+class GenerationResult:
+    text: str
+    prompt_tokens: int
+    completion_tokens: int
+    finish_reason: str
+    prefill_ms: float
+    decode_ms: float
+    cached_tokens: int = 0
+    draft_tokens: int = 0
+    accepted_tokens: int = 0
+
+    @property
+    def timings(self) -> Dict[str, float]:
+        decode_steps = max(self.completion_tokens - 1, 0)
+        timings = {
+            "prefill_ms": round(self.prefill_ms, 2),
+            "decode_ms": round(self.decode_ms, 2),
+            "decode_tokens_per_sec": round(decode_steps / (self.decode_ms / 1000), 2) if self.decode_ms else 0.0,
+        }
+        if self.draft_tokens:
+            # Speculative decoding: share of draft-model proposals the main model kept
+            timings.update(
+                draft_tokens=self.draft_tokens,
+                accepted_draft_tokens=self.accepted_tokens,
+                draft_acceptance_rate=round(self.accepted_tokens / self.draft_tokens, 4),
+            )
+        return timings
+
+
+@dataclass
+class Sequence:
+    """Decoding state of one request: prompt, generated tokens, KV cache and stop conditions."""
+
+    prompt_ids: List[int]
+    max_tokens: int
+    eos_token_id: Optional[int] = None
+    stop: List[str] = field(default_factory=list)
+    sampling: SamplingParams = field(default_factory=lambda: SamplingParams(temperature=0.0))
+    generated_ids: List[int] = field(default_factory=list)
+    past: Optional[List[np.ndarray]] = None
+    finish_reason: Optional[str] = None
+    text: str = ""
+    prefill_ms: float = 0.0
+    decode_ms: float = 0.0
+    emitted: int = 0
+    cached_tokens: int = 0
+    # Speculative decoding: the draft model's own KV cache and its proposal counters
+    draft_past: Optional[List[np.ndarray]] = None
+    draft_tokens: int = 0
+    accepted_tokens: int = 0
+
+    @property
+    def finished(self) -> bool:
+        return self.finish_reason is not None
+
+    @property
+    def context_len(self) -> int:
+        """Tokens already held in the KV cache."""
+        return 0 if self.past is None else self.past[0].shape[2]
+
+    def append(self, token_id: int, tokenizer) -> None:
+        """Record a sampled token and check EOS, stop sequences and the token budget."""
+        if self.eos_token_id is not None and token_id == self.eos_token_id:
+            self.finish_reason = "stop"
+            return
+        self.generated_ids.append(token_id)
+        if self.stop:
+            checked = len(self.text)
+            self.text = tokenizer.decode(self.generated_ids, skip_special_tokens=True)
+            for stop in self.stop:
+                idx = self.text.find(stop, max(0, checked - len(stop)))
+                if idx != -1:
+                    self.text = self.text[:idx]
+                    self.finish_reason = "stop"
+                    return
+        if len(self.generated_ids) >= self.max_tokens:
+            self.finish_reason = "length"
+
+    def pop_delta(self, tokenizer, final: bool = False) -> str:
+        """
+        Text decoded since the last call, for streaming. Until the sequence is final, an incomplete
+        UTF-8 character and any tail that could still grow into a stop sequence are held back.
+        """
+        if not self.stop:
+            self.text = tokenizer.decode(self.generated_ids, skip_special_tokens=True)
+        safe = len(self.text)
+        if not final:
+            safe = len(self.text.rstrip("\ufffd"))
+            holdback = 0
+            for stop in self.stop:
+                for k in range(min(len(stop) - 1, safe), 0, -1):
+                    if self.text.endswith(stop[:k], 0, safe):
+                        holdback = max(holdback, k)
+                        break
+            safe -= holdback
+        delta = self.text[self.emitted:safe]
+        self.emitted = max(self.emitted, safe)
+        return delta
+
+    def result(self, tokenizer) -> GenerationResult:
+        if not self.stop:
+            self.text = tokenizer.decode(self.generated_ids, skip_special_tokens=True)
+        return GenerationResult(
+            text=self.text,
+            prompt_tokens=len(self.prompt_ids),
+            completion_tokens=len(self.generated_ids),
+            finish_reason=self.finish_reason or "length",
+            prefill_ms=self.prefill_ms,
+            decode_ms=self.decode_ms,
+            cached_tokens=self.cached_tokens,
+            draft_tokens=self.draft_tokens,
+            accepted_tokens=self.accepted_tokens,
+        )
+
+
+def forward_batch(io: DecoderIO, seqs: List[Sequence], new_ids: List[List[int]], past_attr: str = "past",
+                  all_positions: bool = False) -> np.ndarray:
+    """
+    Run one forward pass over several sequences with different cache and input lengths.
+    Row layout is [left pad | cached past | new tokens | right pad]: pads are masked out of attention,
+    position ids follow each row's real length, and right pads are never attended by real tokens under
+    the causal mask. Each sequence keeps only its own slice of the returned KV cache.
+    Returns last-real-position logits shaped [batch, vocab], or [batch, new, vocab] logits for every
+    new position with `all_positions`. `past_attr` names the Sequence field holding this model's KV
+    cache (`draft_past` for a speculative draft model).
+    """
+    if not io.has_past:
+        # No KV outputs in this export: recompute the full context every step.
+        new_ids = [seq.prompt_ids + seq.generated_ids for seq in seqs]
+    batch = len(seqs)
+    seq_pasts = [getattr(seq, past_attr) for seq in seqs]
+    past_lens = [0 if past is None else past[0].shape[2] for past in seq_pasts]
+    new_lens = [len(ids) for ids in new_ids]
+    max_past, max_new = max(past_lens), max(new_lens)
+
+    input_ids = np.zeros((batch, max_new), dtype=np.int64)
+    attention_mask = np.zeros((batch, max_past + max_new), dtype=np.int64)
+    position_ids = np.zeros((batch, max_new), dtype=np.int64)
+    for row, (ids, past_len, new_len) in enumerate(zip(new_ids, past_lens, new_lens)):
+        input_ids[row, :new_len] = ids
+        attention_mask[row, max_past - past_len:max_past + new_len] = 1
+        positions = np.arange(past_len, past_len + max_new)
+        position_ids[row] = np.minimum(positions, past_len + new_len - 1)
+
+    past = None
+    if max_past:
+        if batch == 1:
+            past = seq_pasts[0]
+        else:
+            past = []
+            for layer in range(len(io.past_names)):
+                padded = np.zeros((batch, io.num_heads, max_past, io.head_dim), dtype=io.past_dtype)
+                for row, seq_past in enumerate(seq_pasts):
+                    if past_lens[row]:
+                        padded[row, :, max_past - past_lens[row]:] = seq_past[layer][0]
+                past.append(padded)
+
+    logits, presents = io.run(input_ids, attention_mask, position_ids, past)
+    if presents is not None:
+        for row, seq in enumerate(seqs):
+            lo, hi = max_past - past_lens[row], max_past + new_lens[row]
+            if batch == 1 and lo == 0 and hi == presents[0].shape[2]:
+                setattr(seq, past_attr, presents)
+            else:
+                setattr(seq, past_attr, [np.ascontiguousarray(p[row:row + 1, :, lo:hi]) for p in presents])
+    if all_positions:
+        return logits
+    return logits[np.arange(batch), np.array(new_lens) - 1]
+
+
+def generate(io: DecoderIO, tokenizer, seq: Sequence) -> GenerationResult:
+    """KV-cached decoding of a single sequence until EOS, a stop sequence or max_tokens."""
+    start = time.perf_counter()
+    token = int(sample_sequences(forward_batch(io, [seq], [seq.prompt_ids]), [seq])[0])
+    seq.prefill_ms = (time.perf_counter() - start) * 1000
+    seq.append(token, tokenizer)
+
+    start = time.perf_counter()
+    while not seq.finished:
+        token = int(sample_sequences(forward_batch(io, [seq], [[token]]), [seq])[0])
+        seq.append(token, tokenizer)
+    seq.decode_ms = (time.perf_counter() - start) * 1000
+    return seq.result(tokenizer)
+
+
+# Pytest tests
+def _reference_greedy(tokenizer, prompt_ids, max_tokens):
+    """Quadratic full-recompute decoding, the behaviour the cached loop must reproduce."""
+    from cpu_inference_stub import StubSession
+    io = DecoderIO(StubSession(with_past=False))
+    seq = Sequence(prompt_ids=list(prompt_ids), max_tokens=max_tokens)
+    return generate(io, tokenizer, seq).text
+
+
+def test_cached_decoding_matches_full_recompute():
+    from cpu_inference_stub import StubSession, StubTokenizer
+    tokenizer = StubTokenizer()
+    session = StubSession()
+    prompt = tokenizer.encode("User: hello\nAssistant: ")
+    result = generate(DecoderIO(session), tokenizer, Sequence(prompt_ids=prompt, max_tokens=12))
+    assert result.text == _reference_greedy(tokenizer, prompt, 12)
+    assert result.completion_tokens == 12 and result.finish_reason == "length"
+    # One prefill over the prompt, then one token per step.
+    assert session.calls[0] == (1, len(prompt))
+    assert all(shape == (1, 1) for shape in session.calls[1:])
+
+
+def test_eos_and_stop_sequences():
+    from cpu_inference_stub import StubSession, StubTokenizer
+    tokenizer = StubTokenizer()
+    prompt = tokenizer.encode("abc")
+    eos = generate(DecoderIO(StubSession(eos_after=6)), tokenizer,
+                   Sequence(prompt_ids=prompt, max_tokens=50, eos_token_id=tokenizer.eos_token_id))
+    assert eos.completion_tokens == 3 and eos.finish_reason == "stop"
+
+    full = _reference_greedy(tokenizer, prompt, 20)
+    stop = full[5:7]
+    result = generate(DecoderIO(StubSession()), tokenizer,
+                      Sequence(prompt_ids=prompt, max_tokens=20, stop=[stop]))
+    assert result.text == full[:full.find(stop)]
+    assert result.finish_reason == "stop"
+
+
+def test_stream_deltas_hold_back_partial_stop():
+    from cpu_inference_stub import StubTokenizer
+    tokenizer = StubTokenizer()
+    seq = Sequence(prompt_ids=[], max_tokens=20, stop=["\nUser:"])
+    deltas = []
+    for char in "Hi\nUs":
+        seq.append(tokenizer.encode(char)[0], tokenizer)
+        deltas.append(seq.pop_delta(tokenizer))
+    assert "".join(deltas) == "Hi"
+    for char in "er:":
+        seq.append(tokenizer.encode(char)[0], tokenizer)
+    assert seq.finish_reason == "stop"
+    assert seq.pop_delta(tokenizer, final=True) == ""
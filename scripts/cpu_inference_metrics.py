@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+Prometheus instrumentation for the ONNX CPU inference server (served at /metrics).
+Series are recorded at per-request and per-forward-pass granularity only - never per token per
+sequence - so the cost is a few microseconds per decode step and can stay on in production.
+The default registry also carries process_* series (RSS, CPU seconds, open fds).
+"""
+
+import time
+from contextlib import contextmanager
+
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+
+# CPU-sized buckets: tokenization is sub-millisecond, prefill of a 512-token batch can take seconds
+TOKENIZE_SECONDS = Histogram(
+    "cpu_inference_tokenize_seconds", "Prompt tokenization time per request",
+    buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1),
+)
+PREFILL_SECONDS = Histogram(
+    "cpu_inference_prefill_seconds", "Forward pass time per prefill micro-batch",
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0),
+)
+DECODE_STEP_SECONDS = Histogram(
+    "cpu_inference_decode_step_seconds", "Forward pass plus sampling time per shared decode step",
+    buckets=(0.002, 0.005, 0.01, 0.02, 0.035, 0.05, 0.075, 0.1, 0.25, 0.5, 1.0),
+)
+DECODE_BATCH_SIZE = Histogram(
+    "cpu_inference_decode_batch_size", "Sequences advanced per decode step",
+    buckets=(1, 2, 4, 8, 16, 32),
+)
+REQUEST_SECONDS = Histogram(
+    "cpu_inference_request_seconds", "End-to-end request time, including queueing, cold loads and streaming",
+    ["endpoint"],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0),
+)
+MODEL_LOAD_SECONDS = Histogram(
+    "cpu_inference_model_load_seconds", "Cold-load time of a model (tokenizer, session, scheduler)",
+    buckets=(0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0, 300.0),
+)
+
+PROMPT_TOKENS = Counter("cpu_inference_prompt_tokens", "Prompt tokens processed")
+CACHED_PROMPT_TOKENS = Counter("cpu_inference_cached_prompt_tokens", "Prompt tokens served from the prefix KV cache")
+COMPLETION_TOKENS = Counter("cpu_inference_completion_tokens", "Completion tokens generated")
+DRAFT_TOKENS = Counter("cpu_inference_draft_tokens", "Tokens proposed by speculative draft models")
+ACCEPTED_DRAFT_TOKENS = Counter("cpu_inference_accepted_draft_tokens", "Draft tokens kept by the main model")
+MODEL_LOADS = Counter("cpu_inference_model_loads", "Cold loads per model", ["model"])
+MODEL_EVICTIONS = Counter("cpu_inference_model_evictions", "Evictions per model", ["model"])
+
+IN_FLIGHT = Gauge("cpu_inference_in_flight_requests", "Completion requests currently being served")
+QUEUE_DEPTH = Gauge("cpu_inference_queue_depth", "Sequences waiting for a batch slot")
+ACTIVE_SEQUENCES = Gauge("cpu_inference_active_sequences", "Sequences in the running decode batch")
+MODEL_BYTES = Gauge("cpu_inference_model_bytes", "Budgeted footprint of resident models (weights plus prefix cache)")
+LOADED_MODELS = Gauge("cpu_inference_loaded_models", "Models resident in memory")
+PREFIX_CACHE_BYTES = Gauge("cpu_inference_prefix_cache_bytes", "KV tensors held by the prefix cache")
+
+
+@contextmanager
+def track_request(endpoint: str):
+    """Count the request as in flight and observe its total duration when the block exits."""
+    IN_FLIGHT.inc()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        IN_FLIGHT.dec()
+        REQUEST_SECONDS.labels(endpoint).observe(time.perf_counter() - start)
+
+
+def record_tokens(prompt_tokens: int, completion_tokens: int, cached_tokens: int = 0,
+                  draft_tokens: int = 0, accepted_draft_tokens: int = 0) -> None:
+    PROMPT_TOKENS.inc(prompt_tokens)
+    COMPLETION_TOKENS.inc(completion_tokens)
+    if cached_tokens:
+        CACHED_PROMPT_TOKENS.inc(cached_tokens)
+    if draft_tokens:
+        DRAFT_TOKENS.inc(draft_tokens)
+        ACCEPTED_DRAFT_TOKENS.inc(accepted_draft_tokens)
+
+
+def exposition():
+    """(body, content type) for the /metrics endpoint."""
+    return generate_latest(), CONTENT_TYPE_LATEST
+
+
+# Pytest tests
+def test_track_request_counts_in_flight_and_duration():
+    from prometheus_client import REGISTRY
+    before = REGISTRY.get_sample_value("cpu_inference_request_seconds_count", {"endpoint": "unit"}) or 0
+    with track_request("unit"):
+        assert REGISTRY.get_sample_value("cpu_inference_in_flight_requests") >= 1
+    after = REGISTRY.get_sample_value("cpu_inference_request_seconds_count", {"endpoint": "unit"})
+    assert after == before + 1
+    body, content_type = exposition()
+    assert b"cpu_inference_decode_step_seconds_bucket" in body and content_type.startswith("text/plain")
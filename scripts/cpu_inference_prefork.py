@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""
+Pre-fork serving for the CPU inference server: PREFORK_WORKERS=N processes accept on one socket.
+The master imports everything, exports the tokenizers and loads each preloaded model's optimized
+weights once (cpu_inference_server.share_preloaded_models), then forks. Workers hand those arrays to
+their sessions instead of loading their own, so the weights are copy-on-write pages shared by all
+workers, and a worker's start is session creation plus warmup. ONNX Runtime sessions and their
+thread pools are not fork-safe, so every session is created after the fork; only the read-only
+weights cross it. ORT_INTRA_OP_THREADS is the node's budget, split across the workers. The master
+restarts workers that exit.
+Metrics are per worker: each /metrics scrape reports the worker that answered it.
+"""
+
+import os
+import signal
+import socket
+import time
+import traceback
+from typing import Callable, Dict
+
+
+def listen(host: str, port: int, backlog: int = 2048) -> socket.socket:
+    """The listening socket every worker accepts on (the kernel spreads connections across them)."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+def serve(sock: socket.socket, workers: int, run_worker: Callable[[socket.socket, int], None],
+          restart_delay: float = 1.0) -> None:
+    """Fork `workers` processes running run_worker(sock, index); restart any that exit until SIGTERM/SIGINT."""
+    children: Dict[int, int] = {}
+    stopping = False
+
+    def spawn(index):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            code = 0
+            try:
+                run_worker(sock, index)
+            except BaseException:
+                traceback.print_exc()
+                code = 1
+            finally:
+                os._exit(code)
+        children[pid] = index
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for index in range(workers):
+        spawn(index)
+    print(f"🍴 Master {os.getpid()} forked {workers} workers: {', '.join(map(str, children))}")
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        index = children.pop(pid, None)
+        if index is None or stopping:
+            continue
+        print(f"⚠️ Worker {index} (pid {pid}) exited with status {os.waitstatus_to_exitcode(status)}; restarting")
+        time.sleep(restart_delay)
+        if not stopping:
+            spawn(index)
+    sock.close()
+
+
+# Pytest tests
+def _serve_pids(port, workers):
+    """Pre-fork werkzeug server whose responses name the worker process."""
+    from werkzeug.serving import make_server
+    from werkzeug.wrappers import Response
+
+    def app(environ, start_response):
+        return Response(str(os.getpid()))(environ, start_response)
+
+    def run_worker(sock, index):
+        make_server("127.0.0.1", port, app, threaded=True, fd=sock.fileno()).serve_forever()
+
+    serve(listen("127.0.0.1", port), workers, run_worker, restart_delay=0.1)
+
+
+def test_workers_share_the_socket_and_are_restarted():
+    import subprocess
+    import sys
+    import urllib.request
+
+    probe = socket.socket()
+    probe.bind(("127.0.0.1", 0))
+    port = probe.getsockname()[1]
+    probe.close()
+    code = f"import cpu_inference_prefork as p; p._serve_pids({port}, 2)"
+    master = subprocess.Popen([sys.executable, "-c", code], cwd=os.path.dirname(os.path.abspath(__file__)))
+
+    def pids(want, deadline=20.0):
+        seen, end = set(), time.monotonic() + deadline
+        while len(seen) < want and time.monotonic() < end:
+            try:
+                request = urllib.request.Request(f"http://127.0.0.1:{port}/", headers={"Connection": "close"})
+                seen.add(int(urllib.request.urlopen(request, timeout=2).read()))
+            except OSError:
+                time.sleep(0.05)
+        return seen
+
+    try:
+        first = pids(2)
+        assert len(first) == 2 and master.pid not in first
+        victim = first.pop()
+        os.kill(victim, signal.SIGKILL)
+        time.sleep(0.5)
+        replacement = pids(2) - first
+        assert replacement and victim not in replacement
+    finally:
+        master.terminate()
+        assert master.wait(timeout=10) == 0
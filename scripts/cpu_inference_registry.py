@@ -0,0 +1,387 @@
+#!/usr/bin/env python3
+"""
+Model registry for the ONNX CPU inference server.
+Serves several ONNX exports from one process: each model loads lazily on its first request, gets its
+own scheduler and prefix cache, and least-recently-used idle models are evicted when loading another
+would exceed the RAM budget. Sessions are created from file paths, so ONNX Runtime memory-maps
+external weight files instead of reading them into private buffers. A model may have a small draft
+export for speculative decoding; it loads, counts against the budget and is evicted with its model.
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from dataclasses import dataclass, replace
+from typing import Callable, Deque, Dict, List, Optional
+
+import cpu_inference_metrics as metrics
+from cpu_inference_cache import PrefixCache
+from cpu_inference_engine import DecoderIO
+from cpu_inference_scheduler import BatchScheduler
+from cpu_inference_speculative import SpeculativeDecoder
+
+
+class ModelCapacityError(RuntimeError):
+    """The model does not fit in the memory budget next to the models currently serving requests."""
+
+
+@dataclass(frozen=True)
+class ModelSpec:
+    id: str
+    tokenizer: str
+    onnx_path: str
+    draft_path: str = ""
+
+    def disk_bytes(self) -> int:
+        """On-disk size of the fp32 export(s), an upper bound for what loading costs in RAM."""
+        sources = [os.path.join(path, "model.onnx") for path in (self.onnx_path, self.draft_path) if path]
+        return sum(os.path.getsize(p) for s in sources for p in (s, s + "_data") if os.path.exists(p))
+
+
+def parse_model_specs(value: str, default_name: str, default_path: str, drafts: str = "") -> List[ModelSpec]:
+    """
+    `MODELS` env format: comma-separated `id=tokenizer[@onnx_path]` entries, e.g.
+    `DialoGPT-small=microsoft/DialoGPT-small,gpt2=gpt2@/models/gpt2`. The ONNX path defaults to
+    ./onnx_model/<tokenizer>. Unset means the single MODEL_NAME/ONNX_MODEL_PATH model.
+    `DRAFT_MODELS` (`drafts`) maps model ids to draft exports for speculative decoding, in the same
+    comma-separated `id=onnx_path` form; the draft must use the model's tokenizer.
+    """
+    specs = _parse_specs(value, default_name, default_path)
+    draft_paths = dict(e.strip().split("=", 1) for e in drafts.split(",") if e.strip())
+    unknown = set(draft_paths) - {s.id for s in specs}
+    if unknown:
+        raise ValueError(f"DRAFT_MODELS names unknown model ids: {sorted(unknown)}")
+    return [replace(s, draft_path=draft_paths[s.id].strip()) if s.id in draft_paths else s for s in specs]
+
+
+def _parse_specs(value: str, default_name: str, default_path: str) -> List[ModelSpec]:
+    if not value.strip():
+        return [ModelSpec(default_name.split("/")[-1], default_name, default_path)]
+    specs = []
+    for entry in filter(None, (e.strip() for e in value.split(","))):
+        model_id, _, source = entry.partition("=")
+        tokenizer, _, onnx_path = (source or model_id).partition("@")
+        specs.append(ModelSpec(model_id.strip(), tokenizer.strip(), onnx_path.strip() or f"./onnx_model/{tokenizer.strip()}"))
+    if len({s.id for s in specs}) != len(specs):
+        raise ValueError(f"Duplicate model ids in MODELS: {value}")
+    return specs
+
+
+class LoadedModel:
+    """A resident model: its session, tokenizer, scheduler, prefix cache and optional draft model."""
+
+    def __init__(self, spec: ModelSpec, session, tokenizer, config: Optional[dict] = None, info: Optional[dict] = None,
+                 max_batch_size: int = 8, max_wait_ms: float = 5.0, prefix_cache_bytes: int = 0,
+                 draft_session=None, draft_config: Optional[dict] = None, speculative_tokens: int = 4):
+        self.spec = spec
+        self.session = session
+        self.tokenizer = tokenizer
+        self.info = info or {}
+        self.decoder = DecoderIO(session, config)
+        if not self.decoder.has_past:
+            print(f"⚠️  {spec.id} has no past_key_values inputs; re-export with --task text-generation-with-past for KV caching")
+        self.speculative = None
+        if draft_session is not None:
+            if self.decoder.has_past:
+                self.speculative = SpeculativeDecoder(self.decoder, DecoderIO(draft_session, draft_config), speculative_tokens)
+            else:
+                print(f"⚠️  {spec.id}: speculative decoding needs a KV-cached export, ignoring the draft model")
+        self.prefix_cache = PrefixCache(prefix_cache_bytes)
+        self.scheduler = BatchScheduler(self.decoder, tokenizer, max_batch_size, max_wait_ms, self.prefix_cache,
+                                        self.speculative).start()
+        # Weights (model and draft) plus the KV bytes the prefix cache may grow to
+        self.footprint = (self.info.get("model_bytes", 0) + self.info.get("draft", {}).get("model_bytes", 0)
+                          + prefix_cache_bytes)
+        self.in_use = 0
+        self.last_used = time.time()
+
+    @property
+    def id(self) -> str:
+        return self.spec.id
+
+    def close(self) -> None:
+        self.scheduler.stop()
+        self.prefix_cache.clear()
+
+    def stats(self) -> dict:
+        return {
+            "session": self.info,
+            "footprint_bytes": self.footprint,
+            "in_flight": self.in_use,
+            "last_used": self.last_used,
+            "scheduler": {
+                "max_batch_size": self.scheduler.max_batch_size,
+                "active_sequences": self.scheduler.active_count,
+                "queue_depth": self.scheduler.queue_depth,
+                "speculative_tokens": self.speculative.num_tokens if self.speculative else 0,
+            },
+            "prefix_cache": self.prefix_cache.stats(),
+        }
+
+
+class ModelRegistry:
+    """
+    Lazily loads models by id under a byte budget. `load_fn(spec)` builds a LoadedModel; the registry
+    decides when, and which idle models to evict first. Models with requests in flight are never evicted.
+    Room is made before loading from `estimate_fn(spec)` (by default the on-disk size plus
+    `overhead_bytes`) and reserved under the registry lock until the load finishes, so concurrent cold
+    loads cannot overcommit the budget; it is then re-checked against the loaded model's actual footprint.
+    """
+
+    def __init__(self, specs: List[ModelSpec], memory_budget_bytes: int, load_fn: Callable[[ModelSpec], LoadedModel],
+                 overhead_bytes: int = 0, estimate_fn: Optional[Callable[[ModelSpec], int]] = None,
+                 max_events: int = 50):
+        self.specs: "OrderedDict[str, ModelSpec]" = OrderedDict((s.id, s) for s in specs)
+        self.memory_budget = memory_budget_bytes
+        self._load_fn = load_fn
+        self._estimate_fn = estimate_fn or (lambda spec: spec.disk_bytes() + overhead_bytes)
+        self._lock = threading.Lock()
+        self._load_locks: Dict[str, threading.Lock] = {model_id: threading.Lock() for model_id in self.specs}
+        self._loaded: "OrderedDict[str, LoadedModel]" = OrderedDict()
+        self._reserved: Dict[str, int] = {}  # estimated bytes of loads in progress
+        self.events: Deque[dict] = deque(maxlen=max_events)
+
+    @property
+    def default_id(self) -> str:
+        return next(iter(self.specs))
+
+    @property
+    def resident_bytes(self) -> int:
+        return sum(m.footprint for m in list(self._loaded.values()))
+
+    def loaded(self) -> List[LoadedModel]:
+        return list(self._loaded.values())
+
+    def resolve(self, name: Optional[str]) -> str:
+        """Map a request's `model` field to a model id (accepts the id or the tokenizer/hub name)."""
+        if not name:
+            return self.default_id
+        if name in self.specs:
+            return name
+        for spec in self.specs.values():
+            if name == spec.tokenizer:
+                return spec.id
+        raise KeyError(name)
+
+    def checkout(self, model_id: str) -> LoadedModel:
+        """Return the model, loading it if needed, and pin it until `release`."""
+        with self._lock:
+            model = self._pin(model_id)
+        if model is not None:
+            return model
+
+        # Per-model lock: a cold load blocks requests for that model only
+        with self._load_locks[model_id]:
+            with self._lock:
+                model = self._pin(model_id)
+            if model is not None:
+                return model
+            spec = self.specs[model_id]
+            self._make_room(self._estimate_fn(spec), spec.id, reserve=True)
+            try:
+                start = time.perf_counter()
+                model = self._load_fn(spec)
+                seconds = time.perf_counter() - start
+            except BaseException:
+                with self._lock:
+                    self._reserved.pop(model_id, None)
+                raise
+            with self._lock:
+                self._reserved.pop(model_id, None)
+                self._loaded[model_id] = model
+                self._pin(model_id)
+            metrics.MODEL_LOADS.labels(model_id).inc()
+            metrics.MODEL_LOAD_SECONDS.observe(seconds)
+            self._event("load", model_id, seconds=round(seconds, 3), footprint_bytes=model.footprint)
+            # The real footprint is known now (INT8 weights are smaller than the estimate)
+            self._make_room(0, model_id)
+            return model
+
+    def release(self, model: LoadedModel) -> None:
+        with self._lock:
+            model.in_use -= 1
+
+    @contextmanager
+    def acquire(self, model_id: str):
+        model = self.checkout(model_id)
+        try:
+            yield model
+        finally:
+            self.release(model)
+
+    def install(self, model: LoadedModel) -> LoadedModel:
+        """Register an already-built model (startup preload, tests, benchmarks), replacing any resident copy."""
+        with self._lock:
+            self.specs.setdefault(model.id, model.spec)
+            self._load_locks.setdefault(model.id, threading.Lock())
+            previous = self._loaded.pop(model.id, None)
+            self._loaded[model.id] = model
+        if previous is not None:
+            previous.close()
+        return model
+
+    def evict(self, model_id: str, reason: str = "manual") -> bool:
+        with self._lock:
+            model = self._loaded.get(model_id)
+            if model is None or model.in_use:
+                return False
+            del self._loaded[model_id]
+        self._evicted(model, reason)
+        return True
+
+    def _evicted(self, model: LoadedModel, reason: str) -> None:
+        model.close()
+        metrics.MODEL_EVICTIONS.labels(model.id).inc()
+        self._event("evict", model.id, reason=reason, freed_bytes=model.footprint)
+
+    def stats(self) -> dict:
+        loaded = {m.id: m.stats() for m in self.loaded()}
+        return {
+            "memory_budget_bytes": self.memory_budget,
+            "resident_bytes": self.resident_bytes,
+            "models": {
+                model_id: dict(loaded.get(model_id, {}), loaded=model_id in loaded, tokenizer=spec.tokenizer)
+                for model_id, spec in self.specs.items()
+            },
+            "events": list(self.events),
+        }
+
+    def _pin(self, model_id: str) -> Optional[LoadedModel]:
+        if model_id not in self.specs:
+            raise KeyError(model_id)
+        model = self._loaded.get(model_id)
+        if model is not None:
+            self._loaded.move_to_end(model_id)
+            model.in_use += 1
+            model.last_used = time.time()
+        return model
+
+    def _make_room(self, incoming: int, for_id: str, reserve: bool = False) -> None:
+        """
+        Evict idle models, least recently used first, until `incoming` more bytes fit next to what is
+        resident and reserved. With `reserve` the bytes are held for for_id in the same critical section.
+        """
+        while True:
+            with self._lock:
+                committed = self.resident_bytes + sum(self._reserved.values())
+                if committed + incoming <= self.memory_budget:
+                    if reserve:
+                        self._reserved[for_id] = incoming
+                    return
+                victim = next((m for m in self._loaded.values() if not m.in_use and m.id != for_id), None)
+                if victim is not None:
+                    del self._loaded[victim.id]
+            if victim is None:
+                if incoming:
+                    raise ModelCapacityError(
+                        f"{for_id} needs ~{incoming >> 20}MB but only "
+                        f"{max(0, self.memory_budget - committed) >> 20}MB of the budget is free"
+                    )
+                print(f"⚠️  Model memory over budget: {committed >> 20}MB resident or reserved, "
+                      f"{self.memory_budget >> 20}MB budget, no idle model to evict")
+                return
+            self._evicted(victim, reason=f"make room for {for_id}")
+
+    def _event(self, kind: str, model_id: str, **details) -> None:
+        event = dict(event=kind, model=model_id, at=time.time(), **details)
+        self.events.append(event)
+        icon = "📦" if kind == "load" else "♻️ "
+        print(f"{icon} Model {kind}: {model_id} {details}")
+
+
+# Pytest tests
+def _stub_registry(budget, sizes, **kw):
+    from cpu_inference_stub import StubSession, StubTokenizer
+    loads = []
+
+    def load(spec):
+        loads.append(spec.id)
+        return LoadedModel(spec, StubSession(), StubTokenizer(), info={"model_bytes": sizes[spec.id]})
+
+    specs = [ModelSpec(model_id, "stub", "/nonexistent") for model_id in sizes]
+    return ModelRegistry(specs, budget, load, estimate_fn=lambda spec: sizes[spec.id], **kw), loads
+
+
+def test_parse_model_specs():
+    import pytest
+    assert parse_model_specs("", "microsoft/DialoGPT-small", "/m") == [
+        ModelSpec("DialoGPT-small", "microsoft/DialoGPT-small", "/m")
+    ]
+    specs = parse_model_specs("chat=microsoft/DialoGPT-small, gpt2=gpt2@/models/gpt2", "x", "/x")
+    assert specs == [
+        ModelSpec("chat", "microsoft/DialoGPT-small", "./onnx_model/microsoft/DialoGPT-small"),
+        ModelSpec("gpt2", "gpt2", "/models/gpt2"),
+    ]
+    specs = parse_model_specs("", "gpt2", "/m", drafts="gpt2=/models/distilgpt2")
+    assert specs == [ModelSpec("gpt2", "gpt2", "/m", "/models/distilgpt2")]
+    with pytest.raises(ValueError):
+        parse_model_specs("", "gpt2", "/m", drafts="other=/models/distilgpt2")
+
+
+def test_lazy_load_and_lru_eviction_under_budget():
+    registry, loads = _stub_registry(100, {"a": 40, "b": 40, "c": 40})
+    assert loads == [] and registry.resolve(None) == "a"
+    with registry.acquire("a"):
+        pass
+    with registry.acquire("b"):
+        pass
+    with registry.acquire("a"):
+        pass
+    assert loads == ["a", "b"]
+    with registry.acquire("c"):  # evicts b, the least recently used
+        pass
+    assert loads == ["a", "b", "c"] and [m.id for m in registry.loaded()] == ["a", "c"]
+    assert [(e["event"], e["model"]) for e in registry.events] == [
+        ("load", "a"), ("load", "b"), ("evict", "b"), ("load", "c")
+    ]
+    assert registry.resident_bytes <= registry.memory_budget
+    for model in registry.loaded():
+        model.close()
+
+
+def test_busy_models_are_never_evicted():
+    import pytest
+    registry, _ = _stub_registry(100, {"a": 60, "b": 60})
+    busy = registry.checkout("a")
+    with pytest.raises(ModelCapacityError):
+        registry.checkout("b")
+    with pytest.raises(KeyError):
+        registry.resolve("unknown")
+    registry.release(busy)
+    with registry.acquire("b") as model:
+        assert model.id == "b" and [m.id for m in registry.loaded()] == ["b"]
+        model.close()
+
+
+def test_concurrent_cold_loads_cannot_overcommit_the_budget():
+    import threading
+    registry, _ = _stub_registry(100, {"a": 60, "b": 60})
+    load, started = registry._load_fn, threading.Barrier(2, timeout=0.5)
+
+    def slow_load(spec):
+        try:
+            started.wait()  # both loads would be in flight at once without the reservation
+        except threading.BrokenBarrierError:
+            pass
+        return load(spec)
+
+    registry._load_fn = slow_load
+    outcomes = {}
+
+    def checkout(model_id):
+        try:
+            outcomes[model_id] = registry.checkout(model_id)
+        except ModelCapacityError as exc:
+            outcomes[model_id] = exc
+
+    threads = [threading.Thread(target=checkout, args=(m,)) for m in ("a", "b")]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(type(o).__name__ for o in outcomes.values()) == ["LoadedModel", "ModelCapacityError"]
+    assert registry.resident_bytes <= registry.memory_budget and registry._reserved == {}
+    for model in registry.loaded():
+        model.close()
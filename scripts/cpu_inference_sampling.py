@@ -0,0 +1,359 @@
+#!/usr/bin/env python3
+"""
+Vectorized batched sampler for the ONNX CPU inference server.
+Turns a [batch, vocab] logits array into one token per row with per-row temperature, top-k, nucleus
+top-p, repetition/frequency/presence penalties and a seed - as whole-array NumPy operations, so
+sampling stays cheap as more sequences decode together.
+
+Randomness is counter-based (splitmix64 of seed and step), so a seeded request draws the same
+numbers whatever batch it happens to share.
+
+Micro-benchmark: python cpu_inference_sampling.py --bench
+"""
+
+import secrets
+import sys
+import time
+from dataclasses import dataclass, field
+from typing import List, Sequence
+
+import numpy as np
+
+# Candidates examined first for nucleus-only rows; grown until every row's nucleus closes
+_NUCLEUS_CANDIDATES = 64
+# Block width of the two-level inverse CDF (a full-vocabulary cumsum is several times slower)
+_CDF_BLOCK = 256
+
+
+@dataclass
+class SamplingParams:
+    temperature: float = 1.0
+    top_k: int = 0
+    top_p: float = 1.0
+    repetition_penalty: float = 1.0
+    frequency_penalty: float = 0.0
+    presence_penalty: float = 0.0
+    seed: int = field(default_factory=lambda: secrets.randbits(63))
+
+    @classmethod
+    def from_request(cls, data: dict, default_temperature: float = 0.7) -> "SamplingParams":
+        """Read OpenAI-style sampling fields (plus top_k / repetition_penalty) from a request body."""
+        params = cls(
+            temperature=float(data.get("temperature", default_temperature)),
+            top_k=int(data.get("top_k") or 0),
+            top_p=float(data.get("top_p", 1.0)),
+            repetition_penalty=float(data.get("repetition_penalty", 1.0)),
+            frequency_penalty=float(data.get("frequency_penalty", 0.0)),
+            presence_penalty=float(data.get("presence_penalty", 0.0)),
+        )
+        if data.get("seed") is not None:
+            params.seed = int(data["seed"])
+        if params.temperature < 0 or not 0 < params.top_p <= 1 or params.top_k < 0 or params.repetition_penalty <= 0:
+            raise ValueError("Invalid sampling parameters")
+        return params
+
+    @property
+    def greedy(self) -> bool:
+        return self.temperature == 0
+
+
+def uniform(seeds: np.ndarray, steps: np.ndarray) -> np.ndarray:
+    """Counter-based uniforms in [0, 1): splitmix64(seed + (step + 1) * golden ratio)."""
+    with np.errstate(over="ignore"):
+        z = seeds.astype(np.uint64) + (steps.astype(np.uint64) + np.uint64(1)) * np.uint64(0x9E3779B97F4A7C15)
+        z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        z = z ^ (z >> np.uint64(31))
+    return (z >> np.uint64(11)).astype(np.float64) * 2.0 ** -53
+
+
+def _padded(histories: Sequence[Sequence[int]]) -> np.ndarray:
+    """Ragged token histories as a [batch, max_len] array padded with -1."""
+    width = max((len(h) for h in histories), default=0)
+    out = np.full((len(histories), max(width, 1)), -1, dtype=np.int64)
+    for row, history in enumerate(histories):
+        out[row, :len(history)] = history
+    return out
+
+
+def apply_penalties(logits: np.ndarray, params: List[SamplingParams], prompt_ids: Sequence[Sequence[int]],
+                    generated_ids: Sequence[Sequence[int]]) -> np.ndarray:
+    """
+    HF-style repetition penalty over prompt + output tokens, then OpenAI-style frequency and presence
+    penalties over output tokens. Returns a new array; the input is left untouched.
+    """
+    batch, vocab = logits.shape
+    rep = np.array([p.repetition_penalty for p in params], dtype=logits.dtype)
+    freq = np.array([p.frequency_penalty for p in params], dtype=logits.dtype)
+    pres = np.array([p.presence_penalty for p in params], dtype=logits.dtype)
+
+    if np.any(rep != 1.0):
+        seen = _padded([list(a) + list(b) for a, b in zip(prompt_ids, generated_ids)])
+        rows = np.broadcast_to(np.arange(batch)[:, None], seen.shape)
+        valid = seen >= 0
+        mask = np.zeros((batch, vocab), dtype=bool)
+        mask[rows[valid], seen[valid]] = True
+        penalized = np.where(logits > 0, logits / rep[:, None], logits * rep[:, None])
+        logits = np.where(mask, penalized, logits)
+
+    if np.any(freq != 0.0) or np.any(pres != 0.0):
+        out = _padded(generated_ids)
+        rows = np.broadcast_to(np.arange(batch)[:, None], out.shape)
+        valid = out >= 0
+        counts = np.zeros((batch, vocab), dtype=np.float32)
+        np.add.at(counts, (rows[valid], out[valid]), 1.0)
+        logits = logits - freq[:, None] * counts - pres[:, None] * (counts > 0)
+    return logits
+
+
+def _inverse_cdf(weights: np.ndarray, u: np.ndarray) -> np.ndarray:
+    """
+    Index i per row where the running sum of non-negative weights first exceeds u * total.
+    Two-level: block sums locate the block, then a cumsum runs over that block only.
+    """
+    batch, width = weights.shape
+    blocks = -(-width // _CDF_BLOCK)
+    padded = np.zeros((batch, blocks * _CDF_BLOCK), dtype=weights.dtype)
+    padded[:, :width] = weights
+    padded = padded.reshape(batch, blocks, _CDF_BLOCK)
+    block_cdf = np.cumsum(padded.sum(axis=-1, dtype=np.float64), axis=-1)
+    target = u * block_cdf[:, -1]
+    block = np.minimum(np.argmax(block_cdf > target[:, None], axis=-1), blocks - 1)
+    offset = np.where(block > 0, block_cdf[np.arange(batch), block - 1], 0.0)
+    inner = np.cumsum(padded[np.arange(batch), block].astype(np.float64), axis=-1)
+    return block * _CDF_BLOCK + np.argmax(inner > (target - offset)[:, None], axis=-1)
+
+
+def _nucleus(scaled: np.ndarray, k: np.ndarray, p: np.ndarray):
+    """
+    top-k / top-p over temperature-scaled logits. Returns candidate ids sorted by descending logit
+    (ties by id), the mask of candidates kept, and their unnormalised weights. Only a window of top
+    candidates is sorted; it grows until every row's nucleus closes inside it.
+    """
+    rows, vocab = scaled.shape
+    peak = scaled.max(axis=-1, keepdims=True)
+    # top-p is measured on the distribution left after top-k (as in HF / vLLM); rows without
+    # top-k need the full normaliser, the only whole-vocabulary exp on this path
+    total = np.ones(rows)
+    nucleus_only = k == 0
+    if nucleus_only.any():
+        total[nucleus_only] = np.exp(scaled[nucleus_only] - peak[nucleus_only]).sum(axis=-1, dtype=np.float64)
+
+    size = min(vocab, max(int(k.max()), _NUCLEUS_CANDIDATES))
+    while True:
+        if size < vocab:
+            cand = np.argpartition(-scaled, size - 1, axis=-1)[:, :size]
+        else:
+            cand = np.broadcast_to(np.arange(vocab), scaled.shape)
+        vals = np.take_along_axis(scaled, cand, axis=-1)
+        order = np.lexsort((cand, -vals), axis=-1)
+        cand = np.take_along_axis(cand, order, axis=-1)
+        weights = np.exp(np.take_along_axis(vals, order, axis=-1) - peak).astype(np.float64)
+
+        rank = np.arange(size)[None, :]
+        in_top_k = nucleus_only[:, None] | (rank < k[:, None])
+        norm = np.where(nucleus_only, total, np.where(in_top_k, weights, 0).sum(axis=-1))
+        probs = weights / norm[:, None]
+        before = np.cumsum(probs, axis=-1) - probs
+        keep = in_top_k & (before < p[:, None])
+        closed = ~nucleus_only | (keep.sum(axis=-1) < size) | (size == vocab)
+        if closed.all():
+            return cand, keep, weights
+        size = min(vocab, size * 4)
+
+
+def _truncation(params: List[SamplingParams], vocab: int):
+    top_k = np.array([p.top_k if 0 < p.top_k < vocab else 0 for p in params])
+    top_p = np.array([p.top_p for p in params])
+    return top_k, top_p, (top_k > 0) | (top_p < 1.0)
+
+
+def sample(logits: np.ndarray, params: List[SamplingParams], prompt_ids: Sequence[Sequence[int]],
+           generated_ids: Sequence[Sequence[int]]) -> np.ndarray:
+    """Pick one token per row of a [batch, vocab] logits array. Returns int64 [batch]."""
+    batch, vocab = logits.shape
+    logits = apply_penalties(logits.astype(np.float32, copy=False), params, prompt_ids, generated_ids)
+    temperature = np.array([p.temperature for p in params], dtype=np.float32)
+    greedy = temperature <= 0
+    tokens = np.argmax(logits, axis=-1)
+    if greedy.all():
+        return tokens
+
+    top_k, top_p, truncated = _truncation(params, vocab)
+    seeds = np.array([p.seed for p in params], dtype=np.uint64)
+    steps = np.array([len(g) for g in generated_ids], dtype=np.uint64)
+    u = uniform(seeds, steps)
+
+    # Untruncated rows: inverse CDF over the full vocabulary in vocabulary order, no sort needed
+    rows = np.flatnonzero(~greedy & ~truncated)
+    if rows.size:
+        scaled = logits[rows] / temperature[rows, None]
+        weights = np.exp(scaled - scaled.max(axis=-1, keepdims=True))
+        tokens[rows] = _inverse_cdf(weights, u[rows])
+
+    # Truncated rows: sort only the top candidates, growing the window until each nucleus closes
+    rows = np.flatnonzero(~greedy & truncated)
+    if rows.size:
+        cand, keep, weights = _nucleus(logits[rows] / temperature[rows, None], top_k[rows], top_p[rows])
+        pick = _inverse_cdf(np.where(keep, weights, 0.0), u[rows])
+        tokens[rows] = cand[np.arange(rows.size), pick]
+    return tokens
+
+
+def distribution(logits: np.ndarray, params: List[SamplingParams], prompt_ids: Sequence[Sequence[int]],
+                 generated_ids: Sequence[Sequence[int]]) -> np.ndarray:
+    """
+    The exact distribution `sample` draws from, as [batch, vocab] float64 probabilities (one-hot for
+    greedy rows). Speculative decoding needs it for both the draft and the target model.
+    """
+    batch, vocab = logits.shape
+    logits = apply_penalties(logits.astype(np.float32, copy=False), params, prompt_ids, generated_ids)
+    temperature = np.array([p.temperature for p in params], dtype=np.float32)
+    greedy = temperature <= 0
+    top_k, top_p, truncated = _truncation(params, vocab)
+    probs = np.zeros((batch, vocab))
+
+    rows = np.flatnonzero(greedy)
+    probs[rows, np.argmax(logits[rows], axis=-1)] = 1.0
+
+    rows = np.flatnonzero(~greedy & ~truncated)
+    if rows.size:
+        scaled = logits[rows] / temperature[rows, None]
+        weights = np.exp(scaled - scaled.max(axis=-1, keepdims=True)).astype(np.float64)
+        probs[rows] = weights / weights.sum(axis=-1, keepdims=True)
+
+    rows = np.flatnonzero(~greedy & truncated)
+    if rows.size:
+        cand, keep, weights = _nucleus(logits[rows] / temperature[rows, None], top_k[rows], top_p[rows])
+        weights = np.where(keep, weights, 0.0)
+        probs[rows[:, None], cand] = weights / weights.sum(axis=-1, keepdims=True)
+    return probs
+
+
+def sample_sequences(logits: np.ndarray, seqs) -> np.ndarray:
+    """Sample the next token for each engine Sequence in a batch."""
+    return sample(logits, [s.sampling for s in seqs], [s.prompt_ids for s in seqs], [s.generated_ids for s in seqs])
+
+
+# Pytest tests
+def _reference_sample(logits, params, prompt_ids, generated_ids, u):
+    """Straightforward per-row implementation: full sort, explicit filters."""
+    logits = logits.astype(np.float64).copy()
+    for token in set(prompt_ids) | set(generated_ids):
+        if logits[token] > 0:
+            logits[token] /= params.repetition_penalty
+        else:
+            logits[token] *= params.repetition_penalty
+    for token in set(generated_ids):
+        logits[token] -= params.frequency_penalty * generated_ids.count(token) + params.presence_penalty
+    if params.temperature == 0:
+        return int(np.argmax(logits))
+    probs = np.exp(logits / params.temperature - np.max(logits / params.temperature))
+    if not params.top_k and params.top_p >= 1.0:
+        # Untruncated rows invert the CDF in vocabulary order
+        cdf = np.cumsum(probs)
+        return int(np.argmax(cdf > u * cdf[-1]))
+    order = np.lexsort((np.arange(len(probs)), -probs))
+    if params.top_k:
+        order = order[:params.top_k]
+    ordered = probs[order] / probs[order].sum()
+    keep = []
+    mass = 0.0
+    for token, prob in zip(order, ordered):
+        if mass >= params.top_p:
+            break
+        keep.append(token)
+        mass += prob
+    weights = probs[keep]
+    cdf = np.cumsum(weights)
+    return int(keep[int(np.argmax(cdf > u * cdf[-1]))])
+
+
+def test_sampler_matches_reference():
+    rng = np.random.default_rng(0)
+    vocab, batch = 500, 6
+    for trial in range(20):
+        logits = rng.normal(0, 3, size=(batch, vocab))
+        params = [
+            SamplingParams(temperature=0.0, seed=trial),
+            SamplingParams(temperature=0.8, seed=trial + 1),
+            SamplingParams(temperature=1.0, top_k=20, seed=trial + 2),
+            SamplingParams(temperature=0.7, top_p=0.9, seed=trial + 3),
+            SamplingParams(temperature=1.3, top_k=50, top_p=0.5, repetition_penalty=1.3, seed=trial + 4),
+            SamplingParams(temperature=1.0, top_p=0.999, frequency_penalty=0.5, presence_penalty=0.4, seed=trial + 5),
+        ]
+        prompts = [list(rng.integers(0, vocab, 10)) for _ in range(batch)]
+        generated = [list(rng.integers(0, vocab, trial % 5)) for _ in range(batch)]
+        tokens = sample(logits, params, prompts, generated)
+        u = uniform(np.array([p.seed for p in params], dtype=np.uint64),
+                    np.array([len(g) for g in generated], dtype=np.uint64))
+        expected = [_reference_sample(logits[i], params[i], prompts[i], generated[i], u[i]) for i in range(batch)]
+        assert tokens.tolist() == expected
+
+
+def test_seeded_sampling_is_reproducible_and_batch_independent():
+    rng = np.random.default_rng(1)
+    logits = rng.normal(size=(3, 1000))
+    params = [SamplingParams(temperature=1.0, top_p=0.9, seed=42) for _ in range(3)]
+    batched = sample(logits, params, [[]] * 3, [[]] * 3)
+    alone = [sample(logits[i:i + 1], params[:1], [[]], [[]])[0] for i in range(3)]
+    assert batched.tolist() == alone
+    # Greedy and top_k=1 collapse to argmax
+    argmax = np.argmax(logits, axis=-1).tolist()
+    assert sample(logits, [SamplingParams(temperature=0)] * 3, [[]] * 3, [[]] * 3).tolist() == argmax
+    assert sample(logits, [SamplingParams(top_k=1)] * 3, [[]] * 3, [[]] * 3).tolist() == argmax
+
+
+def test_sampled_frequencies_follow_distribution():
+    logits = np.log(np.array([[0.5, 0.3, 0.15, 0.05]]))
+    params = [SamplingParams(temperature=1.0, seed=seed) for seed in range(4000)]
+    tokens = sample(np.repeat(logits, 4000, axis=0), params, [[]] * 4000, [[]] * 4000)
+    counts = np.bincount(tokens, minlength=4)
+    assert np.allclose(counts / counts.sum(), [0.5, 0.3, 0.15, 0.05], atol=0.03)
+
+
+def test_distribution_is_what_sample_draws_from():
+    rng = np.random.default_rng(2)
+    logits = rng.normal(0, 3, size=(4, 50))
+    configs = [SamplingParams(temperature=0), SamplingParams(temperature=0.7),
+               SamplingParams(temperature=0.9, top_k=5), SamplingParams(temperature=1.2, top_p=0.8, frequency_penalty=0.5)]
+    probs = distribution(logits, configs, [[1, 2]] * 4, [[3, 3]] * 4)
+    assert np.allclose(probs.sum(axis=-1), 1.0)
+    assert probs[0].max() == 1.0 and (probs[2] > 0).sum() == 5
+    for row, params in enumerate(configs):
+        seeded = [SamplingParams(**dict(params.__dict__, seed=seed)) for seed in range(3000)]
+        tokens = sample(np.repeat(logits[row:row + 1], 3000, axis=0), seeded, [[1, 2]] * 3000, [[3, 3]] * 3000)
+        assert probs[row, tokens].min() > 0
+        assert np.abs(np.bincount(tokens, minlength=50) / 3000 - probs[row]).max() < 0.04
+
+
+def _benchmark():
+    rng = np.random.default_rng(0)
+    configs = {
+        "greedy": SamplingParams(temperature=0),
+        "temperature": SamplingParams(temperature=0.8),
+        "top_k=50": SamplingParams(temperature=0.8, top_k=50),
+        "top_p=0.9": SamplingParams(temperature=0.8, top_p=0.9),
+        "top_k+top_p+penalties": SamplingParams(temperature=0.8, top_k=40, top_p=0.95, repetition_penalty=1.1,
+                                                frequency_penalty=0.3),
+    }
+    print(f"{'vocab':>7} {'batch':>5}  {'config':<24} {'ms/step':>8}")
+    for vocab in (50_000, 100_000, 150_000):
+        for batch in (1, 8):
+            logits = rng.normal(0, 4, size=(batch, vocab)).astype(np.float32)
+            prompts = [list(rng.integers(0, vocab, 256)) for _ in range(batch)]
+            generated = [list(rng.integers(0, vocab, 64)) for _ in range(batch)]
+            for name, params in configs.items():
+                repeats = 20
+                start = time.perf_counter()
+                for _ in range(repeats):
+                    sample(logits, [params] * batch, prompts, generated)
+                elapsed = (time.perf_counter() - start) * 1000 / repeats
+                print(f"{vocab:>7} {batch:>5}  {name:<24} {elapsed:>8.2f}")
+
+
+if __name__ == "__main__":
+    if "--bench" in sys.argv:
+        _benchmark()
+    else:
+        print(__doc__)
@@ -0,0 +1,351 @@
+#!/usr/bin/env python3
+"""
+Continuous batching scheduler for the ONNX CPU inference server.
+Request threads submit sequences instead of calling `session.run` themselves. A single worker thread
+owns the session and, at every decode step, admits queued sequences (prefilled together as one padded
+micro-batch), advances every active sequence by one token in a shared forward pass, and retires the
+finished ones - iteration-level scheduling in the style of vLLM, sized for a CPU-only node.
+With a speculative draft model, each decode step drafts and verifies instead and a sequence may
+advance by several tokens.
+"""
+
+import queue
+import threading
+import time
+from typing import Callable, Iterator, List, Optional
+
+import cpu_inference_metrics as metrics
+from cpu_inference_cache import PrefixCache
+from cpu_inference_engine import DecoderIO, GenerationResult, Sequence, forward_batch
+from cpu_inference_sampling import sample_sequences
+from cpu_inference_speculative import SpeculativeDecoder
+
+
+class SchedulerRequest:
+    """
+    Handle returned by `BatchScheduler.submit`; `wait()` blocks until the sequence retires.
+    Streaming requests also receive text deltas as tokens are decoded (see `stream()`).
+    Async callers register a listener instead of blocking a thread: it is called from the scheduler
+    thread whenever the request is admitted to a batch, gets a delta, or finishes.
+    """
+
+    def __init__(self, seq: Sequence, stream: bool = False):
+        self.seq = seq
+        self.result: Optional[GenerationResult] = None
+        self.error: Optional[BaseException] = None
+        self.cancelled = False
+        self.submitted_at = time.perf_counter()
+        self.admitted_at: Optional[float] = None
+        self.deltas: Optional["queue.Queue[Optional[str]]"] = queue.Queue() if stream else None
+        self._done = threading.Event()
+        self._listeners: List[Callable[[], None]] = []
+
+    @property
+    def done(self) -> bool:
+        return self._done.is_set()
+
+    def add_listener(self, listener: Callable[[], None]) -> None:
+        """Call `listener()` on every state change; it must be quick and must not block."""
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener: Callable[[], None]) -> None:
+        if listener in self._listeners:
+            self._listeners.remove(listener)
+
+    def _notify(self) -> None:
+        for listener in list(self._listeners):
+            try:
+                listener()
+            except Exception as e:
+                print(f"⚠️  Request listener failed: {e}")
+
+    def cancel(self) -> None:
+        """Stop decoding this sequence at the next step, e.g. when the client disconnected."""
+        self.cancelled = True
+
+    def stream(self, timeout: Optional[float] = None) -> Iterator[str]:
+        """
+        Yield text deltas until the sequence retires. The scheduler never blocks on a slow reader:
+        deltas queue up (at most max_tokens of them) and are coalesced into one chunk per read.
+        """
+        done = False
+        while not done:
+            try:
+                parts = [self.deltas.get(timeout=timeout)]
+            except queue.Empty:
+                raise TimeoutError("No token decoded in time")
+            while True:
+                try:
+                    parts.append(self.deltas.get_nowait())
+                except queue.Empty:
+                    break
+            if None in parts:
+                done = True
+                parts = parts[:parts.index(None)]
+            text = "".join(parts)
+            if text:
+                yield text
+        if self.error is not None:
+            raise self.error
+
+    def wait(self, timeout: Optional[float] = None) -> GenerationResult:
+        if not self._done.wait(timeout):
+            raise TimeoutError("Generation did not finish in time")
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class BatchScheduler:
+    """Queues sequences and decodes them in shared micro-batches on one worker thread."""
+
+    def __init__(self, io: DecoderIO, tokenizer, max_batch_size: int = 8, max_wait_ms: float = 5.0,
+                 prefix_cache: Optional[PrefixCache] = None, speculative: Optional[SpeculativeDecoder] = None):
+        self.io = io
+        self.speculative = speculative
+        self.tokenizer = tokenizer
+        self.prefix_cache = prefix_cache if io.has_past else None
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, max_wait_ms) / 1000
+        self._pending: "queue.Queue[SchedulerRequest]" = queue.Queue()
+        self._active: List[SchedulerRequest] = []
+        self._running = False
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def queue_depth(self) -> int:
+        return self._pending.qsize()
+
+    @property
+    def active_count(self) -> int:
+        return len(self._active)
+
+    def start(self) -> "BatchScheduler":
+        self._running = True
+        self._thread = threading.Thread(target=self._loop, name="batch-scheduler", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self, timeout: float = 5.0) -> None:
+        self._running = False
+        if self._thread:
+            self._thread.join(timeout)
+
+    def submit(self, seq: Sequence, stream: bool = False) -> SchedulerRequest:
+        req = SchedulerRequest(seq, stream)
+        self._pending.put(req)
+        return req
+
+    def generate(self, seq: Sequence, timeout: Optional[float] = None) -> GenerationResult:
+        return self.submit(seq).wait(timeout)
+
+    def _admit(self) -> List[SchedulerRequest]:
+        """Pull queued requests into free batch slots; when idle, wait up to max_wait to fill a batch."""
+        free = self.max_batch_size - len(self._active)
+        admitted: List[SchedulerRequest] = []
+        if free <= 0:
+            return admitted
+        if not self._active:
+            try:
+                admitted.append(self._pending.get(timeout=0.1))
+            except queue.Empty:
+                return admitted
+            deadline = time.perf_counter() + self.max_wait
+            while len(admitted) < free:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    admitted.append(self._pending.get(timeout=remaining))
+                except queue.Empty:
+                    break
+        while len(admitted) < free:
+            try:
+                admitted.append(self._pending.get_nowait())
+            except queue.Empty:
+                break
+        for req in [r for r in admitted if r.cancelled]:
+            admitted.remove(req)
+            self._finish(req)
+        return admitted
+
+    def _finish(self, req: SchedulerRequest) -> None:
+        seq = req.seq
+        if req.cancelled and not seq.finished:
+            seq.finish_reason = "cancelled"
+        elif self.prefix_cache is not None and seq.past is not None:
+            # The cache holds every token except the last sampled one, which was never fed back
+            self.prefix_cache.insert((seq.prompt_ids + seq.generated_ids)[:seq.context_len], seq.past)
+        req.result = seq.result(self.tokenizer)
+        seq.past = seq.draft_past = None
+        if req.deltas is not None:
+            req.deltas.put(req.seq.pop_delta(self.tokenizer, final=True))
+            req.deltas.put(None)
+        req._done.set()
+        req._notify()
+
+    def _fail(self, reqs: List[SchedulerRequest], error: BaseException) -> None:
+        for req in reqs:
+            req.error = error
+            if req.deltas is not None:
+                req.deltas.put(None)
+            req._done.set()
+            req._notify()
+
+    def _step(self, reqs: List[SchedulerRequest], new_ids: List[List[int]]) -> float:
+        """Run one shared forward pass and append a sampled token to every sequence."""
+        start = time.perf_counter()
+        seqs = [r.seq for r in reqs]
+        tokens = sample_sequences(forward_batch(self.io, seqs, new_ids), seqs)
+        for req, token in zip(reqs, tokens):
+            req.seq.append(int(token), self.tokenizer)
+        self._emit(reqs)
+        return (time.perf_counter() - start) * 1000
+
+    def _speculate(self, reqs: List[SchedulerRequest]) -> float:
+        """Draft-and-verify decode step: every sequence advances by one to k + 1 tokens."""
+        start = time.perf_counter()
+        self.speculative.step([r.seq for r in reqs], self.tokenizer)
+        self._emit(reqs)
+        return (time.perf_counter() - start) * 1000
+
+    def _emit(self, reqs: List[SchedulerRequest]) -> None:
+        for req in reqs:
+            if req.deltas is not None and not req.seq.finished:
+                delta = req.seq.pop_delta(self.tokenizer)
+                if delta:
+                    req.deltas.put(delta)
+                    req._notify()
+
+    def _retire(self) -> None:
+        still_active = []
+        for req in self._active:
+            if req.seq.finished or req.cancelled:
+                self._finish(req)
+            else:
+                still_active.append(req)
+        self._active = still_active
+
+    def _loop(self) -> None:
+        while self._running:
+            admitted = self._admit()
+            if admitted:
+                now = time.perf_counter()
+                for req in admitted:
+                    req.admitted_at = now
+                    req._notify()
+                if self.prefix_cache is not None:
+                    for req in admitted:
+                        req.seq.cached_tokens, req.seq.past = self.prefix_cache.lookup(req.seq.prompt_ids)
+                try:
+                    elapsed = self._step(admitted, [r.seq.prompt_ids[r.seq.cached_tokens:] for r in admitted])
+                except Exception as e:
+                    print(f"❌ Prefill batch failed: {e}")
+                    self._fail(admitted, e)
+                else:
+                    metrics.PREFILL_SECONDS.observe(elapsed / 1000)
+                    for req in admitted:
+                        req.seq.prefill_ms = elapsed
+                    self._active.extend(admitted)
+                    self._retire()
+
+            if not self._active:
+                continue
+            try:
+                if self.speculative is not None:
+                    elapsed = self._speculate(self._active)
+                else:
+                    elapsed = self._step(self._active, [[r.seq.generated_ids[-1]] for r in self._active])
+            except Exception as e:
+                print(f"❌ Decode batch failed: {e}")
+                self._fail(self._active, e)
+                self._active = []
+                continue
+            metrics.DECODE_STEP_SECONDS.observe(elapsed / 1000)
+            metrics.DECODE_BATCH_SIZE.observe(len(self._active))
+            for req in self._active:
+                req.seq.decode_ms += elapsed
+            self._retire()
+
+
+# Pytest tests
+def test_batched_decoding_matches_serial():
+    from cpu_inference_engine import generate
+    from cpu_inference_stub import StubSession, StubTokenizer
+    tokenizer = StubTokenizer()
+    prompts = ["User: hi\nAssistant: ", "a", "User: a much longer prompt here\nAssistant: "]
+    budgets = [5, 9, 3]
+    expected = [
+        generate(DecoderIO(StubSession()), tokenizer, Sequence(tokenizer.encode(p), n)).text
+        for p, n in zip(prompts, budgets)
+    ]
+
+    session = StubSession()
+    scheduler = BatchScheduler(DecoderIO(session), tokenizer, max_batch_size=4)
+    reqs = [scheduler.submit(Sequence(tokenizer.encode(p), n)) for p, n in zip(prompts, budgets)]
+    scheduler.start()
+    try:
+        assert [r.wait(5).text for r in reqs] == expected
+    finally:
+        scheduler.stop()
+    # Prefill and decode ran as shared passes; finished sequences left the batch.
+    assert session.calls[0][0] == 3
+    assert [shape[0] for shape in session.calls[1:]] == [3, 3, 2, 2, 1, 1, 1, 1]
+
+
+def test_prefix_cache_reuses_previous_turn():
+    from cpu_inference_engine import generate
+    from cpu_inference_stub import StubSession, StubTokenizer
+    tokenizer = StubTokenizer()
+    turn1 = "User: hello there\nAssistant: "
+    session = StubSession()
+    cache = PrefixCache(max_bytes=1 << 20)
+    scheduler = BatchScheduler(DecoderIO(session), tokenizer, prefix_cache=cache).start()
+    try:
+        reply = scheduler.generate(Sequence(tokenizer.encode(turn1), 6)).text
+        turn2 = tokenizer.encode(turn1 + reply + "\nUser: and?\nAssistant: ")
+        session.calls.clear()
+        result = scheduler.generate(Sequence(turn2, 6))
+    finally:
+        scheduler.stop()
+    expected = generate(DecoderIO(StubSession()), tokenizer, Sequence(turn2, 6)).text
+    assert result.text == expected
+    assert result.cached_tokens == len(turn1) + 5
+    assert session.calls[0] == (1, len(turn2) - result.cached_tokens)
+    assert cache.stats()["hits"] == 1
+
+
+def test_streaming_deltas_and_cancellation():
+    from cpu_inference_stub import StubSession, StubTokenizer
+    tokenizer = StubTokenizer()
+    session = StubSession()
+    scheduler = BatchScheduler(DecoderIO(session), tokenizer).start()
+    try:
+        req = scheduler.submit(Sequence(tokenizer.encode("hi"), 12), stream=True)
+        assert "".join(req.stream(5)) == req.wait(5).text
+
+        req = scheduler.submit(Sequence(tokenizer.encode("hi"), 10_000), stream=True)
+        next(req.stream(5))
+        req.cancel()
+        assert req.wait(5).finish_reason == "cancelled"
+    finally:
+        scheduler.stop()
+    assert len(session.calls) < 1000
+
+
+def test_sequences_join_running_batch():
+    from cpu_inference_stub import StubSession, StubTokenizer
+    tokenizer = StubTokenizer()
+    session = StubSession()
+    scheduler = BatchScheduler(DecoderIO(session), tokenizer, max_batch_size=2, max_wait_ms=0).start()
+    try:
+        first = scheduler.submit(Sequence(tokenizer.encode("hello"), 40))
+        while not session.calls:
+            time.sleep(0.001)
+        second = scheduler.submit(Sequence(tokenizer.encode("x"), 2))
+        third = scheduler.submit(Sequence(tokenizer.encode("y"), 2))
+        results = [r.wait(5) for r in (first, second, third)]
+    finally:
+        scheduler.stop()
+    assert [r.completion_tokens for r in results] == [40, 2, 2]
+    assert max(shape[0] for shape in session.calls) == 2
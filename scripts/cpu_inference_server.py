@@ -2,19 +2,30 @@
 """
 CPU Inference Server for ARM64 Oracle Node - ONNX Optimized
 Lightweight OpenAI-compatible API server for ARM deployment with ONNX Runtime for faster inference.
-Requires: pip install onnxruntime transformers flask
+Serves one or more models (MODELS), loaded lazily and evicted LRU-first under MODEL_MEMORY_BUDGET_MB.
+Requires: pip install onnxruntime tokenizers flask prometheus-client (redis only for the shared response cache;
+transformers only to export a tokenizer into the local cache once, see cpu_inference_tokenizer.py)
 Assumes ONNX model exported via optimum (e.g., optimum-cli export onnx --model microsoft/DialoGPT-small onnx_model/)
+Speculative decoding: point DRAFT_MODELS at a much smaller export with the same tokenizer
+(e.g. DRAFT_MODELS=gpt2-large=./onnx_model/distilgpt2); output is unchanged, decoding gets faster
+when the draft usually agrees. Acceptance rates are reported in each response's timings.
 """
 
 import os
 import json
 import time
 import uuid
+from dataclasses import asdict, dataclass
 from datetime import datetime
 from flask import Flask, request, jsonify, Response
-from transformers import AutoTokenizer
-import onnxruntime as ort
-import numpy as np
+
+import cpu_inference_metrics as metrics
+from cpu_inference_cache import ResponseCache
+from cpu_inference_engine import GenerationResult, Sequence, load_model_config
+from cpu_inference_registry import LoadedModel, ModelCapacityError, ModelRegistry, ModelSpec, parse_model_specs
+from cpu_inference_sampling import SamplingParams
+from cpu_inference_session import create_session, session_settings, share_model
+from cpu_inference_tokenizer import cache_dir_for, load_tokenizer
 
 app = Flask(__name__)
 
@@ -22,165 +33,511 @@ app = Flask(__name__)
 MODEL_NAME = os.getenv("MODEL_NAME", "microsoft/DialoGPT-small")
 ONNX_MODEL_PATH = os.getenv("ONNX_MODEL_PATH", f"./onnx_model/{MODEL_NAME}")
 MAX_LENGTH = int(os.getenv("MAX_LENGTH", "512"))
+MODELS = os.getenv("MODELS", "")
+DRAFT_MODELS = os.getenv("DRAFT_MODELS", "")
+SPECULATIVE_TOKENS = int(os.getenv("SPECULATIVE_TOKENS", "4"))
+MODEL_MEMORY_BUDGET_MB = int(os.getenv("MODEL_MEMORY_BUDGET_MB", "8192"))
 DEVICE = os.getenv("DEVICE", "cpu")
 PORT = int(os.getenv("PORT", "8000"))
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", "8"))
+BATCH_MAX_WAIT_MS = float(os.getenv("BATCH_MAX_WAIT_MS", "5"))
+PREFIX_CACHE_MB = int(os.getenv("PREFIX_CACHE_MB", "512"))
+RESPONSE_CACHE = os.getenv("RESPONSE_CACHE", "0") == "1"
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "300"))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "1024"))
+RESPONSE_CACHE_REDIS_URL = os.getenv("RESPONSE_CACHE_REDIS_URL")
+WARMUP_RUNS = int(os.getenv("WARMUP_RUNS", "2"))
+# >1 forks worker processes that share the preloaded weights (cpu_inference_prefork.py)
+PREFORK_WORKERS = int(os.getenv("PREFORK_WORKERS", "1"))
+SESSION_SETTINGS = session_settings()
+MODEL_SPECS = parse_model_specs(MODELS, MODEL_NAME, ONNX_MODEL_PATH, DRAFT_MODELS)
+# Models loaded at startup (comma-separated ids); the rest load on their first request
+PRELOAD_MODELS = [m for m in os.getenv("PRELOAD_MODELS", MODEL_SPECS[0].id).split(",") if m]
 
 print(f"🚀 Starting ONNX CPU Inference Server")
-print(f"📱 Model: {MODEL_NAME}")
+for spec in MODEL_SPECS:
+    print(f"📱 Model: {spec.id} ({spec.tokenizer}, ONNX path {spec.onnx_path})")
+    if spec.draft_path:
+        print(f"🎯 Speculative draft for {spec.id}: {spec.draft_path}, {SPECULATIVE_TOKENS} tokens per step")
+print(f"🧠 Model memory budget: {MODEL_MEMORY_BUDGET_MB}MB, preloading {', '.join(PRELOAD_MODELS) or 'nothing'}")
 print(f"🖥️  Device: {DEVICE}")
 print(f"🔢 Max Length: {MAX_LENGTH}")
-print(f"📁 ONNX Path: {ONNX_MODEL_PATH}")
+print(f"🧺 Batching: max {BATCH_MAX_SIZE} sequences, {BATCH_MAX_WAIT_MS}ms max wait")
+print(f"🗂️  Prefix KV cache: {PREFIX_CACHE_MB}MB per model")
+print(f"⚙️  ONNX Runtime: {SESSION_SETTINGS['quantize']} weights, opt level {SESSION_SETTINGS['opt_level']}, "
+      f"{SESSION_SETTINGS['intra_op_threads']} intra-op / {SESSION_SETTINGS['inter_op_threads']} inter-op threads")
+if RESPONSE_CACHE:
+    print(f"💾 Response cache: {'redis' if RESPONSE_CACHE_REDIS_URL else 'memory'}, TTL {RESPONSE_CACHE_TTL}s")
+
+# Default stop sequence for the "User:/Assistant:" chat prompt format
+CHAT_STOP = ["\nUser:"]
+
+def load_model_spec(spec):
+    """Load one registry model: tokenizer, tuned ONNX session, scheduler, then warmup"""
+    print(f"📦 Loading tokenizer: {spec.tokenizer}")
+    # Pre-serialized local copy: no transformers import or hub lookup after the first start
+    new_tokenizer, tokenizer_info = load_tokenizer(spec.tokenizer, cache_dir_for(spec.tokenizer, spec.onnx_path))
+    
+    print(f"📦 Loading ONNX model from {spec.onnx_path}")
+    # CPU provider with tuned threads, optional INT8 weights and a cached optimized graph
+    new_session, info = create_session(spec.onnx_path, SESSION_SETTINGS)
+    info["tokenizer"] = tokenizer_info
+    draft_session = draft_config = None
+    if spec.draft_path:
+        print(f"📦 Loading ONNX draft model from {spec.draft_path}")
+        draft_session, info["draft"] = create_session(spec.draft_path, SESSION_SETTINGS)
+        draft_config = load_model_config(spec.draft_path)
+    model = LoadedModel(spec, new_session, new_tokenizer, load_model_config(spec.onnx_path), info,
+                        BATCH_MAX_SIZE, BATCH_MAX_WAIT_MS, PREFIX_CACHE_MB * 1024 * 1024,
+                        draft_session, draft_config, SPECULATIVE_TOKENS)
+    print(f"✅ ONNX model {spec.id} loaded in {info['load_seconds']}s (graph cache {info['graph_cache']}, "
+          f"tokenizer cache {tokenizer_info['tokenizer_cache']})")
+    
+    if WARMUP_RUNS > 0:
+        warmup_model(model)
+    return model
 
 # Global model storage
-session = None
-tokenizer = None
+registry = ModelRegistry(
+    MODEL_SPECS, MODEL_MEMORY_BUDGET_MB * 1024 * 1024, load_model_spec, overhead_bytes=PREFIX_CACHE_MB * 1024 * 1024
+)
+model_ready = False
+response_cache = ResponseCache(
+    RESPONSE_CACHE_TTL, RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_REDIS_URL
+) if RESPONSE_CACHE else None
+
+# Scrape-time gauges read live state instead of being updated on the hot path
+metrics.QUEUE_DEPTH.set_function(lambda: sum(m.scheduler.queue_depth for m in registry.loaded()))
+metrics.ACTIVE_SEQUENCES.set_function(lambda: sum(m.scheduler.active_count for m in registry.loaded()))
+metrics.PREFIX_CACHE_BYTES.set_function(lambda: sum(m.prefix_cache.bytes for m in registry.loaded()))
+metrics.MODEL_BYTES.set_function(lambda: registry.resident_bytes)
+metrics.LOADED_MODELS.set_function(lambda: len(registry.loaded()))
+
+def warmup_model(model, runs=WARMUP_RUNS):
+    """Run short generations so kernels, thread pools and the memory arena are primed before serving"""
+    start = time.perf_counter()
+    for _ in range(runs):
+        seq = prepare_sequence(model, [{"role": "user", "content": "Hello, warm up."}], 4, SamplingParams(temperature=0.0))
+        model.scheduler.generate(seq, timeout=300)
+    model.prefix_cache.clear()
+    print(f"🔥 Warmup {model.id}: {runs} runs in {time.perf_counter() - start:.2f}s")
+
+def install_model(new_session, new_tokenizer, config=None, model_id=None, draft_session=None):
+    """Serve an already-created session and tokenizer (used by tests and benchmarks)"""
+    model_id = model_id or registry.default_id
+    spec = registry.specs.get(model_id) or ModelSpec(model_id, model_id, "")
+    return registry.install(LoadedModel(
+        spec, new_session, new_tokenizer, config, {}, BATCH_MAX_SIZE, BATCH_MAX_WAIT_MS, PREFIX_CACHE_MB * 1024 * 1024,
+        draft_session, None, SPECULATIVE_TOKENS
+    ))
 
 def load_model():
-    """Load the ONNX model and tokenizer"""
-    global session, tokenizer
+    """Load the PRELOAD_MODELS up front so the first requests don't pay for a cold load"""
+    global model_ready
     
     try:
-        print(f"📦 Loading tokenizer: {MODEL_NAME}")
-        tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME)
-        if tokenizer.pad_token is None:
-            tokenizer.pad_token = tokenizer.eos_token
-        
-        print(f"📦 Loading ONNX model from {ONNX_MODEL_PATH}")
-        # Use CPU provider for ARM optimization
-        providers = ['CPUExecutionProvider']
-        session = ort.InferenceSession(f"{ONNX_MODEL_PATH}/model.onnx", providers=providers)
-        
-        print(f"✅ ONNX model loaded successfully")
+        for model_id in PRELOAD_MODELS:
+            with registry.acquire(registry.resolve(model_id)):
+                pass
+        model_ready = True
         return True
         
     except Exception as e:
         print(f"❌ Error loading ONNX model: {e}")
         return False
 
-def generate_response(messages, max_tokens=150, temperature=0.7):
-    """Generate response using ONNX model"""
+def share_preloaded_models(workers):
+    """Pre-fork master: split intra-op threads across workers, export tokenizers and load the shared weights once"""
+    SESSION_SETTINGS["intra_op_threads"] = max(1, SESSION_SETTINGS["intra_op_threads"] // workers)
+    for model_id in PRELOAD_MODELS:
+        spec = registry.specs[registry.resolve(model_id)]
+        load_tokenizer(spec.tokenizer, cache_dir_for(spec.tokenizer, spec.onnx_path))
+        for path in filter(None, (spec.onnx_path, spec.draft_path)):
+            shared = share_model(path, SESSION_SETTINGS)
+            print(f"🔗 Sharing {shared['initializers']} weights from {shared['path']} "
+                  f"({shared['model_bytes'] // 2**20}MB) with {workers} workers")
+
+class ApiError(Exception):
+    """Request rejected with an HTTP status (validation, unknown model, not ready, overload)"""
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+@dataclass
+class CompletionRequest:
+    """A validated /v1/chat/completions or /v1/completions request"""
+    model_id: str
+    messages: list
+    max_tokens: int
+    stop: object
+    sampling: SamplingParams
+    seeded: bool
+    stream: bool = False
+    include_usage: bool = False
+
+def parse_request(data, chat=True):
+    """Validate an OpenAI request body; raises ApiError with the status to return"""
+    data = data or {}
+    if chat:
+        messages = data.get("messages", [])
+        if not messages:
+            raise ApiError(400, "No messages provided")
+    else:
+        prompt = data.get("prompt", "")
+        if not prompt:
+            raise ApiError(400, "No prompt provided")
+        # Convert to message format
+        messages = [{"role": "user", "content": prompt}]
+    
     try:
-        if not session or not tokenizer:
-            return "Error: Model not loaded"
-        
-        # Convert messages to prompt
-        prompt = ""
-        for msg in messages:
-            role = msg.get("role", "user")
-            content = msg.get("content", "")
-            if role == "user":
-                prompt += f"User: {content}\n"
-            elif role == "assistant":
-                prompt += f"Assistant: {content}\n"
-        
-        prompt += "Assistant: "
-        
-        # Tokenize
-        inputs = tokenizer(prompt, return_tensors="np", max_length=MAX_LENGTH, truncation=True)
-        input_ids = inputs["input_ids"]
-        
-        # ONNX inference (simplified; for full generation, use loop for tokens)
-        # Note: For autoregressive models, implement token-by-token generation
-        outputs = session.run(None, {"input_ids": input_ids})[0]
-        generated_ids = np.argmax(outputs, axis=-1)
-        
-        # Decode (take last max_tokens)
-        response_ids = generated_ids[0][-max_tokens:]
-        response = tokenizer.decode(response_ids, skip_special_tokens=True)
-        
-        # Extract assistant response
-        if "Assistant: " in response:
-            response = response.split("Assistant: ")[-1].strip()
-        
-        return response
-        
+        sampling = SamplingParams.from_request(data)
+    except (TypeError, ValueError) as e:
+        raise ApiError(400, f"Invalid sampling parameters: {e}")
+    
+    try:
+        model_id = registry.resolve(data.get("model"))
+    except KeyError:
+        raise ApiError(404, f"Model not found: {data.get('model')}")
+    
+    if not model_ready:
+        raise ApiError(503, "Model not loaded")
+    
+    return CompletionRequest(
+        model_id=model_id,
+        messages=messages,
+        max_tokens=data.get("max_tokens", 150),
+        stop=data.get("stop"),
+        sampling=sampling,
+        seeded=data.get("seed") is not None,
+        stream=chat and bool(data.get("stream", False)),
+        include_usage=bool((data.get("stream_options") or {}).get("include_usage")),
+    )
+
+def build_prompt(messages):
+    """Convert chat messages to the plain-text prompt format"""
+    prompt = ""
+    for msg in messages:
+        role = msg.get("role", "user")
+        content = msg.get("content", "")
+        if role == "user":
+            prompt += f"User: {content}\n"
+        elif role == "assistant":
+            prompt += f"Assistant: {content}\n"
+    
+    prompt += "Assistant: "
+    return prompt
+
+def normalize_stop(stop):
+    """OpenAI `stop` may be a string, a list of strings or null"""
+    if not stop:
+        return []
+    if isinstance(stop, str):
+        return [stop]
+    return [s for s in stop if s]
+
+def prepare_sequence(model, messages, max_tokens=150, sampling=None, stop=None):
+    """Tokenize the chat prompt into a decoding sequence that fits the context window"""
+    prompt = build_prompt(messages)
+    with metrics.TOKENIZE_SECONDS.time():
+        prompt_ids = model.tokenizer(prompt, return_tensors="np")["input_ids"][0].tolist()
+    
+    # Keep the prompt and the completion inside the context window, dropping the oldest turns first
+    max_tokens = max(1, min(int(max_tokens), MAX_LENGTH - 1))
+    prompt_ids = prompt_ids[-(MAX_LENGTH - max_tokens):]
+    
+    return Sequence(
+        prompt_ids=prompt_ids,
+        max_tokens=max_tokens,
+        eos_token_id=model.tokenizer.eos_token_id,
+        stop=CHAT_STOP + normalize_stop(stop),
+        sampling=sampling or SamplingParams(temperature=0.7),
+    )
+
+def log_timings(result):
+    """Log per-request timings and count the tokens the model processed for /metrics"""
+    metrics.record_tokens(result.prompt_tokens - result.cached_tokens, result.completion_tokens, result.cached_tokens,
+                          result.draft_tokens, result.accepted_tokens)
+    timings = result.timings
+    speculative = f" draft acceptance={timings['draft_acceptance_rate']:.0%}" if result.draft_tokens else ""
+    print(f"⏱️  prompt={result.prompt_tokens} completion={result.completion_tokens} "
+          f"prefill={timings['prefill_ms']}ms decode={timings['decode_ms']}ms "
+          f"({timings['decode_tokens_per_sec']} tok/s){speculative} finish={result.finish_reason}")
+
+def finish_result(result):
+    result.text = result.text.strip()
+    log_timings(result)
+    return result
+
+def generate_response(model, messages, max_tokens=150, sampling=None, stop=None):
+    """Generate response using ONNX model with KV-cached token-by-token decoding"""
+    seq = prepare_sequence(model, messages, max_tokens, sampling, stop)
+    try:
+        result = model.scheduler.generate(seq)
     except Exception as e:
         print(f"❌ ONNX generation error: {e}")
-        return f"Error generating response: {str(e)}"
+        raise
+    
+    return finish_result(result)
 
-@app.route("/health", methods=["GET"])
-def health_check():
-    """Health check endpoint"""
-    status = "healthy" if session is not None else "loading"
-    return jsonify({
+def response_cache_key(req):
+    """
+    Key for the opt-in response cache, or None when the request is not cacheable. Only deterministic
+    requests (temperature 0, or an explicit seed) are cached. The model is identified by its id and
+    export paths, not its tokenizer: a base model and its fine-tune can share a tokenizer.
+    """
+    if response_cache is None or not (req.sampling.greedy or req.seeded):
+        return None
+    # Messages are normalized to the prompt text the model actually sees
+    params = asdict(req.sampling)
+    if req.sampling.greedy:
+        params.pop("seed")
+    spec = registry.specs[req.model_id]
+    return ResponseCache.make_key(
+        model=[spec.id, spec.onnx_path, spec.draft_path],
+        prompt=build_prompt(req.messages),
+        max_tokens=int(req.max_tokens),
+        stop=sorted(normalize_stop(req.stop)),
+        sampling=params,
+    )
+
+def cached_result(key):
+    cached = response_cache.get(key)
+    if cached is None:
+        return None
+    return GenerationResult(**dict(cached, prefill_ms=0.0, decode_ms=0.0))
+
+def store_result(key, result):
+    if result.finish_reason != "cancelled":
+        response_cache.set(key, asdict(result))
+
+def cached_generate_response(req):
+    """
+    generate_response behind the opt-in response cache; hits skip the tokenizer, the session and
+    any cold model load. Returns (result, "hit"/"miss"/None).
+    """
+    key = response_cache_key(req)
+    if key is not None:
+        cached = cached_result(key)
+        if cached is not None:
+            return cached, "hit"
+    
+    with registry.acquire(req.model_id) as model:
+        result = generate_response(model, req.messages, req.max_tokens, req.sampling, req.stop)
+    if key is None:
+        return result, None
+    store_result(key, result)
+    return result, "miss"
+
+def usage_body(result):
+    return {
+        "prompt_tokens": result.prompt_tokens,
+        "completion_tokens": result.completion_tokens,
+        "total_tokens": result.prompt_tokens + result.completion_tokens,
+        "prompt_tokens_details": {"cached_tokens": result.cached_tokens}
+    }
+
+def chat_completion_body(req, result):
+    """OpenAI-compatible `chat.completion` response"""
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex[:8]}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": req.model_id,
+        "choices": [
+            {
+                "index": 0,
+                "message": {
+                    "role": "assistant",
+                    "content": result.text
+                },
+                "finish_reason": result.finish_reason
+            }
+        ],
+        "usage": usage_body(result),
+        "timings": result.timings
+    }
+
+def completion_body(req, result):
+    """OpenAI-compatible `text_completion` response"""
+    return {
+        "id": f"cmpl-{uuid.uuid4().hex[:8]}",
+        "object": "text_completion",
+        "created": int(time.time()),
+        "model": req.model_id,
+        "choices": [
+            {
+                "text": result.text,
+                "index": 0,
+                "logprobs": None,
+                "finish_reason": result.finish_reason
+            }
+        ],
+        "usage": usage_body(result),
+        "timings": result.timings
+    }
+
+class ChatChunks:
+    """Formats OpenAI `chat.completion.chunk` SSE events for one streamed completion"""
+    
+    DONE = "data: [DONE]\n\n"
+    HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    
+    def __init__(self, model_id):
+        self.chunk = {
+            "id": f"chatcmpl-{uuid.uuid4().hex[:8]}",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": model_id,
+        }
+        self.started = False
+    
+    def event(self, delta, finish_reason=None, **extra):
+        payload = dict(self.chunk, choices=[{"index": 0, "delta": delta, "finish_reason": finish_reason}], **extra)
+        return f"data: {json.dumps(payload)}\n\n"
+    
+    def role(self):
+        return self.event({"role": "assistant", "content": ""})
+    
+    def content(self, text):
+        """Event for a text delta (leading whitespace of the reply is dropped), or None"""
+        if not self.started:
+            text = text.lstrip()
+            self.started = bool(text)
+        return self.event({"content": text}) if text else None
+    
+    def finish(self, result, include_usage=False):
+        log_timings(result)
+        events = [self.event({}, result.finish_reason)]
+        if include_usage:
+            usage = {
+                "prompt_tokens": result.prompt_tokens,
+                "completion_tokens": result.completion_tokens,
+                "total_tokens": result.prompt_tokens + result.completion_tokens
+            }
+            events.append(f"data: {json.dumps(dict(self.chunk, choices=[], usage=usage, timings=result.timings))}\n\n")
+        return events + [self.DONE]
+    
+    @staticmethod
+    def error(e):
+        print(f"❌ Streaming error: {e}")
+        return f"data: {json.dumps({'error': str(e)})}\n\n"
+
+def stream_chat_completion(model, req):
+    """Yield OpenAI `chat.completion.chunk` SSE events as tokens are decoded"""
+    seq = prepare_sequence(model, req.messages, req.max_tokens, req.sampling, req.stop)
+    handle = model.scheduler.submit(seq, stream=True)
+    chunks = ChatChunks(model.id)
+    
+    def events():
+        # Werkzeug closes this generator when the client goes away; cancelling frees the batch slot
+        with metrics.track_request("chat_stream"):
+            try:
+                yield chunks.role()
+                for text in handle.stream():
+                    event = chunks.content(text)
+                    if event:
+                        yield event
+                yield from chunks.finish(handle.wait(), req.include_usage)
+            except Exception as e:
+                yield chunks.error(e)
+            finally:
+                handle.cancel()
+    
+    return Response(events(), mimetype="text/event-stream", headers=ChatChunks.HEADERS)
+
+def health_body():
+    status = "healthy" if model_ready else ("warming" if registry.loaded() else "loading")
+    return {
         "status": status,
-        "model": MODEL_NAME,
+        "model": registry.default_id,
         "device": DEVICE,
         "onnx": True,
+        "registry": registry.stats(),
+        "response_cache": response_cache.stats() if response_cache else {"enabled": False},
         "timestamp": datetime.utcnow().isoformat()
-    })
+    }
 
-@app.route("/v1/models", methods=["GET"])
-def list_models():
-    """OpenAI-compatible models endpoint"""
-    return jsonify({
+def models_body():
+    loaded = {m.id for m in registry.loaded()}
+    return {
         "object": "list",
         "data": [
             {
-                "id": MODEL_NAME.split("/")[-1],
+                "id": spec.id,
                 "object": "model",
                 "created": int(time.time()),
                 "owned_by": "local",
                 "permission": [],
-                "root": MODEL_NAME,
-                "parent": None
+                "root": spec.tokenizer,
+                "parent": None,
+                "loaded": spec.id in loaded
             }
+            for spec in registry.specs.values()
         ]
-    })
+    }
+
+def root_body():
+    return {
+        "message": "ONNX CPU Inference Server for ARM64",
+        "models": list(registry.specs),
+        "device": DEVICE,
+        "onnx": True,
+        "status": "running" if model_ready else "loading",
+        "endpoints": [
+            "/health",
+            "/metrics",
+            "/v1/models",
+            "/v1/chat/completions",
+            "/v1/completions"
+        ]
+    }
+
+@app.route("/health", methods=["GET"])
+def health_check():
+    """Health check endpoint"""
+    return jsonify(health_body())
+
+@app.route("/metrics", methods=["GET"])
+def prometheus_metrics():
+    """Prometheus scrape endpoint"""
+    body, content_type = metrics.exposition()
+    return Response(body, content_type=content_type)
+
+@app.route("/v1/models", methods=["GET"])
+def list_models():
+    """OpenAI-compatible models endpoint"""
+    return jsonify(models_body())
 
 @app.route("/v1/chat/completions", methods=["POST"])
 def chat_completions():
     """OpenAI-compatible chat completions endpoint"""
     try:
-        data = request.get_json()
-        
-        messages = data.get("messages", [])
-        max_tokens = data.get("max_tokens", 150)
-        temperature = data.get("temperature", 0.7)
-        stream = data.get("stream", False)
-        
-        if not messages:
-            return jsonify({"error": "No messages provided"}), 400
+        req = parse_request(request.get_json(), chat=True)
         
-        if not session:
-            return jsonify({"error": "Model not loaded"}), 503
+        if req.stream:
+            # The model stays pinned (not evictable) until the WSGI server closes the stream
+            model = registry.checkout(req.model_id)
+            try:
+                response = stream_chat_completion(model, req)
+            except Exception:
+                registry.release(model)
+                raise
+            response.call_on_close(lambda: registry.release(model))
+            return response
         
         # Generate response
-        response_text = generate_response(messages, max_tokens, temperature)
+        with metrics.track_request("chat"):
+            result, cache_status = cached_generate_response(req)
         
-        # Create OpenAI-compatible response
-        response_data = {
-            "id": f"chatcmpl-{uuid.uuid4().hex[:8]}",
-            "object": "chat.completion",
-            "created": int(time.time()),
-            "model": MODEL_NAME.split("/")[-1],
-            "choices": [
-                {
-                    "index": 0,
-                    "message": {
-                        "role": "assistant",
-                        "content": response_text
-                    },
-                    "finish_reason": "stop"
-                }
-            ],
-            "usage": {
-                "prompt_tokens": len(tokenizer.encode(str(messages))),
-                "completion_tokens": len(tokenizer.encode(response_text)),
-                "total_tokens": len(tokenizer.encode(str(messages) + response_text))
-            }
-        }
-        
-        if stream:
-            # Simple streaming response
-            def generate_stream():
-                yield f"data: {json.dumps(response_data)}\n\n"
-                yield "data: [DONE]\n\n"
-            
-            return Response(generate_stream(), mimetype="text/plain")
-        
-        return jsonify(response_data)
+        response = jsonify(chat_completion_body(req, result))
+        if cache_status:
+            response.headers["x-cache"] = cache_status
+        return response
         
+    except ApiError as e:
+        return jsonify({"error": str(e)}), e.status
+    except ModelCapacityError as e:
+        return jsonify({"error": str(e)}), 503
     except Exception as e:
         print(f"❌ Chat completion error: {e}")
         return jsonify({"error": str(e)}), 500
@@ -189,42 +546,20 @@ def chat_completions():
 def completions():
     """OpenAI-compatible completions endpoint"""
     try:
-        data = request.get_json()
-        
-        prompt = data.get("prompt", "")
-        max_tokens = data.get("max_tokens", 150)
-        temperature = data.get("temperature", 0.7)
+        req = parse_request(request.get_json(), chat=False)
         
-        if not prompt:
-            return jsonify({"error": "No prompt provided"}), 400
-        
-        if not session:
-            return jsonify({"error": "Model not loaded"}), 503
-        
-        # Convert to message format
-        messages = [{"role": "user", "content": prompt}]
-        response_text = generate_response(messages, max_tokens, temperature)
+        with metrics.track_request("completions"):
+            result, cache_status = cached_generate_response(req)
         
-        return jsonify({
-            "id": f"cmpl-{uuid.uuid4().hex[:8]}",
-            "object": "text_completion",
-            "created": int(time.time()),
-            "model": MODEL_NAME.split("/")[-1],
-            "choices": [
-                {
-                    "text": response_text,
-                    "index": 0,
-                    "logprobs": None,
-                    "finish_reason": "stop"
-                }
-            ],
-            "usage": {
-                "prompt_tokens": len(tokenizer.encode(prompt)),
-                "completion_tokens": len(tokenizer.encode(response_text)),
-                "total_tokens": len(tokenizer.encode(prompt + response_text))
-            }
-        })
+        response = jsonify(completion_body(req, result))
+        if cache_status:
+            response.headers["x-cache"] = cache_status
+        return response
         
+    except ApiError as e:
+        return jsonify({"error": str(e)}), e.status
+    except ModelCapacityError as e:
+        return jsonify({"error": str(e)}), 503
     except Exception as e:
         print(f"❌ Completion error: {e}")
         return jsonify({"error": str(e)}), 500
@@ -232,19 +567,203 @@ def completions():
 @app.route("/", methods=["GET"])
 def root():
     """Root endpoint"""
-    return jsonify({
-        "message": "ONNX CPU Inference Server for ARM64",
-        "model": MODEL_NAME,
-        "device": DEVICE,
-        "onnx": True,
-        "status": "running" if session else "loading",
-        "endpoints": [
-            "/health",
-            "/v1/models",
-            "/v1/chat/completions",
-            "/v1/completions"
-        ]
+    return jsonify(root_body())
+
+# Pytest tests
+def _use_stub_model(**session_kwargs):
+    global model_ready
+    from cpu_inference_stub import StubSession, StubTokenizer
+    model = install_model(StubSession(**session_kwargs), StubTokenizer())
+    model_ready = True
+    return model
+
+def test_chat_completion_generates_new_tokens():
+    _use_stub_model()
+    resp = app.test_client().post("/v1/chat/completions", json={
+        "messages": [{"role": "user", "content": "hi"}], "max_tokens": 8,
     })
+    body = resp.get_json()
+    assert resp.status_code == 200
+    assert body["usage"]["completion_tokens"] == 8
+    assert body["choices"][0]["finish_reason"] == "length"
+    assert body["timings"]["prefill_ms"] >= 0 and "decode_ms" in body["timings"]
+
+def test_completion_honours_eos():
+    _use_stub_model(eos_after=len("User: hi\nAssistant: ") + 2)
+    resp = app.test_client().post("/v1/completions", json={"prompt": "hi", "max_tokens": 50, "temperature": 0})
+    body = resp.get_json()
+    assert body["usage"]["completion_tokens"] == 2
+    assert body["choices"][0]["finish_reason"] == "stop"
+
+def test_chat_completion_streams_chunks():
+    _use_stub_model()
+    client = app.test_client()
+    payload = {"messages": [{"role": "user", "content": "hi"}], "max_tokens": 8, "temperature": 0}
+    full = client.post("/v1/chat/completions", json=payload).get_json()
+    resp = client.post("/v1/chat/completions", json=dict(payload, stream=True, stream_options={"include_usage": True}))
+    assert resp.mimetype == "text/event-stream"
+    events = [line[len("data: "):] for line in resp.get_data(as_text=True).split("\n\n") if line]
+    assert events[-1] == "[DONE]"
+    chunks = [json.loads(e) for e in events[:-1]]
+    assert all(c["object"] == "chat.completion.chunk" for c in chunks)
+    content = [c["choices"][0]["delta"].get("content") for c in chunks if c["choices"]]
+    assert "".join(c for c in content if c) == full["choices"][0]["message"]["content"]
+    assert chunks[-2]["choices"][0]["finish_reason"] == "length"
+    assert chunks[-1]["usage"]["completion_tokens"] == 8
+
+def test_stream_stops_decoding_on_disconnect():
+    model = _use_stub_model()
+    resp = app.test_client().post("/v1/chat/completions", buffered=False, json={
+        "messages": [{"role": "user", "content": "hi"}], "max_tokens": MAX_LENGTH - 20, "stream": True,
+    })
+    stream = iter(resp.response)
+    next(stream)
+    next(stream)
+    resp.close()
+    deadline = time.time() + 5
+    while model.scheduler.active_count and time.time() < deadline:
+        time.sleep(0.01)
+    assert model.scheduler.active_count == 0 and model.in_use == 0
+    assert len(model.session.calls) < MAX_LENGTH - 20
+
+def test_follow_up_turn_hits_prefix_cache():
+    _use_stub_model()
+    client = app.test_client()
+    messages = [{"role": "user", "content": "tell me about the oracle node"}]
+    first = client.post("/v1/chat/completions", json={"messages": messages, "max_tokens": 6}).get_json()
+    messages += [first["choices"][0]["message"], {"role": "user", "content": "and then?"}]
+    second = client.post("/v1/chat/completions", json={"messages": messages, "max_tokens": 6}).get_json()
+    assert second["usage"]["prompt_tokens_details"]["cached_tokens"] > 0
+    prefix_cache = client.get("/health").get_json()["registry"]["models"][registry.default_id]["prefix_cache"]
+    assert prefix_cache["hits"] == 1 and prefix_cache["misses"] == 1
+
+def test_deterministic_requests_hit_response_cache():
+    global response_cache
+    session = _use_stub_model().session
+    response_cache = ResponseCache(ttl_seconds=60, max_entries=8)
+    client = app.test_client()
+    try:
+        payload = {"prompt": "classify: ok", "max_tokens": 5, "temperature": 0}
+        miss = client.post("/v1/completions", json=payload)
+        calls = len(session.calls)
+        hit = client.post("/v1/completions", json=payload)
+        assert (miss.headers["x-cache"], hit.headers["x-cache"]) == ("miss", "hit")
+        assert hit.get_json()["choices"] == miss.get_json()["choices"]
+        assert len(session.calls) == calls
+        sampled = client.post("/v1/completions", json=dict(payload, temperature=0.7))
+        assert "x-cache" not in sampled.headers
+    finally:
+        response_cache = None
+
+def test_response_cache_keys_models_sharing_a_tokenizer_apart():
+    global registry, response_cache
+    _use_stub_model()
+    specs = [ModelSpec("gpt2", "gpt2", "/m/gpt2"), ModelSpec("gpt2-ft", "gpt2", "/m/gpt2-ft")]
+    default_registry, registry = registry, ModelRegistry(specs, 100, lambda spec: None)
+    response_cache = ResponseCache(ttl_seconds=60, max_entries=8)
+    try:
+        payload = {"prompt": "classify: ok", "max_tokens": 5, "temperature": 0}
+        keys = {response_cache_key(parse_request(dict(payload, model=spec.id), chat=False)) for spec in specs}
+        assert len(keys) == 2 and None not in keys
+    finally:
+        registry, response_cache = default_registry, None
+
+def test_seeded_sampling_is_reproducible():
+    _use_stub_model()
+    client = app.test_client()
+    payload = {"prompt": "pick", "max_tokens": 12, "temperature": 1.5, "top_p": 0.95, "seed": 7}
+    texts = {client.post("/v1/completions", json=payload).get_json()["choices"][0]["text"] for _ in range(3)}
+    assert len(texts) == 1
+    greedy = client.post("/v1/completions", json=dict(payload, temperature=0)).get_json()["choices"][0]["text"]
+    assert texts != {greedy}
+    bad = client.post("/v1/completions", json=dict(payload, top_p=0))
+    assert bad.status_code == 400
+
+def test_speculative_decoding_keeps_output_and_reports_acceptance():
+    from cpu_inference_stub import StubSession, StubTokenizer
+    client = app.test_client()
+    request_body = {"messages": [{"role": "user", "content": "hello"}], "max_tokens": 24, "temperature": 0}
+    _use_stub_model()
+    plain = client.post("/v1/chat/completions", json=request_body).get_json()
+    install_model(StubSession(), StubTokenizer(), draft_session=StubSession(num_layers=1, disagree_every=5))
+    body = client.post("/v1/chat/completions", json=request_body).get_json()
+    assert body["choices"][0]["message"]["content"] == plain["choices"][0]["message"]["content"]
+    assert 0 < body["timings"]["draft_acceptance_rate"] <= 1
+    assert "draft_acceptance_rate" not in plain["timings"]
+    assert client.get("/health").get_json()["registry"]["models"][registry.default_id]["scheduler"]["speculative_tokens"] > 0
+
+def test_health_reports_healthy_only_after_warmup():
+    global model_ready
+    model = _use_stub_model()
+    model_ready = False
+    client = app.test_client()
+    assert client.get("/health").get_json()["status"] == "warming"
+    assert client.post("/v1/completions", json={"prompt": "hi"}).status_code == 503
+    warmup_model(model, runs=1)
+    model_ready = True
+    health = client.get("/health").get_json()
+    assert health["status"] == "healthy"
+    assert health["registry"]["models"][model.id]["prefix_cache"]["entries"] == 0
+
+def test_metrics_endpoint_exposes_hot_path_series():
+    from prometheus_client.parser import text_string_to_metric_families
+    _use_stub_model()
+    client = app.test_client()
+    def scrape():
+        text = client.get("/metrics").get_data(as_text=True)
+        return {s.name + str(sorted(s.labels.items())): s.value
+                for family in text_string_to_metric_families(text) for s in family.samples}
+    before = scrape()
+    client.post("/v1/completions", json={"prompt": "hi", "max_tokens": 5, "temperature": 0})
+    after = scrape()
+    def delta(name):
+        return after[name] - before.get(name, 0)
+    assert delta("cpu_inference_completion_tokens_total[]") == 5
+    assert delta("cpu_inference_prompt_tokens_total[]") == len("User: hi\nAssistant: ")
+    assert delta("cpu_inference_tokenize_seconds_count[]") == 1
+    assert delta("cpu_inference_prefill_seconds_count[]") == 1
+    assert delta("cpu_inference_decode_step_seconds_count[]") == 4
+    assert delta("cpu_inference_request_seconds_count[('endpoint', 'completions')]") == 1
+    assert after["cpu_inference_in_flight_requests[]"] == 0
+    assert after["cpu_inference_queue_depth[]"] == 0
+
+def test_requests_route_to_lazily_loaded_models():
+    global registry, model_ready
+    from cpu_inference_stub import StubSession, StubTokenizer
+    def load(spec):
+        # Each stub "weighs" 40 bytes; the budget fits two
+        return LoadedModel(spec, StubSession(), StubTokenizer(), info={"model_bytes": 40})
+    specs = [ModelSpec(model_id, f"org/{model_id}", "") for model_id in ("small", "medium", "large")]
+    default_registry, registry = registry, ModelRegistry(specs, 100, load, estimate_fn=lambda spec: 40)
+    model_ready = True
+    client = app.test_client()
+    try:
+        assert not any(m["loaded"] for m in client.get("/v1/models").get_json()["data"])
+        for name in ("medium", "org/small", None, "large"):
+            payload = {"prompt": "hi", "max_tokens": 3, "model": name}
+            resp = client.post("/v1/completions", json=payload)
+            assert resp.status_code == 200
+        assert resp.get_json()["model"] == "large"
+        assert client.post("/v1/completions", json={"prompt": "hi", "model": "nope"}).status_code == 404
+        events = [(e["event"], e["model"]) for e in client.get("/health").get_json()["registry"]["events"]]
+        assert events == [("load", "medium"), ("load", "small"), ("evict", "medium"), ("load", "large")]
+        assert [m["id"] for m in client.get("/v1/models").get_json()["data"] if m["loaded"]] == ["small", "large"]
+    finally:
+        for model in registry.loaded():
+            model.close()
+        registry = default_registry
+
+def test_concurrent_requests_share_batches():
+    from concurrent.futures import ThreadPoolExecutor
+    session = _use_stub_model().session
+    client = app.test_client()
+    def ask(i):
+        return client.post("/v1/chat/completions", json={
+            "messages": [{"role": "user", "content": f"question {i}"}], "max_tokens": 20,
+        }).status_code
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        assert list(pool.map(ask, range(4))) == [200] * 4
+    assert max(shape[0] for shape in session.calls) > 1
 
 if __name__ == "__main__":
     print(f"🔄 Starting ONNX model loading process...")
@@ -259,10 +778,24 @@ if __name__ == "__main__":
         else:
             print(f"❌ ONNX model loading failed")
     
-    # Start model loading in background
-    loading_thread = threading.Thread(target=load_model_background)
-    loading_thread.daemon = True
-    loading_thread.start()
+    def start_loading():
+        # Start model loading in background
+        loading_thread = threading.Thread(target=load_model_background)
+        loading_thread.daemon = True
+        loading_thread.start()
     
-    print(f"🌐 Starting server on port {PORT}")
-    app.run(host="0.0.0.0", port=PORT, debug=False)
\ No newline at end of file
+    if PREFORK_WORKERS > 1:
+        from werkzeug.serving import make_server
+        from cpu_inference_prefork import listen, serve
+        share_preloaded_models(PREFORK_WORKERS)
+
+        def run_worker(sock, index):
+            start_loading()
+            make_server("0.0.0.0", PORT, app, threaded=True, fd=sock.fileno()).serve_forever()
+
+        print(f"🌐 Starting server on port {PORT} with {PREFORK_WORKERS} pre-forked workers")
+        serve(listen("0.0.0.0", PORT), PREFORK_WORKERS, run_worker)
+    else:
+        start_loading()
+        print(f"🌐 Starting server on port {PORT}")
+        app.run(host="0.0.0.0", port=PORT, debug=False)
@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+"""
+ONNX Runtime session setup for the CPU inference server.
+Builds tuned SessionOptions from env, optionally produces a dynamically quantized INT8 variant of the
+model, and caches the fully optimized graph on disk so later starts skip both quantization and graph
+optimization. The cache is keyed on the source model (path, size, mtime), so one ONNX_CACHE_DIR can
+serve several models, and on ORT version, CPU architecture and options, since an optimized graph
+saved with ORT_ENABLE_ALL may contain hardware-specific kernels.
+A pre-fork master calls share_model() to load the optimized graph's weights into memory once;
+sessions created after the fork take them through SessionOptions.add_initializer, which uses those
+buffers instead of copies, so the weights stay copy-on-write pages shared by every worker. Weight
+prepacking is off for those sessions, since prepacked copies would be private to each worker again.
+"""
+
+import hashlib
+import os
+import platform
+import time
+
+import onnxruntime as ort
+
+OPT_LEVELS = {
+    "disable": ort.GraphOptimizationLevel.ORT_DISABLE_ALL,
+    "basic": ort.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    "extended": ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    "all": ort.GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
+
+
+# Model dir -> (cache tag, graph path, {initializer name: array}), filled by share_model in a pre-fork master
+_shared = {}
+
+
+def _env_flag(name: str, default: str) -> bool:
+    return os.getenv(name, default).lower() in ("1", "true", "yes", "on")
+
+
+def session_settings() -> dict:
+    """Session tuning knobs read from env (defaults suit a 4-core ARM node)."""
+    return {
+        "quantize": os.getenv("ONNX_QUANTIZE", "none").lower(),
+        "opt_level": os.getenv("ONNX_OPT_LEVEL", "all").lower(),
+        "intra_op_threads": int(os.getenv("ORT_INTRA_OP_THREADS", str(os.cpu_count() or 1))),
+        "inter_op_threads": int(os.getenv("ORT_INTER_OP_THREADS", "1")),
+        "cpu_mem_arena": _env_flag("ORT_CPU_MEM_ARENA", "1"),
+        "mem_pattern": _env_flag("ORT_MEM_PATTERN", "1"),
+        "allow_spinning": _env_flag("ORT_ALLOW_SPINNING", "1"),
+        "cache_dir": os.getenv("ONNX_CACHE_DIR", ""),
+    }
+
+
+def build_session_options(settings: dict, optimized_path: str = None) -> ort.SessionOptions:
+    options = ort.SessionOptions()
+    options.graph_optimization_level = OPT_LEVELS.get(settings["opt_level"], OPT_LEVELS["all"])
+    options.intra_op_num_threads = settings["intra_op_threads"]
+    options.inter_op_num_threads = settings["inter_op_threads"]
+    options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+    options.enable_cpu_mem_arena = settings["cpu_mem_arena"]
+    options.enable_mem_pattern = settings["mem_pattern"]
+    options.add_session_config_entry("session.intra_op.allow_spinning", "1" if settings["allow_spinning"] else "0")
+    if optimized_path:
+        options.optimized_model_filepath = optimized_path
+    return options
+
+
+def _fresh(path: str, source: str) -> bool:
+    return os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(source)
+
+
+def _model_bytes(path: str) -> int:
+    """Graph plus external weights on disk, a proxy for the weights' resident footprint."""
+    return sum(os.path.getsize(p) for p in (path, path + "_data") if os.path.exists(p))
+
+
+def quantize_int8(source: str, target: str) -> str:
+    """Dynamic (weight-only scale, activation-at-runtime) INT8 quantization of MatMul/Gemm weights."""
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    if _fresh(target, source):
+        return target
+    start = time.perf_counter()
+    print(f"🧮 Quantizing {source} to INT8 (one-off, cached at {target})")
+    quantize_dynamic(
+        source,
+        target,
+        weight_type=QuantType.QInt8,
+        op_types_to_quantize=["MatMul", "Gemm"],
+        use_external_data_format=os.path.exists(source + "_data"),
+    )
+    print(f"🧮 Quantized in {time.perf_counter() - start:.1f}s")
+    return target
+
+
+def source_key(source: str) -> str:
+    """Identifies one export: its path, plus size and mtime of the graph and external weights."""
+    parts = [os.path.abspath(source)]
+    for path in (source, source + "_data"):
+        if os.path.exists(path):
+            stat = os.stat(path)
+            parts.append(f"{stat.st_size}:{stat.st_mtime_ns}")
+    return hashlib.sha256("|".join(parts).encode()).hexdigest()[:16]
+
+
+def _cache_paths(model_dir: str, settings: dict):
+    """(variant, source model path, cache tag, cache dir); quantizes on the first INT8 start."""
+    source = os.path.join(model_dir, "model.onnx")
+    # One subdirectory per source model: a shared ONNX_CACHE_DIR serves several models and drafts
+    key = source_key(source)
+    cache_dir = os.path.join(settings["cache_dir"] or os.path.join(model_dir, ".ort_cache"), key)
+    os.makedirs(cache_dir, exist_ok=True)
+
+    variant = "int8" if settings["quantize"] == "int8" else "fp32"
+    quantized = os.path.join(cache_dir, f"model.{key}.int8.onnx")
+    model_path = quantize_int8(source, quantized) if variant == "int8" else source
+    tag = f"{key}.{variant}.{settings['opt_level']}.ort{ort.__version__}.{platform.machine()}"
+    return variant, model_path, tag, cache_dir
+
+
+def share_model(model_dir: str, settings: dict = None) -> dict:
+    """
+    Pre-fork master: make sure the optimized graph is cached and load its initializers, so create_session
+    in forked workers hands ORT these arrays instead of deserializing private copies. Needs onnx.
+    """
+    import onnx
+    from onnx import numpy_helper
+    settings = settings or session_settings()
+    _, model_path, tag, cache_dir = _cache_paths(model_dir, settings)
+    graph_path = model_path
+    if settings["opt_level"] != "disable":
+        graph_path = os.path.join(cache_dir, f"model.{tag}.onnx")
+        if not _fresh(graph_path, model_path):
+            options = build_session_options(settings, graph_path)
+            ort.InferenceSession(model_path, sess_options=options, providers=["CPUExecutionProvider"])
+    graph = onnx.load(graph_path)
+    arrays = {t.name: numpy_helper.to_array(t) for t in graph.graph.initializer}
+    _shared[os.path.abspath(model_dir)] = (tag, graph_path, arrays)
+    return {"path": graph_path, "initializers": len(arrays), "model_bytes": sum(a.nbytes for a in arrays.values())}
+
+
+def create_session(model_dir: str, settings: dict = None):
+    """
+    Return (session, info). The first start quantizes (if asked) and writes the optimized graph to the
+    cache; later starts load that graph with optimizations disabled, which is what cuts cold-start time.
+    A model shared by share_model uses the master's weight arrays instead of its own copy.
+    """
+    settings = settings or session_settings()
+    variant, model_path, tag, cache_dir = _cache_paths(model_dir, settings)
+    optimized = os.path.join(cache_dir, f"model.{tag}.onnx")
+    shared_tag, shared_graph, shared_arrays = _shared.get(os.path.abspath(model_dir), (None, None, None))
+
+    start = time.perf_counter()
+    providers = ["CPUExecutionProvider"]
+    if shared_tag == tag:
+        options = build_session_options(dict(settings, opt_level="disable"))
+        options.add_session_config_entry("session.disable_prepacking", "1")
+        values = [ort.OrtValue.ortvalue_from_numpy(array) for array in shared_arrays.values()]
+        for name, value in zip(shared_arrays, values):
+            options.add_initializer(name, value)
+        session = ort.InferenceSession(shared_graph, sess_options=options, providers=providers)
+        session.shared_initializers = values  # ORT reads these buffers; they must live as long as the session
+        model_bytes = sum(array.nbytes for array in shared_arrays.values())
+        graph_cache = "shared"
+    elif settings["opt_level"] != "disable" and _fresh(optimized, model_path):
+        options = build_session_options(dict(settings, opt_level="disable"))
+        session = ort.InferenceSession(optimized, sess_options=options, providers=providers)
+        model_bytes = _model_bytes(optimized)
+        graph_cache = "hit"
+    else:
+        save_to = optimized if settings["opt_level"] != "disable" else None
+        options = build_session_options(settings, save_to)
+        session = ort.InferenceSession(model_path, sess_options=options, providers=providers)
+        model_bytes = _model_bytes(model_path)
+        graph_cache = "miss" if save_to else "off"
+
+    info = {
+        "variant": variant,
+        "opt_level": settings["opt_level"],
+        "graph_cache": graph_cache,
+        "intra_op_threads": settings["intra_op_threads"],
+        "inter_op_threads": settings["inter_op_threads"],
+        "model_bytes": model_bytes,
+        "load_seconds": round(time.perf_counter() - start, 3),
+    }
+    return session, info
+
+
+# Pytest tests
+def _tiny_matmul_model(path, seed=0):
+    import numpy as np
+    import onnx
+    from onnx import TensorProto, helper, numpy_helper
+    weight = numpy_helper.from_array(np.random.default_rng(seed).normal(size=(64, 64)).astype(np.float32), "w")
+    graph = helper.make_graph(
+        [helper.make_node("MatMul", ["x", "w"], ["y"]), helper.make_node("Relu", ["y"], ["logits"])],
+        "tiny",
+        [helper.make_tensor_value_info("x", TensorProto.FLOAT, ["batch", 64])],
+        [helper.make_tensor_value_info("logits", TensorProto.FLOAT, ["batch", 64])],
+        initializer=[weight],
+    )
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid("", 17)])
+    model.ir_version = 8
+    onnx.save(model, path)
+
+
+def test_int8_model_and_optimized_graph_are_cached(tmp_path):
+    import numpy as np
+    _tiny_matmul_model(str(tmp_path / "model.onnx"))
+    settings = dict(session_settings(), quantize="int8", opt_level="all", intra_op_threads=1, cache_dir="")
+
+    session, info = create_session(str(tmp_path), settings)
+    assert (info["variant"], info["graph_cache"]) == ("int8", "miss") and info["model_bytes"] > 0
+    key = source_key(str(tmp_path / "model.onnx"))
+    quantized = tmp_path / ".ort_cache" / key / f"model.{key}.int8.onnx"
+    assert quantized.exists()
+    mtime = quantized.stat().st_mtime
+    x = np.ones((2, 64), dtype=np.float32)
+    first = session.run(None, {"x": x})[0]
+
+    session, info = create_session(str(tmp_path), settings)
+    assert info["graph_cache"] == "hit" and quantized.stat().st_mtime == mtime
+    assert np.allclose(session.run(None, {"x": x})[0], first)
+
+
+def test_models_sharing_one_cache_dir_keep_their_own_weights(tmp_path):
+    import numpy as np
+    x = np.ones((2, 64), dtype=np.float32)
+    for quantize in ("none", "int8"):
+        settings = dict(session_settings(), quantize=quantize, opt_level="all", intra_op_threads=1,
+                        cache_dir=str(tmp_path / f"cache-{quantize}"))
+        outputs = {}
+        for name, seed in (("a", 0), ("b", 1)):
+            (tmp_path / name).mkdir(exist_ok=True)
+            _tiny_matmul_model(str(tmp_path / name / "model.onnx"), seed)
+            create_session(str(tmp_path / name), settings)  # miss: writes the cache
+            session, info = create_session(str(tmp_path / name), settings)
+            assert info["graph_cache"] == "hit"
+            outputs[name] = session.run(None, {"x": x})[0]
+        assert not np.allclose(outputs["a"], outputs["b"])
+
+
+def test_shared_model_bytes_serve_the_same_graph(tmp_path):
+    import numpy as np
+    _tiny_matmul_model(str(tmp_path / "model.onnx"))
+    settings = dict(session_settings(), quantize="none", opt_level="all", intra_op_threads=1, cache_dir="")
+    x = np.ones((3, 64), dtype=np.float32)
+    reference = create_session(str(tmp_path), settings)[0].run(None, {"x": x})[0]
+    try:
+        shared = share_model(str(tmp_path), settings)
+        assert shared["initializers"] == 1 and shared["model_bytes"] == 64 * 64 * 4
+        session, info = create_session(str(tmp_path), settings)
+        assert info["graph_cache"] == "shared" and info["model_bytes"] == shared["model_bytes"]
+        del shared
+        churn = [np.full(1 << 16, np.nan) for _ in range(64)]  # reuse of any freed buffer would show up
+        del churn
+        assert np.allclose(session.run(None, {"x": x})[0], reference)
+        # Different settings mean a different graph: those sessions do not use the shared weights
+        assert create_session(str(tmp_path), dict(settings, quantize="int8"))[1]["graph_cache"] == "miss"
+    finally:
+        _shared.clear()
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+"""
+Speculative decoding for the ONNX CPU inference server.
+A much smaller draft model sharing the tokenizer proposes up to k tokens per sequence with k cheap
+forward passes; the main model then scores every proposal in one batched pass and keeps the longest
+prefix that passes the rejection test of Leviathan et al. / Chen et al. (2023): a draft token x is
+accepted with probability min(1, p(x) / q(x)), and the first rejected one is replaced by a sample
+from norm(max(p - q, 0)). When all k are accepted the same pass yields a bonus token. Emitted tokens
+therefore follow exactly the main model's sampling distribution - greedy output is token-for-token
+identical - while one pass of the expensive model emits up to k + 1 tokens.
+
+p and q are the full post-processing distributions (penalties, temperature, top-k, top-p). Each
+model keeps its own KV cache on the Sequence (`past` / `draft_past`); entries for rejected drafts
+are dropped after every step. Randomness stays counter-based, on streams separate from plain
+sampling, so seeded requests are reproducible.
+"""
+
+from typing import List, Optional, Sequence as Seq, Tuple
+
+import numpy as np
+
+from cpu_inference_engine import DecoderIO, Sequence, forward_batch
+from cpu_inference_sampling import distribution, uniform
+
+# Seed offsets of the three random streams (draft proposals, acceptance tests, resampling)
+_DRAFT_STREAM = np.uint64(0x5DEECE66D)
+_ACCEPT_STREAM = np.uint64(0x2545F4914F6CDD1D)
+_RESAMPLE_STREAM = np.uint64(0xD1B54A32D192ED03)
+
+
+def _uniforms(seq: Sequence, stream: np.uint64, steps) -> np.ndarray:
+    steps = np.asarray(steps, dtype=np.uint64)
+    return uniform(np.full(steps.shape, np.uint64(seq.sampling.seed) ^ stream, dtype=np.uint64), steps)
+
+
+def _pick(weights: np.ndarray, u: float) -> int:
+    """Inverse-CDF draw from non-negative weights; zero-weight ids are never returned."""
+    cdf = np.cumsum(weights)
+    return min(int(np.searchsorted(cdf, u * cdf[-1], side="right")), len(weights) - 1)
+
+
+def _align(p: np.ndarray, q: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Exports of one family often pad the vocabulary differently; missing ids get zero probability."""
+    width = max(len(p), len(q))
+    return np.pad(p, (0, width - len(p))), np.pad(q, (0, width - len(q)))
+
+
+def _keep_matching(past: Optional[List[np.ndarray]], fed: List[int], tokens: List[int],
+                   start: int) -> Optional[List[np.ndarray]]:
+    """Cut a KV cache fed with `fed` back to the prefix that agrees with the sequence's real tokens."""
+    if past is None:
+        return None
+    length = past[0].shape[2]
+    keep = min(start, length)
+    while keep < min(length, len(tokens)) and fed[keep] == tokens[keep]:
+        keep += 1
+    if keep == length:
+        return past
+    return [np.ascontiguousarray(p[:, :, :keep]) for p in past]
+
+
+def _context(past: Optional[List[np.ndarray]]) -> int:
+    return 0 if past is None else past[0].shape[2]
+
+
+def _distribution(logits: np.ndarray, seqs: List[Sequence], extra: List[List[int]]) -> np.ndarray:
+    """Sampling distributions with each sequence's history extended by `extra` (drafts so far)."""
+    return distribution(logits, [s.sampling for s in seqs], [s.prompt_ids for s in seqs],
+                        [s.generated_ids + e for s, e in zip(seqs, extra)])
+
+
+def verify(draft_ids: Seq[int], draft_probs: Seq[np.ndarray], target_probs: Seq[np.ndarray],
+           u_accept: np.ndarray, u_resample: np.ndarray) -> Tuple[List[int], int]:
+    """
+    Rejection step for one sequence. `draft_probs[i]` is q at draft position i; `target_probs` has one
+    more row, p after the last draft token. Returns the tokens to emit and how many drafts survived.
+    """
+    tokens = []
+    for i, token in enumerate(draft_ids):
+        p, q = _align(target_probs[i], draft_probs[i])
+        # u < min(1, p/q) without the division; q[token] > 0 because the draft sampled it
+        if u_accept[i] * q[token] < p[token]:
+            tokens.append(token)
+            continue
+        residual = np.maximum(p - q, 0.0)
+        tokens.append(_pick(residual if residual.sum() > 0 else p, u_resample[i]))
+        return tokens, i
+    tokens.append(_pick(target_probs[len(draft_ids)], u_resample[len(draft_ids)]))
+    return tokens, len(draft_ids)
+
+
+class SpeculativeDecoder:
+    """Drafts with `draft`, verifies with `target`; both must be KV-cached exports sharing a tokenizer."""
+
+    def __init__(self, target: DecoderIO, draft: DecoderIO, num_tokens: int = 4):
+        if not (target.has_past and draft.has_past):
+            raise ValueError("Speculative decoding needs past_key_values exports of both the model and the draft")
+        self.target = target
+        self.draft = draft
+        self.num_tokens = max(1, int(num_tokens))
+
+    def step(self, seqs: List[Sequence], tokenizer) -> None:
+        """One decode step for every sequence: draft, verify in one target pass, append 1..k+1 tokens."""
+        # Never draft past the token budget: the verify pass always adds one token of its own
+        budgets = [max(0, min(self.num_tokens, seq.max_tokens - len(seq.generated_ids) - 1)) for seq in seqs]
+        drafts: List[List[int]] = [[] for _ in seqs]
+        draft_probs: List[List[np.ndarray]] = [[] for _ in seqs]
+        for i in range(max(budgets)):
+            rows = [r for r, budget in enumerate(budgets) if budget > i]
+            batch = [seqs[r] for r in rows]
+            # The first round also catches the draft cache up on the prompt and last step's tokens
+            feeds = [(seqs[r].prompt_ids + seqs[r].generated_ids + drafts[r])[_context(seqs[r].draft_past):]
+                     for r in rows]
+            logits = forward_batch(self.draft, batch, feeds, past_attr="draft_past")
+            probs = _distribution(logits, batch, [drafts[r] for r in rows])
+            for row, r in enumerate(rows):
+                u = _uniforms(seqs[r], _DRAFT_STREAM, [len(seqs[r].generated_ids) + i])[0]
+                drafts[r].append(_pick(probs[row], u))
+                draft_probs[r].append(probs[row])
+
+        feeds = [(seq.prompt_ids + seq.generated_ids)[seq.context_len:] + d for seq, d in zip(seqs, drafts)]
+        logits = forward_batch(self.target, seqs, feeds, all_positions=True)
+        # One verify row per draft position plus the bonus position, with the history at that point
+        rows, cols, histories = [], [], []
+        for r, (seq, d) in enumerate(zip(seqs, drafts)):
+            first = len(feeds[r]) - len(d) - 1
+            for i in range(len(d) + 1):
+                rows.append(r)
+                cols.append(first + i)
+                histories.append(d[:i])
+        target_probs = _distribution(logits[rows, cols], [seqs[r] for r in rows], histories)
+
+        offset = 0
+        for r, (seq, d) in enumerate(zip(seqs, drafts)):
+            start = len(seq.prompt_ids) + len(seq.generated_ids)
+            fed = seq.prompt_ids + seq.generated_ids + d
+            steps = len(seq.generated_ids) + np.arange(len(d) + 1)
+            # Under greedy sampling p and q are one-hot, so this keeps drafts equal to the argmax
+            tokens, accepted = verify(d, draft_probs[r], target_probs[offset:offset + len(d) + 1],
+                                      _uniforms(seq, _ACCEPT_STREAM, steps), _uniforms(seq, _RESAMPLE_STREAM, steps))
+            offset += len(d) + 1
+            seq.draft_tokens += len(d)
+            seq.accepted_tokens += accepted
+            for token in tokens:
+                seq.append(token, tokenizer)
+                if seq.finished:
+                    break
+            actual = seq.prompt_ids + seq.generated_ids
+            seq.past = _keep_matching(seq.past, fed, actual, start)
+            seq.draft_past = _keep_matching(seq.draft_past, fed, actual, start)
+
+
+# Pytest tests
+def _stub_decoders(**draft_kw):
+    from cpu_inference_stub import StubSession
+    target, draft = StubSession(), StubSession(num_layers=1, **draft_kw)
+    return target, draft, SpeculativeDecoder(DecoderIO(target), DecoderIO(draft), num_tokens=4)
+
+
+def test_verify_preserves_target_distribution():
+    rng = np.random.default_rng(3)
+    p, q = rng.dirichlet(np.ones(6)), rng.dirichlet(np.ones(6))
+    trials = 20000
+    counts = np.zeros(6)
+    for seed in range(trials):
+        u = uniform(np.full(5, seed, dtype=np.uint64), np.arange(5, dtype=np.uint64))
+        tokens, _ = verify([_pick(q, u[0])], [q], [p, p], u[1:3], u[3:])
+        counts[tokens[0]] += 1
+    assert np.abs(counts / trials - p).max() < 0.015
+
+
+def test_greedy_output_matches_plain_decoding():
+    from cpu_inference_engine import generate
+    from cpu_inference_scheduler import BatchScheduler
+    from cpu_inference_stub import StubSession, StubTokenizer
+    tokenizer = StubTokenizer()
+    target, _, decoder = _stub_decoders(disagree_every=4)
+    scheduler = BatchScheduler(DecoderIO(target), tokenizer, max_batch_size=4, speculative=decoder).start()
+    try:
+        prompts = ["User: hello\nAssistant: ", "abc", "The quick brown fox"]
+        seqs = [Sequence(prompt_ids=tokenizer.encode(p), max_tokens=n) for p, n in zip(prompts, (30, 7, 1))]
+        reqs = [scheduler.submit(seq) for seq in seqs]
+        results = [req.wait(10) for req in reqs]
+    finally:
+        scheduler.stop()
+    for prompt, n, result in zip(prompts, (30, 7, 1), results):
+        plain = generate(DecoderIO(StubSession()), tokenizer, Sequence(prompt_ids=tokenizer.encode(prompt), max_tokens=n))
+        assert result.text == plain.text and result.completion_tokens == n
+    timings = results[0].timings
+    assert 0 < timings["draft_acceptance_rate"] < 1 and timings["draft_tokens"] > timings["accepted_draft_tokens"]
+    assert "draft_tokens" not in results[2].timings  # a one-token budget leaves nothing to draft
+    # Far fewer passes of the main model than tokens generated
+    assert len(target.calls) < sum(r.completion_tokens for r in results) / 2
+
+
+def test_sampled_speculation_is_reproducible_and_stops_cleanly():
+    from cpu_inference_sampling import SamplingParams
+    from cpu_inference_stub import StubTokenizer
+    tokenizer = StubTokenizer()
+    texts = []
+    for _ in range(2):
+        _, _, decoder = _stub_decoders(disagree_every=3)
+        seq = Sequence(prompt_ids=tokenizer.encode("hi"), max_tokens=25, eos_token_id=tokenizer.eos_token_id,
+                       stop=["zz"], sampling=SamplingParams(temperature=0.8, top_k=5, seed=7))
+        seq.append(5, tokenizer)
+        while not seq.finished:
+            decoder.step([seq], tokenizer)
+            # Both caches hold every token but the last one sampled, minus rejected drafts
+            if not seq.finished:
+                assert seq.context_len == len(seq.prompt_ids) + len(seq.generated_ids) - 1
+                assert _context(seq.draft_past) <= seq.context_len
+        texts.append(seq.result(tokenizer).text)
+        assert seq.accepted_tokens <= seq.draft_tokens and len(seq.generated_ids) <= 25
+    assert texts[0] == texts[1]
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""
+Deterministic stand-ins for the ONNX decoder session and tokenizer used by cpu_inference_server.
+Mirrors the I/O signature of an optimum `text-generation-with-past` export (input_ids, attention_mask,
+position_ids, past_key_values.N.key/value -> logits, present.N.key/value) so the generation engine
+can be exercised without downloading a model.
+"""
+
+import time
+from types import SimpleNamespace
+
+import numpy as np
+
+EOS_TOKEN_ID = 0
+NEWLINE_TOKEN_ID = 96
+VOCAB_SIZE = 97
+
+
+class StubTokenizer:
+    """Character-level tokenizer: 0 is EOS, 1..95 are printable ASCII, 96 is newline."""
+
+    eos_token = "<|endoftext|>"
+    eos_token_id = EOS_TOKEN_ID
+    pad_token = eos_token
+    pad_token_id = EOS_TOKEN_ID
+
+    def encode(self, text, **kwargs):
+        ids = []
+        for char in text:
+            if char == "\n":
+                ids.append(NEWLINE_TOKEN_ID)
+            elif 32 <= ord(char) <= 126:
+                ids.append(ord(char) - 31)
+        return ids
+
+    def decode(self, ids, skip_special_tokens=False, **kwargs):
+        chars = []
+        for token_id in ids:
+            token_id = int(token_id)
+            if token_id == EOS_TOKEN_ID:
+                if not skip_special_tokens:
+                    chars.append(self.eos_token)
+            elif token_id == NEWLINE_TOKEN_ID:
+                chars.append("\n")
+            else:
+                chars.append(chr(token_id + 31))
+        return "".join(chars)
+
+    def __call__(self, text, return_tensors=None, **kwargs):
+        ids = self.encode(text)
+        if return_tensors == "np":
+            return {"input_ids": np.array([ids], dtype=np.int64)}
+        return {"input_ids": ids}
+
+
+class StubSession:
+    """
+    Tiny fake decoder. The next token is a function of the sum of every *attended* token id, so any
+    mistake in KV-cache threading, attention masking or position ids changes the generated text.
+    Set `eos_after` to emit EOS once that many tokens are in context. `step_ms` / `token_ms` make each
+    run() sleep like a real forward pass (fixed cost per call plus a cost per input token).
+    `disagree_every` shifts the prediction whenever the context sum is a multiple of it, which makes
+    a second stub a draft model that agrees with the first most of the time.
+    """
+
+    def __init__(self, num_layers=2, num_heads=2, head_dim=4, with_past=True, eos_after=None,
+                 step_ms=0.0, token_ms=0.0, disagree_every=0):
+        self.num_layers = num_layers
+        self.num_heads = num_heads
+        self.head_dim = head_dim
+        self.with_past = with_past
+        self.eos_after = eos_after
+        self.step_ms = step_ms
+        self.token_ms = token_ms
+        self.disagree_every = disagree_every
+        self.calls = []
+
+        self._inputs = [SimpleNamespace(name="input_ids", shape=["batch_size", "sequence_length"], type="tensor(int64)")]
+        self._outputs = [SimpleNamespace(name="logits", shape=["batch_size", "sequence_length", VOCAB_SIZE], type="tensor(float)")]
+        if with_past:
+            self._inputs += [
+                SimpleNamespace(name="attention_mask", shape=["batch_size", "total_length"], type="tensor(int64)"),
+                SimpleNamespace(name="position_ids", shape=["batch_size", "sequence_length"], type="tensor(int64)"),
+            ]
+            for layer in range(num_layers):
+                for kind in ("key", "value"):
+                    self._inputs.append(SimpleNamespace(
+                        name=f"past_key_values.{layer}.{kind}",
+                        shape=["batch_size", num_heads, "past_sequence_length", head_dim],
+                        type="tensor(float)",
+                    ))
+                    self._outputs.append(SimpleNamespace(
+                        name=f"present.{layer}.{kind}",
+                        shape=["batch_size", num_heads, "total_length", head_dim],
+                        type="tensor(float)",
+                    ))
+
+    def get_inputs(self):
+        return self._inputs
+
+    def get_outputs(self):
+        return self._outputs
+
+    def run(self, output_names, feeds):
+        input_ids = np.asarray(feeds["input_ids"], dtype=np.int64)
+        batch, new_len = input_ids.shape
+        self.calls.append(input_ids.shape)
+        if self.step_ms or self.token_ms:
+            time.sleep((self.step_ms + self.token_ms * batch * new_len) / 1000)
+
+        if self.with_past:
+            past = feeds["past_key_values.0.key"]
+            past_len = past.shape[2]
+            mask = np.asarray(feeds["attention_mask"], dtype=np.int64)
+            if mask.shape != (batch, past_len + new_len):
+                raise ValueError(f"attention_mask shape {mask.shape} != {(batch, past_len + new_len)}")
+            new_kv = np.zeros((batch, self.num_heads, new_len, self.head_dim), dtype=np.float32)
+            new_kv[:, :, :, 0] = input_ids[:, None, :]
+            presents = {}
+            for layer in range(self.num_layers):
+                for kind in ("key", "value"):
+                    presents[f"present.{layer}.{kind}"] = np.concatenate(
+                        [feeds[f"past_key_values.{layer}.{kind}"], new_kv], axis=2
+                    )
+            token_ids = presents["present.0.key"][:, 0, :, 0].astype(np.int64)
+            position_ids = np.asarray(feeds["position_ids"], dtype=np.int64)
+        else:
+            past_len = 0
+            mask = np.ones((batch, new_len), dtype=np.int64)
+            token_ids = input_ids
+            presents = {}
+            position_ids = np.broadcast_to(np.arange(new_len), (batch, new_len))
+
+        logits = np.zeros((batch, new_len, VOCAB_SIZE), dtype=np.float32)
+        vocab = np.arange(VOCAB_SIZE)
+        for row in range(batch):
+            for col in range(new_len):
+                end = past_len + col + 1
+                if not mask[row, end - 1]:
+                    continue
+                attended = mask[row, :end].astype(bool)
+                if position_ids[row, col] != attended.sum() - 1:
+                    raise ValueError(f"position id {position_ids[row, col]} != {attended.sum() - 1}")
+                total = int(token_ids[row, :end][attended].sum())
+                next_id = 1 + total % (VOCAB_SIZE - 2)
+                if self.disagree_every and total % self.disagree_every == 0:
+                    next_id = 1 + next_id % (VOCAB_SIZE - 2)
+                if self.eos_after is not None and attended.sum() >= self.eos_after:
+                    next_id = EOS_TOKEN_ID
+                logits[row, col] = -np.abs(vocab - next_id).astype(np.float32)
+
+        outputs = {"logits": logits, **presents}
+        names = output_names or [o.name for o in self._outputs]
+        return [outputs[name] for name in names]
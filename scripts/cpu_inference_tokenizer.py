@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+"""
+Local tokenizer cache for the CPU inference server.
+Importing transformers takes over a second and AutoTokenizer.from_pretrained(<hub name>) resolves the
+hub (or its cache) on every start, yet the server only encodes prompts, decodes tokens and reads the
+special token ids. The fast tokenizer is therefore exported once to tokenizer.json plus meta.json and
+later starts load it with the `tokenizers` library alone; transformers is imported only to export.
+Cache location: TOKENIZER_CACHE_DIR/<name>, or <onnx_path>/.tokenizer when unset.
+Pre-serialize at build time: python cpu_inference_tokenizer.py microsoft/DialoGPT-small ./onnx_model/microsoft/DialoGPT-small/.tokenizer
+"""
+
+import json
+import os
+import sys
+import time
+from typing import Dict, List, Optional, Tuple
+
+from tokenizers import Tokenizer
+
+META_FIELDS = ("eos_token", "eos_token_id", "pad_token", "pad_token_id", "bos_token_id", "clean_up_tokenization_spaces")
+
+# transformers' clean_up_tokenization, for exports whose tokenizer asks for it
+_CLEANUP = [(" .", "."), (" ?", "?"), (" !", "!"), (" ,", ","), (" ' ", "'"), (" n't", "n't"),
+            (" 'm", "'m"), (" 's", "'s"), (" 've", "'ve"), (" 're", "'re")]
+
+
+class FastTokenizer:
+    """The part of a transformers fast tokenizer the server uses, backed by a `tokenizers.Tokenizer`."""
+
+    def __init__(self, tokenizer: Tokenizer, meta: Dict):
+        self.backend_tokenizer = tokenizer
+        self.eos_token = meta.get("eos_token")
+        self.eos_token_id = meta.get("eos_token_id")
+        # Same fallback the server applies to transformers tokenizers without a pad token
+        self.pad_token = meta.get("pad_token") or self.eos_token
+        self.pad_token_id = meta.get("pad_token_id", self.eos_token_id)
+        self.bos_token_id = meta.get("bos_token_id")
+        self.clean_up_tokenization_spaces = bool(meta.get("clean_up_tokenization_spaces"))
+
+    @classmethod
+    def load(cls, directory: str) -> "FastTokenizer":
+        with open(os.path.join(directory, "meta.json")) as f:
+            meta = json.load(f)
+        return cls(Tokenizer.from_file(os.path.join(directory, "tokenizer.json")), meta)
+
+    def encode(self, text: str, add_special_tokens: bool = True) -> List[int]:
+        return self.backend_tokenizer.encode(text, add_special_tokens=add_special_tokens).ids
+
+    def __call__(self, text: str, return_tensors: Optional[str] = None, add_special_tokens: bool = True):
+        ids = self.encode(text, add_special_tokens)
+        if return_tensors == "np":
+            import numpy as np
+            return {"input_ids": np.array([ids], dtype=np.int64), "attention_mask": np.ones((1, len(ids)), dtype=np.int64)}
+        return {"input_ids": ids, "attention_mask": [1] * len(ids)}
+
+    def decode(self, ids, skip_special_tokens: bool = False, clean_up_tokenization_spaces: Optional[bool] = None,
+               **kwargs) -> str:
+        text = self.backend_tokenizer.decode(list(ids), skip_special_tokens=skip_special_tokens)
+        if self.clean_up_tokenization_spaces if clean_up_tokenization_spaces is None else clean_up_tokenization_spaces:
+            for old, new in _CLEANUP:
+                text = text.replace(old, new)
+        return text
+
+
+def cache_dir_for(name: str, onnx_path: str) -> str:
+    """Where the server keeps `name`'s exported tokenizer (TOKENIZER_CACHE_DIR overrides)."""
+    root = os.getenv("TOKENIZER_CACHE_DIR", "")
+    if root:
+        return os.path.join(root, name.strip("/").replace("/", "--"))
+    return os.path.join(onnx_path, ".tokenizer")
+
+
+def _fresh(directory: str, name: str) -> bool:
+    meta_path = os.path.join(directory, "meta.json")
+    if not os.path.exists(meta_path) or not os.path.exists(os.path.join(directory, "tokenizer.json")):
+        return False
+    with open(meta_path) as f:
+        if json.load(f).get("source") != name:
+            return False
+    if os.path.isdir(name):  # a local tokenizer directory: re-export when it changes
+        cached = os.path.getmtime(meta_path)
+        return all(os.path.getmtime(os.path.join(name, f)) <= cached for f in os.listdir(name))
+    return True
+
+
+def export_tokenizer(name: str, directory: str):
+    """Load `name` with transformers and write tokenizer.json + meta.json; returns the transformers tokenizer."""
+    from transformers import AutoTokenizer
+    tokenizer = AutoTokenizer.from_pretrained(name)
+    if not getattr(tokenizer, "is_fast", False):
+        raise ValueError(f"{name} has no fast (tokenizers) implementation to export")
+    os.makedirs(directory, exist_ok=True)
+    tokenizer.backend_tokenizer.save(os.path.join(directory, "tokenizer.json"))
+    meta = {field: getattr(tokenizer, field, None) for field in META_FIELDS}
+    meta["source"] = name
+    # meta.json last: its presence marks a complete export
+    tmp = os.path.join(directory, "meta.json.tmp")
+    with open(tmp, "w") as f:
+        json.dump(meta, f, indent=2)
+    os.replace(tmp, os.path.join(directory, "meta.json"))
+    return tokenizer
+
+
+def load_tokenizer(name: str, directory: str) -> Tuple[object, Dict]:
+    """
+    Return (tokenizer, info). A cache hit loads FastTokenizer without importing transformers; a miss
+    exports first. If the cache cannot be written, the transformers tokenizer itself is served.
+    """
+    start = time.perf_counter()
+    if _fresh(directory, name):
+        tokenizer, cache = FastTokenizer.load(directory), "hit"
+    else:
+        try:
+            export_tokenizer(name, directory)
+            tokenizer, cache = FastTokenizer.load(directory), "miss"
+        except (OSError, ValueError) as e:
+            print(f"⚠️ Tokenizer cache unavailable for {name} ({e}); using transformers")
+            from transformers import AutoTokenizer
+            tokenizer, cache = AutoTokenizer.from_pretrained(name), "off"
+            if tokenizer.pad_token is None:
+                tokenizer.pad_token = tokenizer.eos_token
+    return tokenizer, {"tokenizer_cache": cache, "load_seconds": round(time.perf_counter() - start, 3)}
+
+
+# Pytest tests
+def _tiny_hf_tokenizer(path):
+    """Byte-level BPE (GPT-2 style) trained offline and saved as a transformers tokenizer directory."""
+    from tokenizers import decoders, models, pre_tokenizers, trainers
+    from transformers import PreTrainedTokenizerFast
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(vocab_size=400, special_tokens=["<|endoftext|>"],
+                                  initial_alphabet=pre_tokenizers.ByteLevel.alphabet())
+    tokenizer.train_from_iterator(["User: hello there, how are you?\nAssistant: I'm fine, thanks."] * 50, trainer)
+    PreTrainedTokenizerFast(tokenizer_object=tokenizer, eos_token="<|endoftext|>").save_pretrained(str(path))
+
+
+def test_cached_tokenizer_matches_transformers(tmp_path):
+    from transformers import AutoTokenizer
+    _tiny_hf_tokenizer(tmp_path / "hf")
+    name, cache = str(tmp_path / "hf"), str(tmp_path / "cache")
+    reference = AutoTokenizer.from_pretrained(name)
+
+    tokenizer, info = load_tokenizer(name, cache)
+    assert info["tokenizer_cache"] == "miss" and isinstance(tokenizer, FastTokenizer)
+    tokenizer, info = load_tokenizer(name, cache)
+    assert info["tokenizer_cache"] == "hit"
+    assert (tokenizer.eos_token_id, tokenizer.pad_token) == (reference.eos_token_id, reference.eos_token)
+    for text in ["User: hello there\nAssistant: ", "I'm fine, thanks. ünïcödé 🚀", ""]:
+        ids = tokenizer(text, return_tensors="np")["input_ids"]
+        assert ids.shape == (1, len(ids[0])) and ids[0].tolist() == reference(text)["input_ids"]
+        with_eos = ids[0].tolist() + [reference.eos_token_id]
+        assert tokenizer.decode(with_eos, skip_special_tokens=True) == reference.decode(with_eos, skip_special_tokens=True)
+
+
+def test_cache_hit_does_not_import_transformers(tmp_path):
+    import subprocess
+    _tiny_hf_tokenizer(tmp_path / "hf")
+    load_tokenizer(str(tmp_path / "hf"), str(tmp_path / "cache"))
+    code = ("import sys, cpu_inference_tokenizer as t; "
+            f"tok, info = t.load_tokenizer({str(tmp_path / 'hf')!r}, {str(tmp_path / 'cache')!r}); "
+            "assert info['tokenizer_cache'] == 'hit' and 'transformers' not in sys.modules, info")
+    subprocess.run([sys.executable, "-c", code], check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("Usage: python cpu_inference_tokenizer.py <tokenizer name or dir> <cache dir>")
+        sys.exit(1)
+    _, info = load_tokenizer(sys.argv[1], sys.argv[2])
+    print(f"📦 Tokenizer {sys.argv[1]} cached at {sys.argv[2]} ({info['tokenizer_cache']}, {info['load_seconds']}s)")
@@ -2,19 +2,34 @@
 """
 API Key Rotation Script for AI-SWARM-MIAMI-2025
 Uses Vault for secure key management and rotation.
+All changes of a run are merged into the current secret and written as one new version with
+check-and-set, so keys that are not rotated survive, and a concurrent writer makes the write retry
+on the fresh version instead of being overwritten. Services pick the new version up through their
+secret cache (cost-optimizer app/vault.py) without a restart.
 WARNING: This script updates Vault secrets; real API rotation requires provider-specific calls.
 """
 
 import os
 import sys
-import hvac
 from datetime import datetime
 
+try:
+    from hvac.exceptions import InvalidPath, InvalidRequest
+except ImportError:  # hvac is only needed against a real Vault
+    class InvalidPath(Exception):
+        pass
+
+    class InvalidRequest(Exception):
+        pass
+
 VAULT_ADDR = os.getenv('VAULT_ADDR', 'http://localhost:8200')
 VAULT_TOKEN = os.getenv('VAULT_TOKEN')  # Use AppRole in production
 VAULT_PATH = 'secret/api-keys'
+CAS_ATTEMPTS = 5
 
 def get_vault_client():
+    import hvac
+
     client = hvac.Client(url=VAULT_ADDR)
     if VAULT_TOKEN:
         client.token = VAULT_TOKEN
@@ -25,33 +40,110 @@ def get_vault_client():
         client.auth.approle.login(role_id=role_id, secret_id=secret_id)
     return client
 
+def placeholder_key(key_name):
+    # Placeholder new key (in production, call provider API)
+    new_value = f"sk-new-{key_name}-{datetime.now().strftime('%Y%m%d%H%M%S')}-placeholder"
+    print(f"Generated placeholder for {key_name}: {new_value}")
+    return new_value
+
+def read_current(client, path=VAULT_PATH):
+    """(data, version) of the secret; ({}, 0) when it does not exist yet."""
+    try:
+        response = client.secrets.kv.v2.read_secret_version(path=path, raise_on_deleted_version=True)
+    except InvalidPath:
+        return {}, 0
+    return response['data']['data'], response['data']['metadata']['version']
+
+def rotate_keys(client, changes, path=VAULT_PATH, attempts=CAS_ATTEMPTS):
+    """Merge `changes` into the secret as one new version (check-and-set); returns the version written."""
+    for _ in range(attempts):
+        current, version = read_current(client, path)
+        merged = dict(current, **changes)
+        if merged == current:
+            print(f"No changes for {path} (version {version})")
+            return version
+        try:
+            response = client.secrets.kv.v2.create_or_update_secret(path=path, secret=merged, cas=version)
+        except InvalidRequest as exc:
+            if 'check-and-set' not in str(exc):
+                raise
+            print(f"{path} changed underneath us (was version {version}), retrying")
+            continue
+        written = response['data']['version']
+        print(f"Rotated {', '.join(sorted(changes))} in Vault at {path} (version {written})")
+        return written
+    raise RuntimeError(f"Could not write {path}: still conflicting after {attempts} attempts")
+
 def rotate_key(client, key_name, new_value=None):
     """Rotate a specific API key in Vault."""
-    if new_value is None:
-        # Generate placeholder new key (in production, call provider API)
-        new_value = f"sk-new-{key_name}-{datetime.now().strftime('%Y%m%d%H%M%S')}-placeholder"
-        print(f"Generated placeholder for {key_name}: {new_value}")
-    
-    data = {key_name: new_value}
-    client.secrets.kv.v2.create_or_update_secret(path=VAULT_PATH, secret=data)
-    print(f"Rotated {key_name} in Vault at {VAULT_PATH}")
+    return rotate_keys(client, {key_name: new_value if new_value is not None else placeholder_key(key_name)})
 
 def main():
     if len(sys.argv) < 2:
         print("Usage: python key_rotation.py [openrouter|gemini|all]")
         sys.exit(1)
-    
+
     key_type = sys.argv[1]
-    client = get_vault_client()
-    
+    changes = {}
     if key_type == 'all' or key_type == 'openrouter':
-        rotate_key(client, 'openrouter', 'sk-or-v1-new-random-string')
-    
+        changes['openrouter'] = 'sk-or-v1-new-random-string'
+
     if key_type == 'all' or key_type == 'gemini':
-        rotate_key(client, 'gemini_primary', 'AIzaSy-new-random-string')
-        rotate_key(client, 'gemini_secondary', 'AIzaSy-new-random-string-alt')
-    
-    print("Key rotation complete. Update services and test.")
+        changes['gemini_primary'] = 'AIzaSy-new-random-string'
+        changes['gemini_secondary'] = 'AIzaSy-new-random-string-alt'
+
+    if not changes:
+        print(f"Unknown key type: {key_type}")
+        sys.exit(1)
+    rotate_keys(get_vault_client(), changes)
+    print("Key rotation complete. Services reload the new version on their next refresh.")
+
+# Pytest tests
+class _LocalVault:
+    """Stand-in for hvac's KV v2 client with Vault's versioning and check-and-set rules."""
+
+    def __init__(self):
+        self.versions = {}
+        self.writes = 0
+        self.before_write = None  # hook to simulate a concurrent writer
+        self.secrets = self
+        self.kv = self
+        self.v2 = self
+
+    def read_secret_version(self, path, raise_on_deleted_version=True):
+        if not self.versions.get(path):
+            raise InvalidPath(f"no secret at {path}")
+        history = self.versions[path]
+        return {'data': {'data': dict(history[-1]), 'metadata': {'version': len(history)}}}
+
+    def create_or_update_secret(self, path, secret, cas=None):
+        if self.before_write is not None:
+            hook, self.before_write = self.before_write, None
+            hook()
+        history = self.versions.setdefault(path, [])
+        if cas is not None and cas != len(history):
+            raise InvalidRequest("check-and-set parameter did not match the current version")
+        self.writes += 1
+        history.append(dict(secret))
+        return {'data': {'version': len(history)}}
+
+def test_rotation_is_one_merged_versioned_write():
+    vault = _LocalVault()
+    vault.versions[VAULT_PATH] = [{'openrouter': 'old', 'anthropic': 'sk-ant'}]
+    version = rotate_keys(vault, {'openrouter': 'new', 'gemini_primary': 'g1', 'gemini_secondary': 'g2'})
+    assert version == 2 and vault.writes == 1
+    # Keys that were not rotated survive the write
+    assert vault.versions[VAULT_PATH][-1] == {
+        'openrouter': 'new', 'anthropic': 'sk-ant', 'gemini_primary': 'g1', 'gemini_secondary': 'g2'}
+    assert rotate_keys(vault, {'openrouter': 'new'}) == 2 and vault.writes == 1
+    assert rotate_keys(vault, {'x': '1'}, path='secret/fresh') == 1
+
+def test_concurrent_writer_forces_a_retry_not_an_overwrite():
+    vault = _LocalVault()
+    vault.versions[VAULT_PATH] = [{'openrouter': 'old'}]
+    vault.before_write = lambda: vault.versions[VAULT_PATH].append({'openrouter': 'old', 'openai': 'sk-oa'})
+    assert rotate_key(vault, 'openrouter', 'new') == 3
+    assert vault.versions[VAULT_PATH][-1] == {'openrouter': 'new', 'openai': 'sk-oa'}
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
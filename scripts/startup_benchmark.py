@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+"""
+Startup benchmark: import time of the Python entry points and time-to-healthy of a server command.
+Every measurement runs in a fresh interpreter so nothing imported by an earlier run hides the cost;
+the heaviest direct imports (from -X importtime) show what is worth deferring. Save a report before
+a change and pass it as --baseline afterwards to get the deltas.
+
+Examples:
+  python scripts/startup_benchmark.py --import main --import scripts/cpu_inference_server -o before.json
+  python scripts/startup_benchmark.py --serve "python scripts/cpu_inference_asgi.py" \\
+      --health http://127.0.0.1:8000/health --env PREFORK_WORKERS=4 --runs 3 --baseline before.json
+"""
+
+import argparse
+import json
+import os
+import shlex
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+from typing import Dict, List, Optional, Tuple
+
+from cpu_inference_benchmark import percentiles
+
+_TIMER = "import time; t = time.perf_counter(); import {module}; print('\\nimport_seconds', time.perf_counter() - t)"
+
+
+def module_location(spec: str) -> Tuple[str, str]:
+    """`scripts/cpu_inference_server(.py)` -> (scripts, cpu_inference_server); a bare name imports from the cwd."""
+    directory, name = os.path.split(spec)
+    return os.path.abspath(directory or "."), name[:-3] if name.endswith(".py") else name
+
+
+def heaviest_imports(stderr: str, module: str, top: int = 5) -> List[Tuple[str, float]]:
+    """Direct imports of `module` by cumulative milliseconds, from `python -X importtime` output."""
+    children = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, name = line.split("|", 2)
+        # The module itself is at depth 1 (" name"); what it imports directly is one level deeper
+        if cumulative.strip().isdigit() and name.startswith("   ") and not name.startswith("    "):
+            children.append((name.strip(), round(int(cumulative) / 1000, 1)))
+    return sorted(children, key=lambda item: -item[1])[:top]
+
+
+def import_time(spec: str, runs: int = 5, env: Optional[Dict[str, str]] = None) -> dict:
+    """Median-of-runs wall time to import `spec` in a fresh interpreter, plus its heaviest imports."""
+    directory, module = module_location(spec)
+    env = dict(os.environ, **(env or {}))
+    samples = []
+    for _ in range(runs):
+        proc = subprocess.run([sys.executable, "-c", _TIMER.format(module=module)], cwd=directory, env=env,
+                              capture_output=True, text=True, timeout=300)
+        if proc.returncode != 0:
+            raise RuntimeError(f"import {module} failed: {proc.stderr.strip().splitlines()[-1:]}")
+        samples.append(float(proc.stdout.rsplit("import_seconds", 1)[1]) * 1000)
+    profile = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], cwd=directory, env=env,
+                             capture_output=True, text=True, timeout=300)
+    return {"module": spec, "runs_ms": [round(s, 1) for s in samples], "ms": percentiles(samples),
+            "heaviest_ms": heaviest_imports(profile.stderr, module)}
+
+
+def _health(url: str, timeout: float) -> Optional[bool]:
+    """None while nothing answers; otherwise whether the server reports itself healthy."""
+    try:
+        with urllib.request.urlopen(url, timeout=timeout) as response:
+            body = response.read()
+    except urllib.error.HTTPError:
+        return False  # listening, not ready (e.g. 503 while loading)
+    except OSError:
+        return None
+    try:
+        status = json.loads(body).get("status")
+    except (ValueError, AttributeError):
+        return True
+    return status in (None, "healthy", "ok")
+
+
+def time_to_healthy(command: str, health_url: str, env: Optional[Dict[str, str]] = None,
+                    timeout: float = 600.0, poll: float = 0.05) -> dict:
+    """Start `command`, poll `health_url` until healthy, then stop its whole process group."""
+    with tempfile.TemporaryFile() as log:
+        start = time.perf_counter()
+        proc = subprocess.Popen(shlex.split(command), env=dict(os.environ, **(env or {})), stdout=log,
+                                stderr=subprocess.STDOUT, start_new_session=True)
+        listening = None
+        try:
+            while True:
+                elapsed = time.perf_counter() - start
+                state = _health(health_url, timeout=max(poll, 1.0))
+                if state is not None and listening is None:
+                    listening = elapsed
+                if state:
+                    return {"listening_s": round(listening, 3), "healthy_s": round(elapsed, 3)}
+                if proc.poll() is not None or elapsed > timeout:
+                    log.seek(0)
+                    tail = log.read().decode(errors="replace").strip().splitlines()[-5:]
+                    reason = f"exited with {proc.returncode}" if proc.returncode is not None else f"not healthy after {timeout}s"
+                    raise RuntimeError(f"{command} {reason}: {tail}")
+                time.sleep(poll)
+        finally:
+            if proc.poll() is None:
+                os.killpg(proc.pid, signal.SIGTERM)
+                try:
+                    proc.wait(timeout=15)
+                except subprocess.TimeoutExpired:
+                    os.killpg(proc.pid, signal.SIGKILL)
+                    proc.wait()
+
+
+def compare(report: dict, baseline: dict) -> dict:
+    """Median change against an earlier report, per import and for time-to-healthy (negative is faster)."""
+    delta = {}
+    for spec, now in report.get("imports", {}).items():
+        before = baseline.get("imports", {}).get(spec)
+        if before:
+            delta[f"import {spec} ms"] = round(now["ms"]["p50"] - before["ms"]["p50"], 1)
+    if report.get("serve") and baseline.get("serve"):
+        for key in ("listening_s", "healthy_s"):
+            delta[f"serve {key}"] = round(report["serve"][key]["p50"] - baseline["serve"][key]["p50"], 3)
+    return delta
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--import", dest="imports", action="append", default=[], metavar="MODULE",
+                        help="module to time, as [dir/]name (repeatable)")
+    parser.add_argument("--serve", help="server command to time until healthy")
+    parser.add_argument("--health", default="http://127.0.0.1:8000/health", help="health URL polled for --serve")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                        help="extra environment for every measured process (repeatable)")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--timeout", type=float, default=600.0, help="seconds to wait for healthy")
+    parser.add_argument("--baseline", help="earlier report to compare against")
+    parser.add_argument("-o", "--output", help="write the JSON report here instead of stdout")
+    args = parser.parse_args(argv)
+    if not args.imports and not args.serve:
+        parser.error("nothing to measure: pass --import and/or --serve")
+    return args
+
+
+def main(argv=None) -> dict:
+    args = parse_args(argv)
+    env = dict(item.split("=", 1) for item in args.env)
+    report = {"timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()), "python": sys.version.split()[0],
+              "env": env, "imports": {}, "serve": None}
+    for spec in args.imports:
+        report["imports"][spec] = import_time(spec, args.runs, env)
+        print(f"✅ import {spec}: {report['imports'][spec]['ms']['p50']}ms", file=sys.stderr)
+    if args.serve:
+        runs = [time_to_healthy(args.serve, args.health, env, args.timeout) for _ in range(args.runs)]
+        report["serve"] = {"command": args.serve, "runs": runs,
+                           "listening_s": percentiles([r["listening_s"] for r in runs]),
+                           "healthy_s": percentiles([r["healthy_s"] for r in runs])}
+        print(f"✅ {args.serve}: healthy in {report['serve']['healthy_s']['p50']}s", file=sys.stderr)
+    if args.baseline:
+        with open(args.baseline) as f:
+            report["delta"] = compare(report, json.load(f))
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    return report
+
+
+# Pytest tests
+def test_import_time_names_the_heaviest_imports(tmp_path):
+    (tmp_path / "slow_dependency.py").write_text("import time\ntime.sleep(0.2)\n")
+    (tmp_path / "entry.py").write_text("import slow_dependency\nprint('side effects are ignored')\n")
+    result = import_time(str(tmp_path / "entry.py"), runs=2)
+    assert len(result["runs_ms"]) == 2 and result["ms"]["p50"] >= 200
+    assert result["heaviest_ms"][0][0] == "slow_dependency" and result["heaviest_ms"][0][1] >= 200
+
+
+def test_time_to_healthy_waits_for_a_healthy_status(tmp_path):
+    import socket
+    probe = socket.socket()
+    probe.bind(("127.0.0.1", 0))
+    port = probe.getsockname()[1]
+    probe.close()
+    # Answers "loading" for its first 0.5s, like the inference server during model load and warmup
+    (tmp_path / "server.py").write_text(f"""
+import json, time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+started = time.monotonic()
+class Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = json.dumps({{"status": "healthy" if time.monotonic() - started > 0.5 else "loading"}}).encode()
+        self.send_response(200)
+        self.end_headers()
+        self.wfile.write(body)
+    def log_message(self, *args):
+        pass
+HTTPServer(("127.0.0.1", {port}), Handler).serve_forever()
+""")
+    baseline = tmp_path / "before.json"
+    baseline.write_text(json.dumps({"serve": {"listening_s": {"p50": 10.0}, "healthy_s": {"p50": 20.0}}}))
+    report = main(["--serve", f"{sys.executable} {tmp_path / 'server.py'}", "--health", f"http://127.0.0.1:{port}/health",
+                   "--runs", "1", "--timeout", "30", "--baseline", str(baseline), "-o", str(tmp_path / "after.json")])
+    run = report["serve"]["runs"][0]
+    assert run["listening_s"] < run["healthy_s"] and run["healthy_s"] >= 0.5
+    assert report["delta"]["serve healthy_s"] < -19 and json.loads((tmp_path / "after.json").read_text())["serve"]
+
+
+if __name__ == "__main__":
+    main()
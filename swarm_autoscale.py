@@ -0,0 +1,384 @@
+#!/usr/bin/env python3
+"""
+vLLM batch-size controllers and an offline simulator to compare them. Every batch-size change
+recreates the vLLM container, so a controller is judged on restarts as much as on utilization.
+Policies see smoothed GPU utilization, queue depth and p95 latency; the shared guard rails enforce a
+cooldown after each change and a budget of restarts per window. `simulate` replays a load trace
+through a discrete-event model of one vLLM replica (decode steps slow down as the batch grows, a
+restart takes the replica offline and requeues in-flight requests) and reports throughput, SLO
+violations and restarts, so policies can be tuned without a GPU.
+"""
+
+import heapq
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Deque, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+
+@dataclass
+class Signals:
+    """One controller input; None means the signal could not be read this round."""
+    utilization: Optional[float] = None  # 0..1
+    queue_depth: Optional[float] = None  # requests waiting
+    latency_p95_ms: Optional[float] = None
+
+
+class ScalingPolicy:
+    """Base policy: subclasses propose a target batch, the guard rails decide whether to apply it."""
+
+    name = 'policy'
+
+    def __init__(self, min_batch: int = 8, max_batch: int = 32, step: int = 4, cooldown: float = 0.0,
+                 max_restarts: Optional[int] = None, restart_window: float = 3600.0):
+        self.min_batch = min_batch
+        self.max_batch = max_batch
+        self.step = step
+        self.cooldown = cooldown
+        self.max_restarts = max_restarts
+        self.restart_window = restart_window
+        self.held = {'cooldown': 0, 'budget': 0}
+        self._changes: Deque[float] = deque()
+
+    def target(self, signals: Signals, batch: int) -> int:
+        raise NotImplementedError
+
+    @staticmethod
+    def blind(signals: Signals) -> bool:
+        """No load reading this round: policies hold rather than act on stale averages."""
+        return signals.utilization is None and signals.queue_depth is None
+
+    def changed(self):
+        """Called after a change is applied; resets per-change state."""
+
+    def decide(self, signals: Signals, batch: int, now: float) -> int:
+        """The batch size to run next; equal to `batch` when nothing should restart."""
+        target = max(self.min_batch, min(self.max_batch, self.target(signals, batch)))
+        if target == batch:
+            return batch
+        if self._changes and now - self._changes[-1] < self.cooldown:
+            self.held['cooldown'] += 1
+            return batch
+        while self._changes and now - self._changes[0] >= self.restart_window:
+            self._changes.popleft()
+        if self.max_restarts is not None and len(self._changes) >= self.max_restarts:
+            self.held['budget'] += 1
+            return batch
+        self._changes.append(now)
+        self.changed()
+        return target
+
+
+class StepPolicy(ScalingPolicy):
+    """The original rule: one utilization sample, +/- step, no smoothing or guard rails."""
+
+    name = 'step'
+
+    def __init__(self, up_util: float = 0.8, down_util: float = 0.3, **kwargs):
+        super().__init__(**kwargs)
+        self.up_util = up_util
+        self.down_util = down_util
+
+    def target(self, signals: Signals, batch: int) -> int:
+        if signals.utilization is None:
+            return batch
+        if signals.utilization > self.up_util:
+            return batch + self.step
+        if signals.utilization < self.down_util:
+            return batch - self.step
+        return batch
+
+
+class _Smoothed:
+    """Exponentially weighted averages of the signals; a missing reading keeps the previous average."""
+
+    def __init__(self, alpha: float):
+        self.alpha = alpha
+        self.values: Dict[str, float] = {}
+
+    def update(self, signals: Signals) -> Dict[str, Optional[float]]:
+        for name in ('utilization', 'queue_depth', 'latency_p95_ms'):
+            value = getattr(signals, name)
+            if value is not None:
+                previous = self.values.get(name, value)
+                self.values[name] = previous + self.alpha * (value - previous)
+        return {name: self.values.get(name) for name in ('utilization', 'queue_depth', 'latency_p95_ms')}
+
+
+class HysteresisPolicy(ScalingPolicy):
+    """
+    Scale up under sustained pressure (high utilization or a standing queue), down when idle or when
+    latency breaks the SLO without a queue (the batch itself is too large). The up and down thresholds
+    are far apart, and a direction must hold for `sustain` consecutive rounds before it acts.
+    """
+
+    name = 'hysteresis'
+
+    def __init__(self, up_util: float = 0.85, down_util: float = 0.4, queue_high: float = 4.0,
+                 latency_slo_ms: Optional[float] = None, alpha: float = 0.3, sustain: int = 3,
+                 cooldown: float = 600.0, max_restarts: Optional[int] = 4, **kwargs):
+        super().__init__(cooldown=cooldown, max_restarts=max_restarts, **kwargs)
+        self.up_util = up_util
+        self.down_util = down_util
+        self.queue_high = queue_high
+        self.latency_slo_ms = latency_slo_ms
+        self.sustain = sustain
+        self.smoothed = _Smoothed(alpha)
+        self._streak = (0, 0)
+
+    def direction(self, signals: Signals) -> int:
+        s = self.smoothed.update(signals)
+        util, queue, latency = s['utilization'], s['queue_depth'] or 0.0, s['latency_p95_ms']
+        over_slo = self.latency_slo_ms is not None and latency is not None and latency > self.latency_slo_ms
+        if queue > self.queue_high or (util is not None and util > self.up_util and not over_slo):
+            return 1
+        if queue < 1 and (over_slo or (util is not None and util < self.down_util)):
+            return -1
+        return 0
+
+    def target(self, signals: Signals, batch: int) -> int:
+        if self.blind(signals):
+            return batch
+        direction = self.direction(signals)
+        count = self._streak[1] + 1 if direction == self._streak[0] else 1
+        self._streak = (direction, count)
+        return batch + direction * self.step if direction and count >= self.sustain else batch
+
+    def changed(self):
+        self._streak = (0, 0)
+
+
+class PIDPolicy(ScalingPolicy):
+    """
+    PI(D) control of smoothed utilization towards `setpoint`, with a standing queue counted as extra
+    error. The output is a relative batch change, rounded to whole steps; moves under one step are held.
+    """
+
+    name = 'pid'
+
+    def __init__(self, setpoint: float = 0.75, kp: float = 0.6, ki: float = 0.1, kd: float = 0.0,
+                 queue_weight: float = 0.05, alpha: float = 0.3, cooldown: float = 600.0,
+                 max_restarts: Optional[int] = 4, **kwargs):
+        super().__init__(cooldown=cooldown, max_restarts=max_restarts, **kwargs)
+        self.setpoint = setpoint
+        self.kp, self.ki, self.kd = kp, ki, kd
+        self.queue_weight = queue_weight
+        self.smoothed = _Smoothed(alpha)
+        self.integral = 0.0
+        self._error: Optional[float] = None
+
+    def target(self, signals: Signals, batch: int) -> int:
+        s = self.smoothed.update(signals)
+        if self.blind(signals) or s['utilization'] is None:
+            return batch
+        error = s['utilization'] - self.setpoint + self.queue_weight * (s['queue_depth'] or 0.0)
+        derivative = 0.0 if self._error is None else error - self._error
+        self._error = error
+        # Anti-windup: only integrate while the output can still move in that direction
+        if not ((batch >= self.max_batch and error > 0) or (batch <= self.min_batch and error < 0)):
+            self.integral = max(-1.0, min(1.0, self.integral + error))
+        output = self.kp * error + self.ki * self.integral + self.kd * derivative
+        steps = int(round(batch * output / self.step))
+        return batch + steps * self.step
+
+
+# Offline simulation
+@dataclass
+class ServingModel:
+    """One vLLM replica: a decode step over n running sequences takes step_ms + step_ms_per_seq * n."""
+    step_ms: float = 25.0
+    step_ms_per_seq: float = 1.5
+    restart_seconds: float = 120.0
+
+    def service_seconds(self, tokens: int, running: int) -> float:
+        return tokens * (self.step_ms + self.step_ms_per_seq * running) / 1000.0
+
+
+@dataclass
+class SimulationReport:
+    policy: str
+    duration: float
+    arrived: int
+    completed: int
+    requeued: int
+    tokens: int
+    latency_p95_ms: Optional[float]
+    slo_violations: int
+    restarts: int
+    downtime_seconds: float
+    batches: List[Tuple[float, int]] = field(default_factory=list)
+
+    @property
+    def tokens_per_second(self) -> float:
+        return self.tokens / self.duration if self.duration else 0.0
+
+    def summary(self) -> Dict[str, object]:
+        return {
+            'policy': self.policy, 'completed': self.completed, 'arrived': self.arrived,
+            'tokens_per_second': round(self.tokens_per_second, 1),
+            'latency_p95_ms': None if self.latency_p95_ms is None else round(self.latency_p95_ms),
+            'slo_violations': self.slo_violations, 'restarts': self.restarts,
+            'downtime_seconds': self.downtime_seconds, 'requeued': self.requeued,
+        }
+
+
+def load_trace(phases: Sequence[Tuple[float, float]], tokens: int = 256, seed: int = 0) -> List[Tuple[float, int]]:
+    """Poisson arrivals [(time, output tokens)] for [(duration seconds, requests per second)] phases."""
+    rng = np.random.default_rng(seed)
+    arrivals, start = [], 0.0
+    for duration, rate in phases:
+        if rate > 0:
+            count = rng.poisson(rate * duration)
+            times = np.sort(rng.uniform(start, start + duration, count))
+            lengths = np.maximum(1, rng.exponential(tokens, count).astype(int))
+            arrivals.extend(zip(times.tolist(), lengths.tolist()))
+        start += duration
+    return arrivals
+
+
+def simulate(policy: ScalingPolicy, arrivals: Sequence[Tuple[float, int]], model: Optional[ServingModel] = None,
+             initial_batch: int = 16, interval: float = 60.0, latency_slo_ms: float = 30000.0) -> SimulationReport:
+    """
+    Replay arrivals against `policy`, consulted every `interval` seconds while load is arriving. The
+    utilization signal is the time-averaged fraction of batch slots in use.
+    """
+    model = model or ServingModel()
+    events: List[Tuple[float, int, str, object]] = []
+    sequence = 0
+
+    def push(at, kind, payload=None):
+        nonlocal sequence
+        sequence += 1
+        heapq.heappush(events, (at, sequence, kind, payload))
+
+    for arrived_at, tokens in arrivals:
+        push(arrived_at, 'arrive', (arrived_at, tokens))
+    end = arrivals[-1][0] if arrivals else 0.0
+    push(interval, 'tick')
+
+    batch, epoch, down_until = initial_batch, 0, 0.0
+    queue: Deque[Tuple[float, int]] = deque()
+    running: Dict[int, Tuple[float, int]] = {}
+    latencies: List[float] = []
+    recent: List[float] = []
+    busy, last, requests = 0.0, 0.0, 0
+    report = SimulationReport(policy.name, 0.0, len(arrivals), 0, 0, 0, None, 0, 0, 0.0, [(0.0, batch)])
+
+    def admit(now):
+        nonlocal requests
+        while now >= down_until and len(running) < batch and queue:
+            request = queue.popleft()
+            requests += 1
+            running[requests] = request
+            push(now + model.service_seconds(request[1], len(running)), 'done', (requests, epoch))
+
+    while events:
+        now, _, kind, payload = heapq.heappop(events)
+        busy += (now - last) * min(1.0, len(running) / batch)
+        last = now
+        if kind == 'arrive':
+            queue.append(payload)
+        elif kind == 'done':
+            request_id, started_epoch = payload
+            if started_epoch != epoch or request_id not in running:
+                continue  # aborted by a restart
+            arrived_at, tokens = running.pop(request_id)
+            latency = (now - arrived_at) * 1000.0
+            latencies.append(latency)
+            recent.append(latency)
+            report.completed += 1
+            report.tokens += tokens
+            report.slo_violations += latency > latency_slo_ms
+        elif kind == 'tick':
+            signals = Signals(busy / interval, float(len(queue)),
+                              float(np.percentile(recent, 95)) if recent else None)
+            busy, recent = 0.0, []
+            new_batch = policy.decide(signals, batch, now)
+            if new_batch != batch:
+                # Recreating the container drops in-flight requests; clients retry them
+                report.requeued += len(running)
+                queue.extendleft(sorted(running.values(), reverse=True))
+                running.clear()
+                epoch += 1
+                batch, down_until = new_batch, now + model.restart_seconds
+                report.restarts += 1
+                report.downtime_seconds += model.restart_seconds
+                report.batches.append((now, batch))
+                push(down_until, 'up')
+            if now + interval <= end:
+                push(now + interval, 'tick')
+        admit(now)
+
+    report.duration = last
+    report.latency_p95_ms = float(np.percentile(latencies, 95)) if latencies else None
+    return report
+
+
+# Pytest tests
+def test_guard_rails_hold_changes():
+    policy = HysteresisPolicy(sustain=2, cooldown=300, max_restarts=2, restart_window=3600, alpha=1.0)
+    busy = Signals(utilization=0.95, queue_depth=8)
+    assert policy.decide(busy, 16, 0) == 16  # one hot round is not enough
+    assert policy.decide(busy, 16, 60) == 20
+    assert policy.decide(busy, 20, 120) == 20 and policy.decide(busy, 20, 180) == 20
+    assert policy.held['cooldown'] == 1
+    assert policy.decide(busy, 20, 420) == 24
+    # Budget of two restarts per hour is spent
+    assert [policy.decide(busy, 24, t) for t in (480, 800, 1200)] == [24, 24, 24] and policy.held['budget'] == 2
+    assert policy.decide(busy, 24, 3700) == 28
+
+
+def test_hysteresis_reads_all_signals():
+    policy = HysteresisPolicy(latency_slo_ms=20000, sustain=1, cooldown=0, alpha=1.0)
+    assert policy.decide(Signals(utilization=0.6), 16, 0) == 16  # between the thresholds
+    assert policy.decide(Signals(utilization=0.6, queue_depth=10), 16, 1) == 20  # standing queue
+    # Over the SLO with no queue: the batch is too large, even at high utilization
+    assert policy.decide(Signals(utilization=0.9, queue_depth=0, latency_p95_ms=45000), 20, 2) == 16
+    assert policy.decide(Signals(utilization=0.2, queue_depth=0), 16, 3) == 12
+    # A missing signal keeps its previous average rather than counting as idle; no readings at all holds
+    assert policy.decide(Signals(queue_depth=0), 12, 4) == 8 and policy.decide(Signals(), 8, 5) == 8
+
+
+def test_pid_moves_towards_setpoint_in_whole_steps():
+    policy = PIDPolicy(cooldown=0, max_restarts=None, alpha=1.0)
+    assert policy.decide(Signals(utilization=0.76), 16, 0) == 16  # inside the dead band
+    assert policy.decide(Signals(utilization=1.0, queue_depth=10), 16, 1) == 24
+    assert policy.decide(Signals(utilization=0.1, queue_depth=0), 24, 2) == 16
+    assert policy.decide(Signals(), 16, 3) == 16
+
+
+def test_simulation_compares_policies_under_oscillating_load():
+    # Load swings between busy and quiet every five minutes for three hours
+    arrivals = load_trace([(300, 1.6), (300, 0.3)] * 18, seed=3)
+    legacy = simulate(StepPolicy(), arrivals)
+    guarded = simulate(HysteresisPolicy(latency_slo_ms=30000), arrivals)
+    assert legacy.arrived == guarded.arrived == len(arrivals)
+    assert legacy.completed == guarded.completed == len(arrivals)  # nothing is lost, only delayed
+    assert guarded.restarts <= legacy.restarts // 3
+    assert guarded.slo_violations < legacy.slo_violations
+    assert guarded.downtime_seconds == guarded.restarts * ServingModel().restart_seconds
+    assert set(guarded.summary()) >= {'tokens_per_second', 'latency_p95_ms', 'slo_violations', 'restarts'}
+
+    # Steady load that fits: a guarded policy leaves vLLM alone
+    steady = simulate(HysteresisPolicy(), load_trace([(3600, 0.9)], seed=1))
+    assert steady.restarts == 0 and steady.requeued == 0
+
+
+if __name__ == "__main__":
+    import argparse
+    import csv
+    import json
+
+    parser = argparse.ArgumentParser(description="Compare vLLM scaling policies on a load trace")
+    parser.add_argument("--trace", help="CSV of arrival_seconds,output_tokens (default: synthetic oscillating load)")
+    parser.add_argument("--interval", type=float, default=60.0, help="seconds between scaling decisions")
+    parser.add_argument("--slo-ms", type=float, default=30000.0, help="end-to-end latency SLO")
+    args = parser.parse_args()
+    if args.trace:
+        with open(args.trace) as f:
+            trace = sorted((float(row[0]), int(row[1])) for row in csv.reader(f) if row)
+    else:
+        trace = load_trace([(300, 1.6), (300, 0.3)] * 18)
+    for policy in (StepPolicy(), HysteresisPolicy(latency_slo_ms=args.slo_ms), PIDPolicy()):
+        print(json.dumps(simulate(policy, trace, interval=args.interval, latency_slo_ms=args.slo_ms).summary()))
@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+"""
+Dependency-aware deployment for the AI-SWARM orchestrator.
+A deployment is a DAG of steps - one node, one compose file, a few services each - with declared
+dependencies (Postgres/Redis before LiteLLM, Qdrant before the RAG pipeline, ...). Every step
+starts as soon as its dependencies have succeeded, up to `parallelism` at once. When a step fails
+its dependents are skipped right away while independent branches carry on. A full deploy takes
+the critical path rather than the sum of all node times, and the report says which path that was.
+"""
+
+import asyncio
+import logging
+import shlex
+import time
+from typing import Awaitable, Callable, Dict, Iterable, List, Mapping, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+SWARM_ROOT = "/opt/ai-swarm"
+
+OK, FAILED, SKIPPED = "ok", "failed", "skipped"
+
+
+class DeployStep:
+    def __init__(self, name: str, node: str, command: str, depends_on: Iterable[str] = (),
+                 timeout: Optional[float] = None, workdir: Optional[str] = None,
+                 compose_file: Optional[str] = None, services: Iterable[str] = (),
+                 env: Optional[Mapping[str, str]] = None):
+        self.name = name
+        self.node = node
+        self.command = command
+        self.depends_on = tuple(depends_on)
+        self.timeout = timeout
+        self.workdir = workdir
+        self.compose_file = compose_file
+        self.services = list(services)
+        self.env = dict(env or {})
+
+    @property
+    def remote_command(self) -> str:
+        return f"cd {self.workdir} && {self.command}" if self.workdir else self.command
+
+    @classmethod
+    def compose(cls, name: str, node: str, compose_file: str, services: Iterable[str],
+                depends_on: Iterable[str] = (), timeout: Optional[float] = None,
+                env: Optional[Mapping[str, str]] = None, recreate: Iterable[str] = ()) -> "DeployStep":
+        """
+        `docker-compose up -d` of some services of one compose file, run from the swarm checkout with
+        `env` set. Ordering comes from the graph, hence --no-deps. Compose recreates a container when
+        its definition or interpolated env changed, but not when a mounted config file did, so the
+        `recreate` services are forced. No services means there is nothing to run.
+        """
+        services, recreate = list(services), set(recreate)
+        prefix = "".join(f"{key}={shlex.quote(value)} " for key, value in sorted((env or {}).items()))
+        base = f"{prefix}docker-compose -f {compose_file} up -d --no-deps"
+        forced = [svc for svc in services if svc in recreate]
+        plain = [svc for svc in services if svc not in recreate]
+        commands = ([f"{base} --force-recreate {' '.join(forced)}"] if forced else []) + \
+                   ([f"{base} {' '.join(plain)}"] if plain else [])
+        return cls(name, node, " && ".join(commands), depends_on, timeout, workdir=SWARM_ROOT,
+                   compose_file=compose_file, services=services, env=env)
+
+
+class StepResult:
+    def __init__(self, step: DeployStep, status: str, started: float = 0.0, finished: float = 0.0,
+                 output: str = "", reason: str = ""):
+        self.step = step
+        self.status = status
+        self.started = started    # seconds since the deploy began
+        self.finished = finished
+        self.output = output
+        self.reason = reason
+
+    @property
+    def duration(self) -> float:
+        return self.finished - self.started
+
+
+class DeployReport:
+    def __init__(self, graph: "DeployGraph", results: Dict[str, StepResult], wall_seconds: float):
+        self.graph = graph
+        self.results = results
+        self.wall_seconds = wall_seconds
+
+    @property
+    def ok(self) -> bool:
+        return all(r.status == OK for r in self.results.values())
+
+    @property
+    def serial_seconds(self) -> float:
+        """What running the same steps one after another would have taken."""
+        return sum(r.duration for r in self.results.values())
+
+    def critical_path(self) -> Tuple[List[str], float]:
+        """The dependency chain with the largest summed step time, and that time."""
+        longest: Dict[str, Tuple[float, Optional[str]]] = {}
+        for name in self.graph.order:
+            before = max(((longest[d][0], d) for d in self.graph.steps[name].depends_on), default=(0.0, None))
+            longest[name] = (before[0] + self.results[name].duration, before[1])
+        if not longest:
+            return [], 0.0
+        name = max(longest, key=lambda n: longest[n][0])
+        total, path = longest[name][0], []
+        while name is not None:
+            path.append(name)
+            name = longest[name][1]
+        return path[::-1], total
+
+    def timings(self) -> Dict[str, Dict[str, object]]:
+        return {
+            name: {'node': r.step.node, 'status': r.status, 'start': round(r.started, 3),
+                   'seconds': round(r.duration, 3), **({'reason': r.reason} if r.reason else {})}
+            for name, r in self.results.items()
+        }
+
+    def summary(self) -> str:
+        path, path_seconds = self.critical_path()
+        lines = [f"{'step':<24} {'node':<10} {'status':<8} {'start':>8} {'seconds':>8}"]
+        for name in self.graph.order:
+            r = self.results[name]
+            lines.append(f"{name:<24} {r.step.node:<10} {r.status:<8} {r.started:>8.2f} {r.duration:>8.2f}"
+                         + (f"  {r.reason}" if r.reason else ""))
+        lines.append(f"wall {self.wall_seconds:.2f}s | critical path {path_seconds:.2f}s ({' -> '.join(path)}) "
+                     f"| serial {self.serial_seconds:.2f}s")
+        return "\n".join(lines)
+
+
+class DeployGraph:
+    def __init__(self, steps: Iterable[DeployStep]):
+        self.steps: Dict[str, DeployStep] = {}
+        for step in steps:
+            if step.name in self.steps:
+                raise ValueError(f"Duplicate deploy step {step.name!r}")
+            self.steps[step.name] = step
+        for step in self.steps.values():
+            unknown = [d for d in step.depends_on if d not in self.steps]
+            if unknown:
+                raise ValueError(f"Deploy step {step.name!r} depends on unknown step(s) {unknown}")
+        self.dependents: Dict[str, List[str]] = {name: [] for name in self.steps}
+        for step in self.steps.values():
+            for dep in step.depends_on:
+                self.dependents[dep].append(step.name)
+        self.order = self._topological_order()
+
+    def _topological_order(self) -> List[str]:
+        waiting = {name: len(step.depends_on) for name, step in self.steps.items()}
+        ready = [name for name, count in waiting.items() if count == 0]
+        order = []
+        while ready:
+            name = ready.pop(0)
+            order.append(name)
+            for child in self.dependents[name]:
+                waiting[child] -= 1
+                if waiting[child] == 0:
+                    ready.append(child)
+        if len(order) != len(self.steps):
+            cycle = sorted(name for name, count in waiting.items() if count > 0)
+            raise ValueError(f"Deploy steps form a cycle: {cycle}")
+        return order
+
+    def _descendants(self, name: str) -> List[str]:
+        found, stack = [], list(self.dependents[name])
+        while stack:
+            child = stack.pop()
+            if child not in found:
+                found.append(child)
+                stack.extend(self.dependents[child])
+        return found
+
+    async def run(self, execute: Callable[[DeployStep], Awaitable[Tuple[bool, str]]],
+                  parallelism: int = 4) -> DeployReport:
+        """
+        Run every step through `execute(step) -> (ok, output)`. Exceptions count as failures and
+        a step over its timeout is cancelled; either way its dependents are skipped.
+        """
+        began = time.monotonic()
+        limit = asyncio.Semaphore(max(1, parallelism))
+        results: Dict[str, StepResult] = {}
+        waiting = {name: len(step.depends_on) for name, step in self.steps.items()}
+        running: Dict[asyncio.Task, str] = {}
+
+        async def attempt(step: DeployStep) -> StepResult:
+            async with limit:
+                started = time.monotonic() - began
+                try:
+                    ok, output = await asyncio.wait_for(execute(step), step.timeout)
+                    reason = "" if ok else "command failed"
+                except asyncio.TimeoutError:
+                    ok, output, reason = False, "", f"timed out after {step.timeout:g}s"
+                except Exception as exc:
+                    ok, output, reason = False, "", f"{type(exc).__name__}: {exc}"
+                return StepResult(step, OK if ok else FAILED, started, time.monotonic() - began, output, reason)
+
+        def launch(name: str):
+            running[asyncio.create_task(attempt(self.steps[name]))] = name
+
+        for name in self.order:
+            if waiting[name] == 0:
+                launch(name)
+        while running:
+            done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                name = running.pop(task)
+                result = results[name] = task.result()
+                logger.info(f"Deploy step {name} on {result.step.node}: {result.status} in {result.duration:.2f}s"
+                            + (f" ({result.reason})" if result.reason else ""))
+                if result.status != OK:
+                    now = time.monotonic() - began
+                    for child in self._descendants(name):
+                        if child not in results:
+                            results[child] = StepResult(self.steps[child], SKIPPED, now, now,
+                                                        reason=f"dependency {name} {result.status}")
+                    continue
+                for child in self.dependents[name]:
+                    waiting[child] -= 1
+                    if waiting[child] == 0 and child not in results:
+                        launch(child)
+        return DeployReport(self, {name: results[name] for name in self.order}, time.monotonic() - began)
+
+
+# Pytest tests
+def _timed(durations: Dict[str, float], failing: Iterable[str] = ()):
+    failing = set(failing)
+    log = []
+
+    async def execute(step: DeployStep):
+        log.append(("start", step.name))
+        await asyncio.sleep(durations.get(step.name, 0.0))
+        log.append(("end", step.name))
+        return step.name not in failing, f"{step.name} done"
+
+    return execute, log
+
+
+def _diamond() -> DeployGraph:
+    return DeployGraph([
+        DeployStep.compose("oracle-data", "oracle", "deploy/01-oracle-ARM.yml", ["postgres", "redis"]),
+        DeployStep.compose("oracle-litellm", "oracle", "deploy/01-oracle-ARM.yml", ["litellm"], ["oracle-data"]),
+        DeployStep.compose("starlord-qdrant", "starlord", "deploy/02-starlord-OPTIMIZED.yml", ["qdrant"]),
+        DeployStep.compose("thanos-rag", "thanos", "deploy/03-thanos-SECURED.yml", ["rag-pipeline"],
+                           ["oracle-litellm", "starlord-qdrant"]),
+        DeployStep("thanos-monitor", "thanos", "true"),
+    ])
+
+
+def test_independent_steps_overlap_and_report_critical_path():
+    durations = {"oracle-data": 0.2, "oracle-litellm": 0.2, "starlord-qdrant": 0.3, "thanos-rag": 0.1,
+                 "thanos-monitor": 0.3}
+    execute, log = _timed(durations)
+    report = asyncio.run(_diamond().run(execute, parallelism=4))
+    assert report.ok and report.results["oracle-litellm"].output == "oracle-litellm done"
+    assert log.index(("end", "oracle-data")) < log.index(("start", "oracle-litellm"))
+    assert log.index(("end", "starlord-qdrant")) < log.index(("start", "thanos-rag"))
+    path, seconds = report.critical_path()
+    assert path == ["oracle-data", "oracle-litellm", "thanos-rag"] and 0.5 <= seconds < 0.6
+    assert report.wall_seconds < 0.65 < report.serial_seconds
+    assert "critical path" in report.summary() and report.timings()["thanos-rag"]["node"] == "thanos"
+    assert _diamond().steps["oracle-litellm"].remote_command == \
+        "cd /opt/ai-swarm && docker-compose -f deploy/01-oracle-ARM.yml up -d --no-deps litellm"
+    incremental = DeployStep.compose("s", "starlord", "f.yml", ["vllm", "qdrant"], env={"N": "a b"}, recreate=["qdrant"])
+    assert incremental.command == ("N='a b' docker-compose -f f.yml up -d --no-deps --force-recreate qdrant && "
+                                   "N='a b' docker-compose -f f.yml up -d --no-deps vllm")
+
+    serial = asyncio.run(_diamond().run(_timed(durations)[0], parallelism=1))
+    assert serial.wall_seconds >= 1.1
+
+
+def test_failure_skips_dependents_but_not_independent_steps():
+    execute, log = _timed({"starlord-qdrant": 0.3, "thanos-monitor": 0.1}, failing={"oracle-data"})
+    report = asyncio.run(_diamond().run(execute))
+    status = {name: r.status for name, r in report.results.items()}
+    assert status == {"oracle-data": FAILED, "oracle-litellm": SKIPPED, "starlord-qdrant": OK,
+                      "thanos-rag": SKIPPED, "thanos-monitor": OK}
+    assert ("start", "oracle-litellm") not in log and ("start", "thanos-rag") not in log
+    assert report.results["thanos-rag"].reason == "dependency oracle-data failed" and not report.ok
+    # A hung step times out and counts as failed
+    hung = DeployGraph([DeployStep("pull", "oracle", "x", timeout=0.05), DeployStep("up", "oracle", "y", ["pull"])])
+    report = asyncio.run(hung.run(_timed({"pull": 5})[0]))
+    assert report.results["pull"].reason == "timed out after 0.05s" and report.results["up"].status == SKIPPED
+
+
+def test_graph_validation():
+    import pytest
+    with pytest.raises(ValueError, match="unknown"):
+        DeployGraph([DeployStep("a", "oracle", "true", ["missing"])])
+    with pytest.raises(ValueError, match="cycle"):
+        DeployGraph([DeployStep("a", "oracle", "true", ["b"]), DeployStep("b", "oracle", "true", ["a"])])
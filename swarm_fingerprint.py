@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+"""
+Content fingerprints of what each compose service is deployed from, for incremental deploys.
+A service's inputs are its own definition in the compose file, every relative bind-mount source it
+references (config/*.yml, *.conf, whole config directories) and the environment variables it
+interpolates that the orchestrator itself injects into the compose command (DeployStep.env).
+Variables a node supplies from its own shell or .env are not visible here and are not fingerprinted;
+the orchestrator's local environment is deliberately ignored, since compose on the node never sees
+it. Each input is hashed separately, so a diff names what changed; only hashes are cached, never
+environment values. The last-applied fingerprints live in a local JSON file per
+node, compose file and service.
+"""
+
+import hashlib
+import json
+import os
+import re
+from pathlib import Path
+from typing import Any, Dict, List, Mapping, Optional, Tuple
+
+import yaml
+
+_ENV_REFERENCE = re.compile(r"\$\{([A-Za-z_][A-Za-z0-9_]*)[^}]*\}|\$([A-Za-z_][A-Za-z0-9_]*)")
+
+
+def _digest(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()[:16]
+
+
+def _volume_source(volume: Any) -> Optional[str]:
+    if isinstance(volume, dict):
+        return volume.get('source') if volume.get('type', 'bind') == 'bind' else None
+    source = str(volume).split(':', 1)[0]
+    return source if ':' in str(volume) else None
+
+
+class Fingerprinter:
+    """Hashes service inputs under `root` (the swarm checkout); file hashes are cached by mtime and size."""
+
+    def __init__(self, root: Path):
+        self.root = Path(root)
+        self._files: Dict[str, Tuple[int, int, str]] = {}
+        self._compose: Dict[str, Tuple[int, Dict[str, Any]]] = {}
+
+    def services(self, compose_file: str) -> Dict[str, Any]:
+        path = self.root / compose_file
+        mtime = path.stat().st_mtime_ns
+        cached = self._compose.get(compose_file)
+        if cached is None or cached[0] != mtime:
+            cached = (mtime, (yaml.safe_load(path.read_text()) or {}).get('services') or {})
+            self._compose[compose_file] = cached
+        return cached[1]
+
+    def _resolve(self, compose_file: str, source: str) -> Path:
+        # Compose resolves against the compose file's directory; the configs live at the checkout root
+        beside = (self.root / compose_file).parent / source
+        return beside if beside.exists() else self.root / source
+
+    def _hash_path(self, path: Path) -> str:
+        if path.is_dir():
+            return _digest("\n".join(f"{p.relative_to(path)}:{self._hash_path(p)}"
+                                     for p in sorted(path.rglob('*')) if p.is_file()).encode())
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            return "missing"
+        cached = self._files.get(str(path))
+        if cached is None or cached[:2] != (stat.st_mtime_ns, stat.st_size):
+            cached = (stat.st_mtime_ns, stat.st_size, _digest(path.read_bytes()))
+            self._files[str(path)] = cached
+        return cached[2]
+
+    def service(self, compose_file: str, name: str, env: Mapping[str, str]) -> Dict[str, Any]:
+        """
+        {'definition': hash, 'files': {source: hash}, 'env': {VAR: hash}} of one service. `env` is what
+        the deploy step injects; referenced variables it does not set are left out.
+        """
+        definition = self.services(compose_file)[name]
+        text = json.dumps(definition, sort_keys=True, default=str)
+        files = {}
+        for volume in definition.get('volumes') or []:
+            source = _volume_source(volume)
+            if source and source.startswith('.'):
+                files[source] = self._hash_path(self._resolve(compose_file, source))
+        variables = sorted({a or b for a, b in _ENV_REFERENCE.findall(text)})
+        return {
+            'definition': _digest(text.encode()),
+            'files': files,
+            'env': {var: _digest(env[var].encode()) for var in variables if var in env},
+        }
+
+
+def changes(applied: Optional[Dict[str, Any]], current: Dict[str, Any]) -> List[str]:
+    """Why a service needs deploying: [] when nothing changed, ['new'] when it was never applied."""
+    if applied is None:
+        return ['new']
+    reasons = []
+    if applied.get('definition') != current['definition']:
+        reasons.append('definition')
+    for kind, label in (('files', 'file'), ('env', 'env')):
+        before, after = applied.get(kind, {}), current[kind]
+        for key in sorted(set(before) | set(after)):
+            if before.get(key) != after.get(key):
+                reasons.append(f"{label}:{key}")
+    return reasons
+
+
+class AppliedState:
+    """Last-applied fingerprints: {node: {compose_file: {service: fingerprint}}} in a JSON file."""
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        try:
+            self.data = json.loads(self.path.read_text())
+        except (FileNotFoundError, ValueError):
+            self.data = {}
+
+    def get(self, node: str, compose_file: str, service: str) -> Optional[Dict[str, Any]]:
+        return self.data.get(node, {}).get(compose_file, {}).get(service)
+
+    def record(self, node: str, compose_file: str, service: str, fingerprint: Dict[str, Any]):
+        self.data.setdefault(node, {}).setdefault(compose_file, {})[service] = fingerprint
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix('.tmp')
+        tmp.write_text(json.dumps(self.data, indent=2, sort_keys=True))
+        os.replace(tmp, self.path)
+
+
+# Pytest tests
+def _checkout(tmp_path) -> Path:
+    (tmp_path / 'deploy').mkdir()
+    (tmp_path / 'config').mkdir()
+    (tmp_path / 'config' / 'litellm.yaml').write_text("model_list: []\n")
+    (tmp_path / 'config' / 'grafana').mkdir()
+    (tmp_path / 'config' / 'grafana' / 'datasource.yml').write_text("a: 1\n")
+    (tmp_path / 'deploy' / 'oracle.yml').write_text(yaml.safe_dump({'services': {
+        'litellm': {'image': 'litellm:1', 'environment': {'KEY': '${LITELLM_MASTER_KEY}'},
+                    'volumes': ['./config/litellm.yaml:/app/config.yaml:ro', '/mnt/data:/data']},
+        'grafana': {'image': 'grafana:10', 'volumes': ['./config/grafana:/etc/grafana/provisioning:ro']},
+        'redis': {'image': 'redis:7', 'command': 'redis-server --requirepass $REDIS_PASSWORD'},
+    }}))
+    return tmp_path
+
+
+def test_fingerprints_name_what_changed(tmp_path):
+    root = _checkout(tmp_path)
+    fp = Fingerprinter(root)
+    env = {'LITELLM_MASTER_KEY': 'k1', 'REDIS_PASSWORD': 'p1'}
+    before = {name: fp.service('deploy/oracle.yml', name, env) for name in ('litellm', 'grafana', 'redis')}
+    assert set(before['litellm']['files']) == {'./config/litellm.yaml'} and 'k1' not in json.dumps(before)
+    assert list(before['redis']['env']) == ['REDIS_PASSWORD']
+    # Only injected variables count: a node's own .env is invisible, the orchestrator's shell irrelevant
+    assert fp.service('deploy/oracle.yml', 'redis', {})['env'] == {}
+
+    assert all(changes(before[n], fp.service('deploy/oracle.yml', n, env)) == [] for n in before)
+    (root / 'config' / 'grafana' / 'datasource.yml').write_text("a: 2\n")
+    env['REDIS_PASSWORD'] = 'p2'
+    after = {name: fp.service('deploy/oracle.yml', name, env) for name in before}
+    assert changes(before['grafana'], after['grafana']) == ['file:./config/grafana']
+    assert changes(before['redis'], after['redis']) == ['env:REDIS_PASSWORD']
+    assert changes(before['litellm'], after['litellm']) == [] and changes(None, after['redis']) == ['new']
+
+
+def test_applied_state_round_trip(tmp_path):
+    state = AppliedState(tmp_path / 'state' / 'applied.json')
+    assert state.get('oracle', 'deploy/oracle.yml', 'redis') is None
+    state.record('oracle', 'deploy/oracle.yml', 'redis', {'definition': 'abc', 'files': {}, 'env': {}})
+    state.save()
+    reloaded = AppliedState(tmp_path / 'state' / 'applied.json')
+    assert reloaded.get('oracle', 'deploy/oracle.yml', 'redis')['definition'] == 'abc'
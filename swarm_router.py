@@ -0,0 +1,381 @@
+#!/usr/bin/env python3
+"""
+Request-time router for the swarm's OpenAI-compatible inference backends: Starlord's vLLM, the
+Thanos vLLM backup and Oracle's CPU inference server. The router tracks in-flight requests and a
+smoothed latency per backend, and sends each request to the backend that serves the requested
+model with the least expected latency. GPU backends are preferred; once every GPU backend's queue
+is deeper than `spill_queue_depth`, requests spill over to the CPU path. Each backend keeps its own
+pool of keep-alive connections. A backend that refuses a connection, or answers 429/503
+(overloaded or still loading), is benched for a short cooldown. The request then moves to the
+next-best backend; an overloaded answer is retried only once.
+Run: python main.py --router 8090
+"""
+
+import asyncio
+import json
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Iterable, List, Optional, Set
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+_HOP_BY_HOP = {'connection', 'keep-alive', 'transfer-encoding', 'upgrade', 'proxy-connection', 'te', 'trailer'}
+_FORWARDED_HEADERS = ('authorization', 'content-type', 'accept')
+
+
+@dataclass
+class Backend:
+    name: str
+    url: str
+    kind: str = 'gpu'  # 'gpu' or 'cpu'
+    node: Optional[str] = None
+    capacity: int = 16  # requests it runs at once (vLLM max-num-seqs, CPU batch size)
+    aliases: Dict[str, str] = field(default_factory=dict)  # requested model -> model name it serves
+    models: Optional[Set[str]] = None  # from /v1/models; None until discovered
+    latency_ms: float = 1000.0  # prior until requests are measured
+    in_flight: int = 0
+    served: int = 0
+    failures: int = 0
+    down_until: float = 0.0
+
+    def serves(self, model: Optional[str]) -> bool:
+        if model is None:
+            return True
+        return model in self.aliases or (self.models is not None and model in self.models)
+
+    def expected_ms(self) -> float:
+        # Latency grows with the share of the backend's batch already taken
+        return self.latency_ms * (1.0 + self.in_flight / self.capacity)
+
+
+class SwarmRouter:
+    """Backend choice, accounting and pooled forwarding; `create_app` puts an HTTP front on it."""
+
+    def __init__(self, backends: Iterable[Backend], spill_queue_depth: float = 4.0, alpha: float = 0.2,
+                 failure_cooldown: float = 10.0, timeout: float = 300.0, max_connections: int = 64,
+                 queue_depth: Optional[Callable[[Backend], Optional[float]]] = None):
+        self.backends: Dict[str, Backend] = {b.name: b for b in backends}
+        self.spill_queue_depth = spill_queue_depth
+        self.alpha = alpha
+        self.failure_cooldown = failure_cooldown
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.external_queue_depth = queue_depth  # e.g. vLLM's own waiting count from telemetry
+        self.spilled = 0
+        self._clients: Dict[str, httpx.AsyncClient] = {}
+
+    def client(self, backend: Backend) -> httpx.AsyncClient:
+        if backend.name not in self._clients:
+            self._clients[backend.name] = httpx.AsyncClient(
+                base_url=backend.url,
+                timeout=httpx.Timeout(self.timeout, connect=5.0),
+                limits=httpx.Limits(max_connections=self.max_connections,
+                                    max_keepalive_connections=self.max_connections, keepalive_expiry=60.0),
+            )
+        return self._clients[backend.name]
+
+    async def close(self):
+        clients, self._clients = list(self._clients.values()), {}
+        await asyncio.gather(*(c.aclose() for c in clients))
+
+    async def refresh(self):
+        """Discover what each backend serves; a backend that cannot answer keeps its last known list."""
+        async def discover(backend: Backend):
+            try:
+                response = await self.client(backend).get('/v1/models', timeout=5.0)
+                response.raise_for_status()
+                backend.models = {m['id'] for m in response.json().get('data', [])}
+            except (httpx.HTTPError, ValueError, KeyError, TypeError) as exc:
+                logger.warning(f"Model discovery failed on {backend.name}: {exc}")
+        await asyncio.gather(*(discover(b) for b in self.backends.values()))
+
+    def queue_depth(self, backend: Backend) -> float:
+        if self.external_queue_depth is not None:
+            depth = self.external_queue_depth(backend)
+            if depth is not None:
+                return depth
+        return max(0, backend.in_flight - backend.capacity)
+
+    def choose(self, model: Optional[str], exclude: Iterable[str] = ()) -> Optional[Backend]:
+        now = time.monotonic()
+        candidates = [b for b in self.backends.values()
+                      if b.name not in exclude and b.down_until <= now and b.serves(model)]
+        gpus = [b for b in candidates if b.kind == 'gpu' and self.queue_depth(b) <= self.spill_queue_depth]
+        cpus = [b for b in candidates if b.kind == 'cpu']
+        if not gpus and cpus and len(cpus) < len(candidates):
+            self.spilled += 1
+        # Queued GPUs remain the fallback for models no CPU backend serves
+        return min(gpus or cpus or candidates, key=lambda b: b.expected_ms(), default=None)
+
+    def finished(self, backend: Backend, started: float, ok: bool):
+        backend.in_flight -= 1
+        if ok:
+            backend.served += 1
+            elapsed = (time.monotonic() - started) * 1000.0
+            backend.latency_ms += self.alpha * (elapsed - backend.latency_ms)
+        else:
+            backend.failures += 1
+
+    async def send(self, backend: Backend, path: str, payload: dict, headers: Dict[str, str]) -> httpx.Response:
+        """Start a request on `backend`; the caller reads the streamed response and calls `finished`."""
+        model = payload.get('model')
+        if model in backend.aliases:
+            payload = dict(payload, model=backend.aliases[model])
+        client = self.client(backend)
+        request = client.build_request('POST', path, content=json.dumps(payload).encode(), headers=headers)
+        backend.in_flight += 1
+        try:
+            return await client.send(request, stream=True)
+        except Exception:
+            backend.in_flight -= 1
+            backend.failures += 1
+            raise
+
+    def bench(self, backend: Backend, reason: str):
+        backend.down_until = time.monotonic() + self.failure_cooldown
+        logger.warning(f"Backend {backend.name} benched for {self.failure_cooldown}s: {reason}")
+
+    def status(self) -> Dict[str, object]:
+        now = time.monotonic()
+        return {
+            'spilled': self.spilled,
+            'backends': {b.name: {
+                'kind': b.kind, 'in_flight': b.in_flight, 'capacity': b.capacity,
+                'latency_ms': round(b.latency_ms, 1), 'expected_ms': round(b.expected_ms(), 1),
+                'queue_depth': self.queue_depth(b), 'served': b.served, 'failures': b.failures,
+                'up': b.down_until <= now, 'models': sorted(b.models or ()) + sorted(b.aliases),
+            } for b in self.backends.values()},
+        }
+
+
+def create_app(router: SwarmRouter, refresh_seconds: float = 60.0):
+    """FastAPI app proxying /v1/chat/completions and /v1/completions through `router`."""
+    from contextlib import asynccontextmanager
+
+    from fastapi import FastAPI, Request
+    from fastapi.responses import JSONResponse, StreamingResponse
+    from starlette.background import BackgroundTask
+
+    async def refresh_loop():
+        while True:
+            await router.refresh()
+            await asyncio.sleep(refresh_seconds)
+
+    @asynccontextmanager
+    async def lifespan(app):
+        task = asyncio.create_task(refresh_loop())
+        yield
+        task.cancel()
+        await router.close()
+
+    app = FastAPI(title="AI Swarm Router", docs_url=None, redoc_url=None, lifespan=lifespan)
+
+    def error(status: int, message: str):
+        return JSONResponse({'error': {'message': message, 'type': 'router_error'}}, status_code=status)
+
+    async def proxy(request: Request):
+        try:
+            payload = json.loads(await request.body())
+        except ValueError:
+            return error(400, "Request body must be JSON")
+        if not isinstance(payload, dict):
+            return error(400, "Request body must be a JSON object")
+        model = payload.get('model')
+        headers = {k: v for k, v in request.headers.items() if k in _FORWARDED_HEADERS}
+        tried: List[str] = []
+        retried = False
+        while True:
+            backend = router.choose(model, tried)
+            if backend is None:
+                if tried:
+                    return error(503, f"No backend could take the request (tried {', '.join(tried)})")
+                return error(404 if model else 503, f"No available backend serves model {model!r}")
+            tried.append(backend.name)
+            started = time.monotonic()
+            try:
+                response = await router.send(backend, request.url.path, payload, headers)
+            except httpx.TransportError as exc:
+                router.bench(backend, str(exc) or type(exc).__name__)
+                continue
+            if response.status_code in (429, 503):
+                router.bench(backend, f"HTTP {response.status_code}")
+                if not retried:
+                    retried = True
+                    await response.aclose()
+                    router.finished(backend, started, ok=False)
+                    continue
+
+            async def done(backend=backend, response=response, started=started):
+                await response.aclose()
+                # A fast 429/503 rejection is not a latency sample: it would make the backend look quick
+                router.finished(backend, started, ok=response.status_code < 500 and response.status_code != 429)
+
+            forwarded = {k: v for k, v in response.headers.items() if k.lower() not in _HOP_BY_HOP}
+            forwarded['x-swarm-backend'] = backend.name
+            return StreamingResponse(response.aiter_raw(), status_code=response.status_code,
+                                     headers=forwarded, background=BackgroundTask(done))
+
+    app.add_api_route('/v1/chat/completions', proxy, methods=['POST'])
+    app.add_api_route('/v1/completions', proxy, methods=['POST'])
+
+    @app.get('/v1/models')
+    async def models():
+        names = set()
+        for backend in router.backends.values():
+            names |= (backend.models or set()) | set(backend.aliases)
+        return {'object': 'list', 'data': [{'id': name, 'object': 'model'} for name in sorted(names)]}
+
+    @app.get('/router/status')
+    async def status():
+        return router.status()
+
+    return app
+
+
+# Pytest tests
+class _StubBackend:
+    """A real local HTTP server speaking enough of the OpenAI API to route to."""
+
+    def __init__(self, name: str, models: List[str], delay: float = 0.0, status: int = 200):
+        import threading
+
+        import uvicorn
+        from fastapi import FastAPI, Request
+        from fastapi.responses import JSONResponse, StreamingResponse
+
+        self.name, self.delay = name, delay
+        self.client_ports: Set[int] = set()
+        self.models_seen: List[str] = []
+        app = FastAPI()
+
+        @app.get('/v1/models')
+        async def list_models():
+            return {'object': 'list', 'data': [{'id': m} for m in models]}
+
+        @app.post('/v1/chat/completions')
+        async def chat(request: Request):
+            body = await request.json()
+            self.client_ports.add(request.client.port)
+            self.models_seen.append(body.get('model'))
+            await asyncio.sleep(self.delay)
+            if status != 200:
+                return JSONResponse({'error': {'message': 'busy'}}, status_code=status)
+            if body.get('stream'):
+                async def events():
+                    for word in ('hello', 'from', name):
+                        yield f"data: {json.dumps({'choices': [{'delta': {'content': word}}]})}\n\n"
+                    yield "data: [DONE]\n\n"
+                return StreamingResponse(events(), media_type='text/event-stream')
+            return {'backend': name, 'choices': [{'message': {'content': f"hello from {name}"}}]}
+
+        self.server = uvicorn.Server(uvicorn.Config(app, host='127.0.0.1', port=0, log_level='warning',
+                                                    lifespan='off', ws='none'))
+        self.thread = threading.Thread(target=self.server.run, daemon=True)
+        self.thread.start()
+        while not self.server.started:
+            time.sleep(0.01)
+        self.url = f"http://127.0.0.1:{self.server.servers[0].sockets[0].getsockname()[1]}"
+
+    def close(self):
+        self.server.should_exit = True
+        self.thread.join(timeout=5)
+
+
+def test_choose_prefers_fast_gpus_and_spills_to_cpu():
+    gpu = Backend('starlord', 'http://gpu', capacity=2, models={'llama'}, latency_ms=500)
+    backup = Backend('thanos', 'http://backup', capacity=2, models={'llama'}, latency_ms=900)
+    cpu = Backend('oracle', 'http://cpu', kind='cpu', capacity=2, aliases={'llama': 'tinyllama'},
+                  models={'phi'}, latency_ms=2000)
+    router = SwarmRouter([gpu, backup, cpu], spill_queue_depth=1)
+    assert router.choose('llama') is gpu
+    gpu.in_flight = 2  # 500 * 2 = 1000ms expected: the idle backup is now faster
+    assert router.choose('llama') is backup
+    assert router.choose('phi') is cpu and router.choose('mistral') is None
+    # Both GPUs queue past the threshold: spill over to CPU
+    gpu.in_flight, backup.in_flight = 4, 4
+    assert router.choose('llama') is cpu and router.spilled == 1
+    router.external_queue_depth = lambda b: 0.0 if b.name == 'thanos' else None
+    assert router.choose('llama') is backup  # telemetry says the backup's vLLM is not queueing
+    backup.down_until = time.monotonic() + 60
+    assert router.choose('llama') is cpu
+
+
+def test_proxy_balances_spills_and_fails_over():
+    gpu = _StubBackend('starlord', ['llama'], delay=0.3)
+    cpu = _StubBackend('oracle', ['tinyllama'], delay=0.05)
+    busy = _StubBackend('thanos', ['llama'], status=503)
+    backends = [
+        Backend('starlord', gpu.url, capacity=2),
+        Backend('oracle', cpu.url, kind='cpu', capacity=4, aliases={'llama': 'tinyllama'}, latency_ms=5000),
+        # Nothing listens any more: discovery keeps the last known models, the first request benches it
+        Backend('dead', 'http://127.0.0.1:9', models={'llama'}, latency_ms=1),
+        Backend('thanos', busy.url, latency_ms=2),
+    ]
+    router = SwarmRouter(backends, spill_queue_depth=0)
+    app = create_app(router)
+
+    async def scenario():
+        await router.refresh()
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://router') as client:
+            # 'dead' is tried first (lowest expected latency) and benched; 'thanos' answers 503 and is skipped
+            first = await client.post('/v1/chat/completions', json={'model': 'llama', 'messages': []})
+            burst = await asyncio.gather(*(
+                client.post('/v1/chat/completions', json={'model': 'llama', 'messages': []}) for _ in range(8)))
+            pooled = len(cpu.client_ports)
+            for _ in range(5):
+                await client.post('/v1/chat/completions', json={'model': 'tinyllama', 'messages': []})
+            streamed = await client.post('/v1/chat/completions', json={'model': 'llama', 'stream': True})
+            missing = await client.post('/v1/chat/completions', json={'model': 'mistral'})
+            listed = (await client.get('/v1/models')).json()
+            status = (await client.get('/router/status')).json()
+        await router.close()
+        return first, burst, pooled, streamed, missing, listed, status
+
+    try:
+        first, burst, pooled, streamed, missing, listed, status = asyncio.run(scenario())
+    finally:
+        for stub in (gpu, cpu, busy):
+            stub.close()
+    assert first.status_code == 200 and first.headers['x-swarm-backend'] in ('starlord', 'oracle')
+    assert status['backends']['dead']['failures'] == 1 and not status['backends']['dead']['up']
+    assert status['backends']['thanos']['failures'] == 1
+    served = [r.headers['x-swarm-backend'] for r in burst]
+    assert all(r.status_code == 200 for r in burst)
+    # Starlord takes its batch plus one queued request; the rest spill to the CPU path under its model name
+    assert served.count('starlord') == 3 and served.count('oracle') == 5 and status['spilled'] >= 5
+    assert set(cpu.models_seen) == {'tinyllama'} and set(gpu.models_seen) == {'llama'}
+    # Pooled keep-alive: later requests reuse the burst's connections instead of opening new ones
+    assert len(cpu.client_ports) == pooled
+    assert streamed.text.count('data: ') == 4 and streamed.text.endswith("data: [DONE]\n\n")
+    assert missing.status_code == 404
+    assert {m['id'] for m in listed['data']} == {'llama', 'tinyllama'}
+    assert all(b['in_flight'] == 0 for b in status['backends'].values())
+
+
+def test_rejections_after_the_retry_are_not_latency_samples():
+    limited = _StubBackend('starlord', ['llama'], status=429)
+    overloaded = _StubBackend('thanos', ['llama'], status=503)
+    backends = [Backend('starlord', limited.url, latency_ms=800), Backend('thanos', overloaded.url, latency_ms=900)]
+    router = SwarmRouter(backends)
+
+    async def scenario():
+        await router.refresh()
+        transport = httpx.ASGITransport(app=create_app(router))
+        async with httpx.AsyncClient(transport=transport, base_url='http://router') as client:
+            response = await client.post('/v1/chat/completions', json={'model': 'llama', 'messages': []})
+            await asyncio.sleep(0.05)  # the streamed response's background task records the outcome
+        await router.close()
+        return response
+
+    try:
+        response = asyncio.run(scenario())
+    finally:
+        limited.close()
+        overloaded.close()
+    assert response.status_code in (429, 503)
+    for backend, latency in zip(backends, (800, 900)):
+        assert backend.failures == 1 and backend.served == 0 and backend.latency_ms == latency
@@ -0,0 +1,396 @@
+#!/usr/bin/env python3
+"""
+Pooled, non-blocking SSH for the AI-SWARM orchestrator.
+Each node keeps one persistent paramiko session with transport keep-alives; commands open a
+channel on it (SSH multiplexes channels), so only the first command - or the first after a
+dropped connection - pays for a handshake. paramiko is blocking, so connecting and reading run in
+a thread pool and the event loop (auto-scaler included) never waits on a remote host. `run_all`
+fans one command out to every node at once; `stream` follows a long-running command's output.
+"""
+
+import asyncio
+import codecs
+import logging
+import os
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Any, AsyncIterator, Dict, Iterable, Optional
+
+if TYPE_CHECKING:  # paramiko (and its crypto stack) is imported on the first connect, not at startup
+    import paramiko
+
+logger = logging.getLogger(__name__)
+
+
+def _dropped() -> tuple:
+    """Failures that mean the session itself is gone; the command is retried once on a fresh one."""
+    import paramiko
+
+    return (paramiko.SSHException, EOFError, ConnectionError, socket.error)
+
+
+class SSHResult:
+    def __init__(self, node: str, stdout: str = "", stderr: str = "", exit_status: Optional[int] = None,
+                 error: Optional[str] = None, elapsed: float = 0.0):
+        self.node = node
+        self.stdout = stdout
+        self.stderr = stderr
+        self.exit_status = exit_status
+        self.error = error
+        self.elapsed = elapsed
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None and self.exit_status == 0
+
+    def __repr__(self) -> str:
+        return f"SSHResult(node={self.node!r}, exit_status={self.exit_status}, error={self.error!r})"
+
+
+class _NodeSession:
+    """The persistent client of one node; `lock` serializes (re)connecting, not commands."""
+
+    def __init__(self):
+        self.client: Optional['paramiko.SSHClient'] = None
+        self.lock = threading.Lock()
+        self.connects = 0
+
+    def active(self) -> bool:
+        transport = self.client.get_transport() if self.client is not None else None
+        return transport is not None and transport.is_active()
+
+    def close(self):
+        if self.client is not None:
+            self.client.close()
+            self.client = None
+
+
+class SSHPool:
+    """
+    nodes: name -> {'host', 'username', optional 'port'}. At most `max_sessions` commands run on one
+    node at a time (sshd's MaxSessions defaults to 10).
+    """
+
+    def __init__(self, nodes: Dict[str, Dict[str, Any]], key_path: Optional[str] = None,
+                 connect_timeout: float = 10.0, command_timeout: float = 120.0, keepalive: int = 30,
+                 max_sessions: int = 4):
+        self.nodes = nodes
+        self.key_path = os.path.expanduser(key_path) if key_path else None
+        self.connect_timeout = connect_timeout
+        self.command_timeout = command_timeout
+        self.keepalive = keepalive
+        self.max_sessions = max_sessions
+        self._sessions = {name: _NodeSession() for name in nodes}
+        self._limits: Dict[str, asyncio.Semaphore] = {}
+        self._executor = ThreadPoolExecutor(max_workers=max(4, len(nodes) * max_sessions),
+                                            thread_name_prefix="ssh")
+
+    def _connect(self, node: str, session: _NodeSession) -> 'paramiko.SSHClient':
+        import paramiko
+
+        with session.lock:
+            if session.active():
+                return session.client
+            session.close()
+            spec = self.nodes[node]
+            client = paramiko.SSHClient()
+            client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+            client.connect(spec['host'], port=spec.get('port', 22), username=spec['username'],
+                           key_filename=self.key_path, timeout=self.connect_timeout,
+                           banner_timeout=self.connect_timeout, auth_timeout=self.connect_timeout)
+            client.get_transport().set_keepalive(self.keepalive)
+            session.client = client
+            session.connects += 1
+            logger.info(f"SSH session to {node} opened ({spec['host']})")
+            return client
+
+    def _exec(self, client: 'paramiko.SSHClient', command: str, timeout: float):
+        channel = client.get_transport().open_session(timeout=self.connect_timeout)
+        try:
+            channel.exec_command(command)
+            # Short reads so stderr is drained even while stdout is quiet; a full window on either stalls the other
+            channel.settimeout(0.1)
+            deadline = time.monotonic() + timeout
+            out, err = [], []
+            while True:
+                while channel.recv_stderr_ready():
+                    err.append(channel.recv_stderr(65536))
+                try:
+                    chunk = channel.recv(65536)
+                except socket.timeout:
+                    if time.monotonic() > deadline:
+                        raise TimeoutError(f"command timed out after {timeout:g}s")
+                    continue
+                if not chunk:
+                    break
+                out.append(chunk)
+            status = channel.recv_exit_status()
+            while channel.recv_stderr_ready():
+                err.append(channel.recv_stderr(65536))
+            return b"".join(out).decode(errors="replace"), b"".join(err).decode(errors="replace"), status
+        finally:
+            channel.close()
+
+    def _run_blocking(self, node: str, command: str, timeout: float) -> SSHResult:
+        started = time.monotonic()
+        session = self._sessions[node]
+        for attempt in (1, 2):
+            reused = session.active()
+            try:
+                client = self._connect(node, session)
+                stdout, stderr, status = self._exec(client, command, timeout)
+                return SSHResult(node, stdout, stderr, status, elapsed=time.monotonic() - started)
+            except TimeoutError as exc:
+                return SSHResult(node, error=str(exc), elapsed=time.monotonic() - started)
+            except _dropped() as exc:
+                with session.lock:
+                    session.close()
+                if not reused or attempt == 2:
+                    return SSHResult(node, error=f"{type(exc).__name__}: {exc}", elapsed=time.monotonic() - started)
+                logger.info(f"SSH session to {node} dropped ({exc}); reconnecting")
+            except Exception as exc:
+                return SSHResult(node, error=f"{type(exc).__name__}: {exc}", elapsed=time.monotonic() - started)
+
+    async def run(self, node: str, command: str, timeout: Optional[float] = None) -> SSHResult:
+        """Run `command` on `node` off the event loop. Failures are reported in the result, never raised."""
+        if node not in self.nodes:
+            raise KeyError(f"Unknown node {node!r}")
+        limit = self._limits.setdefault(node, asyncio.Semaphore(self.max_sessions))
+        async with limit:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(
+                self._executor, self._run_blocking, node, command, timeout or self.command_timeout)
+
+    async def run_all(self, command: str, nodes: Optional[Iterable[str]] = None,
+                      timeout: Optional[float] = None) -> Dict[str, SSHResult]:
+        """Run `command` on every node (or the given ones) concurrently."""
+        names = list(nodes) if nodes is not None else list(self.nodes)
+        results = await asyncio.gather(*(self.run(name, command, timeout) for name in names))
+        return dict(zip(names, results))
+
+    async def stream(self, node: str, command: str) -> AsyncIterator[str]:
+        """
+        Yield the output of a long-running command as it arrives, on the node's pooled session. The
+        command gets a pty, so it is hung up when the stream is closed. Ends when the command exits;
+        connection errors are raised. Each open stream holds one thread of the pool.
+        """
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue()
+        closing = threading.Event()
+
+        def put(item):
+            try:
+                loop.call_soon_threadsafe(queue.put_nowait, item)
+            except RuntimeError:  # the loop is already closed
+                closing.set()
+
+        def pump():
+            decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+            try:
+                channel = self._connect(node, self._sessions[node]).get_transport().open_session(
+                    timeout=self.connect_timeout)
+                try:
+                    channel.get_pty()
+                    channel.exec_command(command)
+                    channel.settimeout(0.5)
+                    while not closing.is_set():
+                        try:
+                            data = channel.recv(65536)
+                        except socket.timeout:
+                            continue
+                        if not data:
+                            break
+                        put(decoder.decode(data))
+                finally:
+                    channel.close()
+            except Exception as exc:
+                put(exc)
+            put(None)
+
+        loop.run_in_executor(self._executor, pump)
+        try:
+            while True:
+                item = await queue.get()
+                if item is None:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            closing.set()
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        return {name: {'connected': s.active(), 'connects': s.connects} for name, s in self._sessions.items()}
+
+    async def close(self):
+        for session in self._sessions.values():
+            with session.lock:
+                session.close()
+        self._executor.shutdown(wait=False)
+
+
+# Pytest tests
+class _LocalSSHServer:
+    """A real SSH server on 127.0.0.1 that runs commands with /bin/sh - no remote hosts needed."""
+
+    def __init__(self, tmp_path):
+        import subprocess
+
+        import paramiko
+
+        self.key = paramiko.RSAKey.generate(2048)
+        self.key_path = str(tmp_path / "id_rsa")
+        self.key.write_private_key_file(self.key_path)
+        self.handshakes = 0
+        self.transports = []
+        self.sock = socket.socket()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen(16)
+        self.port = self.sock.getsockname()[1]
+        stub = self
+
+        def execute(channel, command):
+            proc = subprocess.Popen(["/bin/sh", "-c", command], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            for chunk in iter(lambda: proc.stdout.read1(65536), b""):
+                channel.sendall(chunk)
+            channel.sendall_stderr(proc.stderr.read())
+            channel.send_exit_status(proc.wait(timeout=60))
+            # EOF rather than close: a close can overtake the exec reply; the client closes the channel
+            channel.shutdown_write()
+
+        class Server(paramiko.ServerInterface):
+            def get_allowed_auths(self, username):
+                return "publickey"
+
+            def check_auth_publickey(self, username, key):
+                return paramiko.AUTH_SUCCESSFUL if key == stub.key else paramiko.AUTH_FAILED
+
+            def check_channel_request(self, kind, chanid):
+                return paramiko.OPEN_SUCCEEDED if kind == "session" else paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+            def check_channel_pty_request(self, *args):
+                return True
+
+            def check_channel_exec_request(self, channel, command):
+                threading.Thread(target=execute, args=(channel, command.decode()), daemon=True).start()
+                return True
+
+        def session(conn):
+            transport = paramiko.Transport(conn)
+            transport.add_server_key(self.key)
+            transport.start_server(server=Server())
+            self.handshakes += 1
+            self.transports.append(transport)
+            channels = []  # a dropped Channel object closes itself
+            while transport.is_active():
+                channel = transport.accept(0.5)
+                if channel is not None:
+                    channels = [c for c in channels if not c.closed] + [channel]
+
+        def serve():
+            while True:
+                try:
+                    conn, _ = self.sock.accept()
+                except OSError:
+                    return
+                threading.Thread(target=session, args=(conn,), daemon=True).start()
+
+        threading.Thread(target=serve, daemon=True).start()
+
+    def node(self, username="swarm"):
+        return {'host': "127.0.0.1", 'port': self.port, 'username': username}
+
+    def drop_connections(self):
+        for transport in self.transports:
+            transport.close()
+
+    def close(self):
+        self.drop_connections()
+        self.sock.close()
+
+
+def test_pool_reuses_one_session_and_reconnects(tmp_path):
+    server = _LocalSSHServer(tmp_path)
+    pool = SSHPool({'starlord': server.node()}, key_path=server.key_path, command_timeout=10)
+
+    async def scenario():
+        first = [await pool.run('starlord', f"echo run-{i}; echo warn >&2; exit {i % 2}") for i in range(5)]
+        server.drop_connections()
+        await asyncio.sleep(0.1)
+        after_drop = await pool.run('starlord', "echo back")
+        timed_out = await pool.run('starlord', "sleep 5", timeout=0.3)
+        still_up = await pool.run('starlord', "echo alive")
+        await pool.close()
+        return first, after_drop, timed_out, still_up
+
+    try:
+        first, after_drop, timed_out, still_up = asyncio.run(scenario())
+    finally:
+        server.close()
+    assert [r.stdout.strip() for r in first] == [f"run-{i}" for i in range(5)]
+    assert [r.exit_status for r in first] == [0, 1, 0, 1, 0] and first[0].stderr.strip() == "warn"
+    assert after_drop.ok and after_drop.stdout.strip() == "back"
+    assert "timed out" in timed_out.error and still_up.stdout.strip() == "alive"
+    # One handshake for five commands, one more after the server dropped the session
+    assert server.handshakes == 2 and pool.stats()['starlord']['connects'] == 2
+
+
+def test_stream_yields_output_as_it_arrives(tmp_path):
+    server = _LocalSSHServer(tmp_path)
+    pool = SSHPool({'thanos': server.node()}, key_path=server.key_path)
+
+    async def scenario():
+        arrivals = []
+        async for chunk in pool.stream('thanos', "for i in 1 2 3; do echo sample-$i; sleep 0.2; done"):
+            arrivals.append((time.monotonic(), chunk))
+        await pool.close()
+        return arrivals
+
+    try:
+        arrivals = asyncio.run(scenario())
+    finally:
+        server.close()
+    assert "".join(chunk for _, chunk in arrivals).split() == ["sample-1", "sample-2", "sample-3"]
+    # Chunks arrived while the command was still running, not all at the end
+    assert arrivals[-1][0] - arrivals[0][0] > 0.3
+
+
+def test_fan_out_is_concurrent_and_keeps_the_loop_free(tmp_path):
+    server = _LocalSSHServer(tmp_path)
+    refused = socket.socket()
+    refused.bind(("127.0.0.1", 0))
+    dead_port = refused.getsockname()[1]
+    refused.close()
+    nodes = {name: server.node() for name in ('oracle', 'starlord', 'thanos')}
+    nodes['offline'] = {'host': "127.0.0.1", 'port': dead_port, 'username': "swarm"}
+    pool = SSHPool(nodes, key_path=server.key_path, connect_timeout=2)
+
+    async def scenario():
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        await pool.run_all("true", nodes=['oracle', 'starlord', 'thanos'])  # warm the sessions
+        task = asyncio.create_task(ticker())
+        started = time.monotonic()
+        results = await pool.run_all("sleep 0.5; hostname")
+        elapsed = time.monotonic() - started
+        task.cancel()
+        await pool.close()
+        return results, elapsed, ticks
+
+    try:
+        results, elapsed, ticks = asyncio.run(scenario())
+    finally:
+        server.close()
+    assert all(results[name].ok for name in ('oracle', 'starlord', 'thanos'))
+    assert results['offline'].error.startswith(("NoValidConnectionsError", "ConnectionRefusedError"))
+    assert elapsed < 0.5 * 2  # three 0.5 s commands side by side, not one after another
+    assert ticks > 20  # the loop kept running while the commands were in flight
@@ -0,0 +1,420 @@
+#!/usr/bin/env python3
+"""
+Streaming GPU and vLLM telemetry for the swarm nodes. Each node runs one long-lived command over
+its pooled SSH session: `nvidia-smi --loop-ms` for per-GPU utilization and memory, multiplexed with
+a periodic scrape of vLLM's Prometheus `/metrics` for queue depth, running requests, KV-cache usage
+and generation throughput. Output is parsed incrementally as it arrives into fixed-size,
+array-backed ring buffers, so consumers (the auto-scaler) read windowed mean, p95 and slope without
+touching a remote host. Unparseable samples are counted, never recorded as zero.
+"""
+
+import asyncio
+import logging
+import re
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+GPU_QUERY = "index,utilization.gpu,memory.used,memory.total"
+
+# vLLM gauge -> (metric, scale); newer vLLM renamed the KV-cache gauge
+_VLLM_GAUGES = {
+    'vllm:num_requests_waiting': ('queue_depth', 1.0),
+    'vllm:num_requests_running': ('running', 1.0),
+    'vllm:gpu_cache_usage_perc': ('kv_cache_percent', 100.0),
+    'vllm:kv_cache_usage_perc': ('kv_cache_percent', 100.0),
+}
+_VLLM_GENERATED = 'vllm:generation_tokens_total'
+_VLLM_LATENCY_BUCKET = 'vllm:e2e_request_latency_seconds_bucket'
+_BUCKET_BOUND = re.compile(r'le="([^"]+)"')
+
+
+def histogram_quantile(buckets: Dict[float, float], q: float) -> Optional[float]:
+    """Quantile from cumulative Prometheus buckets {upper bound: count}, interpolated within a bucket."""
+    bounds = sorted(buckets)
+    total = buckets[bounds[-1]] if bounds else 0.0
+    if total <= 0:
+        return None
+    rank, lower, below = q * total, 0.0, 0.0
+    for bound in bounds:
+        count = buckets[bound]
+        if count >= rank:
+            if bound == float('inf'):
+                return lower
+            return lower + (bound - lower) * (rank - below) / (count - below) if count > below else bound
+        lower, below = bound, count
+    return lower
+
+
+def telemetry_command(vllm_port: Optional[int] = None, gpu_interval_ms: int = 1000,
+                      scrape_interval: int = 5) -> str:
+    """One shell command streaming `gpu ...` and `vllm ...` lines until it is hung up."""
+    parts = ["trap 'kill 0' HUP TERM EXIT",
+             f"nvidia-smi --query-gpu={GPU_QUERY} --format=csv,noheader,nounits --loop-ms={gpu_interval_ms} "
+             "2>&1 | sed -u 's/^/gpu /' &"]
+    if vllm_port:
+        parts.append(f"while true; do curl -sf localhost:{vllm_port}/metrics | grep '^vllm:' | sed 's/^/vllm /'; "
+                     f"echo 'vllm # end'; sleep {scrape_interval}; done")
+    else:
+        parts.append("wait")
+    return "; ".join(parts)
+
+
+@dataclass
+class WindowStats:
+    """Aggregates over one window; slope is least-squares change per second (None below two samples)."""
+    samples: int
+    mean: float
+    p95: float
+    min: float
+    max: float
+    last: float
+    slope: Optional[float]
+
+    @classmethod
+    def of(cls, times: np.ndarray, values: np.ndarray) -> Optional['WindowStats']:
+        if not len(values):
+            return None
+        slope = None
+        if len(values) > 1:
+            dt = times - times.mean()
+            spread = float(dt @ dt)
+            if spread > 0:
+                slope = float(dt @ (values - values.mean())) / spread
+        return cls(len(values), float(values.mean()), float(np.percentile(values, 95)),
+                   float(values.min()), float(values.max()), float(values[np.argmax(times)]), slope)
+
+
+class RingSeries:
+    """Fixed-capacity (time, value) ring buffer; appends must be in time order."""
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self._times = np.zeros(capacity)
+        self._values = np.zeros(capacity)
+        self._head = 0
+        self.count = 0
+
+    def append(self, at: float, value: float):
+        self._times[self._head] = at
+        self._values[self._head] = value
+        self._head = (self._head + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def ordered(self) -> Tuple[np.ndarray, np.ndarray]:
+        if self.count < self.capacity:
+            return self._times[:self.count], self._values[:self.count]
+        order = np.r_[self._head:self.capacity, 0:self._head]
+        return self._times[order], self._values[order]
+
+    def window(self, seconds: float, now: float) -> Tuple[np.ndarray, np.ndarray]:
+        times, values = self.ordered()
+        start = np.searchsorted(times, now - seconds, side='left')
+        return times[start:], values[start:]
+
+
+class MetricStore:
+    """Ring buffers keyed by (node, metric, device); device is '' for node-wide metrics."""
+
+    def __init__(self, capacity: int = 3600, clock: Callable[[], float] = time.monotonic):
+        self.capacity = capacity
+        self.clock = clock
+        self._series: Dict[Tuple[str, str, str], RingSeries] = {}
+
+    def record(self, node: str, metric: str, value: float, device: str = "", at: Optional[float] = None):
+        key = (node, metric, device)
+        if key not in self._series:
+            self._series[key] = RingSeries(self.capacity)
+        self._series[key].append(self.clock() if at is None else at, value)
+
+    def devices(self, node: str, metric: str) -> List[str]:
+        return sorted(d for n, m, d in self._series if n == node and m == metric)
+
+    def aggregate(self, node: str, metric: str, seconds: float, device: Optional[str] = None,
+                  now: Optional[float] = None) -> Optional[WindowStats]:
+        """Stats over the last `seconds`; device=None pools the samples of every device (e.g. all GPUs)."""
+        now = self.clock() if now is None else now
+        devices = self.devices(node, metric) if device is None else [device]
+        windows = [self._series[(node, metric, d)].window(seconds, now)
+                   for d in devices if (node, metric, d) in self._series]
+        if not windows:
+            return None
+        return WindowStats.of(np.concatenate([t for t, _ in windows]), np.concatenate([v for _, v in windows]))
+
+    def summary(self, seconds: float = 60.0) -> Dict[str, Dict[str, Dict[str, float]]]:
+        """{node: {metric: {mean, p95, slope, last}}} over the window, for logs and dashboards."""
+        now = self.clock()
+        out: Dict[str, Dict[str, Dict[str, float]]] = {}
+        for node, metric in sorted({(n, m) for n, m, _ in self._series}):
+            stats = self.aggregate(node, metric, seconds, now=now)
+            if stats is not None:
+                out.setdefault(node, {})[metric] = {
+                    'mean': round(stats.mean, 3), 'p95': round(stats.p95, 3),
+                    'slope': None if stats.slope is None else round(stats.slope, 4), 'last': stats.last}
+        return out
+
+
+class NodeStreamParser:
+    """Incremental parser for one node's telemetry stream; feed it chunks as they arrive."""
+
+    def __init__(self, node: str, store: MetricStore):
+        self.node = node
+        self.store = store
+        self.parse_errors = 0
+        self.last_sample: Optional[float] = None
+        self._buffer = ""
+        self._scrape: Dict[str, float] = {}
+        self._scrape_buckets: Dict[float, float] = {}
+        self._generated: Optional[Tuple[float, float]] = None
+        self._latency_buckets: Optional[Dict[float, float]] = None
+
+    def feed(self, chunk: str):
+        *lines, self._buffer = (self._buffer + chunk).split("\n")
+        for line in lines:
+            line = line.strip("\r ")
+            if line:
+                self._line(line)
+
+    def _error(self, line: str):
+        self.parse_errors += 1
+        logger.debug(f"Unparseable telemetry from {self.node}: {line!r}")
+
+    def _line(self, line: str):
+        source, _, payload = line.partition(" ")
+        if source == 'gpu':
+            self._gpu(line, payload)
+        elif source == 'vllm':
+            self._vllm(line, payload)
+        else:
+            self._error(line)
+
+    def _gpu(self, line: str, payload: str):
+        try:
+            index, util, used, total = (field.strip() for field in payload.split(","))
+            util, used, total = float(util), float(used), float(total)
+        except ValueError:  # wrong field count, "[N/A]", or an nvidia-smi error message
+            return self._error(line)
+        now = self.store.clock()
+        self.store.record(self.node, 'utilization', util, index, now)
+        self.store.record(self.node, 'memory_used_mib', used, index, now)
+        if total > 0:
+            self.store.record(self.node, 'memory_percent', 100.0 * used / total, index, now)
+        self.last_sample = now
+
+    def _vllm(self, line: str, payload: str):
+        if payload == '# end':
+            return self._end_scrape()
+        if payload.startswith('#'):
+            return
+        name = payload.split('{', 1)[0].split(' ', 1)[0]
+        try:
+            value = float(payload.rsplit('}', 1)[-1].split()[0])
+        except (ValueError, IndexError):
+            return self._error(line)
+        # Sum over label sets (one per model/engine)
+        if name == _VLLM_LATENCY_BUCKET:
+            bound = _BUCKET_BOUND.search(payload)
+            if bound is None:
+                return self._error(line)
+            le = float(bound.group(1))
+            self._scrape_buckets[le] = self._scrape_buckets.get(le, 0.0) + value
+        else:
+            self._scrape[name] = self._scrape.get(name, 0.0) + value
+
+    def _end_scrape(self):
+        scrape, self._scrape = self._scrape, {}
+        buckets, self._scrape_buckets = self._scrape_buckets, {}
+        if not scrape:  # vLLM down or still loading: nothing to record
+            return
+        now = self.store.clock()
+        for name, (metric, scale) in _VLLM_GAUGES.items():
+            if name in scrape:
+                self.store.record(self.node, metric, scrape[name] * scale, at=now)
+        total = scrape.get(_VLLM_GENERATED)
+        if total is not None:
+            if self._generated is not None and now > self._generated[0]:
+                previous_at, previous = self._generated
+                # A counter that went backwards means vLLM restarted and counts from zero again
+                delta = total - previous if total >= previous else total
+                self.store.record(self.node, 'throughput_tps', delta / (now - previous_at), at=now)
+            self._generated = (now, total)
+        if buckets:
+            # p95 of the requests that finished since the previous scrape
+            previous = self._latency_buckets or {}
+            recent = {le: count - previous.get(le, 0.0) for le, count in buckets.items()}
+            if any(count < 0 for count in recent.values()):  # vLLM restarted
+                recent = buckets
+            p95 = histogram_quantile(recent, 0.95)
+            if p95 is not None:
+                self.store.record(self.node, 'latency_p95_ms', p95 * 1000.0, at=now)
+            self._latency_buckets = buckets
+        self.last_sample = now
+
+
+class TelemetryCollector:
+    """Keeps one streaming telemetry command per node alive and feeds it into a MetricStore."""
+
+    def __init__(self, pool, nodes: Dict[str, Optional[int]], store: Optional[MetricStore] = None,
+                 restart_delay: float = 5.0, max_restart_delay: float = 60.0):
+        self.pool = pool
+        self.nodes = nodes  # node -> vLLM port to scrape (None: GPUs only)
+        self.store = store or MetricStore()
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self.parsers: Dict[str, NodeStreamParser] = {}
+        self.restarts: Dict[str, int] = {node: 0 for node in nodes}
+        self._tasks: Dict[str, asyncio.Task] = {}
+
+    def start(self):
+        for node in self.nodes:
+            if node not in self._tasks or self._tasks[node].done():
+                self._tasks[node] = asyncio.create_task(self._follow(node))
+
+    async def stop(self):
+        tasks = list(self._tasks.values())
+        self._tasks.clear()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _follow(self, node: str):
+        command = telemetry_command(self.nodes[node])
+        delay = self.restart_delay
+        while True:
+            parser = self.parsers[node] = NodeStreamParser(node, self.store)
+            try:
+                async for chunk in self.pool.stream(node, command):
+                    parser.feed(chunk)
+                    if parser.last_sample is not None:
+                        delay = self.restart_delay
+                logger.warning(f"Telemetry stream on {node} ended")
+            except Exception as exc:
+                logger.warning(f"Telemetry stream on {node} failed: {exc}")
+            self.restarts[node] += 1
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.max_restart_delay)
+
+    def status(self) -> Dict[str, Dict[str, Optional[float]]]:
+        now = self.store.clock()
+        out = {}
+        for node in self.nodes:
+            parser = self.parsers.get(node)
+            last = parser.last_sample if parser else None
+            out[node] = {
+                'streaming': node in self._tasks and not self._tasks[node].done(),
+                'restarts': self.restarts[node],
+                'parse_errors': parser.parse_errors if parser else 0,
+                'sample_age': None if last is None else round(now - last, 1),
+            }
+        return out
+
+
+# Pytest tests
+_RECORDED_GPU = [
+    "0, 35, 20480, 24576\n1, 40, 18000, 24576",
+    "0, 55, 20992, 24576\n1, 60, 18000, 24576",
+    "0, [N/A], [N/A], 24576\n1, 80, 18100, 24576",
+    "0, 95, 21504, 24576\n1, 90, 18200, 24576",
+]
+_RECORDED_VLLM = """# HELP vllm:num_requests_waiting Number of requests waiting to be processed.
+# TYPE vllm:num_requests_waiting gauge
+vllm:num_requests_waiting{{model_name="llama"}} {waiting}
+vllm:num_requests_running{{model_name="llama"}} 4.0
+vllm:gpu_cache_usage_perc{{model_name="llama"}} 0.5
+# TYPE vllm:generation_tokens_total counter
+vllm:generation_tokens_total{{model_name="llama"}} {generated}
+vllm:generation_tokens_total{{model_name="draft"}} 100.0
+vllm:e2e_request_latency_seconds_bucket{{le="1.0",model_name="llama"}} {fast}
+vllm:e2e_request_latency_seconds_bucket{{le="10.0",model_name="llama"}} {finished}
+vllm:e2e_request_latency_seconds_bucket{{le="+Inf",model_name="llama"}} {finished}
+vllm:e2e_request_latency_seconds_count{{model_name="llama"}} {finished}
+"""
+
+
+def _recording() -> List[Tuple[float, str]]:
+    """(clock, text) frames as the node's command would print them."""
+    frames = []
+    scrapes = zip([0, 2, 6, 12], [0, 500, 1500, 200], [0, 19, 38, 10], [0, 20, 60, 10])
+    for second, (gpu, (waiting, generated, fast, finished)) in enumerate(zip(_RECORDED_GPU, scrapes)):
+        text = "".join(f"gpu {row}\r\n" for row in gpu.split("\n"))
+        scrape = _RECORDED_VLLM.format(waiting=waiting, generated=generated, fast=fast, finished=finished)
+        text += "".join(f"vllm {row}\r\n" for row in scrape.splitlines())
+        frames.append((float(second), text + "vllm # end\r\n"))
+    frames.append((4.0, "gpu NVIDIA-SMI has failed because it couldn't communicate with the driver\r\n"))
+    return frames
+
+
+def test_ring_series_wraps_and_aggregates():
+    series = RingSeries(8)
+    for i in range(20):
+        series.append(float(i), float(i * i))
+    times, values = series.ordered()
+    assert list(times) == [float(i) for i in range(12, 20)] and series.count == 8
+
+    times, values = series.window(5, now=19.0)
+    assert list(times) == [14.0, 15.0, 16.0, 17.0, 18.0, 19.0]
+    stats = WindowStats.of(times, values)
+    assert stats.mean == np.mean(values) and stats.p95 == np.percentile(values, 95)
+    assert abs(stats.slope - np.polyfit(times, values, 1)[0]) < 1e-9 and stats.last == 361.0
+    assert WindowStats.of(times[:1], values[:1]).slope is None and WindowStats.of(times[:0], values[:0]) is None
+
+
+def test_replayed_stream_parses_incrementally():
+    clock = [0.0]
+    store = MetricStore(capacity=16, clock=lambda: clock[0])
+    parser = NodeStreamParser('starlord', store)
+    rng = np.random.default_rng(7)
+    for at, text in _recording():
+        clock[0] = at
+        cuts = sorted(rng.integers(0, len(text), size=6))
+        for start, end in zip([0, *cuts], [*cuts, len(text)]):
+            parser.feed(text[start:end])
+
+    # The [N/A] row and the driver error are counted, not recorded as 0% utilization
+    assert parser.parse_errors == 2
+    assert store.aggregate('starlord', 'utilization', 10, device='0').samples == 3
+    util = store.aggregate('starlord', 'utilization', 10)
+    assert util.samples == 7 and util.mean == np.mean([35, 40, 55, 60, 80, 95, 90]) and util.slope > 0
+    assert store.aggregate('starlord', 'queue_depth', 10).last == 12.0
+    assert store.aggregate('starlord', 'kv_cache_percent', 10).mean == 50.0
+    # 100 -> 600 -> 1600 -> (restart) 300 generated tokens across both label sets, one scrape per second
+    tps = store.aggregate('starlord', 'throughput_tps', 10)
+    assert tps.samples == 3 and tps.last == 300.0 and tps.max == 1000.0
+    assert store.aggregate('starlord', 'queue_depth', 1.5, now=3.0).samples == 2
+    assert store.summary(10)['starlord']['running']['mean'] == 4.0
+    # p95 of each scrape's newly finished requests, interpolated inside the histogram buckets
+    _, latency = store._series[('starlord', 'latency_p95_ms', '')].ordered()
+    assert np.allclose(latency, [1000.0, 1000.0 + 9000.0 * 19 / 21, 950.0])
+
+
+def test_collector_restarts_streams_and_fills_the_store():
+    class ReplayPool:
+        def __init__(self):
+            self.commands = []
+
+        async def stream(self, node, command):
+            self.commands.append((node, command))
+            if len(self.commands) == 1:
+                raise ConnectionError("node unreachable")
+            for _, text in _recording():
+                yield text
+                await asyncio.sleep(0)
+
+    async def scenario():
+        pool = ReplayPool()
+        collector = TelemetryCollector(pool, {'starlord': 8000}, restart_delay=0.01)
+        collector.start()
+        while collector.restarts['starlord'] < 2:
+            await asyncio.sleep(0.01)
+        await collector.stop()
+        return pool, collector
+
+    pool, collector = asyncio.run(scenario())
+    assert 'localhost:8000/metrics' in pool.commands[0][1] and '--loop-ms=1000' in pool.commands[0][1]
+    status = collector.status()['starlord']
+    assert status['parse_errors'] == 2 and status['streaming'] is False and status['restarts'] >= 2
+    assert collector.store.aggregate('starlord', 'utilization', 60).samples >= 7